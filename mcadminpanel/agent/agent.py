@@ -1,37 +1,77 @@
 """
-The agent process that manages the servers on this node
+The agent process that manages the servers on this node.
+
+Every CLI command imports this module, so the heavy dependencies that only
+some commands need (daemon, psutil, asyncio and the agent subsystems) are
+imported by the methods that use them.
 """
 
-import asyncio
 import logging
-import logging.handlers
+import os
+import os.path
 import sys
-
-import daemon
-import daemon.pidfile
-import psutil
+import time
 
 import mcadminpanel.agent.errors
 
+# pylint: disable=too-many-instance-attributes,too-many-public-methods
 class Agent(object):
     """
     Agent process for managing server processes
     """
 
+    # Extra time given to the agent to exit after its servers have stopped
+    STOP_GRACE = 30
+
+    # Configuration sections that are applied without restarting the agent
+    RELOADABLE = {'logging', 'supervisor', 'servers'}
+
     def __init__(self, config):
         """
         Setup the agent with the given configuration options
         """
 
+        self.config = config
         self.root = config.root
         self.pidfile = config.pidfile
+        self.statefile = config.statefile
         self.log_conf = config.logging
+        self.supervisor_conf = config.supervisor
+        self.servers_conf = config.servers
+        self.metrics_conf = config.metrics
+        self.console_conf = config.console
+        self.api_conf = config.api
+        self.watch_conf = config.watch
+        self.backup_conf = config.backup
+        self.journal_conf = config.journal
+        self.monitor_conf = config.monitor
+        self.workers_conf = config.workers
+        self.artifacts_conf = config.artifacts
+        self.hibernation_conf = config.hibernation
+        self.worker = None
+        self.keep_servers = False
+        self.router = None
+        self.supervisor = None
+        self.sampler = None
+        self.backups = None
+        self.artifacts = None
+        self.hibernator = None
+        self.journal = None
+        self.monitor = None
+        self.log_handler = None
+        self.log_listener = None
+        self.api = None
+        self.watcher = None
+        self.console_files = {}
 
     def start(self, detach=True):
         """
         Start the agent process and detach
         """
 
+        import daemon
+        import daemon.pidfile
+
         with daemon.DaemonContext(
             detach_process=detach,
             working_directory=self.root,
@@ -39,22 +79,276 @@ class Agent(object):
             stdout=(None if detach else sys.stdout),
             stderr=(None if detach else sys.stderr),
         ):
-            self.run(detach)
+            try:
+                workers = self.workers_conf['count'] or os.cpu_count() or 1
+                if workers > 1:
+                    self.run_workers(detach, workers)
+                else:
+                    self.run(detach)
+            finally:
+                self.stop_logger()
 
-    def stop(self):
+    def stop(self, keep_servers=False):
         """
-        Stop the agent process
+        Stop the agent process, optionally leaving the servers running for
+        the next agent to adopt
         """
 
+        import signal
+
+        import psutil
+
         with open(self.pidfile, 'r') as pidfile:
             pid = int(pidfile.read().strip())
 
         proc = psutil.Process(pid)
-        proc.terminate()
+        if keep_servers:
+            proc.send_signal(signal.SIGUSR2)
+        else:
+            proc.terminate()
+
+        # The agent saves and stops every server before it exits
+        timeout = self.supervisor_conf['stop_timeout'] + Agent.STOP_GRACE
+        try:
+            proc.wait(timeout)
+        except psutil.TimeoutExpired:
+            raise mcadminpanel.agent.errors.MCAdminPanelError(
+                'Agent did not stop within {} seconds'.format(timeout),
+            )
+
+    def restore(self, name, snapshot_id=None, verify=True):
+        """
+        Restore a stopped server from a backup.
+
+        A running agent is asked to do the restore over the control API so it
+        can refuse to restore a running server, otherwise the server is
+        restored from this process.
+        """
+
+        if self.running():
+            return self.call_api(
+                'restore',
+                name=name,
+                snapshot_id=snapshot_id,
+                verify=verify,
+            )
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.backup
+        import mcadminpanel.agent.eventloop
+        import mcadminpanel.agent.supervisor
+        # pylint: enable=redefined-outer-name
+
+        event_loop = mcadminpanel.agent.eventloop.new_event_loop(self.config.event_loop)
+        try:
+            supervisor = mcadminpanel.agent.supervisor.Supervisor(
+                self.root,
+                self.servers_conf,
+                self.supervisor_conf,
+                loop=event_loop,
+            )
+            backups = mcadminpanel.agent.backup.BackupEngine(
+                supervisor,
+                self.backup_conf,
+                loop=event_loop,
+            )
+            try:
+                return event_loop.run_until_complete(
+                    backups.api_restore(name, snapshot_id, verify),
+                )
+            finally:
+                backups.close()
+        finally:
+            event_loop.close()
+
+    def provision(self, name, template=None, method=None):
+        """
+        Create the directory of a server from a template.
+
+        A running agent is asked to do it over the control API so the server
+        is not started while its directory is created, otherwise the server
+        is provisioned from this process.
+        """
+
+        if self.running():
+            return self.call_api('provision', name=name, template=template, method=method)
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.artifacts
+        import mcadminpanel.agent.eventloop
+        # pylint: enable=redefined-outer-name
+
+        event_loop = mcadminpanel.agent.eventloop.new_event_loop(self.config.event_loop)
+        try:
+            artifacts = mcadminpanel.agent.artifacts.ArtifactStore(
+                None,
+                self.artifacts_conf,
+                loop=event_loop,
+            )
+            return event_loop.run_until_complete(
+                self.provision_server(artifacts, name, template, method),
+            )
+        finally:
+            event_loop.close()
+
+    async def provision_server(self, artifacts, name, template=None, method=None):
+        """
+        Create the directory of a server from a template, linking its server
+        jar and plugins from the artifact store
+        """
+
+        import mcadminpanel.agent.provision # pylint: disable=redefined-outer-name
+
+        server_conf = self.servers_conf.get(name)
+        if server_conf is None:
+            raise mcadminpanel.agent.errors.ServerError('Unknown server {}'.format(name))
+
+        provision_conf = self.config.provision
+        if method is not None:
+            provision_conf = dict(provision_conf, method=method)
+
+        stats = await artifacts.run(
+            mcadminpanel.agent.provision.provision,
+            name,
+            server_conf,
+            os.path.join(self.root, server_conf.get('directory') or name),
+            provision_conf,
+            template,
+            artifacts,
+        )
+
+        logging.info(
+            'Provisioned server %s from template %s: %s files in %.2fs',
+            name,
+            stats['template'],
+            stats['files'],
+            stats['duration'],
+        )
+
+        return stats
+
+    def call_api(self, _command, **args):
+        """
+        Run a command on the running agent over the control API, the command
+        is positional so commands may have an argument named command
+        """
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.api
+        import mcadminpanel.agent.eventloop
+        # pylint: enable=redefined-outer-name
+
+        event_loop = mcadminpanel.agent.eventloop.new_event_loop(self.config.event_loop)
+
+        async def call():
+            client = await mcadminpanel.agent.api.APIClient.connect(
+                socket=self.api_conf['socket'],
+                host=self.api_conf['host'],
+                port=self.api_conf['port'],
+                loop=event_loop,
+                token=self.api_conf['token'],
+            )
+            try:
+                return await client.request(_command, args)
+            finally:
+                await client.close()
+
+        try:
+            return event_loop.run_until_complete(call())
+        except OSError as ex:
+            raise mcadminpanel.agent.errors.APIError(
+                'Unable to reach the agent: {}'.format(ex),
+            )
+        finally:
+            event_loop.close()
+
+    def running(self):
+        """
+        Whether the agent process is running
+        """
+
+        import psutil
+
+        try:
+            with open(self.pidfile, 'r') as pidfile:
+                pid = int(pidfile.read().strip())
+        except (OSError, ValueError):
+            return False
+
+        return psutil.pid_exists(pid)
 
     def configure_logger(self, detached):
         """
-        Configure the logging system
+        Configure the logging system.
+
+        Logging calls only put records on a bounded queue, a listener thread
+        writes them to the log file, and the terminal when not detached, so
+        the event loop never waits on the disk or on log rotation.
+        """
+
+        import queue
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.logqueue
+        # pylint: enable=redefined-outer-name
+
+        log_level = self.log_level()
+
+        formatter = logging.Formatter(
+            self.log_conf['format'],
+            self.log_conf['date_format'],
+        )
+
+        handlers = [
+            mcadminpanel.agent.logqueue.BatchFileHandler(
+                self.log_conf['file'],
+                when='midnight',
+            ),
+        ]
+        if not detached:
+            handlers.append(logging.StreamHandler())
+
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        self.log_handler = mcadminpanel.agent.logqueue.DroppingQueueHandler(
+            queue.Queue(self.log_conf['queue_size']),
+        )
+        self.log_handler.setLevel(log_level)
+
+        root_logger = logging.getLogger()
+        root_logger.setLevel(log_level)
+        root_logger.addHandler(self.log_handler)
+
+        self.log_listener = mcadminpanel.agent.logqueue.LogListener(
+            self.log_handler.queue,
+            handlers,
+        )
+        self.log_listener.start()
+
+    def stop_logger(self):
+        """
+        Write out the queued log records and close the log handlers
+        """
+
+        if self.log_listener is None:
+            return
+
+        if self.log_handler.dropped:
+            logging.warning(
+                'Dropped %s log records in total because the log queue was full',
+                self.log_handler.dropped,
+            )
+
+        logging.getLogger().removeHandler(self.log_handler)
+        self.log_listener.stop()
+
+        self.log_handler = None
+        self.log_listener = None
+
+    def log_level(self):
+        """
+        The configured log level
         """
 
         log_level = self.log_conf['level'].upper()
@@ -62,48 +356,591 @@ class Agent(object):
             raise mcadminpanel.agent.errors.ConfigurationError(
                 'Improperly configured log level: {}'.format(log_level),
             )
-        log_level = getattr(logging, log_level)
 
-        handlers = []
+        return getattr(logging, log_level)
+
+    def reload_config(self):
+        """
+        Reload the configuration file and apply the changes in place
+        """
+
+        import asyncio
+
+        changes = self.config.reload()
+        if not changes:
+            return
 
-        file_handler = logging.handlers.TimedRotatingFileHandler(
-            self.log_conf['file'],
-            when='midnight',
+        logging.info(
+            'Configuration changed: %s',
+            ', '.join('.'.join(path) for path in changes),
         )
-        file_handler.setLevel(log_level)
-        handlers.append(file_handler)
 
-        if not detached:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(log_level)
-            handlers.append(stream_handler)
+        sections = set(path[0] for path in changes)
+
+        if 'logging' in sections:
+            self.log_conf = self.config.logging
+            if ('logging', 'level') in changes:
+                log_level = self.log_level()
+                root_logger = logging.getLogger()
+                root_logger.setLevel(log_level)
+                for handler in root_logger.handlers:
+                    handler.setLevel(log_level)
+            if sections_changed(changes, 'logging', ignore=('level',)):
+                logging.warning('Logging changes other than the level need a restart')
+
+        if 'supervisor' in sections or 'servers' in sections:
+            names = None
+            if 'supervisor' in sections:
+                self.supervisor.supervisor_conf = self.config.supervisor
+            else:
+                names = set(path[1] for path in changes if path[0] == 'servers')
+
+            self.servers_conf = self.config.servers
+            asyncio.ensure_future(
+                self.reconfigure_servers(names),
+                loop=self.supervisor.loop,
+            )
+
+        for section in sorted(sections - Agent.RELOADABLE):
+            logging.warning('Changes to %s need an agent restart', section)
+
+    async def reconfigure_servers(self, names=None):
+        """
+        Apply the current servers configuration to the supervisor
+        """
+
+        changes = await self.supervisor.reconfigure(self.servers_conf, names)
+
+        for name in changes['added']:
+            self.setup_console(self.supervisor.servers[name], self.supervisor.loop)
+        for name in changes['removed']:
+            console_file = self.console_files.pop(name, None)
+            if console_file is not None:
+                await console_file.stop()
+
+        for change, servers in sorted(changes.items()):
+            if servers:
+                logging.info('Servers %s: %s', change, ', '.join(servers))
+
+        return changes
+
+    async def api_restore(self, name, snapshot_id=None, verify=True):
+        """
+        API command restoring a stopped server from a backup.
+
+        The console log file of the server is closed while the directory it
+        lives in is replaced and opened again afterwards.
+        """
+
+        server = self.supervisor.get(name)
+
+        console_file = None
+        if not server.running:
+            console_file = self.console_files.pop(name, None)
+        if console_file is not None:
+            server.console.unsubscribe(console_file)
+            await console_file.stop()
+
+        try:
+            return await self.backups.restore_server(server, snapshot_id, verify)
+        finally:
+            if console_file is not None:
+                self.setup_console(server, self.supervisor.loop)
+
+    async def api_provision(self, name, template=None, method=None):
+        """
+        API command creating the directory of a stopped server from a
+        template, its console log file is opened again afterwards
+        """
 
-        logging.basicConfig(
-            level=log_level,
-            datefmt=self.log_conf['date_format'],
-            format=self.log_conf['format'],
-            handlers=handlers,
+        server = self.supervisor.get(name)
+        if server.running:
+            raise mcadminpanel.agent.errors.ProvisionError(
+                'Server {} must be stopped before it is provisioned'.format(name),
+            )
+
+        console_file = self.console_files.pop(name, None)
+        if console_file is not None:
+            server.console.unsubscribe(console_file)
+            await console_file.stop()
+
+        try:
+            return await self.provision_server(self.artifacts, name, template, method)
+        finally:
+            if console_file is not None:
+                self.setup_console(server, self.supervisor.loop)
+
+    def setup_console(self, server, event_loop):
+        """
+        Attach the journal and the console log file to a server's console
+        stream
+        """
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.logstream
+        # pylint: enable=redefined-outer-name
+
+        if self.journal is not None:
+            self.journal.watch(server)
+
+        if not self.console_conf['file']:
+            return
+
+        console_file = mcadminpanel.agent.logstream.FileSubscriber(
+            os.path.join(server.directory, self.console_conf['file']),
+            maxsize=self.console_conf['queue_size'],
+            loop=event_loop,
         )
+        server.console.subscribe(console_file)
+        console_file.start()
+
+        self.console_files[server.name] = console_file
+
+    async def stop_consoles(self):
+        """
+        Flush and close all of the console log files
+        """
+
+        for console_file in self.console_files.values():
+            await console_file.stop()
+        self.console_files.clear()
 
     def run(self, detached):
         """
         The actual agent processing
         """
 
+        import signal
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.artifacts
+        import mcadminpanel.agent.backup
+        import mcadminpanel.agent.eventloop
+        import mcadminpanel.agent.metrics
+        import mcadminpanel.agent.watcher
+        # pylint: enable=redefined-outer-name
+
         self.configure_logger(detached)
 
         logging.info('Starting agent process...')
 
         logging.debug('Setting up event loop...')
 
-        event_loop = asyncio.get_event_loop()
+        event_loop = mcadminpanel.agent.eventloop.setup_event_loop(self.config.event_loop)
+
+        if self.monitor_conf['enabled']:
+            self.start_monitor(event_loop)
+
+        self.start_supervisor(event_loop)
+
+        logging.debug('Starting metrics sampler...')
+
+        self.sampler = mcadminpanel.agent.metrics.MetricsSampler(
+            self.supervisor,
+            self.metrics_conf,
+            loop=event_loop,
+        )
+        if self.journal is not None:
+            self.sampler.add_listener(self.journal.metrics_sample)
+        self.sampler.start()
+
+        self.backups = mcadminpanel.agent.backup.BackupEngine(
+            self.supervisor,
+            self.backup_conf,
+            loop=event_loop,
+        )
+        self.artifacts = mcadminpanel.agent.artifacts.ArtifactStore(
+            self.supervisor,
+            self.artifacts_conf,
+            loop=event_loop,
+        )
+        self.start_hibernator(event_loop)
+
+        self.start_api(event_loop)
+
+        if self.watch_conf['enabled'] and self.config.path is not None:
+            self.watcher = mcadminpanel.agent.watcher.ConfigWatcher(
+                self.config.path,
+                self.reload_config,
+                poll_interval=self.watch_conf['poll_interval'],
+                loop=event_loop,
+            )
+            self.watcher.start()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            event_loop.add_signal_handler(signum, event_loop.stop)
+        event_loop.add_signal_handler(signal.SIGUSR2, self.stop_detached, event_loop)
+        event_loop.add_signal_handler(signal.SIGHUP, self.reload_config)
 
         logging.debug('Starting event loop...')
 
+        try:
+            event_loop.run_forever()
+        except BaseException:
+            # The worker taking over the servers of a failed worker adopts them
+            if self.worker is not None:
+                self.keep_servers = True
+            raise
+        finally:
+            self.shutdown(event_loop)
+
+        logging.info('Stopped agent process')
+
+    def start_api(self, event_loop):
+        """
+        Start the control API with the commands of every part of the agent
+        """
+
+        import mcadminpanel.agent.api # pylint: disable=redefined-outer-name
+
+        logging.debug('Starting control API...')
+
+        self.api = mcadminpanel.agent.api.APIServer(self.api_conf, loop=event_loop)
+        self.api.add_routes(self.supervisor.api_routes())
+        self.api.add_routes(self.sampler.api_routes())
+        self.api.add_routes(self.backups.api_routes())
+        self.api.add_routes(self.artifacts.api_routes())
+        self.api.add_routes(self.hibernator.api_routes())
+        self.api.route('restore', self.api_restore)
+        self.api.route('provision', self.api_provision)
+        if self.worker is not None:
+            self.api.route('assign_servers', self.api_assign_servers)
+        if self.journal is not None:
+            self.api.add_routes(self.journal.api_routes())
+        if self.monitor is not None:
+            self.api.add_routes(self.monitor.api_routes())
+        event_loop.run_until_complete(self.api.start())
+
+    def start_supervisor(self, event_loop):
+        """
+        Start the server supervisor along with the journal and console
+        files, adopting the servers left running by a previous agent
+        """
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.journal
+        import mcadminpanel.agent.supervisor
+        # pylint: enable=redefined-outer-name
+
+        logging.debug('Starting server supervisor...')
+
+        self.supervisor = mcadminpanel.agent.supervisor.Supervisor(
+            self.root,
+            self.servers_conf,
+            self.supervisor_conf,
+            loop=event_loop,
+        )
+
+        if self.journal_conf['file']:
+            self.journal = mcadminpanel.agent.journal.Journal(
+                self.journal_conf,
+                loop=event_loop,
+            )
+            self.supervisor.add_listener(self.journal.server_event)
+            self.journal.start()
+
+        for server in self.supervisor.servers.values():
+            self.setup_console(server, event_loop)
+
+        if self.statefile:
+            self.adopt_servers()
+
+        self.supervisor.start()
+
+    def start_hibernator(self, event_loop):
+        """
+        Start hibernating the servers that stay empty
+        """
+
+        import mcadminpanel.agent.hibernation # pylint: disable=redefined-outer-name
+
+        self.hibernator = mcadminpanel.agent.hibernation.Hibernator(
+            self.supervisor,
+            self.hibernation_conf,
+            loop=event_loop,
+        )
+        self.hibernator.start()
+
+    def adopt_servers(self):
+        """
+        Adopt the servers left running by a previous agent and keep the
+        state file up to date for the next one
+        """
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.discovery
+        # pylint: enable=redefined-outer-name
+
+        state = mcadminpanel.agent.discovery.StateFile(self.statefile)
+
+        started = time.monotonic()
+        adopted = mcadminpanel.agent.discovery.discover(
+            self.supervisor.servers,
+            state.load(),
+        )
+        logging.info(
+            'Adopted %s running servers in %.3fs',
+            len(adopted),
+            time.monotonic() - started,
+        )
+
+        self.supervisor.add_listener(state.server_event)
+        self.supervisor.adopt(adopted)
+
+    def run_workers(self, detached, count):
+        """
+        Fork the worker processes, each running the agent for its share of
+        the servers, and route the control API to them
+        """
+
+        import signal
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.api
+        import mcadminpanel.agent.eventloop
+        import mcadminpanel.agent.workers
+        # pylint: enable=redefined-outer-name
+
+        ring = mcadminpanel.agent.workers.HashRing(range(count))
+        assignments = ring.assign(self.servers_conf)
+
+        pids = {}
+        for index in range(count):
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker(index, assignments.get(index, []), detached)
+            pids[index] = pid
+
+        self.configure_logger(detached)
+
+        logging.info('Started %s agent workers', count)
+
+        event_loop = mcadminpanel.agent.eventloop.setup_event_loop(self.config.event_loop)
+
+        self.router = mcadminpanel.agent.workers.WorkerRouter(
+            ring,
+            self.workers_conf,
+            loop=event_loop,
+        )
+        self.router.on_empty = event_loop.stop
+        for index, pid in pids.items():
+            self.router.add_worker(
+                index,
+                pid,
+                self.worker_socket(index),
+                assignments.get(index, []),
+            )
+
+        self.api = mcadminpanel.agent.api.APIServer(self.api_conf, loop=event_loop)
+        self.api.default_route(self.router.call)
+        self.api.add_routes(self.router.api_routes())
+        event_loop.run_until_complete(self.api.start())
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            event_loop.add_signal_handler(signum, event_loop.stop)
+        event_loop.add_signal_handler(signal.SIGUSR2, self.stop_detached, event_loop)
+        event_loop.add_signal_handler(signal.SIGCHLD, self.router.reap)
+        event_loop.add_signal_handler(
+            signal.SIGHUP,
+            logging.warning,
+            'Configuration changes need an agent restart when running several workers',
+        )
+
         try:
             event_loop.run_forever()
         finally:
-            logging.info('Stopping agent process')
+            logging.info('Stopping agent workers')
+            event_loop.run_until_complete(self.api.stop())
+            event_loop.run_until_complete(self.router.stop(
+                self.supervisor_conf['stop_timeout'] + Agent.STOP_GRACE,
+                signal.SIGUSR2 if self.keep_servers else signal.SIGTERM,
+            ))
 
         logging.info('Stopped agent process')
 
+    def run_worker(self, index, servers, detached):
+        """
+        Run the agent for the given servers in a forked worker process, never
+        returns
+        """
+
+        status = 1
+        try:
+            self.configure_worker(index, servers)
+            self.run(detached)
+            status = 0
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Agent worker %s failed', index)
+        finally:
+            self.stop_logger()
+            os._exit(status) # pylint: disable=protected-access
+
+    def configure_worker(self, index, servers):
+        """
+        Limit the agent to the servers of a worker, with its own API socket,
+        log, journal and state files
+        """
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.workers
+        # pylint: enable=redefined-outer-name
+
+        self.worker = index
+        self.servers_conf = {name: self.servers_conf[name] for name in servers}
+        self.api_conf = dict(self.api_conf, socket=self.worker_socket(index), port=None)
+        self.watch_conf = dict(self.watch_conf, enabled=False)
+        self.log_conf = dict(
+            self.log_conf,
+            file=mcadminpanel.agent.workers.worker_path(self.log_conf['file'], index),
+        )
+        if self.journal_conf['file']:
+            self.journal_conf = dict(
+                self.journal_conf,
+                file=mcadminpanel.agent.workers.worker_path(self.journal_conf['file'], index),
+            )
+        if self.statefile:
+            self.statefile = mcadminpanel.agent.workers.worker_path(self.statefile, index)
+
+    def worker_socket(self, index):
+        """
+        The control API socket of a worker, next to the pid file
+        """
+
+        base, _ = os.path.splitext(self.pidfile)
+
+        return '{}.worker{}.sock'.format(base, index)
+
+    def api_assign_servers(self, names, worker=None):
+        """
+        API command taking over the servers of an exited worker, the servers
+        still running are adopted and the others started if they autostart
+        """
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.discovery
+        import mcadminpanel.agent.workers
+        # pylint: enable=redefined-outer-name
+
+        servers_conf = self.config.servers
+        servers = {}
+        for name in names:
+            self.servers_conf[name] = servers_conf[name]
+            servers[name] = self.supervisor.add_server(name, servers_conf[name])
+            self.setup_console(servers[name], self.supervisor.loop)
+
+        state = {}
+        if self.config.statefile and worker is not None:
+            state = mcadminpanel.agent.discovery.StateFile(
+                mcadminpanel.agent.workers.worker_path(self.config.statefile, worker),
+            ).load()
+
+        adopted = mcadminpanel.agent.discovery.discover(servers, state)
+        self.supervisor.adopt(adopted)
+
+        started = []
+        for name, server in sorted(servers.items()):
+            if name not in adopted and server.autostart:
+                server.start()
+                started.append(name)
+
+        return {'adopted': sorted(adopted), 'started': started}
+
+    def start_monitor(self, event_loop):
+        """
+        Start measuring the health of the event loop along with the depth of
+        the log and console queues
+        """
+
+        # pylint: disable=redefined-outer-name
+        import mcadminpanel.agent.monitor
+        # pylint: enable=redefined-outer-name
+
+        logging.debug('Starting event loop monitor...')
+
+        self.monitor = mcadminpanel.agent.monitor.LoopMonitor(
+            self.monitor_conf,
+            loop=event_loop,
+        )
+        if self.log_handler is not None:
+            self.monitor.add_gauge('log', self.log_handler.queue.qsize)
+        self.monitor.add_gauge(
+            'console',
+            lambda: sum(len(console_file) for console_file in self.console_files.values()),
+        )
+        self.monitor.start()
+
+    def stop_detached(self, event_loop):
+        """
+        Stop the agent and leave the servers running for the next agent, or
+        for the worker taking them over
+        """
+
+        if self.config.statefile or self.worker is not None:
+            self.keep_servers = True
+        else:
+            logging.warning('Stopping the servers, the next agent needs a state file to adopt them')
+
+        event_loop.stop()
+
+    def shutdown(self, event_loop):
+        """
+        Stop every part of the agent, the servers are stopped gracefully
+        unless they are kept running for the next agent
+        """
+
+        logging.info('Stopping agent process')
+
+        if self.watcher is not None:
+            self.watcher.stop()
+        event_loop.run_until_complete(self.api.stop())
+        event_loop.run_until_complete(self.sampler.stop())
+        event_loop.run_until_complete(self.hibernator.stop())
+
+        if self.keep_servers:
+            detached = event_loop.run_until_complete(self.supervisor.detach())
+            logging.info('Left servers running: %s', ', '.join(detached) or 'none')
+        else:
+            log_shutdown_report(
+                event_loop.run_until_complete(self.supervisor.stop())
+            )
+
+        event_loop.run_until_complete(self.stop_consoles())
+
+        if self.journal is not None:
+            event_loop.run_until_complete(self.journal.stop())
+
+        self.backups.close()
+
+        if self.monitor is not None:
+            event_loop.run_until_complete(self.monitor.stop())
+# pylint: enable=too-many-instance-attributes,too-many-public-methods
+
+def sections_changed(changes, section, ignore=()):
+    """
+    Whether any value of a section changed other than the ignored keys
+    """
+
+    return any(
+        path[0] == section and (len(path) == 1 or path[1] not in ignore)
+        for path in changes
+    )
+
+def log_shutdown_report(report):
+    """
+    Log how long it took to stop every server
+    """
+
+    for name, server in sorted(report['servers'].items()):
+        logging.info(
+            'Server %s stopped in %.2fs%s',
+            name,
+            server['latency'],
+            ' (killed)' if server['killed'] else '',
+        )
+
+    logging.info(
+        'Stopped %s servers in %.2fs',
+        len(report['servers']),
+        report['latency'],
+    )
+
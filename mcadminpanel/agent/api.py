@@ -0,0 +1,444 @@
+"""
+Control API for managing a running agent.
+
+Messages are JSON objects sent in frames prefixed with their length as a 4
+byte big endian integer. Every request carries an id that is echoed back in
+its response so a connection can have many requests in flight at once and
+responses may arrive in any order:
+
+    {"id": 1, "command": "list_servers", "args": {}}
+    {"id": 1, "result": [...]}
+    {"id": 2, "error": {"type": "ServerError", "message": "..."}}
+
+The Unix socket is only accessible to the user running the agent. Anyone
+able to reach the TCP listener could restore, provision or run commands on
+the servers, so it needs a shared token carried by every request:
+
+    {"id": 1, "command": "list_servers", "args": {}, "token": "..."}
+"""
+
+import asyncio
+import functools
+import hmac
+import inspect
+import json
+import logging
+import os
+import stat
+import struct
+
+import mcadminpanel.agent.errors
+
+HEADER = struct.Struct('>I')
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+def encode_frame(message):
+    """
+    Serialize a message into a length prefixed frame
+    """
+
+    payload = json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+    return HEADER.pack(len(payload)) + payload
+
+def encode_response(response):
+    """
+    Serialize a response into a frame, a result that can not be serialized
+    is replaced by an error
+    """
+
+    try:
+        return encode_frame(response)
+    except (TypeError, ValueError) as ex:
+        logging.error('Unable to encode API response %s: %s', response.get('id'), ex)
+        return encode_frame({
+            'id': response.get('id'),
+            'error': {
+                'type': 'InternalError',
+                'message': 'Unable to encode the result: {}'.format(ex),
+            },
+        })
+
+async def read_frame(reader):
+    """
+    Read and deserialize the next frame, returns None at the end of the
+    stream, even in the middle of a frame
+    """
+
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+
+    length, = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise mcadminpanel.agent.errors.APIError(
+            'Frame of {} bytes is too large'.format(length),
+        )
+
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+    try:
+        return json.loads(payload.decode('utf-8'))
+    except ValueError:
+        raise mcadminpanel.agent.errors.APIError('Invalid JSON in frame')
+
+
+async def remove_stale_socket(path):
+    """
+    Remove the socket left behind by an agent that did not stop cleanly,
+    anything else at the path is left alone
+    """
+
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+
+    if not stat.S_ISSOCK(mode):
+        raise mcadminpanel.agent.errors.APIError(
+            'Unable to listen on {}: the path exists and is not a socket'.format(path),
+        )
+
+    try:
+        _, writer = await asyncio.open_unix_connection(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(path)
+        return
+
+    writer.close()
+    raise mcadminpanel.agent.errors.APIError(
+        'Unable to listen on {}: another agent is listening on it'.format(path),
+    )
+
+
+# pylint: disable=too-many-instance-attributes
+class APIServer(object):
+    """
+    Server side of the control API.
+
+    Commands are routed to handlers that may be plain functions or
+    coroutines. Each request is handled in its own task so a slow command
+    never holds up the other requests on the same connection.
+    """
+
+    def __init__(self, api_conf, loop=None):
+        """
+        Setup the server for the configured socket and address
+        """
+
+        self.socket = api_conf['socket']
+        self.host = api_conf['host']
+        self.port = api_conf['port']
+        self.token = api_conf['token']
+        self.max_pending = api_conf['max_pending']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.routes = {}
+        self.default = None
+
+        self._servers = []
+        self._connections = set()
+
+    def route(self, command, handler):
+        """
+        Route a command to the given handler
+        """
+
+        self.routes[command] = handler
+
+    def add_routes(self, routes):
+        """
+        Route all of the commands in a command to handler mapping
+        """
+
+        for command, handler in routes.items():
+            self.route(command, handler)
+
+    def default_route(self, handler):
+        """
+        Route every command without a handler to handler(command, args)
+        """
+
+        self.default = handler
+
+    async def start(self):
+        """
+        Start listening for connections
+        """
+
+        if self.port is not None and not self.token:
+            raise mcadminpanel.agent.errors.ConfigurationError(
+                'The API needs a token to listen on TCP port {}'.format(self.port),
+            )
+
+        if self.socket:
+            await remove_stale_socket(self.socket)
+
+            self._servers.append(
+                await asyncio.start_unix_server(self._handle_connection, path=self.socket)
+            )
+            os.chmod(self.socket, 0o600)
+            logging.info('API listening on %s', self.socket)
+
+        if self.port is not None:
+            self._servers.append(
+                await asyncio.start_server(
+                    functools.partial(self._handle_connection, token=self.token),
+                    host=self.host,
+                    port=self.port,
+                )
+            )
+            logging.info('API listening on %s:%s', self.host, self.port)
+
+    async def stop(self):
+        """
+        Stop listening and close all of the open connections
+        """
+
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+
+        for connection in list(self._connections):
+            connection.cancel()
+
+        if self.socket and os.path.exists(self.socket):
+            os.remove(self.socket)
+
+    @property
+    def addresses(self):
+        """
+        The addresses being listened on
+        """
+
+        return [
+            sock.getsockname()
+            for server in self._servers
+            for sock in server.sockets
+        ]
+
+    async def handle(self, request, token=None):
+        """
+        Run the handler of a request and build the response, the request must
+        carry the token if one is given
+        """
+
+        if not isinstance(request, dict):
+            return {
+                'id': None,
+                'error': {'type': 'APIError', 'message': 'Requests must be JSON objects'},
+            }
+
+        response = {'id': request.get('id')}
+
+        try:
+            if token is not None and not hmac.compare_digest(
+                    str(request.get('token')).encode('utf-8'),
+                    token.encode('utf-8'),
+            ):
+                raise mcadminpanel.agent.errors.APIError('Invalid token')
+
+            args = request.get('args') or {}
+            handler = self.routes.get(request.get('command'))
+            if handler is not None:
+                try:
+                    inspect.signature(handler).bind(**args)
+                except TypeError as ex:
+                    raise mcadminpanel.agent.errors.APIError(
+                        'Invalid arguments: {}'.format(ex),
+                    )
+
+                result = handler(**args)
+            elif self.default is not None:
+                result = self.default(request.get('command'), args)
+            else:
+                raise mcadminpanel.agent.errors.APIError(
+                    'Unknown command: {}'.format(request.get('command')),
+                )
+
+            if inspect.isawaitable(result):
+                result = await result
+
+            response['result'] = result
+        except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+            response['error'] = {'type': type(ex).__name__, 'message': str(ex)}
+        except Exception as ex: # pylint: disable=broad-except
+            logging.exception('API command %s failed', request.get('command'))
+            response['error'] = {'type': 'InternalError', 'message': str(ex)}
+
+        return response
+
+    async def _handle_connection(self, reader, writer, token=None):
+        connection = asyncio.ensure_future(
+            self._serve_connection(reader, writer, token),
+            loop=self.loop,
+        )
+        self._connections.add(connection)
+        try:
+            await connection
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(connection)
+            writer.close()
+
+    async def _serve_connection(self, reader, writer, token):
+        pending = set()
+        slots = asyncio.Semaphore(self.max_pending)
+        write_lock = asyncio.Lock()
+
+        async def respond(request):
+            try:
+                response = await self.handle(request, token)
+                writer.write(encode_response(response))
+                async with write_lock:
+                    await writer.drain()
+            finally:
+                slots.release()
+
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader)
+                except mcadminpanel.agent.errors.APIError as ex:
+                    logging.warning('Closing API connection: %s', ex)
+                    break
+                if request is None:
+                    break
+
+                await slots.acquire()
+                task = asyncio.ensure_future(respond(request), loop=self.loop)
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            for task in pending:
+                task.cancel()
+# pylint: enable=too-many-instance-attributes
+
+
+class APIClient(object):
+    """
+    Client side of the control API.
+
+    A single connection is kept open and shared by every call, calls made
+    concurrently are pipelined on that connection.
+    """
+
+    def __init__(self, reader, writer, loop=None, token=None):
+        """
+        Setup a client for an open connection, sending the token with every
+        request if one is given
+        """
+
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.token = token
+
+        self._reader = reader
+        self._writer = writer
+        self._next_id = 0
+        self._waiting = {}
+        self._receiver = asyncio.ensure_future(self._receive(), loop=self.loop)
+
+    # pylint: disable=too-many-arguments
+    @classmethod
+    async def connect(cls, socket=None, host=None, port=None, loop=None, token=None):
+        """
+        Connect to an agent over its Unix socket or over TCP with the token
+        of its API
+        """
+
+        if socket is not None:
+            reader, writer = await asyncio.open_unix_connection(socket)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+
+        return cls(reader, writer, loop=loop, token=token)
+    # pylint: enable=too-many-arguments
+
+    @property
+    def closed(self):
+        """
+        Whether the connection is closed
+        """
+
+        return self._receiver.done()
+
+    async def call(self, _command, **args):
+        """
+        Run a command on the agent and return its result, the command is
+        positional so commands may have an argument named command
+        """
+
+        return await self.request(_command, args)
+
+    async def request(self, command, args):
+        """
+        Run a command with a mapping of arguments on the agent and return its
+        result
+        """
+
+        if self._receiver.done():
+            raise mcadminpanel.agent.errors.APIError('Connection is closed')
+
+        self._next_id += 1
+        request_id = self._next_id
+
+        future = self.loop.create_future()
+        self._waiting[request_id] = future
+
+        request = {'id': request_id, 'command': command, 'args': args}
+        if self.token is not None:
+            request['token'] = self.token
+
+        self._writer.write(encode_frame(request))
+        await self._writer.drain()
+
+        response = await future
+        if 'error' in response:
+            raise mcadminpanel.agent.errors.APIError(
+                '{}: {}'.format(
+                    response['error']['type'],
+                    response['error']['message'],
+                ),
+            )
+
+        return response['result']
+
+    async def close(self):
+        """
+        Close the connection
+        """
+
+        self._writer.close()
+        self._receiver.cancel()
+        try:
+            await self._receiver
+        except asyncio.CancelledError:
+            pass
+
+    async def _receive(self):
+        try:
+            while True:
+                response = await read_frame(self._reader)
+                if response is None:
+                    break
+
+                future = self._waiting.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(
+                        mcadminpanel.agent.errors.APIError('Connection closed'),
+                    )
+            self._waiting.clear()
+
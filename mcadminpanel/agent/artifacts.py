@@ -0,0 +1,392 @@
+"""
+Content addressed store of the server jars and plugins.
+
+Servers usually run the same server jar and many of the same plugins, and
+every copy takes its own disk space and page cache. The store keeps a single
+copy of every artifact named by its SHA-256 hash and puts it in the server
+directories as a hard link, or as a reflink or a plain copy when they are on
+another file system:
+
+    <path>/objects/ab/abcdef...
+    <path>/index.json
+    <path>/index.lock
+
+The index records when every artifact was last used, it is shared by the
+worker processes of the agent which take a lock on the lock file while they
+use it. Once the store grows
+past its size limit the least recently used artifacts are evicted, skipping
+the ones still linked into a server directory as removing them would not
+free any space. An artifact is only hashed again before it is used when its
+size or modification time changed since it was last verified.
+"""
+
+import asyncio
+import errno
+import fcntl
+import glob
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+import mcadminpanel.agent.backup
+import mcadminpanel.agent.errors
+
+# ioctl cloning a file on copy on write file systems, not exposed by fcntl
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+
+def clone_file(source, target):
+    """
+    Create target with the content of source as cheaply as possible and
+    return how, 'link', 'reflink' or 'copy'
+    """
+
+    try:
+        os.link(source, target)
+        return 'link'
+    except OSError as ex:
+        if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            method = 'reflink'
+        except OSError:
+            size = os.fstat(source_file.fileno()).st_size
+            mcadminpanel.agent.backup.copy_range(
+                source_file.fileno(),
+                target_file.fileno(),
+                0,
+                size,
+            )
+            method = 'copy'
+
+    os.chmod(target, os.stat(source).st_mode & 0o7777)
+
+    return method
+
+def replace_file(source, target):
+    """
+    Replace target with a clone of source so readers never see it missing
+    """
+
+    # Links need a free name, the clone is made in a private directory
+    directory = tempfile.mkdtemp(dir=os.path.dirname(target), suffix='.tmp')
+    temporary = os.path.join(directory, os.path.basename(target))
+    try:
+        method = clone_file(source, temporary)
+        os.replace(temporary, target)
+    finally:
+        if os.path.lexists(temporary):
+            os.unlink(temporary)
+        os.rmdir(directory)
+
+    return method
+
+def find_artifacts(directory, patterns):
+    """
+    The regular files of a directory matching any of the artifact patterns
+    """
+
+    paths = set()
+    for pattern in patterns:
+        paths.update(glob.glob(os.path.join(directory, pattern), recursive=True))
+
+    return sorted(
+        path
+        for path in paths
+        if os.path.isfile(path) and not os.path.islink(path)
+    )
+
+
+class ArtifactStore(object):
+    """
+    Deduplicates the server jars and plugins of the managed servers
+    """
+
+    def __init__(self, supervisor, artifacts_conf, loop=None):
+        """
+        Setup the store from the artifacts configuration
+        """
+
+        self.supervisor = supervisor
+        self.path = artifacts_conf['path']
+        self.max_size = artifacts_conf['max_size']
+        self.patterns = artifacts_conf['patterns']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.index = {}
+
+        self._lock = None
+
+    def object_path(self, digest):
+        """
+        The file an artifact is stored in
+        """
+
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def load(self):
+        """
+        Read the index and match it with the stored artifacts, artifacts
+        missing from the index are verified before they are used
+        """
+
+        try:
+            with open(os.path.join(self.path, 'index.json'), 'r') as index_file:
+                index = json.load(index_file)['artifacts']
+        except (OSError, ValueError, KeyError, TypeError):
+            index = {}
+
+        self.index = {}
+        for path in glob.glob(os.path.join(self.path, 'objects', '*', '*')):
+            digest = os.path.basename(path)
+            if digest.endswith('.tmp'):
+                continue
+
+            entry = index.get(digest)
+            if entry is None:
+                entry = {'size': os.stat(path).st_size, 'used': 0, 'verified': None}
+            self.index[digest] = entry
+
+    def save(self):
+        """
+        Write the index
+        """
+
+        mcadminpanel.agent.backup.write_json(
+            os.path.join(self.path, 'index.json'),
+            {'artifacts': self.index},
+        )
+
+    def verify(self, digest):
+        """
+        Check the hash of an artifact if its file changed since it was last
+        verified, a corrupted artifact is removed
+        """
+
+        entry = self.index.get(digest)
+        if entry is None:
+            raise mcadminpanel.agent.errors.ArtifactError('Unknown artifact {}'.format(digest))
+
+        path = self.object_path(digest)
+        stat = os.stat(path)
+        if entry['verified'] == [stat.st_size, stat.st_mtime_ns]:
+            return
+
+        if mcadminpanel.agent.backup.file_digest(path) != digest:
+            logging.error('Removing corrupted artifact %s', digest)
+            os.unlink(path)
+            del self.index[digest]
+            raise mcadminpanel.agent.errors.ArtifactError(
+                'Artifact {} is corrupted'.format(digest),
+            )
+
+        entry['size'] = stat.st_size
+        entry['verified'] = [stat.st_size, stat.st_mtime_ns]
+
+    def add(self, path):
+        """
+        Store the artifact at path, which becomes a link to the stored copy,
+        and return its hash and whether it was already stored
+        """
+
+        digest = mcadminpanel.agent.backup.file_digest(path)
+        if digest in self.index:
+            try:
+                self.place(digest, path)
+                return digest, True
+            except mcadminpanel.agent.errors.ArtifactError:
+                pass
+
+        target = self.object_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.chmod(path, os.stat(path).st_mode & ~0o222)
+        replace_file(path, target)
+
+        stat = os.stat(target)
+        self.index[digest] = {
+            'size': stat.st_size,
+            'used': time.time(),
+            'verified': [stat.st_size, stat.st_mtime_ns],
+        }
+
+        return digest, False
+
+    def place(self, digest, target):
+        """
+        Put a stored artifact at target and return how it was cloned
+        """
+
+        self.verify(digest)
+
+        source = self.object_path(digest)
+        if os.path.exists(target) and os.path.samefile(source, target):
+            method = 'link'
+        else:
+            method = replace_file(source, target)
+        self.index[digest]['used'] = time.time()
+
+        return method
+
+    def inodes(self):
+        """
+        The hash of every stored artifact by the device and inode of its file
+        """
+
+        inodes = {}
+        for digest in self.index:
+            try:
+                stat = os.stat(self.object_path(digest))
+            except FileNotFoundError:
+                continue
+            inodes[stat.st_dev, stat.st_ino] = digest
+
+        return inodes
+
+    def dedupe(self, directory):
+        """
+        Store the artifacts of a server directory, replacing them by links
+        to the stored copies, and return the dedupe stats
+        """
+
+        stats = {'files': 0, 'stored': 0, 'linked': 0, 'saved_bytes': 0}
+
+        stored = self.inodes()
+        for path in find_artifacts(directory, self.patterns):
+            stats['files'] += 1
+            stat = os.stat(path)
+            if (stat.st_dev, stat.st_ino) in stored:
+                self.index[stored[stat.st_dev, stat.st_ino]]['used'] = time.time()
+                continue
+
+            digest, known = self.add(path)
+            if known:
+                stats['linked'] += 1
+                stats['saved_bytes'] += self.index[digest]['size']
+            else:
+                stats['stored'] += 1
+
+        return stats
+
+    def evict(self):
+        """
+        Remove the least recently used artifacts no server uses until the
+        store fits in its size limit, and return their hashes
+        """
+
+        if self.max_size is None:
+            return []
+
+        size = sum(entry['size'] for entry in self.index.values())
+        evicted = []
+        for digest in sorted(self.index, key=lambda digest: self.index[digest]['used']):
+            if size <= self.max_size:
+                break
+
+            path = self.object_path(digest)
+            try:
+                if os.stat(path).st_nlink > 1:
+                    continue
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            size -= self.index.pop(digest)['size']
+            evicted.append(digest)
+
+        return evicted
+
+    def artifacts(self):
+        """
+        The stored artifacts, most recently used first
+        """
+
+        artifacts = []
+        for digest, entry in self.index.items():
+            try:
+                links = os.stat(self.object_path(digest)).st_nlink - 1
+            except FileNotFoundError:
+                continue
+            artifacts.append({
+                'digest': digest,
+                'size': entry['size'],
+                'used': entry['used'],
+                'links': links,
+            })
+
+        return sorted(artifacts, key=lambda artifact: artifact['used'], reverse=True)
+
+    async def run(self, function, *args):
+        """
+        Run a store operation in a worker thread, one at a time, with the
+        index loaded before and saved after it.
+
+        The index is replaced when it is saved so the lock is taken on a
+        separate file, it keeps the other worker processes out of the index
+        until it is saved.
+        """
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        def operation():
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'index.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+                self.load()
+                try:
+                    return function(*args)
+                finally:
+                    self.save()
+
+        async with self._lock:
+            return await self.loop.run_in_executor(None, operation)
+
+    def api_routes(self):
+        """
+        The control API commands for the artifact store
+        """
+
+        return {
+            'dedupe_artifacts': self.api_dedupe_artifacts,
+            'list_artifacts': self.api_list_artifacts,
+        }
+
+    async def api_dedupe_artifacts(self, names=None):
+        """
+        API command deduplicating the artifacts of some servers, all of them
+        by default, and evicting the artifacts over the size limit
+        """
+
+        if names is None:
+            names = sorted(self.supervisor.servers)
+        servers = [self.supervisor.get(name) for name in names]
+
+        def dedupe():
+            report = {
+                server.name: self.dedupe(server.directory)
+                for server in servers
+            }
+
+            return {'servers': report, 'evicted': self.evict()}
+
+        report = await self.run(dedupe)
+
+        logging.info(
+            'Deduplicated artifacts of %s servers, saved %s bytes',
+            len(servers),
+            sum(stats['saved_bytes'] for stats in report['servers'].values()),
+        )
+
+        return report
+
+    async def api_list_artifacts(self):
+        """
+        API command listing the stored artifacts
+        """
+
+        return await self.run(self.artifacts)
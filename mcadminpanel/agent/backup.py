@@ -0,0 +1,695 @@
+"""
+Incremental, content addressed backups of the server directories.
+
+Files are split into fixed size chunks that are stored by their SHA-256 hash
+so a chunk shared by several snapshots, or several files, is only stored
+once. A snapshot is a manifest listing the chunks of every file:
+
+    <path>/chunks/ab/abcdef...
+    <path>/snapshots/<server>/<snapshot id>.json
+
+Files that have the same size and modification time as in the previous
+snapshot of a server are not read again.
+
+Restores rebuild a directory from the chunks of a snapshot, copying every
+chunk into place from a pool of worker threads. Chunks are copied inside the
+kernel with copy_file_range or sendfile, or mapped into memory and hashed
+on the way when they are verified, so their data is never copied through
+Python buffers.
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import logging
+import mmap
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.logstream
+
+SAVED = re.compile(rb'Saved the (game|world)')
+
+SNAPSHOT_ID = re.compile(r'[0-9]{8}T[0-9]{12}Z')
+
+# pylint: disable=too-few-public-methods
+class RateLimiter(object):
+    """
+    A thread safe token bucket limiting the number of bytes per second
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Setup a limiter allowing rate bytes per second, or no limit if None
+        """
+
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        Take amount bytes from the bucket, sleeping until they are available
+        """
+
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.rate,
+            )
+            self._updated = now
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+# pylint: enable=too-few-public-methods
+
+
+class ChunkStore(object):
+    """
+    Chunks stored in files named by their hash
+    """
+
+    def __init__(self, path):
+        """
+        Setup a store in the given directory
+        """
+
+        self.path = path
+
+    def chunk_path(self, digest):
+        """
+        The file a chunk is stored in
+        """
+
+        return os.path.join(self.path, digest[:2], digest)
+
+    def has(self, digest):
+        """
+        Whether a chunk is stored
+        """
+
+        return os.path.exists(self.chunk_path(digest))
+
+    def put(self, digest, data):
+        """
+        Store a chunk, returns False if it was already stored
+        """
+
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, data)
+
+        return True
+
+
+# pylint: disable=too-many-instance-attributes
+class BackupEngine(object):
+    """
+    Takes incremental snapshots of the managed servers.
+
+    Backups of different servers run concurrently while the files of a
+    snapshot are read and hashed by a bounded pool of worker threads,
+    hashlib releases the GIL on large buffers so hashing uses several cores.
+    Every read and every newly stored chunk goes through a shared rate
+    limiter so backups never starve the live servers of disk bandwidth.
+    """
+
+    def __init__(self, supervisor, backup_conf, loop=None):
+        """
+        Setup the engine from the backup configuration
+        """
+
+        self.supervisor = supervisor
+        self.path = backup_conf['path']
+        self.chunk_size = backup_conf['chunk_size']
+        self.save_timeout = backup_conf['save_timeout']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.limiter = RateLimiter(backup_conf['rate_limit'])
+        self.store = ChunkStore(os.path.join(self.path, 'chunks'))
+        self.pool = concurrent.futures.ThreadPoolExecutor(backup_conf['workers'])
+
+        self._locks = {}
+
+    def close(self):
+        """
+        Shutdown the worker threads
+        """
+
+        self.pool.shutdown()
+
+    def snapshot_dir(self, name):
+        """
+        The directory holding the snapshots of a server
+        """
+
+        return os.path.join(self.path, 'snapshots', name)
+
+    def snapshots(self, name):
+        """
+        The ids of the snapshots of a server, oldest first
+        """
+
+        try:
+            files = os.listdir(self.snapshot_dir(name))
+        except FileNotFoundError:
+            return []
+
+        return sorted(
+            filename[:-len('.json')]
+            for filename in files
+            if filename.endswith('.json')
+        )
+
+    def manifest(self, name, snapshot_id):
+        """
+        Load the manifest of a snapshot
+        """
+
+        if not isinstance(snapshot_id, str) or not SNAPSHOT_ID.fullmatch(snapshot_id):
+            raise mcadminpanel.agent.errors.BackupError(
+                'Invalid snapshot id: {}'.format(snapshot_id),
+            )
+
+        path = os.path.join(self.snapshot_dir(name), snapshot_id + '.json')
+        try:
+            with open(path, 'r') as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            raise mcadminpanel.agent.errors.BackupError(
+                'Unknown snapshot {} of server {}'.format(snapshot_id, name),
+            )
+
+    def snapshot(self, name, directory):
+        """
+        Take a snapshot of a directory and return its manifest
+        """
+
+        started = time.monotonic()
+
+        previous = {}
+        snapshot_ids = self.snapshots(name)
+        if snapshot_ids:
+            for entry in self.manifest(name, snapshot_ids[-1])['files']:
+                previous[entry['path']] = entry
+
+        results = list(self.pool.map(
+            lambda path: self._snapshot_file(directory, path, previous.get(path)),
+            walk_files(directory),
+        ))
+
+        files = [entry for entry, _ in results]
+        stats = {
+            'files': len(files),
+            'bytes': sum(entry['size'] for entry in files),
+            'reused_files': 0,
+            'hashed_bytes': 0,
+            'new_chunks': 0,
+            'new_bytes': 0,
+        }
+        for _, file_stats in results:
+            for key, value in file_stats.items():
+                stats[key] += value
+
+        snapshot_id = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')
+        stats['duration'] = time.monotonic() - started
+        manifest = {
+            'server': name,
+            'id': snapshot_id,
+            'created': time.time(),
+            'chunk_size': self.chunk_size,
+            'files': files,
+            'stats': stats,
+        }
+
+        os.makedirs(self.snapshot_dir(name), exist_ok=True)
+        write_atomic(
+            os.path.join(self.snapshot_dir(name), snapshot_id + '.json'),
+            json.dumps(manifest).encode('utf-8'),
+        )
+
+        return manifest
+
+    def restore(self, name, snapshot_id, directory, verify=True):
+        """
+        Rebuild a directory from a snapshot and return the restore stats.
+
+        The files are written into a staging directory that replaces the
+        directory once every chunk has been copied, so a failed restore
+        leaves the directory untouched. When verify is set the hash of every
+        chunk is checked while it is copied.
+        """
+
+        started = time.monotonic()
+        manifest = self.manifest(name, snapshot_id)
+
+        staging = directory.rstrip(os.sep) + '.restoring'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+
+        copies = []
+        for entry in manifest['files']:
+            path = os.path.join(staging, entry['path'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as target:
+                target.truncate(entry['size'])
+
+            copies.extend(
+                (path, index * manifest['chunk_size'], digest)
+                for index, digest in enumerate(entry['chunks'])
+            )
+
+        try:
+            for _ in self.pool.map(lambda copy: self._restore_chunk(*copy, verify=verify), copies):
+                pass
+
+            for entry in manifest['files']:
+                path = os.path.join(staging, entry['path'])
+                os.chmod(path, entry['mode'])
+                os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        replace_directory(staging, directory)
+
+        return {
+            'files': len(manifest['files']),
+            'bytes': sum(entry['size'] for entry in manifest['files']),
+            'chunks': len(copies),
+            'verified': verify,
+            'duration': time.monotonic() - started,
+        }
+
+    async def restore_server(self, server, snapshot_id=None, verify=True):
+        """
+        Restore a stopped server from a snapshot, the latest by default
+        """
+
+        if server.running:
+            raise mcadminpanel.agent.errors.BackupError(
+                'Server {} must be stopped before it is restored'.format(server.name),
+            )
+
+        if snapshot_id is None:
+            snapshot_ids = self.snapshots(server.name)
+            if not snapshot_ids:
+                raise mcadminpanel.agent.errors.BackupError(
+                    'Server {} has no backups'.format(server.name),
+                )
+            snapshot_id = snapshot_ids[-1]
+
+        lock = self._locks.setdefault(server.name, asyncio.Lock())
+        async with lock:
+            stats = await self.loop.run_in_executor(
+                None,
+                self.restore,
+                server.name,
+                snapshot_id,
+                server.directory,
+                verify,
+            )
+
+        logging.info(
+            'Restored server %s from %s: %s bytes in %.2fs',
+            server.name,
+            snapshot_id,
+            stats['bytes'],
+            stats['duration'],
+        )
+
+        return {'id': snapshot_id, 'stats': stats}
+
+    async def backup(self, server):
+        """
+        Snapshot a managed server.
+
+        A running server is told to flush its world to disk and to stop
+        saving until the snapshot is done so the files are consistent, an
+        adopted server has no console and is told over RCON.
+        """
+
+        lock = self._locks.setdefault(server.name, asyncio.Lock())
+        async with lock:
+            paused = False
+            adopted = False
+            if server.process is not None and server.process.returncode is None:
+                await self.pause_saving(server)
+                paused = True
+            elif server.adopted is not None:
+                await self.pause_saving_rcon(server)
+                adopted = True
+
+            try:
+                manifest = await self.loop.run_in_executor(
+                    None,
+                    self.snapshot,
+                    server.name,
+                    server.directory,
+                )
+            finally:
+                if paused:
+                    resume_saving(server)
+                elif adopted:
+                    await resume_saving_rcon(server)
+
+        logging.info(
+            'Backed up server %s as %s: %s new chunks, %s new bytes in %.2fs',
+            server.name,
+            manifest['id'],
+            manifest['stats']['new_chunks'],
+            manifest['stats']['new_bytes'],
+            manifest['stats']['duration'],
+        )
+
+        return manifest
+
+    async def pause_saving(self, server):
+        """
+        Turn off saving and wait for the server to flush its world
+        """
+
+        waiter = server.console.subscribe(
+            mcadminpanel.agent.logstream.QueueSubscriber(),
+        )
+        try:
+            server.send_command('save-off')
+            server.send_command('save-all flush')
+
+            await asyncio.wait_for(
+                mcadminpanel.agent.logstream.wait_for_line(waiter, SAVED),
+                self.save_timeout,
+            )
+        except asyncio.TimeoutError:
+            resume_saving(server)
+            raise mcadminpanel.agent.errors.BackupError(
+                'Server {} did not save within {}s'.format(
+                    server.name,
+                    self.save_timeout,
+                ),
+            )
+        finally:
+            server.console.unsubscribe(waiter)
+
+    async def pause_saving_rcon(self, server):
+        """
+        Turn off saving of an adopted server over RCON, the server answers
+        once its world is flushed
+        """
+
+        if server.rcon_conf is None:
+            raise mcadminpanel.agent.errors.BackupError(
+                'Server {} was adopted and needs RCON to be backed up while running'.format(
+                    server.name,
+                ),
+            )
+
+        try:
+            await server.commands.execute('save-off', timeout=self.save_timeout)
+            result = await server.commands.execute('save-all flush', timeout=self.save_timeout)
+        except (mcadminpanel.agent.errors.ServerError, OSError) as ex:
+            await resume_saving_rcon(server)
+            raise mcadminpanel.agent.errors.BackupError(
+                'Server {} did not save: {}'.format(server.name, ex),
+            )
+
+        if not SAVED.search(result['response'].encode('utf-8')):
+            await resume_saving_rcon(server)
+            raise mcadminpanel.agent.errors.BackupError(
+                'Server {} did not save: {}'.format(server.name, result['response']),
+            )
+
+    def api_routes(self):
+        """
+        The control API commands for backups
+        """
+
+        return {
+            'backup': self.api_backup,
+            'backup_all': self.api_backup_all,
+            'list_backups': self.api_list_backups,
+            'restore': self.api_restore,
+        }
+
+    async def api_backup(self, name):
+        """
+        API command backing up a server
+        """
+
+        manifest = await self.backup(self.supervisor.get(name))
+
+        return {'id': manifest['id'], 'stats': manifest['stats']}
+
+    async def api_backup_all(self):
+        """
+        API command backing up every server concurrently
+        """
+
+        names = sorted(self.supervisor.servers)
+        results = await asyncio.gather(
+            *[self.api_backup(name) for name in names],
+            return_exceptions=True
+        )
+
+        report = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logging.error('Unable to back up server %s: %s', name, result)
+                result = {'error': str(result)}
+            report[name] = result
+
+        return report
+
+    async def api_restore(self, name, snapshot_id=None, verify=True):
+        """
+        API command restoring a stopped server from a snapshot
+        """
+
+        return await self.restore_server(self.supervisor.get(name), snapshot_id, verify)
+
+    def api_list_backups(self, name):
+        """
+        API command listing the snapshots of a server
+        """
+
+        return self.snapshots(self.supervisor.get(name).name)
+
+    def _snapshot_file(self, directory, path, previous):
+        full_path = os.path.join(directory, path)
+        stat = os.stat(full_path)
+
+        entry = {
+            'path': path,
+            'size': stat.st_size,
+            'mode': stat.st_mode & 0o7777,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+
+        if (
+                previous is not None and
+                previous['size'] == entry['size'] and
+                previous['mtime_ns'] == entry['mtime_ns'] and
+                all(self.store.has(digest) for digest in previous['chunks'])
+        ):
+            entry['chunks'] = previous['chunks']
+            return entry, {'reused_files': 1}
+
+        stats = {'hashed_bytes': 0, 'new_chunks': 0, 'new_bytes': 0}
+        chunks = []
+        with open(full_path, 'rb') as source:
+            while True:
+                data = source.read(self.chunk_size)
+                if not data:
+                    break
+
+                self.limiter.consume(len(data))
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append(digest)
+                stats['hashed_bytes'] += len(data)
+
+                if self.store.put(digest, data):
+                    self.limiter.consume(len(data))
+                    stats['new_chunks'] += 1
+                    stats['new_bytes'] += len(data)
+
+        entry['chunks'] = chunks
+
+        return entry, stats
+
+    def _restore_chunk(self, path, offset, digest, verify):
+        source = os.open(self.store.chunk_path(digest), os.O_RDONLY)
+        try:
+            target = os.open(path, os.O_WRONLY)
+            try:
+                size = os.fstat(source).st_size
+                self.limiter.consume(size)
+
+                if verify:
+                    write_verified(source, target, offset, digest)
+                else:
+                    copy_range(source, target, offset, size)
+            finally:
+                os.close(target)
+        finally:
+            os.close(source)
+# pylint: enable=too-many-instance-attributes
+
+def resume_saving(server):
+    """
+    Turn saving back on, the server may have exited in the meantime
+    """
+
+    try:
+        server.send_command('save-on')
+    except (mcadminpanel.agent.errors.ServerError, OSError):
+        pass
+
+async def resume_saving_rcon(server):
+    """
+    Turn saving of an adopted server back on over RCON
+    """
+
+    try:
+        await server.commands.execute('save-on')
+    except (mcadminpanel.agent.errors.ServerError, OSError) as ex:
+        logging.warning('Unable to turn saving of server %s back on: %s', server.name, ex)
+
+def write_verified(source, target, offset, digest):
+    """
+    Check the hash of a chunk and write it at offset in the target file
+    """
+
+    with mmap.mmap(source, 0, access=mmap.ACCESS_READ) as data:
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise mcadminpanel.agent.errors.BackupError(
+                'Chunk {} is corrupted'.format(digest),
+            )
+
+        with memoryview(data) as view:
+            written = 0
+            while written < len(view):
+                written += os.pwrite(target, view[written:], offset + written)
+
+def file_digest(path):
+    """
+    The SHA-256 hash of a file
+    """
+
+    with open(path, 'rb') as source:
+        if not os.fstat(source.fileno()).st_size:
+            return hashlib.sha256().hexdigest()
+
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hashlib.sha256(data).hexdigest()
+
+def copy_range(source, target, offset, size):
+    """
+    Copy the start of the source file to offset in the target file.
+
+    The data is copied inside the kernel with copy_file_range, or sendfile
+    when copy_file_range is not available or not supported by the file
+    systems.
+    """
+
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                count = os.copy_file_range(
+                    source,
+                    target,
+                    size - copied,
+                    copied,
+                    offset + copied,
+                )
+                if not count:
+                    break
+                copied += count
+        except OSError:
+            pass
+
+    os.lseek(target, offset + copied, os.SEEK_SET)
+    while copied < size:
+        count = os.sendfile(target, source, copied, size - copied)
+        if not count:
+            raise mcadminpanel.agent.errors.BackupError('Chunk is truncated')
+        copied += count
+
+def replace_directory(source, directory):
+    """
+    Move a directory into the place of another one, removing the old one
+    """
+
+    if not os.path.exists(directory):
+        os.rename(source, directory)
+        return
+
+    previous = directory.rstrip(os.sep) + '.previous'
+    os.rename(directory, previous)
+    os.rename(source, directory)
+    shutil.rmtree(previous)
+
+def walk_files(directory):
+    """
+    The paths of every regular file under a directory, relative to it
+    """
+
+    for root, _, files in os.walk(directory):
+        for filename in sorted(files):
+            full_path = os.path.join(root, filename)
+            if os.path.isfile(full_path) and not os.path.islink(full_path):
+                yield os.path.relpath(full_path, directory)
+
+def write_atomic(path, data):
+    """
+    Write a file so readers never see it partially written
+    """
+
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o644
+
+    handle, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        prefix=os.path.basename(path) + '.',
+        suffix='.tmp',
+    )
+    try:
+        with open(handle, 'wb') as output:
+            os.fchmod(output.fileno(), mode)
+            output.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+def write_json(path, document):
+    """
+    Write a JSON document atomically, creating its directory if needed
+    """
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    write_atomic(path, json.dumps(document, sort_keys=True).encode('utf-8'))
+
@@ -0,0 +1,155 @@
+"""
+Class data sharing archives of the server jars.
+
+Most of the seconds a server JVM takes to start are spent loading and
+verifying the classes of the server jar. Class data sharing maps them from
+an archive written by an earlier run of the same jar instead. The agent
+keeps one archive per server jar and Java runtime:
+
+* the first start of a jar runs with -XX:ArchiveClassesAtExit, the JVM
+  writes the classes it loaded when the server stops,
+* later starts run with -XX:SharedArchiveFile to map them.
+
+Archives are named by the file of the jar and of the java executable, so
+servers sharing a jar through the artifact store share its archive, and an
+update of either one starts a new archive. JVMs that do not know these
+options ignore them, and a JVM that can not map an archive starts normally.
+"""
+
+import collections
+import hashlib
+import os
+import os.path
+import shutil
+
+# Options turning on class data sharing, before the -jar option
+IGNORE_UNKNOWN = '-XX:+IgnoreUnrecognizedVMOptions'
+USE_ARCHIVE = '-XX:SharedArchiveFile={}'
+DUMP_ARCHIVE = '-XX:ArchiveClassesAtExit={}'
+
+# Prefixes of the options added to the commands of servers
+OPTIONS = (IGNORE_UNKNOWN, USE_ARCHIVE.format(''), DUMP_ARCHIVE.format(''))
+
+# How a server is started: its command, whether its archive is used or
+# dumped or None without one, and the files of the archive
+Launch = collections.namedtuple('Launch', ('command', 'mode', 'temporary', 'archive'))
+
+def server_jar(command):
+    """
+    The java executable and the server jar of a java -jar command, None when
+    the command does not run a jar
+    """
+
+    if not command or not os.path.basename(command[0]).startswith('java'):
+        return None
+
+    try:
+        index = command.index('-jar')
+    except ValueError:
+        return None
+    if index + 1 >= len(command):
+        return None
+
+    return command[0], index, command[index + 1]
+
+def without_options(command):
+    """
+    A server command without the class data sharing options added to it
+    """
+
+    return [argument for argument in command if not argument.startswith(OPTIONS)]
+
+def archive_name(java, jar):
+    """
+    The name of the archive of a jar run by a java executable, given their
+    stat results
+    """
+
+    identity = ':'.join(str(value) for value in (
+        java.st_dev, java.st_ino, java.st_size, java.st_mtime_ns,
+        jar.st_dev, jar.st_ino, jar.st_size, jar.st_mtime_ns,
+    ))
+
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest() + '.jsa'
+
+
+class ArchiveCache(object):
+    """
+    The class data sharing archives of the server jars in a directory
+    """
+
+    def __init__(self, path):
+        """
+        Setup a cache of archives in the given directory
+        """
+
+        self.path = path
+
+    def archive(self, command, directory):
+        """
+        The archive of the jar run by a server command from its directory or
+        None if the command does not run a jar
+        """
+
+        found = server_jar(command)
+        if found is None:
+            return None
+        java, _, jar = found
+
+        if os.sep in java:
+            executable = os.path.join(directory, java)
+        else:
+            executable = shutil.which(java)
+            if executable is None:
+                return None
+
+        try:
+            java_stat = os.stat(os.path.realpath(executable))
+            jar_stat = os.stat(os.path.join(directory, jar))
+        except OSError:
+            return None
+
+        return os.path.join(self.path, archive_name(java_stat, jar_stat))
+
+    def launch(self, name, command, directory):
+        """
+        How to start a server with the archive of its jar
+        """
+
+        archive = self.archive(command, directory)
+        if archive is None:
+            return Launch(list(command), None, None, None)
+
+        _, index, _ = server_jar(command)
+        if os.path.exists(archive):
+            options = [IGNORE_UNKNOWN, USE_ARCHIVE.format(archive)]
+            mode, temporary = 'use', None
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            temporary = '{}.{}.tmp'.format(archive, name)
+            options = [IGNORE_UNKNOWN, DUMP_ARCHIVE.format(temporary)]
+            mode = 'dump'
+
+        return Launch(
+            list(command[:index]) + options + list(command[index:]),
+            mode,
+            temporary,
+            archive,
+        )
+
+    @staticmethod
+    def finish(launch):
+        """
+        Keep the archive dumped by a server that exited, if it wrote one
+        """
+
+        if launch.temporary is None:
+            return
+
+        try:
+            if os.path.getsize(launch.temporary):
+                os.replace(launch.temporary, launch.archive)
+            else:
+                os.unlink(launch.temporary)
+        except FileNotFoundError:
+            pass
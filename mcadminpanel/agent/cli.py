@@ -2,13 +2,40 @@
 Main CLI command for the agent
 """
 
+import datetime
+import json
 import os
 import os.path
+import time
 
 import click
 
 import mcadminpanel.agent.agent
 import mcadminpanel.agent.config
+import mcadminpanel.agent.errors
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+def parse_time(ctx, param, value): # pylint: disable=unused-argument
+    """
+    Parse a Unix timestamp or a local date and time option
+    """
+
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format).timestamp()
+        except ValueError:
+            pass
+
+    raise click.BadParameter('expected a Unix timestamp or YYYY-MM-DD[THH:MM:SS]')
 
 @click.group()
 @click.option(
@@ -74,12 +101,261 @@ def start(ctx, detach):
     agent.start(detach)
 
 @mcadminpanel_agent.command()
+@click.option(
+    '--keep-servers',
+    is_flag=True,
+    default=False,
+    help='Leave the servers running for the next agent to adopt, to upgrade '
+    'the agent without stopping them')
 @click.pass_context
-def stop(ctx):
+def stop(ctx, keep_servers):
     """
     Stop the agent
     """
 
     agent = mcadminpanel.agent.agent.Agent(ctx.obj['config'])
-    agent.stop()
+    agent.stop(keep_servers)
+
+@mcadminpanel_agent.command()
+@click.argument('name')
+@click.option(
+    '--snapshot',
+    default=None,
+    help='Snapshot to restore, the latest one by default')
+@click.option(
+    '--verify/--no-verify',
+    default=True,
+    help='Check the hash of every chunk while restoring')
+@click.pass_context
+def restore(ctx, name, snapshot, verify):
+    """
+    Restore a stopped server from a backup
+    """
+
+    agent = mcadminpanel.agent.agent.Agent(ctx.obj['config'])
+    try:
+        result = agent.restore(name, snapshot, verify)
+    except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+        raise click.ClickException(str(ex))
+
+    click.echo('Restored {} files of server {} from {} in {:.2f}s'.format(
+        result['stats']['files'],
+        name,
+        result['id'],
+        result['stats']['duration'],
+    ))
+
+@mcadminpanel_agent.command()
+@click.argument('name')
+@click.option(
+    '--template',
+    default=None,
+    help='Template to create the server from, the configured one by default')
+@click.option(
+    '--method',
+    type=click.Choice(('auto', 'reflink', 'copy_file_range', 'copy')),
+    default=None,
+    help='How to copy the files of the template, the configured one by default')
+@click.pass_context
+def provision(ctx, name, template, method):
+    """
+    Create the directory of a configured server from a template
+    """
+
+    agent = mcadminpanel.agent.agent.Agent(ctx.obj['config'])
+    try:
+        result = agent.provision(name, template, method)
+    except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+        raise click.ClickException(str(ex))
+
+    click.echo('Provisioned server {} from template {}: {} files in {:.2f}s ({})'.format(
+        name,
+        result['template'],
+        result['files'],
+        result['duration'],
+        ', '.join(
+            '{} {}'.format(count, used)
+            for used, count in sorted(result['methods'].items())
+        ),
+    ))
+
+@mcadminpanel_agent.command()
+@click.pass_context
+def stats(ctx):
+    """
+    Show the health of the running agent's event loop
+    """
+
+    agent = mcadminpanel.agent.agent.Agent(ctx.obj['config'])
+    try:
+        result = agent.call_api('loop_stats')
+    except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+        raise click.ClickException(str(ex))
+
+    click.echo(json.dumps(result, indent=4, sort_keys=True))
+
+@mcadminpanel_agent.command()
+@click.option(
+    '--duration',
+    type=float,
+    default=10,
+    help='Seconds to profile the agent for')
+@click.option(
+    '--interval',
+    type=float,
+    default=None,
+    help='Seconds between samples, the configured interval by default')
+@click.option(
+    '--top',
+    type=int,
+    default=50,
+    help='Number of stacks to show')
+@click.pass_context
+def profile(ctx, duration, interval, top):
+    """
+    Sample the running agent's event loop and print the most common stacks
+    in the folded format of flame graph tools
+    """
+
+    agent = mcadminpanel.agent.agent.Agent(ctx.obj['config'])
+    try:
+        agent.call_api('profile_start', interval=interval)
+        time.sleep(duration)
+        result = agent.call_api('profile_stop', top=top)
+    except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+        raise click.ClickException(str(ex))
+
+    for entry in result['stacks']:
+        click.echo('{} {}'.format(entry['stack'], entry['count']))
+
+@mcadminpanel_agent.command()
+@click.option(
+    '--server',
+    multiple=True,
+    help='Only deduplicate this server, may be repeated')
+@click.pass_context
+def dedupe_artifacts(ctx, server):
+    """
+    Replace the server jars and plugins of the servers by links to a single
+    stored copy
+    """
+
+    agent = mcadminpanel.agent.agent.Agent(ctx.obj['config'])
+    try:
+        result = agent.call_api('dedupe_artifacts', names=list(server) or None)
+    except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+        raise click.ClickException(str(ex))
+
+    click.echo(json.dumps(result, indent=4, sort_keys=True))
+
+@mcadminpanel_agent.command()
+@click.option(
+    '--since',
+    callback=parse_time,
+    default=None,
+    help='Only export events at or after this time')
+@click.option(
+    '--until',
+    callback=parse_time,
+    default=None,
+    help='Only export events at or before this time')
+@click.option(
+    '--server',
+    multiple=True,
+    help='Only export the events of this server, may be repeated')
+@click.option(
+    '--event',
+    multiple=True,
+    help='Only export this type of event, may be repeated')
+@click.option(
+    '--output',
+    type=click.File('w'),
+    default='-',
+    help='File to write the events to as JSON lines')
+@click.pass_context
+def export_journal(ctx, since, until, server, event, output): # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Export events from the event journal, merging the journals of the
+    worker processes
+    """
+
+    # pylint: disable=redefined-outer-name
+    import mcadminpanel.agent.journal
+    import mcadminpanel.agent.workers
+    # pylint: enable=redefined-outer-name
+
+    path = ctx.obj['config'].journal['file']
+    paths = []
+    if path:
+        paths = [path] if os.path.exists(path) else []
+        paths.extend(mcadminpanel.agent.workers.worker_paths(path))
+    if not paths:
+        raise click.ClickException('No event journal to export')
+
+    try:
+        for entry in mcadminpanel.agent.journal.merge_events(
+                paths,
+                since,
+                until,
+                server or None,
+                event or None,
+        ):
+            output.write(json.dumps(entry, sort_keys=True) + '\n')
+    except mcadminpanel.agent.errors.JournalError as ex:
+        raise click.ClickException(str(ex))
+
+
+@mcadminpanel_agent.command()
+@click.option(
+    '--server',
+    multiple=True,
+    help='Only analyze the worlds of this server, may be repeated')
+@click.option(
+    '--inhabited-below',
+    type=click.IntRange(min=1),
+    default=None,
+    help='Count the chunks players stayed in for fewer ticks as unvisited, '
+    'reads every chunk instead of only the region headers')
+@click.option(
+    '--output',
+    type=click.File('w'),
+    default='-',
+    help='File to write the statistics of every world to as JSON lines')
+@click.pass_context
+def analyze_regions(ctx, server, inhabited_below, output):
+    """
+    Report the chunks of the server worlds to find the bloat worth pruning
+    """
+
+    import mcadminpanel.agent.regions # pylint: disable=redefined-outer-name
+
+    config = ctx.obj['config']
+
+    unknown = sorted(set(server) - set(config.servers))
+    if unknown:
+        raise click.ClickException('Unknown servers: {}'.format(', '.join(unknown)))
+
+    directories = {
+        name: os.path.join(config.root, server_conf.get('directory') or name)
+        for name, server_conf in config.servers.items()
+        if not server or name in server
+    }
+
+    cache = mcadminpanel.agent.regions.RegionCache(config.regions['cache'])
+    cache.load()
 
+    try:
+        for summary in mcadminpanel.agent.regions.analyze(
+                directories,
+                cache,
+                config.regions['oversized_chunk'],
+                inhabited_below,
+                config.regions['processes'] or None,
+        ):
+            output.write(json.dumps(summary, sort_keys=True) + '\n')
+            output.flush()
+    finally:
+        try:
+            cache.save()
+        except OSError as ex:
+            click.echo('Unable to write the region cache: {}'.format(ex), err=True)
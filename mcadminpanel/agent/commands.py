@@ -0,0 +1,389 @@
+"""
+Console commands sent to the servers through a pipeline.
+
+Every server has a single pipeline. Commands are queued and written to the
+server's stdin by one writer task, everything waiting in the queue is
+written in a single batch so the lines of concurrent callers never
+interleave. The server answers commands in the order it reads them, a
+reader task matches the console output to the oldest pending command whose
+response pattern it fits and resolves that command's future.
+
+Servers the agent has no process for, such as servers adopted after a
+restart, are sent their commands over RCON when it is configured.
+"""
+
+import asyncio
+import collections
+import re
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.logstream
+import mcadminpanel.agent.rcon
+
+# Console output answering the common commands, other commands are done as
+# soon as they are written unless the caller gives a pattern
+RESPONSES = (
+    (re.compile(r'save-all\b'), re.compile(rb'Saved the (game|world)')),
+    (re.compile(r'say\b'), re.compile(rb'\[(Server|Rcon)\] ')),
+    (
+        re.compile(r'whitelist add\b'),
+        re.compile(rb'Added \S+ to the whitelist|already whitelisted|does not exist'),
+    ),
+    (
+        re.compile(r'whitelist remove\b'),
+        re.compile(rb'Removed \S+ from the whitelist|not whitelisted|does not exist'),
+    ),
+    (re.compile(r'whitelist reload\b'), re.compile(rb'Reloaded the whitelist')),
+    (re.compile(r'list\b'), re.compile(rb'There are \d+')),
+)
+
+UNKNOWN = re.compile(rb'Unknown (or incomplete )?command')
+
+def response_pattern(command):
+    """
+    The pattern of the console output answering a command or None
+    """
+
+    for prefix, pattern in RESPONSES:
+        if prefix.match(command):
+            return pattern
+
+    return None
+
+def compile_pattern(pattern):
+    """
+    Compile a response pattern given over the control API
+    """
+
+    if pattern is None:
+        return None
+
+    try:
+        return re.compile(pattern.encode('utf-8'))
+    except re.error as ex:
+        raise mcadminpanel.agent.errors.ServerError(
+            'Invalid response pattern {}: {}'.format(pattern, ex),
+        )
+
+
+# pylint: disable=too-few-public-methods
+class PendingCommand(object):
+    """
+    A command waiting to be written or answered
+    """
+
+    __slots__ = ('command', 'pattern', 'future', 'queued', 'sent')
+
+    def __init__(self, command, pattern, future, queued):
+        self.command = command
+        self.pattern = pattern
+        self.future = future
+        self.queued = queued
+        self.sent = None
+# pylint: enable=too-few-public-methods
+
+
+# pylint: disable=too-many-instance-attributes
+class CommandPipeline(object):
+    """
+    Queue of console commands for a server with their responses
+    """
+
+    def __init__(self, server, loop=None):
+        """
+        Setup the pipeline of a server, its tasks start with the first command
+        """
+
+        self.server = server
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.batches = 0
+        self.completed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self._queue = collections.deque()
+        self._queued = asyncio.Event()
+        self._pending = collections.deque()
+        self._written = collections.deque()
+        self._subscriber = None
+        self._tasks = []
+        self._rcon = None
+
+    def start(self):
+        """
+        Start the writer and reader tasks if they are not running
+        """
+
+        if self._tasks:
+            return
+
+        self._subscriber = self.server.console.subscribe(
+            mcadminpanel.agent.logstream.QueueSubscriber(),
+        )
+        self._tasks = [
+            asyncio.ensure_future(self._write(), loop=self.loop),
+            asyncio.ensure_future(self._read(), loop=self.loop),
+        ]
+
+    async def close(self):
+        """
+        Stop the tasks and fail every command still waiting
+        """
+
+        if self._rcon is not None:
+            await self._rcon.close()
+            self._rcon = None
+
+        if not self._tasks:
+            return
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.wait(self._tasks)
+        self._tasks = []
+
+        self.server.console.unsubscribe(self._subscriber)
+        self._subscriber = None
+
+        for entry in list(self._queue) + list(self._pending):
+            self._fail(entry, 'Server {} stopped'.format(self.server.name))
+        self._queue.clear()
+        self._pending.clear()
+        self._written.clear()
+
+    def submit(self, command, pattern=None):
+        """
+        Queue a command and return a future of its result.
+
+        The command is answered by the first console line matching the
+        pattern, a compiled bytes pattern, or the known response of the
+        command when no pattern is given.
+        """
+
+        if '\n' in command or '\r' in command:
+            raise mcadminpanel.agent.errors.ServerError(
+                'Console commands must be a single line',
+            )
+
+        self.server.check_console()
+        self.start()
+
+        entry = PendingCommand(
+            command,
+            pattern if pattern is not None else response_pattern(command),
+            self.loop.create_future(),
+            self.loop.time(),
+        )
+        self._queue.append(entry)
+        self._queued.set()
+
+        return entry.future
+
+    async def execute(self, command, pattern=None, timeout=None):
+        """
+        Run a command and wait for its result, the response line and how
+        long the command waited in the queue and for its response
+        """
+
+        if timeout is None:
+            timeout = self.server.command_timeout
+
+        if self.server.process is None and self.server.rcon_conf is not None:
+            future = self._execute_rcon(command)
+        else:
+            future = self.submit(command, pattern)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise mcadminpanel.agent.errors.ServerError(
+                'Server {} did not answer {} within {}s'.format(
+                    self.server.name,
+                    command,
+                    timeout,
+                ),
+            )
+
+    def stats(self):
+        """
+        Counters of the pipeline
+        """
+
+        stats = {
+            'queued': len(self._queue),
+            'pending': len(self._pending),
+            'batches': self.batches,
+            'completed': self.completed,
+            'mean_latency': self.total_latency / self.completed if self.completed else None,
+            'max_latency': self.max_latency,
+        }
+        if self._rcon is not None:
+            stats['rcon'] = self._rcon.stats()
+
+        return stats
+
+    def rcon(self):
+        """
+        The RCON connection pool of the server, replaced when the server's
+        RCON configuration changes
+        """
+
+        if self._rcon is not None and self._rcon.conf != self.server.rcon_conf:
+            asyncio.ensure_future(self._rcon.close(), loop=self.loop)
+            self._rcon = None
+
+        if self._rcon is None:
+            self._rcon = mcadminpanel.agent.rcon.RconPool(self.server.rcon_conf, loop=self.loop)
+
+        return self._rcon
+
+    def _fail(self, entry, message):
+        if not entry.future.done():
+            entry.future.set_exception(mcadminpanel.agent.errors.ServerError(message))
+
+    def _record(self, latency):
+        self.completed += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def _resolve(self, entry, line):
+        if entry.future.done():
+            return
+
+        latency = self.loop.time() - entry.sent
+        self._record(latency)
+
+        entry.future.set_result({
+            'command': entry.command,
+            'response': line.decode('utf-8', 'replace').rstrip() if line is not None else None,
+            'queued': entry.sent - entry.queued,
+            'latency': latency,
+        })
+
+    async def _execute_rcon(self, command):
+        started = self.loop.time()
+        response = await self.rcon().execute(command)
+        latency = self.loop.time() - started
+
+        if UNKNOWN.search(response.encode('utf-8')):
+            raise mcadminpanel.agent.errors.ServerError(
+                'Server {} did not understand {}: {}'.format(self.server.name, command, response),
+            )
+
+        self._record(latency)
+
+        return {
+            'command': command,
+            'response': response,
+            'queued': 0.0,
+            'latency': latency,
+        }
+
+    async def _write(self):
+        while True:
+            while not self._queue:
+                self._queued.clear()
+                await self._queued.wait()
+
+            batch = self._take_batch()
+            if batch:
+                await self._send(batch)
+
+    def _take_batch(self):
+        batch = []
+        while self._queue and len(batch) < self.server.command_batch_size:
+            entry = self._queue.popleft()
+            if not entry.future.done():
+                batch.append(entry)
+
+        return batch
+
+    async def _send(self, batch):
+        process = self.server.process
+        if process is None or process.returncode is not None:
+            for entry in batch:
+                self._fail(entry, 'Server {} is not running'.format(self.server.name))
+            return
+
+        sent = self.loop.time()
+        self._forget(sent - self.server.command_timeout)
+        for entry in batch:
+            entry.sent = sent
+            self._written.append(entry)
+            if entry.pattern is not None:
+                self._pending.append(entry)
+
+        try:
+            process.stdin.write(b''.join(
+                entry.command.encode('utf-8') + b'\n'
+                for entry in batch
+            ))
+            await process.stdin.drain()
+        except OSError as ex:
+            for entry in batch:
+                self._fail(entry, 'Unable to write to server {}: {}'.format(
+                    self.server.name,
+                    ex,
+                ))
+            return
+
+        self.batches += 1
+        for entry in batch:
+            if entry.pattern is None:
+                self._resolve(entry, None)
+
+    async def _read(self):
+        while True:
+            batch = await self._subscriber.get()
+            if not batch:
+                return
+
+            for channel, line in batch:
+                if channel != 'agent':
+                    self._match(line)
+
+    def _match(self, line):
+        while self._pending and self._pending[0].future.done():
+            self._pending.popleft()
+        if not self._pending and not self._written:
+            return
+
+        for entry in self._pending:
+            if not entry.future.done() and entry.pattern.search(line):
+                self._pending.remove(entry)
+                # The server answers in order, every command before this one
+                # was already handled
+                while self._written and self._written.popleft() is not entry:
+                    pass
+                self._resolve(entry, line)
+                return
+
+        if UNKNOWN.search(line):
+            self._unknown(line)
+
+    def _forget(self, before):
+        # Commands without a response pattern are done once written and
+        # never answered, they are assumed handled after the command timeout
+        while self._written and self._written[0].future.done() and self._written[0].sent < before:
+            self._written.popleft()
+
+    def _unknown(self, line):
+        # Done commands can no longer fail, the oldest command still waiting
+        # is the one the server did not understand
+        while self._written and self._written[0].future.done():
+            self._written.popleft()
+        if not self._written:
+            return
+
+        entry = self._written.popleft()
+        if entry in self._pending:
+            self._pending.remove(entry)
+
+        self._fail(entry, 'Server {} did not understand {}: {}'.format(
+            self.server.name,
+            entry.command,
+            line.decode('utf-8', 'replace').rstrip(),
+        ))
+# pylint: enable=too-many-instance-attributes
+
@@ -7,6 +7,314 @@ import json
 import os.path
 
 import mcadminpanel.agent.errors
+import mcadminpanel.agent.schema
+
+from mcadminpanel.agent.schema import (
+    REQUIRED,
+    Boolean,
+    Integer,
+    ListOf,
+    MappingOf,
+    Number,
+    Optional,
+    Scalar,
+    Section,
+    SectionOf,
+    String,
+)
+
+LOG_LEVELS = ('critical', 'fatal', 'error', 'warning', 'warn', 'info', 'debug', 'notset')
+
+EVENT_LOOPS = ('auto', 'uvloop', 'asyncio')
+
+COPY_METHODS = ('auto', 'reflink', 'copy_file_range', 'copy')
+
+class LoggingConfig(Section):
+    """
+    Logging options of the agent
+    """
+
+    __slots__ = ('level', 'file', 'date_format', 'format', 'queue_size')
+
+    FIELDS = (
+        ('level', String(choices=LOG_LEVELS), REQUIRED),
+        ('file', String(), REQUIRED),
+        ('date_format', String(), REQUIRED),
+        ('format', String(), REQUIRED),
+        ('queue_size', Integer(minimum=1), REQUIRED),
+    )
+
+class SupervisorConfig(Section):
+    """
+    Restart, shutdown and console command options for the server processes
+    """
+
+    __slots__ = (
+        'restart_delay', 'max_restart_delay', 'reset_after',
+        'stop_commands', 'stop_timeout', 'command_timeout', 'command_batch_size',
+        'cgroup_root', 'cds_archives',
+    )
+
+    FIELDS = (
+        ('restart_delay', Number(minimum=0), REQUIRED),
+        ('max_restart_delay', Number(minimum=0), REQUIRED),
+        ('reset_after', Number(minimum=0), REQUIRED),
+        ('stop_commands', ListOf(String()), REQUIRED),
+        ('stop_timeout', Number(minimum=0), REQUIRED),
+        ('command_timeout', Number(minimum=0), REQUIRED),
+        ('command_batch_size', Integer(minimum=1), REQUIRED),
+        ('cgroup_root', Optional(String()), REQUIRED),
+        ('cds_archives', Optional(String()), REQUIRED),
+    )
+
+class MetricsConfig(Section):
+    """
+    Resource sampling options
+    """
+
+    __slots__ = ('interval', 'history')
+
+    FIELDS = (
+        ('interval', Number(minimum=0.1), REQUIRED),
+        ('history', Integer(minimum=1), REQUIRED),
+    )
+
+class ConsoleConfig(Section):
+    """
+    Server console streaming options
+    """
+
+    __slots__ = ('file', 'queue_size')
+
+    FIELDS = (
+        ('file', Optional(String()), REQUIRED),
+        ('queue_size', Integer(minimum=1), REQUIRED),
+    )
+
+class APIConfig(Section):
+    """
+    Control API options
+    """
+
+    __slots__ = ('socket', 'host', 'port', 'token', 'max_pending')
+
+    FIELDS = (
+        ('socket', Optional(String()), REQUIRED),
+        ('host', Optional(String()), REQUIRED),
+        ('port', Optional(Integer(minimum=0, maximum=65535)), REQUIRED),
+        ('token', Optional(String()), REQUIRED),
+        ('max_pending', Integer(minimum=1), REQUIRED),
+    )
+
+class WatchConfig(Section):
+    """
+    Configuration file watching options
+    """
+
+    __slots__ = ('enabled', 'poll_interval')
+
+    FIELDS = (
+        ('enabled', Boolean(), REQUIRED),
+        ('poll_interval', Number(minimum=0.1), REQUIRED),
+    )
+
+class BackupConfig(Section):
+    """
+    World backup options
+    """
+
+    __slots__ = ('path', 'chunk_size', 'workers', 'rate_limit', 'save_timeout')
+
+    FIELDS = (
+        ('path', String(), REQUIRED),
+        ('chunk_size', Integer(minimum=4096), REQUIRED),
+        ('workers', Integer(minimum=1), REQUIRED),
+        ('rate_limit', Optional(Number(minimum=1)), REQUIRED),
+        ('save_timeout', Number(minimum=0), REQUIRED),
+    )
+
+class JournalConfig(Section):
+    """
+    Event journal options
+    """
+
+    __slots__ = ('file', 'block_size', 'flush_interval')
+
+    FIELDS = (
+        ('file', Optional(String()), REQUIRED),
+        ('block_size', Integer(minimum=4096, maximum=16 * 1024 * 1024), REQUIRED),
+        ('flush_interval', Number(minimum=0.1), REQUIRED),
+    )
+
+class MonitorConfig(Section):
+    """
+    Event loop instrumentation options
+    """
+
+    __slots__ = (
+        'enabled', 'heartbeat_interval', 'slow_callback',
+        'task_cpu', 'profile_interval',
+    )
+
+    FIELDS = (
+        ('enabled', Boolean(), REQUIRED),
+        ('heartbeat_interval', Number(minimum=0.01), REQUIRED),
+        ('slow_callback', Number(minimum=0.01), REQUIRED),
+        ('task_cpu', Boolean(), REQUIRED),
+        ('profile_interval', Number(minimum=0.001), REQUIRED),
+    )
+
+class WorkersConfig(Section):
+    """
+    Options for running the agent as several worker processes
+    """
+
+    __slots__ = ('count', 'connect_timeout')
+
+    FIELDS = (
+        ('count', Integer(minimum=0), REQUIRED),
+        ('connect_timeout', Number(minimum=0.1), REQUIRED),
+    )
+
+class RegionsConfig(Section):
+    """
+    World region file analysis options
+    """
+
+    __slots__ = ('cache', 'processes', 'oversized_chunk')
+
+    FIELDS = (
+        ('cache', Optional(String()), REQUIRED),
+        ('processes', Integer(minimum=0), REQUIRED),
+        ('oversized_chunk', Integer(minimum=4096), REQUIRED),
+    )
+
+class ArtifactsConfig(Section):
+    """
+    Server jar and plugin store options
+    """
+
+    __slots__ = ('path', 'max_size', 'patterns')
+
+    FIELDS = (
+        ('path', String(), REQUIRED),
+        ('max_size', Optional(Integer(minimum=0)), REQUIRED),
+        ('patterns', ListOf(String()), REQUIRED),
+    )
+
+class ProvisionConfig(Section):
+    """
+    Options for creating servers from templates
+    """
+
+    __slots__ = ('templates', 'method', 'workers')
+
+    FIELDS = (
+        ('templates', String(), REQUIRED),
+        ('method', String(choices=COPY_METHODS), REQUIRED),
+        ('workers', Integer(minimum=1), REQUIRED),
+    )
+
+class HibernationConfig(Section):
+    """
+    Options for stopping idle servers until a player joins
+    """
+
+    __slots__ = ('enabled', 'idle_timeout', 'poll_interval', 'timeout', 'message')
+
+    FIELDS = (
+        ('enabled', Boolean(), REQUIRED),
+        ('idle_timeout', Number(minimum=0), REQUIRED),
+        ('poll_interval', Number(minimum=0.1), REQUIRED),
+        ('timeout', Number(minimum=0.1), REQUIRED),
+        ('message', String(), REQUIRED),
+    )
+
+class RconConfig(Section):
+    """
+    RCON access to a server
+    """
+
+    __slots__ = ('host', 'port', 'password', 'pool_size', 'keepalive', 'timeout')
+
+    FIELDS = (
+        ('host', String(), '127.0.0.1'),
+        ('port', Integer(minimum=1, maximum=65535), REQUIRED),
+        ('password', String(), REQUIRED),
+        ('pool_size', Integer(minimum=1), 2),
+        ('keepalive', Number(minimum=1), 30),
+        ('timeout', Number(minimum=0.1), 10),
+    )
+
+class LimitsConfig(Section):
+    """
+    Resource limits of a server
+    """
+
+    __slots__ = ('cpu_weight', 'cpu_quota', 'memory_max', 'io_weight')
+
+    FIELDS = (
+        ('cpu_weight', Optional(Integer(minimum=1, maximum=10000)), None),
+        ('cpu_quota', Optional(Number(minimum=0.01)), None),
+        ('memory_max', Optional(Integer(minimum=1024 * 1024)), None),
+        ('io_weight', Optional(Integer(minimum=1, maximum=10000)), None),
+    )
+
+class ServerConfig(Section):
+    """
+    A managed server
+    """
+
+    __slots__ = (
+        'command', 'directory', 'autostart', 'stop_commands', 'stop_timeout', 'rcon',
+        'limits', 'template', 'properties', 'hibernate',
+    )
+
+    FIELDS = (
+        ('command', ListOf(String(), min_length=1), REQUIRED),
+        ('directory', Optional(String()), None),
+        ('autostart', Boolean(), True),
+        ('stop_commands', Optional(ListOf(String())), None),
+        ('stop_timeout', Optional(Number(minimum=0)), None),
+        ('rcon', Optional(SectionOf(RconConfig)), None),
+        ('limits', Optional(SectionOf(LimitsConfig)), None),
+        ('template', Optional(String()), None),
+        ('properties', Optional(MappingOf(Scalar())), None),
+        ('hibernate', Optional(Boolean()), None),
+    )
+
+class AgentConfig(Section):
+    """
+    All of the agent options
+    """
+
+    __slots__ = (
+        'root', 'pidfile', 'statefile', 'event_loop', 'logging', 'supervisor', 'metrics',
+        'console', 'api', 'watch', 'backup', 'journal', 'monitor', 'workers', 'regions',
+        'artifacts', 'provision', 'hibernation', 'servers',
+    )
+
+    FIELDS = (
+        ('root', String(), REQUIRED),
+        ('pidfile', String(), REQUIRED),
+        ('statefile', Optional(String()), REQUIRED),
+        ('event_loop', String(choices=EVENT_LOOPS), REQUIRED),
+        ('logging', SectionOf(LoggingConfig), REQUIRED),
+        ('supervisor', SectionOf(SupervisorConfig), REQUIRED),
+        ('metrics', SectionOf(MetricsConfig), REQUIRED),
+        ('console', SectionOf(ConsoleConfig), REQUIRED),
+        ('api', SectionOf(APIConfig), REQUIRED),
+        ('watch', SectionOf(WatchConfig), REQUIRED),
+        ('backup', SectionOf(BackupConfig), REQUIRED),
+        ('journal', SectionOf(JournalConfig), REQUIRED),
+        ('monitor', SectionOf(MonitorConfig), REQUIRED),
+        ('workers', SectionOf(WorkersConfig), REQUIRED),
+        ('regions', SectionOf(RegionsConfig), REQUIRED),
+        ('artifacts', SectionOf(ArtifactsConfig), REQUIRED),
+        ('provision', SectionOf(ProvisionConfig), REQUIRED),
+        ('hibernation', SectionOf(HibernationConfig), REQUIRED),
+        ('servers', MappingOf(SectionOf(ServerConfig)), REQUIRED),
+    )
 
 # pylint: disable=too-few-public-methods
 class Configuration(object):
@@ -26,6 +334,10 @@ class Configuration(object):
         'pidfile': os.path.expanduser(
             os.path.join('~', 'mcadminpanel', 'agent.pid')
         ),
+        'statefile': os.path.expanduser(
+            os.path.join('~', 'mcadminpanel', 'agent.state')
+        ),
+        'event_loop': 'auto',
         'logging': {
             'level': 'warn',
             'file': os.path.expanduser(
@@ -33,9 +345,100 @@ class Configuration(object):
             ),
             'date_format': '%m-%d-%Y %H:%M:%S',
             'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        }
+            'queue_size': 10000,
+        },
+        'supervisor': {
+            'restart_delay': 1,
+            'max_restart_delay': 300,
+            'reset_after': 600,
+            'stop_commands': ['save-all', 'stop'],
+            'stop_timeout': 60,
+            'command_timeout': 10,
+            'command_batch_size': 64,
+            'cgroup_root': None,
+            'cds_archives': None,
+        },
+        'metrics': {
+            'interval': 5,
+            'history': 720,
+        },
+        'console': {
+            'file': 'console.log',
+            'queue_size': 10000,
+        },
+        'api': {
+            'socket': os.path.expanduser(
+                os.path.join('~', 'mcadminpanel', 'agent.sock')
+            ),
+            'host': '127.0.0.1',
+            'port': None,
+            'token': None,
+            'max_pending': 64,
+        },
+        'watch': {
+            'enabled': True,
+            'poll_interval': 2,
+        },
+        'backup': {
+            'path': os.path.expanduser(
+                os.path.join('~', 'mcadminpanel', 'backups')
+            ),
+            'chunk_size': 1024 * 1024,
+            'workers': 4,
+            'rate_limit': 64 * 1024 * 1024,
+            'save_timeout': 60,
+        },
+        'journal': {
+            'file': os.path.expanduser(
+                os.path.join('~', 'mcadminpanel', 'events.journal')
+            ),
+            'block_size': 64 * 1024,
+            'flush_interval': 1,
+        },
+        'monitor': {
+            'enabled': True,
+            'heartbeat_interval': 0.5,
+            'slow_callback': 0.1,
+            'task_cpu': False,
+            'profile_interval': 0.005,
+        },
+        'workers': {
+            'count': 1,
+            'connect_timeout': 10,
+        },
+        'regions': {
+            'cache': os.path.expanduser(
+                os.path.join('~', 'mcadminpanel', 'regions.cache')
+            ),
+            'processes': 0,
+            'oversized_chunk': 256 * 1024,
+        },
+        'artifacts': {
+            'path': os.path.expanduser(
+                os.path.join('~', 'mcadminpanel', 'artifacts')
+            ),
+            'max_size': 4 * 1024 * 1024 * 1024,
+            'patterns': ['*.jar', 'plugins/*.jar', 'mods/*.jar', 'libraries/**/*.jar'],
+        },
+        'provision': {
+            'templates': os.path.expanduser(
+                os.path.join('~', 'mcadminpanel', 'templates')
+            ),
+            'method': 'auto',
+            'workers': 8,
+        },
+        'hibernation': {
+            'enabled': False,
+            'idle_timeout': 900,
+            'poll_interval': 30,
+            'timeout': 5,
+            'message': 'The server is starting, join again in a minute',
+        },
+        'servers': {},
     }
 
+    __slots__ = ('path', '_raw', '_merged') + AgentConfig.__slots__
+
     def __init__(self, config_file=None):
         """
         Load configuration settings from the specified configuration file
@@ -44,22 +447,55 @@ class Configuration(object):
         if config_file is None:
             config_file = Configuration.DEFAULT_CONFIG_FILE
 
-        try:
-            with open(config_file, 'r') as config:
-                self._config = self._get_config(config)
-        except json.JSONDecodeError:
-            raise mcadminpanel.agent.errors.ConfigurationError(
-                'Unable to parse configuration. Invalid JSON',
-            )
-        except IOError as ex:
-            raise mcadminpanel.agent.errors.ConfigurationError(
-                'Unable to open and read configuration file: {}'.format(
-                    str(ex)
-                ),
-            )
+        self.path = config_file
+        self._raw = self._read(config_file)
+        self._merged = merge(self.DEFAULTS, self._raw)
+
+        values = AgentConfig.build(self._merged)
+        for name in values:
+            setattr(self, name, values[name])
 
     def __getattr__(self, name):
-        return self._config.get(name)
+        raise AttributeError('Unknown configuration option: {}'.format(name))
+
+    def reload(self):
+        """
+        Reload the configuration file in place.
+
+        Only the top level sections that changed in the file are merged with
+        their defaults and validated again. Nothing is changed if the new
+        file is invalid. Returns the paths of every changed value as tuples
+        of keys, such as ('servers', 'survival', 'command').
+        """
+
+        raw = self._read(self.path)
+
+        fields = dict((name, validator) for name, validator, _ in AgentConfig.FIELDS)
+        for key in sorted(set(raw) - set(fields)):
+            mcadminpanel.agent.schema.Validator.fail(key, 'unknown option')
+
+        changes = []
+        updates = {}
+        for key in sorted(set(raw) | set(self._raw)):
+            if key in raw and key in self._raw and raw[key] == self._raw[key]:
+                continue
+
+            value = self.DEFAULTS[key]
+            if key in raw:
+                value = merge({key: value}, {key: raw[key]})[key]
+
+            updates[key] = (value, fields[key](value, key))
+            changes.extend(diff(self._merged[key], value, (key,)))
+
+        merged = dict(self._merged)
+        for key, (value, section) in updates.items():
+            merged[key] = value
+            setattr(self, key, section)
+
+        self._raw = raw
+        self._merged = merged
+
+        return changes
 
     @classmethod
     def save_default_config(cls, path):
@@ -70,28 +506,59 @@ class Configuration(object):
         with open(path, 'w') as file_stream:
             json.dump(cls.DEFAULTS, file_stream, indent=4)
 
-    @classmethod
-    def _get_config(cls, raw_config):
-        config = json.load(raw_config)
-
-        return merge(cls.DEFAULTS, config)
+    @staticmethod
+    def _read(config_file):
+        try:
+            with open(config_file, 'r') as config:
+                return json.load(config)
+        except json.JSONDecodeError:
+            raise mcadminpanel.agent.errors.ConfigurationError(
+                'Unable to parse configuration. Invalid JSON',
+            )
+        except IOError as ex:
+            raise mcadminpanel.agent.errors.ConfigurationError(
+                'Unable to open and read configuration file: {}'.format(
+                    str(ex)
+                ),
+            )
 
 # pylint: enable=too-few-public-methods
 
 def merge(obj, overrides, clone=True):
     """
-    Recursively merge to dictionaries
+    Recursively merge to dictionaries.
+
+    Neither dictionary is modified, the result is a deep copy that shares
+    no value with them.
     """
 
     result = copy.deepcopy(obj) if clone else obj
 
     for key, value in overrides.items():
-        if key not in result:
-            result[key] = value
-        elif not isinstance(value, dict) and not isinstance(result[key], dict):
-            result[key] = value
-        elif isinstance(value, dict) and isinstance(result[key], dict):
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
             merge(result[key], value, False)
+        else:
+            result[key] = copy.deepcopy(value)
 
     return result
 
+def diff(old, new, path=()):
+    """
+    The paths of the values that differ between two configuration trees
+    """
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in sorted(set(old) | set(new)):
+            if key not in old or key not in new:
+                changes.append(path + (key,))
+            elif old[key] != new[key]:
+                changes.extend(diff(old[key], new[key], path + (key,)))
+
+        return changes
+
+    if old != new:
+        return [path]
+
+    return []
+
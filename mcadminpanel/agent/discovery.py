@@ -0,0 +1,191 @@
+"""
+Adoption of server processes that outlived the agent.
+
+A state file records the process of every running server. After a restart
+the agent first checks the recorded processes, which only reads a few proc
+entries each, and then scans the host for the servers that are still
+missing. The scan only asks for the name of every process and reads the
+working directory and command line of the processes named like a server's
+executable, so it stays cheap on hosts with thousands of processes.
+"""
+
+import json
+import logging
+import os
+import os.path
+
+import psutil
+
+import mcadminpanel.agent.backup
+import mcadminpanel.agent.cds
+
+# Process names are truncated by the kernel
+MAX_NAME = 15
+
+def same_command(command, cmdline):
+    """
+    Whether a process command line runs a server command, the executable
+    may have been resolved to a full path and class data sharing options
+    may have been added
+    """
+
+    command = mcadminpanel.agent.cds.without_options(command)
+    cmdline = mcadminpanel.agent.cds.without_options(cmdline)
+
+    return (
+        len(cmdline) == len(command) and
+        cmdline[1:] == command[1:] and
+        os.path.basename(cmdline[0]) == os.path.basename(command[0])
+    )
+
+def matches(server, cwd, cmdline):
+    """
+    Whether a process with the given working directory and command line is
+    a server
+    """
+
+    if not cwd or not cmdline:
+        return False
+
+    return (
+        os.path.realpath(cwd) == os.path.realpath(server.directory) and
+        same_command(server.command, cmdline)
+    )
+
+def check_recorded(server, entry):
+    """
+    The recorded process of a server if it is still the same process
+    """
+
+    try:
+        process = psutil.Process(entry['pid'])
+        if process.create_time() != entry['create_time']:
+            return None
+        if not matches(server, process.cwd(), process.cmdline()):
+            return None
+    except (psutil.Error, KeyError, TypeError):
+        return None
+
+    return process
+
+def scan(servers):
+    """
+    Find the processes of servers by scanning the processes of the host
+    """
+
+    missing = dict(servers)
+    names = set(
+        os.path.basename(server.command[0])[:MAX_NAME]
+        for server in missing.values()
+    )
+
+    found = {}
+    for process in psutil.process_iter(attrs=['name']):
+        if process.info['name'] not in names or process.pid == os.getpid():
+            continue
+
+        try:
+            cwd = process.cwd()
+            cmdline = process.cmdline()
+        except psutil.Error:
+            continue
+
+        for name, server in missing.items():
+            if matches(server, cwd, cmdline):
+                found[name] = process
+                del missing[name]
+                break
+
+        if not missing:
+            break
+
+    return found
+
+def discover(servers, state):
+    """
+    Find the processes of the servers that are not running under the
+    agent, checking the recorded processes before scanning the host
+    """
+
+    candidates = {
+        name: server
+        for name, server in servers.items()
+        if not server.running
+    }
+
+    found = {}
+    for name, entry in state.items():
+        server = candidates.get(name)
+        if server is None:
+            continue
+
+        process = check_recorded(server, entry)
+        if process is not None:
+            found[name] = process
+            del candidates[name]
+
+    if candidates:
+        found.update(scan(candidates))
+
+    return found
+
+
+class StateFile(object):
+    """
+    The processes of the running servers, kept on disk for the next agent
+    """
+
+    def __init__(self, path):
+        """
+        Setup the state file at the given path
+        """
+
+        self.path = path
+        self.servers = {}
+
+    def load(self):
+        """
+        Read the recorded processes, a missing or damaged file is empty
+        """
+
+        try:
+            with open(self.path, 'r') as state_file:
+                self.servers = json.load(state_file)['servers']
+        except FileNotFoundError:
+            self.servers = {}
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            logging.warning('Ignoring unreadable state file %s: %s', self.path, ex)
+            self.servers = {}
+
+        return dict(self.servers)
+
+    def save(self):
+        """
+        Write the recorded processes
+        """
+
+        mcadminpanel.agent.backup.write_json(self.path, {'servers': self.servers})
+
+    def server_event(self, name, event, data):
+        """
+        Supervisor listener recording the process of started servers and
+        forgetting the servers that exited
+        """
+
+        if event == 'start':
+            try:
+                create_time = psutil.Process(data['pid']).create_time()
+            except psutil.Error:
+                return
+            self.servers[name] = {'pid': data['pid'], 'create_time': create_time}
+        elif event in ('stop', 'crash'):
+            if self.servers.pop(name, None) is None:
+                return
+        else:
+            return
+
+        try:
+            self.save()
+        except OSError as ex:
+            logging.warning('Unable to write state file %s: %s', self.path, ex)
+
@@ -12,3 +12,52 @@ class ConfigurationError(MCAdminPanelError):
     A configuration error in the application
     """
 
+class SchemaError(ConfigurationError):
+    """
+    An invalid configuration value
+    """
+
+    def __init__(self, path, message):
+        super(SchemaError, self).__init__('{}: {}'.format(path, message))
+
+        self.path = path
+
+class ServerError(MCAdminPanelError):
+    """
+    An error managing one of the servers
+    """
+
+class RconError(ServerError):
+    """
+    An error talking to a server over RCON
+    """
+
+class APIError(MCAdminPanelError):
+    """
+    An error handling a request to the agent API
+    """
+
+class BackupError(MCAdminPanelError):
+    """
+    An error backing up or restoring a server
+    """
+
+class JournalError(MCAdminPanelError):
+    """
+    An error writing or reading the event journal
+    """
+
+class ArtifactError(MCAdminPanelError):
+    """
+    An error storing or placing a server artifact
+    """
+
+class ProvisionError(MCAdminPanelError):
+    """
+    An error creating a server from a template
+    """
+
+class HibernationError(MCAdminPanelError):
+    """
+    An error hibernating a server or speaking to a Minecraft client
+    """
@@ -0,0 +1,61 @@
+"""
+Selection of the event loop implementation the agent runs on.
+
+uvloop handles the many server pipes and API connections of a node with a
+lot less overhead than the loop of the standard library. It is optional,
+the auto backend uses it when it is installed and falls back to the
+standard library loop otherwise.
+"""
+
+import asyncio
+import importlib
+import logging
+
+import mcadminpanel.agent.errors
+
+def loop_policy(backend):
+    """
+    The event loop policy of a backend and the name of the backend it
+    resolved to, the policy is None for the standard library loop
+    """
+
+    if backend == 'asyncio':
+        return None, 'asyncio'
+
+    try:
+        uvloop = importlib.import_module('uvloop')
+    except ImportError:
+        if backend == 'uvloop':
+            raise mcadminpanel.agent.errors.ConfigurationError(
+                'The uvloop event loop backend is not installed',
+            )
+
+        return None, 'asyncio'
+
+    return uvloop.EventLoopPolicy(), 'uvloop'
+
+def setup_event_loop(backend):
+    """
+    Install the event loop policy of a backend and return the event loop of
+    the current thread
+    """
+
+    policy, name = loop_policy(backend)
+    if policy is not None:
+        asyncio.set_event_loop_policy(policy)
+
+    logging.debug('Using the %s event loop', name)
+
+    return asyncio.get_event_loop()
+
+def new_event_loop(backend):
+    """
+    Create a new event loop of a backend without changing the policy
+    """
+
+    policy, _ = loop_policy(backend)
+    if policy is None:
+        return asyncio.new_event_loop()
+
+    return policy.new_event_loop()
+
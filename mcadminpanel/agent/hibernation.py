@@ -0,0 +1,543 @@
+"""
+Hibernation of idle servers.
+
+An empty server still holds gigabytes of memory. Servers that had no
+players for the idle timeout are stopped and the agent listens on their port
+in their place, speaking just enough of the Minecraft protocol:
+
+* status pings of the server list are answered with the status the server
+  gave before it was stopped, so it is still listed with its MOTD,
+* a login wakes the server up and tells the player to join again once it is
+  ready.
+
+Packets are a VarInt length followed by a VarInt packet id and the packet
+data. Every connection starts with a handshake saying whether the client
+wants the status of the server or to log in. The listener is closed as soon
+as the server is started again, by a login or otherwise, so the server can
+bind its port.
+"""
+
+import asyncio
+import json
+import logging
+import struct
+import time
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.provision
+
+# Packet ids of the handshake, status and login states
+HANDSHAKE = 0x00
+STATUS_REQUEST = 0x00
+STATUS_RESPONSE = 0x00
+PING = 0x01
+LOGIN_START = 0x00
+LOGIN_DISCONNECT = 0x00
+
+# States a handshake asks for
+STATE_STATUS = 1
+STATE_LOGIN = 2
+
+# Protocol version sent by clients only asking for the status
+PROTOCOL_ANY = -1
+
+# Largest packet accepted from a client
+MAX_PACKET = 32767
+
+DEFAULT_PORT = 25565
+
+PORT = struct.Struct('>H')
+
+# Version shown for servers that did not give their status before hibernating
+HIBERNATING_VERSION = 'Hibernating'
+
+def encode_varint(value):
+    """
+    Encode a VarInt, negative values take five bytes
+    """
+
+    value &= 0xffffffff
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+def decode_varint(data, offset=0):
+    """
+    Decode a VarInt and return its value and the offset after it
+    """
+
+    value = 0
+    for shift in range(0, 35, 7):
+        if offset >= len(data):
+            raise mcadminpanel.agent.errors.HibernationError('Truncated VarInt')
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            if value >= 1 << 31:
+                value -= 1 << 32
+            return value, offset
+
+    raise mcadminpanel.agent.errors.HibernationError('VarInt is too long')
+
+def encode_string(text):
+    """
+    Encode a length prefixed string
+    """
+
+    data = text.encode('utf-8')
+
+    return encode_varint(len(data)) + data
+
+def decode_string(data, offset=0):
+    """
+    Decode a length prefixed string and return it and the offset after it
+    """
+
+    length, offset = decode_varint(data, offset)
+    if offset + length > len(data):
+        raise mcadminpanel.agent.errors.HibernationError('Truncated string')
+
+    return data[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+def encode_packet(packet_id, payload=b''):
+    """
+    Encode a packet with its length prefix
+    """
+
+    body = encode_varint(packet_id) + payload
+
+    return encode_varint(len(body)) + body
+
+async def read_packet(reader):
+    """
+    Read the next packet and return its id and payload
+    """
+
+    length = 0
+    for shift in range(0, 35, 7):
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            break
+
+    if length < 1 or length > MAX_PACKET:
+        raise mcadminpanel.agent.errors.HibernationError(
+            'Invalid packet length {}'.format(length),
+        )
+
+    body = await reader.readexactly(length)
+    packet_id, offset = decode_varint(body)
+
+    return packet_id, body[offset:]
+
+def encode_handshake(host, port, state, protocol=PROTOCOL_ANY):
+    """
+    Encode the handshake of a client
+    """
+
+    return encode_packet(
+        HANDSHAKE,
+        encode_varint(protocol) + encode_string(host) + PORT.pack(port) + encode_varint(state),
+    )
+
+def decode_handshake(payload):
+    """
+    The protocol version and the state asked for by a handshake
+    """
+
+    protocol, offset = decode_varint(payload)
+    _, offset = decode_string(payload, offset)
+    state, _ = decode_varint(payload, offset + PORT.size)
+
+    return protocol, state
+
+async def ping_server(host, port):
+    """
+    Ask a server for its status the way the server list does
+    """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            encode_handshake(host, port, STATE_STATUS)
+            + encode_packet(STATUS_REQUEST)
+        )
+        await writer.drain()
+
+        packet_id, payload = await read_packet(reader)
+        if packet_id != STATUS_RESPONSE:
+            raise mcadminpanel.agent.errors.HibernationError(
+                'Unexpected packet {} instead of the status'.format(packet_id),
+            )
+
+        response, _ = decode_string(payload)
+    finally:
+        writer.close()
+
+    try:
+        return json.loads(response)
+    except ValueError:
+        raise mcadminpanel.agent.errors.HibernationError('Invalid status {}'.format(response))
+
+def server_address(properties):
+    """
+    The host and port a server listens on given its properties, the host is
+    None when it listens on every address
+    """
+
+    try:
+        port = int(properties.get('server-port') or DEFAULT_PORT)
+    except ValueError:
+        port = DEFAULT_PORT
+
+    return properties.get('server-ip') or None, port
+
+def idle_status(status, properties):
+    """
+    The status shown for a hibernating server, the status the server gave
+    without its players or a status made from its properties
+    """
+
+    if status is None:
+        try:
+            max_players = int(properties.get('max-players', 20))
+        except ValueError:
+            max_players = 20
+        status = {
+            'description': {'text': properties.get('motd', 'A Minecraft Server')},
+            'players': {'max': max_players},
+        }
+
+    status = dict(status)
+    status['players'] = dict(status.get('players') or {}, online=0)
+    status['players'].pop('sample', None)
+
+    return status
+
+
+# pylint: disable=too-many-instance-attributes
+class HibernationListener(object):
+    """
+    Stand in for a hibernating server, listening on its port
+    """
+
+    def __init__(self, hibernator, name, address, status):
+        """
+        Setup a listener for the named server, it is not listening
+        """
+
+        self.hibernator = hibernator
+        self.name = name
+        self.host, self.port = address
+        self.status = status
+        self.since = time.time()
+        self.pings = 0
+        self.logins = 0
+
+        self._server = None
+
+    async def start(self):
+        """
+        Start listening on the port of the server
+        """
+
+        self._server = await asyncio.start_server(
+            self._connection,
+            self.host,
+            self.port,
+            reuse_address=True,
+        )
+
+    def close(self):
+        """
+        Stop listening so the server can bind its port
+        """
+
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def describe(self):
+        """
+        A summary of the hibernation of the server
+        """
+
+        return {
+            'since': self.since,
+            'port': self.port,
+            'pings': self.pings,
+            'logins': self.logins,
+        }
+
+    async def _connection(self, reader, writer):
+        try:
+            await asyncio.wait_for(
+                self._handle(reader, writer),
+                self.hibernator.conf['timeout'],
+            )
+        except (
+                asyncio.IncompleteReadError,
+                asyncio.TimeoutError,
+                OSError,
+                mcadminpanel.agent.errors.HibernationError,
+        ) as ex:
+            logging.debug('Dropped a connection to hibernating server %s: %r', self.name, ex)
+        finally:
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        packet_id, payload = await read_packet(reader)
+        if packet_id != HANDSHAKE:
+            raise mcadminpanel.agent.errors.HibernationError(
+                'Expected a handshake, got packet {}'.format(packet_id),
+            )
+
+        protocol, state = decode_handshake(payload)
+        if state == STATE_STATUS:
+            await self._status(reader, writer, protocol)
+        elif state == STATE_LOGIN:
+            await self._login(reader, writer)
+
+    async def _status(self, reader, writer, protocol):
+        packet_id, _ = await read_packet(reader)
+        if packet_id != STATUS_REQUEST:
+            return
+
+        status = dict(self.status)
+        if 'version' not in status:
+            status['version'] = {'name': HIBERNATING_VERSION, 'protocol': protocol}
+
+        writer.write(encode_packet(STATUS_RESPONSE, encode_string(json.dumps(status))))
+        await writer.drain()
+        self.pings += 1
+
+        packet_id, payload = await read_packet(reader)
+        if packet_id == PING:
+            writer.write(encode_packet(PING, payload))
+            await writer.drain()
+
+    async def _login(self, reader, writer):
+        packet_id, payload = await read_packet(reader)
+        if packet_id != LOGIN_START:
+            return
+
+        player, _ = decode_string(payload)
+        message = json.dumps({'text': self.hibernator.conf['message']})
+        writer.write(encode_packet(LOGIN_DISCONNECT, encode_string(message)))
+        await writer.drain()
+        self.logins += 1
+
+        self.hibernator.wake(self.name, player)
+# pylint: enable=too-many-instance-attributes
+
+
+class Hibernator(object):
+    """
+    Stops the servers that stay empty and starts them again when a player
+    logs in
+    """
+
+    def __init__(self, supervisor, hibernation_conf, loop=None):
+        """
+        Setup hibernation of the servers of a supervisor
+        """
+
+        self.supervisor = supervisor
+        self.conf = hibernation_conf
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.listeners = {}
+        self.idle_since = {}
+
+        self._task = None
+
+    def start(self):
+        """
+        Start watching for idle servers in the background
+        """
+
+        if self._task is None or self._task.done():
+            self.supervisor.add_listener(self.server_event)
+            self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+        return self._task
+
+    async def stop(self):
+        """
+        Stop watching and close the listeners of the hibernating servers
+        """
+
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.wait([task])
+
+        for listener in self.listeners.values():
+            listener.close()
+        self.listeners.clear()
+
+    def enabled(self, server):
+        """
+        Whether a server hibernates when it is idle
+        """
+
+        if server.hibernate is not None:
+            return server.hibernate
+
+        return self.conf['enabled']
+
+    async def check(self):
+        """
+        Hibernate the servers that have been empty for the idle timeout and
+        return their names
+        """
+
+        now = time.monotonic()
+        idle = []
+
+        for name, server in sorted(self.supervisor.servers.items()):
+            if (
+                    not self.enabled(server)
+                    or server.state != server.RUNNING
+                    or server.process is None
+                    or server.start_requested is not None
+                    or server.log.online
+            ):
+                self.idle_since.pop(name, None)
+                continue
+
+            since = self.idle_since.setdefault(name, now)
+            if now - since >= self.conf['idle_timeout']:
+                idle.append(name)
+
+        hibernated = []
+        for name in idle:
+            try:
+                await self.hibernate(name)
+                hibernated.append(name)
+            except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+                logging.warning('Unable to hibernate server %s: %s', name, ex)
+
+        return hibernated
+
+    async def hibernate(self, name):
+        """
+        Stop a server once it is known to be empty and listen on its port
+        until a player logs in
+        """
+
+        server = self.supervisor.get(name)
+        if name in self.listeners:
+            return self.listeners[name].describe()
+        if server.state != server.RUNNING or server.process is None:
+            raise mcadminpanel.agent.errors.HibernationError(
+                'Server {} is not running under the agent'.format(name),
+            )
+
+        await server.commands.execute('list')
+        if server.log.online:
+            raise mcadminpanel.agent.errors.HibernationError(
+                'Server {} has {} players online'.format(name, len(server.log.online)),
+            )
+
+        properties = mcadminpanel.agent.provision.read_properties(server.directory)
+        address = server_address(properties)
+        try:
+            status = await asyncio.wait_for(
+                ping_server(address[0] or '127.0.0.1', address[1]),
+                self.conf['timeout'],
+            )
+        except (OSError, asyncio.TimeoutError, mcadminpanel.agent.errors.HibernationError):
+            status = None
+
+        await server.stop()
+        self.idle_since.pop(name, None)
+
+        listener = HibernationListener(self, name, address, idle_status(status, properties))
+        try:
+            await listener.start()
+        except OSError as ex:
+            server.start()
+            raise mcadminpanel.agent.errors.HibernationError(
+                'Unable to listen on port {}: {}'.format(address[1], ex),
+            )
+        self.listeners[name] = listener
+
+        logging.info('Server %s is hibernating on port %s', name, address[1])
+        server.notify('hibernate', port=address[1], cached_status=status is not None)
+
+        return listener.describe()
+
+    def wake(self, name, player=None):
+        """
+        Stop listening in place of a hibernating server and start it
+        """
+
+        listener = self.listeners.pop(name, None)
+        if listener is None:
+            raise mcadminpanel.agent.errors.HibernationError(
+                'Server {} is not hibernating'.format(name),
+            )
+        listener.close()
+
+        server = self.supervisor.get(name)
+        logging.info('Waking server %s up for %s', name, player or 'the agent')
+        server.notify('wake', player=player, hibernated=time.time() - listener.since)
+        server.start()
+
+        return server.describe()
+
+    def server_event(self, name, event, data): # pylint: disable=unused-argument
+        """
+        Supervisor listener releasing the port of hibernating servers that
+        were started some other way
+        """
+
+        if event == 'start' and name in self.listeners:
+            self.listeners.pop(name).close()
+
+    def api_routes(self):
+        """
+        The control API commands for hibernating servers
+        """
+
+        return {
+            'hibernation': self.api_hibernation,
+            'hibernate_server': self.api_hibernate_server,
+            'wake_server': self.api_wake_server,
+        }
+
+    def api_hibernation(self):
+        """
+        API command listing the hibernating servers
+        """
+
+        return {
+            name: listener.describe()
+            for name, listener in self.listeners.items()
+        }
+
+    async def api_hibernate_server(self, name):
+        """
+        API command hibernating an empty server now
+        """
+
+        return await self.hibernate(name)
+
+    def api_wake_server(self, name):
+        """
+        API command starting a hibernating server
+        """
+
+        return self.wake(name)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.conf['poll_interval'])
+            await self.check()
@@ -0,0 +1,604 @@
+"""
+Append only binary journal of server events.
+
+Server starts, stops and crashes, servers becoming ready, hibernating and
+waking up, players joining and leaving, lag spikes and metrics samples are
+written to the journal as length prefixed frames:
+
+    frame:  payload length (4 bytes), kind (1 byte), payload
+    event:  timestamp (double), event type (1 byte), server name length
+            (1 byte), server name, event data
+
+The file is split into fixed size blocks and a frame never crosses into the
+next block, the rest of a full block is padding. Every block after the first
+starts with an index frame describing the block before it: the first and
+last timestamps, the number of events and a bit mask of the servers in it.
+Readers binary search the index frames to find the blocks of a time range
+and skip the blocks without the wanted servers, reading only those blocks.
+The first block starts with a header frame holding the block size instead.
+
+Metrics samples are stored as packed doubles, the data of other events as
+compact JSON.
+"""
+
+import asyncio
+import contextlib
+import heapq
+import json
+import logging
+import math
+import os
+import os.path
+import struct
+import time
+import zlib
+
+import mcadminpanel.agent.errors
+
+MAGIC = b'MCJ1'
+
+FRAME = struct.Struct('>IB')
+HEADER = struct.Struct('>4sI')
+INDEX = struct.Struct('>ddIQ')
+EVENT = struct.Struct('>dBB')
+
+KIND_HEADER = 0
+KIND_EVENT = 1
+KIND_INDEX = 2
+KIND_PADDING = 3
+
+EVENT_TYPES = (
+    'start', 'stop', 'crash', 'join', 'leave', 'metrics', 'lag', 'ready', 'hibernate', 'wake',
+)
+
+EVENT_CODES = dict((event, code) for code, event in enumerate(EVENT_TYPES, 1))
+
+# The console log events that are recorded
+JOURNALED_LOG_EVENTS = ('join', 'leave', 'lag')
+
+# The metrics sampled by the agent, in the order of MetricsSampler.FIELDS
+METRIC_FIELDS = ('cpu_percent', 'rss', 'threads', 'fds', 'read_rate', 'write_rate')
+
+def encode_frame(kind, payload):
+    """
+    A frame holding the given payload
+    """
+
+    return FRAME.pack(len(payload), kind) + payload
+
+def server_bit(server):
+    """
+    The bit of a server in the server masks of the index frames
+    """
+
+    return 1 << (zlib.crc32(server.encode('utf-8')) % 64)
+
+def encode_event(timestamp, event, server, data=None):
+    """
+    Encode an event into a frame
+    """
+
+    code = EVENT_CODES.get(event)
+    if code is None:
+        raise mcadminpanel.agent.errors.JournalError('Unknown event: {}'.format(event))
+
+    name = server.encode('utf-8')
+    if len(name) > 255:
+        raise mcadminpanel.agent.errors.JournalError(
+            'Server name is too long: {}'.format(server),
+        )
+
+    if event == 'metrics':
+        values = [
+            math.nan if data.get(field) is None else data[field]
+            for field in METRIC_FIELDS
+        ]
+        body = struct.pack('>B{}d'.format(len(values)), len(values), *values)
+    elif data:
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    else:
+        body = b''
+
+    return encode_frame(
+        KIND_EVENT,
+        EVENT.pack(timestamp, code, len(name)) + name + body,
+    )
+
+def decode_event(payload):
+    """
+    Decode the payload of an event frame
+    """
+
+    timestamp, code, name_length = EVENT.unpack_from(payload)
+    name_end = EVENT.size + name_length
+    event = EVENT_TYPES[code - 1]
+    body = payload[name_end:]
+
+    if event == 'metrics':
+        count = body[0]
+        values = struct.unpack_from('>{}d'.format(count), body, 1)
+        data = {
+            field: None if math.isnan(value) else value
+            for field, value in zip(METRIC_FIELDS, values)
+        }
+    elif body:
+        data = json.loads(body.decode('utf-8'))
+    else:
+        data = {}
+
+    return {
+        'timestamp': timestamp,
+        'event': event,
+        'server': payload[EVENT.size:name_end].decode('utf-8'),
+        'data': data,
+    }
+
+def matches(event, start, end, servers, events):
+    """
+    Whether an event is in the time range and of one of the servers and
+    event types, None matches everything
+    """
+
+    return (
+        (start is None or event['timestamp'] >= start) and
+        (end is None or event['timestamp'] <= end) and
+        (servers is None or event['server'] in servers) and
+        (events is None or event['event'] in events)
+    )
+
+
+class JournalReader(object):
+    """
+    Reads the events of a journal, seeking to the blocks that are needed
+    """
+
+    def __init__(self, path):
+        """
+        Open a journal for reading
+        """
+
+        self.path = path
+        self._file = open(path, 'rb') # pylint: disable=consider-using-with
+
+        header = self._file.read(FRAME.size + HEADER.size)
+        if len(header) < FRAME.size + HEADER.size:
+            self.close()
+            raise mcadminpanel.agent.errors.JournalError(
+                'Not an event journal: {}'.format(path),
+            )
+
+        _, kind = FRAME.unpack_from(header)
+        magic, self.block_size = HEADER.unpack_from(header, FRAME.size)
+        if kind != KIND_HEADER or magic != MAGIC:
+            self.close()
+            raise mcadminpanel.agent.errors.JournalError(
+                'Not an event journal: {}'.format(path),
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close the journal file
+        """
+
+        self._file.close()
+
+    @property
+    def block_count(self):
+        """
+        The number of blocks in the journal, the last one may be partial
+        """
+
+        size = os.fstat(self._file.fileno()).st_size
+
+        return max(-(-size // self.block_size), 1)
+
+    def index(self, block):
+        """
+        The first and last timestamps, event count and server mask of a
+        block, or None for the last block which has no index yet
+        """
+
+        data = os.pread(
+            self._file.fileno(),
+            FRAME.size + INDEX.size,
+            (block + 1) * self.block_size,
+        )
+        if len(data) < FRAME.size + INDEX.size:
+            return None
+
+        _, kind = FRAME.unpack_from(data)
+        if kind != KIND_INDEX:
+            raise mcadminpanel.agent.errors.JournalError(
+                'Missing index for block {} of {}'.format(block, self.path),
+            )
+
+        return INDEX.unpack_from(data, FRAME.size)
+
+    def frames(self, block):
+        """
+        The offset, kind and payload of every complete frame in a block
+        """
+
+        start = block * self.block_size
+        data = os.pread(self._file.fileno(), self.block_size, start)
+
+        position = 0
+        while position + FRAME.size <= len(data):
+            length, kind = FRAME.unpack_from(data, position)
+            end = position + FRAME.size + length
+            if end > len(data):
+                return
+
+            yield start + position, kind, data[position + FRAME.size:end]
+            position = end
+
+    def events(self, start=None, end=None, servers=None, events=None):
+        """
+        The events between the start and end timestamps, optionally only
+        those of some servers and event types, oldest first.
+
+        Timestamps come from the wall clock so blocks are expected to be in
+        time order.
+        """
+
+        mask = 0
+        if servers is not None:
+            servers = set(servers)
+            for server in servers:
+                mask |= server_bit(server)
+
+        for block in range(self._first_block(start), self.block_count):
+            index = self.index(block)
+            if index is not None:
+                # Only the block being written when the agent crashed can
+                # have been given an empty index
+                if not index[2]:
+                    continue
+
+                first, last, _, block_mask = index
+                if end is not None and first > end:
+                    return
+                if start is not None and last < start:
+                    continue
+                if servers is not None and not block_mask & mask:
+                    continue
+
+            for _, kind, payload in self.frames(block):
+                if kind != KIND_EVENT:
+                    continue
+
+                event = decode_event(payload)
+                if matches(event, start, end, servers, events):
+                    yield event
+
+    def _first_block(self, start):
+        low, high = 0, self.block_count - 1
+        if start is None:
+            return low
+
+        while low < high:
+            middle = (low + high) // 2
+            index = self.index(middle)
+            if index is not None and index[1] < start:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+
+class JournalWriter(object):
+    """
+    Appends events to a journal.
+
+    Encoded frames are kept in memory until they are taken and written so
+    that the caller decides when and on which thread the disk is touched.
+    """
+
+    def __init__(self, path, block_size=65536):
+        """
+        Open a journal for appending, creating it if it does not exist
+        """
+
+        self.path = path
+        self.block_size = block_size
+        self.offset = 0
+        self.pending = bytearray()
+
+        self._block = None
+        self._file = None
+
+        self._recover()
+
+    def append(self, timestamp, event, server, data=None):
+        """
+        Add an event to the journal
+        """
+
+        frame = encode_event(timestamp, event, server, data)
+        if len(frame) + FRAME.size + INDEX.size > self.block_size:
+            raise mcadminpanel.agent.errors.JournalError(
+                'Event of {} bytes does not fit in a block'.format(len(frame)),
+            )
+
+        used = self.offset % self.block_size
+        if used == 0 or used + len(frame) > self.block_size:
+            self._next_block()
+
+        self.pending += frame
+        self.offset += len(frame)
+
+        first, last, count, mask = self._block
+        self._block = (
+            min(first, timestamp),
+            max(last, timestamp),
+            count + 1,
+            mask | server_bit(server),
+        )
+
+    def take(self):
+        """
+        Remove and return the frames that have not been written yet
+        """
+
+        data = bytes(self.pending)
+        self.pending.clear()
+
+        return data
+
+    def write(self, data):
+        """
+        Write frames taken from the writer to the file
+        """
+
+        if self._file is None:
+            self._file = open(self.path, 'ab') # pylint: disable=consider-using-with
+
+        self._file.write(data)
+        self._file.flush()
+
+    def flush(self):
+        """
+        Write all of the pending frames
+        """
+
+        self.write(self.take())
+
+    def close(self):
+        """
+        Write the pending frames and close the file
+        """
+
+        self.flush()
+        self._file.close()
+        self._file = None
+
+    def _recover(self):
+        self._block = (math.inf, -math.inf, 0, 0)
+
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            size = 0
+
+        if size == 0:
+            self.pending += encode_frame(KIND_HEADER, HEADER.pack(MAGIC, self.block_size))
+            self.offset = len(self.pending)
+            return
+
+        with JournalReader(self.path) as reader:
+            self.block_size = reader.block_size
+            block = reader.block_count - 1
+            self._scan(reader, block)
+
+            # Cut off before the index of the previous block was complete so
+            # that block is still the one being written
+            if block > 0 and self.offset == block * self.block_size:
+                self._scan(reader, block - 1)
+
+        if self.offset < size:
+            logging.warning(
+                'Discarding %s bytes of a partially written frame from %s',
+                size - self.offset,
+                self.path,
+            )
+            os.truncate(self.path, self.offset)
+
+    def _scan(self, reader, block):
+        self._block = (math.inf, -math.inf, 0, 0)
+        self.offset = block * self.block_size
+
+        for offset, kind, payload in reader.frames(block):
+            self.offset = offset + FRAME.size + len(payload)
+            if kind == KIND_EVENT:
+                event = decode_event(payload)
+                first, last, count, mask = self._block
+                self._block = (
+                    min(first, event['timestamp']),
+                    max(last, event['timestamp']),
+                    count + 1,
+                    mask | server_bit(event['server']),
+                )
+
+    def _next_block(self):
+        remaining = -self.offset % self.block_size
+        if remaining >= FRAME.size:
+            self.pending += encode_frame(KIND_PADDING, bytes(remaining - FRAME.size))
+        elif remaining:
+            self.pending += bytes(remaining)
+
+        self.pending += encode_frame(KIND_INDEX, INDEX.pack(*self._block))
+        self.offset += remaining + FRAME.size + INDEX.size
+        self._block = (math.inf, -math.inf, 0, 0)
+
+
+class Journal(object):
+    """
+    Records the events of the agent in the journal.
+
+    Events are encoded on the event loop and written to the file from the
+    default executor every flush interval.
+    """
+
+    def __init__(self, journal_conf, loop=None):
+        """
+        Setup the journal from its configuration
+        """
+
+        self.path = journal_conf['file']
+        self.flush_interval = journal_conf['flush_interval']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.writer = JournalWriter(self.path, journal_conf['block_size'])
+
+        self._watched = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def record(self, event, server, data=None, timestamp=None):
+        """
+        Add an event to the journal
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        self.writer.append(timestamp, event, server, data)
+
+    def server_event(self, name, event, data):
+        """
+        Supervisor listener recording server lifecycle events
+        """
+
+        self.record(event, name, data)
+
+    def metrics_sample(self, name, timestamp, values):
+        """
+        Metrics sampler listener recording samples
+        """
+
+        self.record('metrics', name, dict(zip(METRIC_FIELDS, values)), timestamp)
+
+    def log_event(self, name, event):
+        """
+        Console log parser listener recording players joining and leaving
+        and lag spikes
+        """
+
+        if event.event in JOURNALED_LOG_EVENTS:
+            self.record(event.event, name, event.data)
+
+    def watch(self, server):
+        """
+        Record the console log events of a server
+        """
+
+        parser = self._watched.get(server.name)
+        if parser is not None:
+            parser.remove_listener(self.log_event)
+
+        server.log.add_listener(self.log_event)
+        self._watched[server.name] = server.log
+
+    def start(self):
+        """
+        Start writing events in the background
+        """
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+        return self._task
+
+    async def stop(self):
+        """
+        Write out the remaining events and close the journal
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+
+        await self.flush()
+        await self.loop.run_in_executor(None, self.writer.close)
+
+    async def flush(self):
+        """
+        Write the recorded events to the file
+        """
+
+        async with self._flush_lock:
+            data = self.writer.take()
+            if data:
+                await self.loop.run_in_executor(None, self.writer.write, data)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def api_routes(self):
+        """
+        The control API commands for reading the journal
+        """
+
+        return {
+            'events': self.api_events,
+        }
+
+    # pylint: disable=too-many-arguments
+    async def api_events(self, start=None, end=None, server=None, event=None, limit=1000):
+        """
+        API command returning the events in a time range, oldest first
+        """
+
+        await self.flush()
+
+        return await self.loop.run_in_executor(
+            None,
+            read_events,
+            self.path,
+            start,
+            end,
+            [server] if server is not None else None,
+            [event] if event is not None else None,
+            limit,
+        )
+    # pylint: enable=too-many-arguments
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def read_events(path, start=None, end=None, servers=None, events=None, limit=None):
+    """
+    Read a list of up to limit events from a journal
+    """
+
+    result = []
+    with JournalReader(path) as reader:
+        for event in reader.events(start, end, servers, events):
+            if limit is not None and len(result) >= limit:
+                break
+            result.append(event)
+
+    return result
+# pylint: enable=too-many-arguments,too-many-positional-arguments
+
+
+def merge_events(paths, start=None, end=None, servers=None, events=None):
+    """
+    The events of several journals, such as those of the worker processes,
+    merged oldest first
+    """
+
+    with contextlib.ExitStack() as stack:
+        readers = [stack.enter_context(JournalReader(path)) for path in paths]
+
+        yield from heapq.merge(
+            *[reader.events(start, end, servers, events) for reader in readers],
+            key=lambda event: event['timestamp']
+        )
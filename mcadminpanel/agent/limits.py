@@ -0,0 +1,258 @@
+"""
+Resource limits of the server processes.
+
+With a cgroup v2 directory delegated to the agent every server runs in its
+own child cgroup, which applies the CPU, memory and IO limits to the whole
+process tree and gives its usage without walking the tree. Servers join
+their cgroup before they exec so the JVM never runs outside of it.
+
+Without cgroups the limits degrade to the nice value and the IO priority,
+applied to the server process after it started. Memory is left unlimited as
+an rlimit on the data segment also counts the heap, metaspace and code cache
+the JVM reserves without using.
+"""
+
+import logging
+import math
+import os
+import os.path
+
+import psutil
+
+CONTROLLERS = ('cpu', 'memory', 'io')
+
+# Period of the CPU quota in microseconds
+CPU_PERIOD = 100000
+
+# Weight of a cgroup without a configured weight
+DEFAULT_WEIGHT = 100
+
+def weight_to_nice(weight):
+    """
+    The nice value closest to a cgroup CPU weight, every nice level is
+    about 1.25 times the CPU share of the next one
+    """
+
+    nice = -math.log(weight / DEFAULT_WEIGHT, 1.25)
+
+    return max(-20, min(19, int(round(nice))))
+
+def weight_to_ioprio(weight):
+    """
+    The best effort IO priority level closest to a cgroup IO weight
+    """
+
+    level = 4 - math.log10(weight / DEFAULT_WEIGHT) * 2
+
+    return max(0, min(7, int(round(level))))
+
+def read_keyed(path):
+    """
+    Read a flat keyed cgroup file of "key value" lines
+    """
+
+    values = {}
+    with open(path, 'r') as keyed_file:
+        for line in keyed_file:
+            key, _, value = line.partition(' ')
+            values[key] = int(value)
+
+    return values
+
+def read_io_stat(path):
+    """
+    Sum the bytes read and written over every device of an io.stat file
+    """
+
+    read_bytes = write_bytes = 0
+    with open(path, 'r') as io_file:
+        for line in io_file:
+            for field in line.split()[1:]:
+                key, _, value = field.partition('=')
+                if key == 'rbytes':
+                    read_bytes += int(value)
+                elif key == 'wbytes':
+                    write_bytes += int(value)
+
+    return read_bytes, write_bytes
+
+def write_value(path, value):
+    """
+    Write a single value to a cgroup file
+    """
+
+    with open(path, 'w') as cgroup_file:
+        cgroup_file.write('{}\n'.format(value))
+
+
+class CgroupLimits(object):
+    """
+    Limits of a server applied through its own cgroup
+    """
+
+    def __init__(self, path, limits_conf):
+        """
+        Setup the limits of the cgroup at path, it is not created
+        """
+
+        self.path = path
+        self.limits_conf = limits_conf or {}
+
+    def setup(self):
+        """
+        Create the cgroup and write its limits
+        """
+
+        parent = os.path.dirname(self.path)
+        for controller in CONTROLLERS:
+            try:
+                write_value(os.path.join(parent, 'cgroup.subtree_control'), '+' + controller)
+            except OSError as ex:
+                logging.debug('Unable to enable the %s controller: %s', controller, ex)
+
+        os.makedirs(self.path, exist_ok=True)
+
+        cpu_weight = self.limits_conf.get('cpu_weight')
+        cpu_quota = self.limits_conf.get('cpu_quota')
+        memory_max = self.limits_conf.get('memory_max')
+        io_weight = self.limits_conf.get('io_weight')
+
+        self._write('cpu.weight', cpu_weight if cpu_weight is not None else DEFAULT_WEIGHT)
+        self._write('cpu.max', '{} {}'.format(
+            int(cpu_quota * CPU_PERIOD) if cpu_quota is not None else 'max',
+            CPU_PERIOD,
+        ))
+        self._write('memory.max', memory_max if memory_max is not None else 'max')
+        if io_weight is not None:
+            self._write('io.weight', 'default {}'.format(io_weight))
+
+    def attach(self, pid):
+        """
+        Move a process into the cgroup
+        """
+
+        self._write('cgroup.procs', pid)
+
+    def enter(self):
+        """
+        Move the calling process into the cgroup, run by the server process
+        between fork and exec
+        """
+
+        # Nothing can be reported from the child, the supervisor attaches
+        # the server again once it started and logs failures
+        try:
+            self.attach(os.getpid())
+        except OSError:
+            pass
+
+    def usage(self):
+        """
+        The CPU time in microseconds, memory and IO bytes of every process in
+        the cgroup
+        """
+
+        read_bytes, write_bytes = read_io_stat(os.path.join(self.path, 'io.stat'))
+        with open(os.path.join(self.path, 'memory.current'), 'r') as memory_file:
+            memory = int(memory_file.read())
+
+        return {
+            'cpu_usec': read_keyed(os.path.join(self.path, 'cpu.stat'))['usage_usec'],
+            'memory': memory,
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes,
+        }
+
+    def cleanup(self):
+        """
+        Remove the cgroup once its processes exited
+        """
+
+        try:
+            os.rmdir(self.path)
+        except OSError as ex:
+            logging.debug('Unable to remove cgroup %s: %s', self.path, ex)
+
+    def _write(self, name, value):
+        write_value(os.path.join(self.path, name), value)
+
+
+class ProcessLimits(object):
+    """
+    Limits of a server applied to its process without cgroups
+    """
+
+    def __init__(self, limits_conf):
+        """
+        Setup the limits, nothing is applied until a process is attached
+        """
+
+        self.limits_conf = limits_conf or {}
+
+    def setup(self):
+        """
+        Nothing needs to be created without cgroups
+        """
+
+        if self.limits_conf.get('cpu_quota') is not None:
+            logging.warning('CPU quotas need cgroups, only the CPU weight is applied')
+        if self.limits_conf.get('memory_max') is not None:
+            logging.warning('Memory limits need cgroups, the memory is not limited')
+
+    def attach(self, pid):
+        """
+        Apply the limits to a process
+        """
+
+        process = psutil.Process(pid)
+
+        cpu_weight = self.limits_conf.get('cpu_weight')
+        io_weight = self.limits_conf.get('io_weight')
+
+        try:
+            if cpu_weight is not None:
+                process.nice(weight_to_nice(cpu_weight))
+            if io_weight is not None:
+                process.ionice(psutil.IOPRIO_CLASS_BE, weight_to_ioprio(io_weight))
+        except psutil.AccessDenied as ex:
+            logging.warning('Unable to limit process %s: %s', pid, ex)
+
+    def usage(self):
+        """
+        Usage is sampled from the process itself without cgroups
+        """
+
+        return None
+
+    def cleanup(self):
+        """
+        Nothing is left behind without cgroups
+        """
+
+def server_limits(name, limits_conf, cgroup_root):
+    """
+    The limits of a server, through a cgroup when a cgroup root is
+    configured and usable, otherwise through the process when it has limits
+    """
+
+    if cgroup_root:
+        limits = CgroupLimits(os.path.join(cgroup_root, name), limits_conf)
+        try:
+            limits.setup()
+            return limits
+        except OSError as ex:
+            logging.warning(
+                'Unable to setup the cgroup of server %s, falling back to '
+                'process limits: %s',
+                name,
+                ex,
+            )
+
+    if limits_conf is None:
+        return None
+
+    limits = ProcessLimits(limits_conf)
+    limits.setup()
+
+    return limits
+
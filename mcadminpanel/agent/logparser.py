@@ -0,0 +1,196 @@
+"""
+Parsing of the console output of the servers into events.
+
+Every line is matched once against a single regular expression anchored at
+the start of the line. It reads the level from the log prefix and then tries
+the messages the agent cares about as alternatives, each in its own named
+group, so the name of the last matched group tells which event the line is.
+Lines are bytes and never decoded unless they hold an event.
+
+Each server has a parser keeping the live state derived from the events,
+the online players and the lag spikes, updated in constant time per event.
+"""
+
+import collections
+import logging
+import re
+
+LogEvent = collections.namedtuple('LogEvent', ('event', 'data'))
+
+# The log prefix, "[12:00:00] [Server thread/INFO]: " with an optional
+# logger name after the level as printed by modded servers
+PREFIX = rb'\[[^\]]*\] \[[^\]]*/(?P<level>[A-Z]+)\](?: \[[^\]]*\])?: '
+
+MESSAGES = (
+    rb'(?P<join>(?P<join_player>\w+) joined the game)',
+    rb'(?P<leave>(?P<leave_player>\w+) left the game)',
+    rb"(?P<lag>Can't keep up! .*?Running (?P<lag_behind>\d+)ms)",
+    rb'(?P<players>There are (?P<players_count>\d+) of a max (?:of )?(?P<players_max>\d+) '
+    rb'players online:(?P<players_names>.*))',
+    rb'(?P<ready>Done \((?P<ready_startup>[\d.]+)s\)!)',
+    rb'(?P<stopping>Stopping (?:the )?server)',
+)
+
+LINE = re.compile(PREFIX + rb'(?:' + rb'|'.join(MESSAGES) + rb')?')
+
+ERROR_LEVELS = (b'ERROR', b'FATAL')
+
+def decode(value):
+    """
+    Decode a part of a console line
+    """
+
+    return value.decode('utf-8', 'replace')
+
+def player_names(names):
+    """
+    The player names of a list command response
+    """
+
+    return [name for name in decode(names).replace(',', ' ').split() if name]
+
+# Builders of the data of every event from the match of its line
+EVENT_DATA = {
+    'join': lambda match: {'player': decode(match.group('join_player'))},
+    'leave': lambda match: {'player': decode(match.group('leave_player'))},
+    'lag': lambda match: {'behind': int(match.group('lag_behind'))},
+    'players': lambda match: {
+        'count': int(match.group('players_count')),
+        'max': int(match.group('players_max')),
+        'players': player_names(match.group('players_names')),
+    },
+    'ready': lambda match: {'startup': float(match.group('ready_startup'))},
+    'stopping': lambda match: {},
+}
+
+def parse_line(line):
+    """
+    The event of a console line or None for lines without one
+    """
+
+    match = LINE.match(line)
+    if match is None:
+        return None
+
+    event = match.lastgroup
+    if event != 'level':
+        return LogEvent(event, EVENT_DATA[event](match))
+
+    if match.group('level') in ERROR_LEVELS:
+        return LogEvent('error', {'message': decode(line[match.end():].rstrip())})
+
+    return None
+
+
+# pylint: disable=too-many-instance-attributes
+class LogParser(object):
+    """
+    Console subscriber turning the lines of a server into events and
+    keeping the live state of the server
+    """
+
+    def __init__(self, name):
+        """
+        Setup a parser for the console of the named server
+        """
+
+        self.name = name
+        self.online = set()
+        self.lines = 0
+        self.lag_spikes = 0
+        self.last_lag = None
+        self.max_lag = 0
+        self.errors = 0
+        self.last_error = None
+        self.startup = None
+        self.listeners = []
+
+        self._apply = {
+            'join': self._join,
+            'leave': self._leave,
+            'players': self._players,
+            'lag': self._lag,
+            'error': self._error,
+            'ready': self._ready,
+            'stopping': self._stopping,
+        }
+
+    def add_listener(self, listener):
+        """
+        Call listener(name, event) for every event of the server
+        """
+
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Stop calling a listener
+        """
+
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def put(self, channel, line):
+        """
+        Parse a console line
+        """
+
+        if channel == 'agent':
+            return
+
+        self.lines += 1
+
+        event = parse_line(line)
+        if event is None:
+            return
+
+        self._apply[event.event](event.data)
+
+        for listener in self.listeners:
+            try:
+                listener(self.name, event)
+            except Exception: # pylint: disable=broad-except
+                logging.exception('Console log listener failed')
+
+    def state(self):
+        """
+        The live state of the server
+        """
+
+        return {
+            'players': sorted(self.online),
+            'lines': self.lines,
+            'lag_spikes': self.lag_spikes,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'startup': self.startup,
+        }
+
+    def _join(self, data):
+        self.online.add(data['player'])
+
+    def _leave(self, data):
+        self.online.discard(data['player'])
+
+    def _players(self, data):
+        self.online = set(data['players'])
+
+    def _lag(self, data):
+        self.lag_spikes += 1
+        self.last_lag = data['behind']
+        if data['behind'] > self.max_lag:
+            self.max_lag = data['behind']
+
+    def _error(self, data):
+        self.errors += 1
+        self.last_error = data['message']
+
+    def _ready(self, data):
+        self.online.clear()
+        self.startup = data['startup']
+
+    def _stopping(self, data): # pylint: disable=unused-argument
+        self.online.clear()
+# pylint: enable=too-many-instance-attributes
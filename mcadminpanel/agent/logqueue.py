@@ -0,0 +1,137 @@
+"""
+Logging through a bounded queue so the event loop never waits on the disk.
+
+Records are put on the queue by a QueueHandler without blocking and written
+by a listener thread in batches. When the queue is full records are dropped
+and counted, the next record that fits is preceded by a warning saying how
+many were lost.
+"""
+
+import logging
+import logging.handlers
+import queue
+import threading
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that drops records instead of blocking on a full queue
+    """
+
+    def __init__(self, log_queue):
+        """
+        Setup a handler putting records on the given bounded queue
+        """
+
+        super(DroppingQueueHandler, self).__init__(log_queue)
+
+        self.dropped = 0
+        self._pending_drops = 0
+
+    def enqueue(self, record):
+        try:
+            if self._pending_drops:
+                self.queue.put_nowait(self._drop_record(record))
+                self._pending_drops = 0
+
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._pending_drops += 1
+
+    def _drop_record(self, record):
+        return logging.makeLogRecord({
+            'name': __name__,
+            'levelno': logging.WARNING,
+            'levelname': logging.getLevelName(logging.WARNING),
+            'msg': 'Dropped {} log records because the log queue was full'.format(
+                self._pending_drops,
+            ),
+            'created': record.created,
+            'msecs': record.msecs,
+        })
+
+
+class BatchFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    Rotating file handler that flushes once per batch instead of per record
+    """
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        """
+        Flush the records written since the last batch
+        """
+
+        super(BatchFileHandler, self).flush()
+
+
+class LogListener(object):
+    """
+    Thread writing queued records to the real handlers in batches
+    """
+
+    BATCH_SIZE = 256
+
+    _STOP = object()
+
+    def __init__(self, log_queue, handlers):
+        """
+        Setup a listener for the queue, it is not started
+        """
+
+        self.queue = log_queue
+        self.handlers = handlers
+
+        self._thread = None
+
+    def start(self):
+        """
+        Start writing records in a background thread
+        """
+
+        self._thread = threading.Thread(target=self._run, name='log-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Write out the queued records, stop the thread and close the handlers
+        """
+
+        if self._thread is not None:
+            self.queue.put(LogListener._STOP)
+            self._thread.join()
+            self._thread = None
+
+        for handler in self.handlers:
+            handler.close()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LogListener.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for record in batch:
+                if record is LogListener._STOP:
+                    stop = True
+                    continue
+
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+            for handler in self.handlers:
+                if isinstance(handler, BatchFileHandler):
+                    handler.flush_batch()
+                else:
+                    handler.flush()
+
+            if stop:
+                return
+
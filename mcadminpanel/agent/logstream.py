@@ -0,0 +1,307 @@
+"""
+Streaming of the console output of the managed servers
+"""
+
+import asyncio
+import collections
+import logging
+
+class LineSplitter(object):
+    """
+    Incrementally splits chunks of output into lines.
+
+    Partial lines are kept until the rest of the line arrives, lines longer
+    than the maximum length are split so a server that never writes a
+    newline can not grow the buffer without bound.
+    """
+
+    def __init__(self, max_line=65536):
+        """
+        Setup an empty splitter
+        """
+
+        self.max_line = max_line
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add a chunk of output and return the lines it completed
+        """
+
+        self._buffer.extend(data)
+
+        lines = []
+        start = 0
+        while True:
+            end = self._buffer.find(b'\n', start)
+            if end < 0:
+                break
+            lines.append(bytes(self._buffer[start:end + 1]))
+            start = end + 1
+
+        while len(self._buffer) - start >= self.max_line:
+            lines.append(bytes(self._buffer[start:start + self.max_line]))
+            start += self.max_line
+
+        del self._buffer[:start]
+
+        return lines
+
+    def flush(self):
+        """
+        Return whatever partial line is left in the buffer
+        """
+
+        rest = bytes(self._buffer)
+        self._buffer.clear()
+
+        return rest
+
+
+class LogStream(object):
+    """
+    Fans out the console lines of a server to its subscribers.
+
+    Publishing never blocks, subscribers are expected to buffer or drop lines
+    themselves so a slow subscriber can never stall the server's pipes.
+    """
+
+    def __init__(self, tail=1000):
+        """
+        Setup a stream with a tail buffer of the most recent lines
+        """
+
+        self.tail = TailBuffer(tail)
+        self.subscribers = [self.tail]
+        self.published = 0
+
+    def subscribe(self, subscriber):
+        """
+        Add a subscriber that will receive every new line
+        """
+
+        self.subscribers.append(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Remove a subscriber
+        """
+
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def publish(self, channel, line):
+        """
+        Send a line to every subscriber
+        """
+
+        self.published += 1
+
+        for subscriber in self.subscribers:
+            try:
+                subscriber.put(channel, line)
+            except Exception: # pylint: disable=broad-except
+                logging.exception('Console subscriber failed')
+
+
+class TailBuffer(object):
+    """
+    Subscriber keeping the most recent lines in memory
+    """
+
+    def __init__(self, size):
+        """
+        Setup a buffer for up to size lines
+        """
+
+        self.lines = collections.deque(maxlen=size)
+
+    def put(self, channel, line):
+        """
+        Add a line, dropping the oldest one when full
+        """
+
+        self.lines.append((channel, line))
+
+    def get(self, count=None):
+        """
+        The last count lines, or all of them
+        """
+
+        if count is None or count >= len(self.lines):
+            return list(self.lines)
+
+        return list(self.lines)[-count:]
+
+
+class QueueSubscriber(object):
+    """
+    Subscriber with a bounded queue for consumers that may fall behind.
+
+    Consecutive duplicate lines are coalesced into a single entry and once the
+    queue is full the oldest lines are dropped. Consumers are told how many
+    lines they missed by a marker line on the 'agent' channel.
+    """
+
+    def __init__(self, maxsize=10000):
+        """
+        Setup an empty queue holding up to maxsize lines
+        """
+
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+
+        self._entries = collections.deque()
+        self._pending_drops = 0
+        self._ready = asyncio.Event()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, channel, line):
+        """
+        Queue a line without blocking
+        """
+
+        if self.closed:
+            return
+
+        if self._entries:
+            last = self._entries[-1]
+            if last[0] == channel and last[1] == line:
+                last[2] += 1
+                self.coalesced += 1
+                return
+
+        if len(self._entries) >= self.maxsize:
+            self._entries.popleft()
+            self.dropped += 1
+            self._pending_drops += 1
+
+        self._entries.append([channel, line, 1])
+        self._ready.set()
+
+    def close(self):
+        """
+        Stop accepting lines and wake up any waiting consumer
+        """
+
+        self.closed = True
+        self._ready.set()
+
+    async def get(self, limit=None):
+        """
+        Wait for lines and return a batch of up to limit entries.
+
+        An empty batch is returned once the subscriber is closed and drained.
+        """
+
+        while not self._entries and not self._pending_drops:
+            if self.closed:
+                return []
+            self._ready.clear()
+            await self._ready.wait()
+
+        batch = []
+        if self._pending_drops:
+            batch.append((
+                'agent',
+                '[{} lines dropped]\n'.format(self._pending_drops).encode(),
+            ))
+            self._pending_drops = 0
+
+        while self._entries and (limit is None or len(batch) < limit):
+            channel, line, count = self._entries.popleft()
+            batch.append((channel, line))
+            if count > 1:
+                batch.append((
+                    'agent',
+                    '[last line repeated {} more times]\n'.format(count - 1).encode(),
+                ))
+
+        return batch
+
+
+class FileSubscriber(QueueSubscriber):
+    """
+    Subscriber writing the console output of a server to a file.
+
+    The file is written from the default executor in batches so the event
+    loop never waits on the disk.
+    """
+
+    def __init__(self, path, maxsize=10000, loop=None):
+        """
+        Setup a subscriber appending to the given path
+        """
+
+        super(FileSubscriber, self).__init__(maxsize)
+
+        self.path = path
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self._file = None
+        self._task = None
+
+    def start(self):
+        """
+        Start writing queued lines to the file
+        """
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._write_lines(), loop=self.loop)
+
+        return self._task
+
+    async def stop(self):
+        """
+        Write out the remaining lines and close the file
+        """
+
+        self.close()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def _write_lines(self):
+        try:
+            self._file = await self.loop.run_in_executor(None, open, self.path, 'ab')
+
+            while True:
+                batch = await self.get(limit=1024)
+                if not batch:
+                    break
+
+                data = b''.join(line for _, line in batch)
+                await self.loop.run_in_executor(None, self._write, data)
+        except OSError as ex:
+            logging.error('Unable to write console log %s: %s', self.path, ex)
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+
+async def wait_for_line(subscriber, pattern):
+    """
+    Wait for a line matching a compiled bytes pattern and return the match
+    """
+
+    while True:
+        batch = await subscriber.get()
+        if not batch:
+            raise EOFError('Console closed before a matching line')
+
+        for _, line in batch:
+            match = pattern.search(line)
+            if match is not None:
+                return match
+
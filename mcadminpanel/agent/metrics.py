@@ -0,0 +1,494 @@
+"""
+Resource metrics for the managed server processes
+"""
+
+import array
+import asyncio
+import collections
+import logging
+import time
+
+import psutil
+
+IOCounters = collections.namedtuple('IOCounters', ('read_bytes', 'write_bytes'))
+
+Usage = collections.namedtuple('Usage', ('cpu', 'cpu_percent', 'rss', 'io_counters'))
+
+class RingBuffer(object):
+    """
+    A fixed size, array backed buffer that overwrites the oldest values
+    """
+
+    __slots__ = ('_data', '_capacity', '_index', '_size')
+
+    def __init__(self, capacity, typecode='d'):
+        """
+        Preallocate a buffer with room for the given number of values
+        """
+
+        self._data = array.array(typecode, [0]) * capacity
+        self._capacity = capacity
+        self._index = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        start = self._index - self._size
+        for offset in range(self._size):
+            yield self._data[(start + offset) % self._capacity]
+
+    @property
+    def capacity(self):
+        """
+        The maximum number of values kept in the buffer
+        """
+
+        return self._capacity
+
+    @property
+    def latest(self):
+        """
+        The most recently added value or None when empty
+        """
+
+        if not self._size:
+            return None
+
+        return self._data[self._index - 1]
+
+    def append(self, value):
+        """
+        Add a value, overwriting the oldest one if the buffer is full
+        """
+
+        self._data[self._index] = value
+        self._index = (self._index + 1) % self._capacity
+        if self._size < self._capacity:
+            self._size += 1
+
+    def tolist(self):
+        """
+        The values in the buffer ordered from oldest to newest
+        """
+
+        return list(self)
+
+
+# pylint: disable=too-many-instance-attributes
+class Downsampler(object):
+    """
+    Incrementally aggregates samples into fixed time buckets.
+
+    Every sample only updates a running sum, count and maximum. When a bucket
+    ends its mean and maximum are pushed to ring buffers so aggregates never
+    need to be recomputed from the raw samples.
+    """
+
+    __slots__ = (
+        'period', 'starts', 'means', 'maxes',
+        '_start', '_count', '_sums', '_peaks',
+    )
+
+    def __init__(self, period, capacity, width):
+        """
+        Setup buckets of period seconds for samples with width values
+        """
+
+        self.period = period
+        self.starts = RingBuffer(capacity)
+        self.means = [RingBuffer(capacity) for _ in range(width)]
+        self.maxes = [RingBuffer(capacity) for _ in range(width)]
+
+        self._start = None
+        self._count = 0
+        self._sums = array.array('d', [0]) * width
+        self._peaks = array.array('d', [0]) * width
+
+    def add(self, timestamp, values):
+        """
+        Add a sample to the bucket it belongs to
+        """
+
+        start = timestamp - timestamp % self.period
+        if self._start is not None and start != self._start:
+            self._close()
+
+        if not self._count:
+            self._start = start
+            for index, value in enumerate(values):
+                self._sums[index] = value
+                self._peaks[index] = value
+        else:
+            for index, value in enumerate(values):
+                self._sums[index] += value
+                if value > self._peaks[index]:
+                    self._peaks[index] = value
+
+        self._count += 1
+
+    def current(self):
+        """
+        The start, means and maximums of the bucket being filled
+        """
+
+        if not self._count:
+            return None
+
+        return (
+            self._start,
+            [total / self._count for total in self._sums],
+            list(self._peaks),
+        )
+
+    def last(self):
+        """
+        The start, means and maximums of the last completed bucket
+        """
+
+        if not self.starts:
+            return None
+
+        return (
+            self.starts.latest,
+            [means.latest for means in self.means],
+            [maxes.latest for maxes in self.maxes],
+        )
+
+    def _close(self):
+        self.starts.append(self._start)
+        for index, total in enumerate(self._sums):
+            self.means[index].append(total / self._count)
+            self.maxes[index].append(self._peaks[index])
+
+        self._start = None
+        self._count = 0
+# pylint: enable=too-many-instance-attributes
+
+
+class ServerMetrics(object):
+    """
+    The sample history for a single server
+    """
+
+    # Downsampled tiers as (label, bucket period, number of buckets kept)
+    TIERS = (
+        ('1m', 60, 60),
+        ('5m', 300, 288),
+        ('1h', 3600, 168),
+    )
+
+    def __init__(self, fields, history):
+        """
+        Setup empty histories for the given fields
+        """
+
+        self.fields = fields
+        self.timestamps = RingBuffer(history)
+        self.series = [RingBuffer(history) for _ in fields]
+        self.tiers = [
+            (label, Downsampler(period, capacity, len(fields)))
+            for label, period, capacity in ServerMetrics.TIERS
+        ]
+
+    def add(self, timestamp, values):
+        """
+        Record a sample of values ordered like the fields
+        """
+
+        self.timestamps.append(timestamp)
+        for series, value in zip(self.series, values):
+            series.append(value)
+
+        for _, downsampler in self.tiers:
+            downsampler.add(timestamp, values)
+
+    def latest(self):
+        """
+        The most recent sample or None if nothing was sampled
+        """
+
+        if not self.timestamps:
+            return None
+
+        result = dict(zip(
+            self.fields,
+            [series.latest for series in self.series],
+        ))
+        result['timestamp'] = self.timestamps.latest
+
+        return result
+
+    def history(self):
+        """
+        The raw samples ordered from oldest to newest
+        """
+
+        result = dict(zip(
+            self.fields,
+            [series.tolist() for series in self.series],
+        ))
+        result['timestamp'] = self.timestamps.tolist()
+
+        return result
+
+    def aggregates(self):
+        """
+        The mean and maximum of every field for each downsampled tier.
+
+        The last completed bucket is used, or the bucket being filled if no
+        bucket has completed yet.
+        """
+
+        result = {}
+        for label, downsampler in self.tiers:
+            bucket = downsampler.last()
+            complete = bucket is not None
+            if not complete:
+                bucket = downsampler.current()
+            if bucket is None:
+                continue
+
+            start, means, maxes = bucket
+            result[label] = {
+                'start': start,
+                'complete': complete,
+                'mean': dict(zip(self.fields, means)),
+                'max': dict(zip(self.fields, maxes)),
+            }
+
+        return result
+
+
+# pylint: disable=too-many-instance-attributes
+class MetricsSampler(object):
+    """
+    Periodically samples the resource usage of all the managed servers
+    """
+
+    FIELDS = ('cpu_percent', 'rss', 'threads', 'fds', 'read_rate', 'write_rate')
+
+    def __init__(self, supervisor, metrics_conf, loop=None):
+        """
+        Setup the sampler for the servers of the given supervisor
+        """
+
+        self.supervisor = supervisor
+        self.interval = metrics_conf['interval']
+        self.history = metrics_conf['history']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.metrics = {}
+        self.listeners = []
+
+        self._processes = {}
+        self._task = None
+
+    def start(self):
+        """
+        Start sampling in the background
+        """
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+        return self._task
+
+    async def stop(self):
+        """
+        Stop sampling
+        """
+
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def add_listener(self, listener):
+        """
+        Call listener(name, timestamp, values) with every sample, the values
+        are ordered like FIELDS
+        """
+
+        self.listeners.append(listener)
+
+    def latest(self, name):
+        """
+        The most recent sample for a server or None
+        """
+
+        metrics = self.metrics.get(name)
+
+        return metrics.latest() if metrics is not None else None
+
+    def aggregates(self, name):
+        """
+        The downsampled aggregates for a server
+        """
+
+        metrics = self.metrics.get(name)
+
+        return metrics.aggregates() if metrics is not None else {}
+
+    def api_routes(self):
+        """
+        The control API commands for reading metrics
+        """
+
+        return {
+            'metrics': self.api_metrics,
+        }
+
+    def api_metrics(self, name=None):
+        """
+        API command returning the latest sample and aggregates of servers
+        """
+
+        names = [name] if name is not None else sorted(self.metrics)
+
+        return {
+            server: {
+                'latest': self.latest(server),
+                'aggregates': self.aggregates(server),
+            }
+            for server in names
+        }
+
+    def sample(self, timestamp=None):
+        """
+        Take one sample of every running server, forgetting the servers that
+        were removed
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        for name in set(self.metrics) | set(self._processes):
+            if name not in self.supervisor.servers:
+                self.metrics.pop(name, None)
+                self._processes.pop(name, None)
+
+        for name, server in self.supervisor.servers.items():
+            pid = server.pid
+            if pid is None:
+                self._processes.pop(name, None)
+                continue
+
+            try:
+                usage = server.limits.usage() if server.limits is not None else None
+            except (OSError, KeyError, ValueError) as ex:
+                logging.warning('Unable to read the cgroup usage of server %s: %s', name, ex)
+                usage = None
+
+            try:
+                values = self._sample_process(name, pid, timestamp, usage)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                self._processes.pop(name, None)
+                continue
+            except psutil.AccessDenied:
+                logging.warning('Unable to sample server %s (pid %s)', name, pid)
+                continue
+
+            metrics = self.metrics.get(name)
+            if metrics is None:
+                metrics = ServerMetrics(MetricsSampler.FIELDS, self.history)
+                self.metrics[name] = metrics
+            metrics.add(timestamp, values)
+
+            for listener in self.listeners:
+                try:
+                    listener(name, timestamp, values)
+                except Exception: # pylint: disable=broad-except
+                    logging.exception('Metrics listener failed')
+
+    def _sample_process(self, name, pid, timestamp, usage=None):
+        """
+        Sample a server process, the CPU, memory and IO of the whole process
+        tree are taken from the cgroup usage when there is one
+        """
+
+        cached = self._processes.get(name)
+        if cached is None or cached[0].pid != pid:
+            cached = (psutil.Process(pid), None, None, None)
+
+        proc, last_io, last_timestamp, last_cpu = cached
+        elapsed = timestamp - last_timestamp if last_timestamp is not None else 0
+
+        with proc.oneshot():
+            threads = proc.num_threads()
+            fds = proc.num_fds()
+            if usage is None:
+                current = sample_usage(proc)
+            else:
+                current = cgroup_usage(usage, last_cpu, elapsed)
+
+        self._processes[name] = (proc, current.io_counters, timestamp, current.cpu)
+
+        return (
+            (current.cpu_percent, current.rss, threads, fds) +
+            io_rates(last_io, current.io_counters, elapsed)
+        )
+
+    async def _run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+# pylint: enable=too-many-instance-attributes
+
+
+def sample_usage(proc):
+    """
+    The CPU time, CPU usage, resident memory and IO counters of a process
+    """
+
+    cpu_percent = proc.cpu_percent()
+    rss = proc.memory_info().rss
+    try:
+        io_counters = proc.io_counters()
+    except (AttributeError, psutil.AccessDenied):
+        io_counters = None
+
+    return Usage(None, cpu_percent, rss, io_counters)
+
+def cgroup_usage(usage, last_cpu, elapsed):
+    """
+    The CPU time, CPU usage, memory and IO counters of a cgroup
+    """
+
+    cpu = usage['cpu_usec'] / 1000000
+
+    return Usage(
+        cpu,
+        cpu_rate(last_cpu, cpu, elapsed),
+        usage['memory'],
+        IOCounters(usage['read_bytes'], usage['write_bytes']),
+    )
+
+def cpu_rate(before, after, elapsed):
+    """
+    The CPU usage in percent of one core between two CPU times in seconds
+    """
+
+    if before is None or elapsed <= 0:
+        return 0.0
+
+    return (after - before) / elapsed * 100
+
+def io_rates(before, after, elapsed):
+    """
+    The read and write rates in bytes per second between two IO counters
+    """
+
+    if before is None or after is None or elapsed <= 0:
+        return 0.0, 0.0
+
+    return (
+        (after.read_bytes - before.read_bytes) / elapsed,
+        (after.write_bytes - before.write_bytes) / elapsed,
+    )
+
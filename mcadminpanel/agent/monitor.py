@@ -0,0 +1,394 @@
+"""
+Health instrumentation of the agent's event loop.
+
+The loop lag is measured by a heartbeat task that sleeps for a fixed interval
+and records how late it woke up. A watchdog thread pings the loop several
+times per slow callback threshold and, when a ping is not answered within
+the threshold, captures the stack of the loop thread so the code blocking
+it can be found. When enabled
+the CPU time of every task is measured per coroutine function. A sampling
+profiler reading the stack of the loop thread can be toggled on a live
+agent.
+"""
+
+import asyncio
+import collections
+import collections.abc
+import logging
+import os.path
+import sys
+import threading
+import time
+import traceback
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.metrics
+
+# CPU time of the current thread, Python 3.5 and 3.6 only have process time
+thread_time = getattr(time, 'thread_time', time.process_time) # pylint: disable=invalid-name
+
+def all_tasks(loop):
+    """
+    The unfinished tasks of a loop
+    """
+
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+
+    return set(
+        task
+        for task in asyncio.Task.all_tasks(loop) # pylint: disable=no-member
+        if not task.done()
+    )
+
+def fold_stack(frame):
+    """
+    A frame's stack in the folded format of flame graph tools, outermost
+    call first
+    """
+
+    names = []
+    while frame is not None:
+        names.append('{}:{}'.format(
+            os.path.basename(frame.f_code.co_filename),
+            frame.f_code.co_name,
+        ))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class TimedCoroutine(collections.abc.Coroutine):
+    """
+    Wraps the coroutine of a task to add the CPU time of each step to the
+    stats of its coroutine function
+    """
+
+    __slots__ = ('_coro', '_stats')
+
+    def __init__(self, coro, stats):
+        """
+        Wrap a coroutine, stats maps coroutine names to [steps, cpu time]
+        """
+
+        self._coro = coro
+
+        name = getattr(coro, '__qualname__', type(coro).__name__)
+        self._stats = stats.setdefault(name, [0, 0.0])
+
+    def send(self, value):
+        started = thread_time()
+        try:
+            return self._coro.send(value)
+        finally:
+            self._stats[0] += 1
+            self._stats[1] += thread_time() - started
+
+    def throw(self, typ, val=None, tb=None):
+        started = thread_time()
+        try:
+            return self._coro.throw(typ, val, tb)
+        finally:
+            self._stats[0] += 1
+            self._stats[1] += thread_time() - started
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    @property
+    def cr_frame(self):
+        """
+        The frame of the wrapped coroutine
+        """
+
+        return getattr(self._coro, 'cr_frame', None)
+
+    @property
+    def cr_await(self):
+        """
+        What the wrapped coroutine is waiting on
+        """
+
+        return getattr(self._coro, 'cr_await', None)
+
+    @property
+    def cr_code(self):
+        """
+        The code of the wrapped coroutine
+        """
+
+        return getattr(self._coro, 'cr_code', None)
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a thread from a background thread and counts the
+    folded stacks
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        """
+        Setup a profiler for the thread with the given identifier
+        """
+
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.started = None
+
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        """
+        Whether the profiler is sampling
+        """
+
+        return self._thread is not None
+
+    def start(self):
+        """
+        Start sampling
+        """
+
+        self.samples.clear()
+        self.started = time.monotonic()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self, top=50):
+        """
+        Stop sampling and return the most common stacks
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        return {
+            'duration': time.monotonic() - self.started,
+            'samples': sum(self.samples.values()),
+            'stacks': [
+                {'stack': stack, 'count': count}
+                for stack, count in self.samples.most_common(top)
+            ],
+        }
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id) # pylint: disable=protected-access
+            if frame is not None:
+                self.samples[fold_stack(frame)] += 1
+            del frame
+
+
+# pylint: disable=too-many-instance-attributes
+class LoopMonitor(object):
+    """
+    Measures the health of an event loop
+    """
+
+    SLOW_HISTORY = 20
+
+    # Pings per slow callback threshold, a block is found at most a fraction
+    # of the threshold late
+    WATCHDOG_PINGS = 4
+
+    def __init__(self, monitor_conf, loop=None):
+        """
+        Setup the monitor from its configuration, it is not started
+        """
+
+        self.heartbeat_interval = monitor_conf['heartbeat_interval']
+        self.slow_callback = monitor_conf['slow_callback']
+        self.profile_interval = monitor_conf['profile_interval']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.lag = mcadminpanel.agent.metrics.RingBuffer(
+            max(int(60 / self.heartbeat_interval), 1),
+        )
+        self.max_lag = 0.0
+        self.slow_callbacks = collections.deque(maxlen=LoopMonitor.SLOW_HISTORY)
+        self.slow_count = 0
+        self.task_cpu = {} if monitor_conf['task_cpu'] else None
+        self.gauges = {}
+        self.profiler = None
+
+        self._thread_id = None
+        self._heartbeat = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+
+    def add_gauge(self, name, gauge):
+        """
+        Report the value returned by calling gauge, such as a queue depth,
+        with the stats
+        """
+
+        self.gauges[name] = gauge
+
+    def start(self):
+        """
+        Start monitoring, must be called from the thread running the loop
+        """
+
+        self._thread_id = threading.get_ident()
+
+        if self.task_cpu is not None:
+            self.loop.set_task_factory(self._task_factory)
+
+        self._heartbeat = asyncio.ensure_future(self._beat(), loop=self.loop)
+
+        self._stopping.clear()
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        """
+        Stop monitoring
+        """
+
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.stop()
+
+        self._stopping.set()
+        if self._watchdog is not None:
+            await self.loop.run_in_executor(None, self._watchdog.join)
+            self._watchdog = None
+
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.wait([self._heartbeat])
+            self._heartbeat = None
+
+        if self.task_cpu is not None:
+            self.loop.set_task_factory(None)
+
+    def stats(self):
+        """
+        The current health of the loop
+        """
+
+        lags = self.lag.tolist()
+
+        result = {
+            'lag': {
+                'last': lags[-1] if lags else None,
+                'mean': sum(lags) / len(lags) if lags else None,
+                'max': self.max_lag,
+            },
+            'slow_callbacks': {
+                'count': self.slow_count,
+                'recent': list(self.slow_callbacks),
+            },
+            'tasks': len(all_tasks(self.loop)),
+            'ready': len(getattr(self.loop, '_ready', ())),
+            'scheduled': len(getattr(self.loop, '_scheduled', ())),
+            'queues': {name: gauge() for name, gauge in self.gauges.items()},
+            'profiling': self.profiler is not None and self.profiler.running,
+        }
+
+        if self.task_cpu is not None:
+            result['task_cpu'] = {
+                name: {'steps': steps, 'cpu': cpu}
+                for name, (steps, cpu) in sorted(
+                    self.task_cpu.items(),
+                    key=lambda item: item[1][1],
+                    reverse=True,
+                )[:20]
+            }
+
+        return result
+
+    def api_routes(self):
+        """
+        The control API commands for inspecting the event loop
+        """
+
+        return {
+            'loop_stats': self.api_loop_stats,
+            'profile_start': self.api_profile_start,
+            'profile_stop': self.api_profile_stop,
+        }
+
+    def api_loop_stats(self):
+        """
+        API command returning the health of the event loop
+        """
+
+        return self.stats()
+
+    def api_profile_start(self, interval=None):
+        """
+        API command starting the sampling profiler
+        """
+
+        if self.profiler is not None and self.profiler.running:
+            raise mcadminpanel.agent.errors.MCAdminPanelError('The profiler is already running')
+
+        self.profiler = SamplingProfiler(
+            self._thread_id,
+            interval if interval is not None else self.profile_interval,
+        )
+        self.profiler.start()
+
+    async def api_profile_stop(self, top=50):
+        """
+        API command stopping the sampling profiler and returning the most
+        common stacks of the loop thread
+        """
+
+        if self.profiler is None or not self.profiler.running:
+            raise mcadminpanel.agent.errors.MCAdminPanelError('The profiler is not running')
+
+        return await self.loop.run_in_executor(None, self.profiler.stop, top)
+
+    def _task_factory(self, loop, coro, **kwargs):
+        return asyncio.Task(TimedCoroutine(coro, self.task_cpu), loop=loop, **kwargs)
+
+    async def _beat(self):
+        while True:
+            started = self.loop.time()
+            await asyncio.sleep(self.heartbeat_interval)
+
+            lag = max(self.loop.time() - started - self.heartbeat_interval, 0.0)
+            self.lag.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def _watch(self):
+        interval = self.slow_callback / LoopMonitor.WATCHDOG_PINGS
+        while not self._stopping.wait(interval):
+            sent = time.monotonic()
+            answered = threading.Event()
+            try:
+                self.loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:
+                return
+
+            if answered.wait(self.slow_callback):
+                continue
+
+            frame = sys._current_frames().get(self._thread_id) # pylint: disable=protected-access
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            del frame
+
+            while not answered.wait(self.slow_callback):
+                if self._stopping.is_set():
+                    return
+
+            duration = time.monotonic() - sent
+            self.slow_count += 1
+            self.slow_callbacks.append({
+                'timestamp': time.time(),
+                'duration': duration,
+                'stack': stack,
+            })
+            logging.warning('Event loop blocked for %.3fs in:\n%s', duration, stack)
+# pylint: enable=too-many-instance-attributes
+
@@ -0,0 +1,295 @@
+"""
+Creation of new servers from template directories.
+
+A template is a server directory ready to be copied, with the server jar,
+its plugins, the configuration files and maybe a world. It is cloned into
+the directory of the new server as cheaply as the file system allows:
+
+* the server jar and plugins are hard links to the artifact store, so they
+  are never copied at all,
+* other files are reflinked on copy on write file systems such as btrfs or
+  XFS, sharing their blocks until the server writes to them,
+* or copied inside the kernel with copy_file_range, which some file systems
+  turn into a server side copy or a reflink on their own.
+
+Files are cloned from a pool of threads as most of the time is spent waiting
+on the file system. The tree is built in a staging directory that is renamed
+into place once server.properties has been rendered from the configuration
+of the server, so a failed provisioning leaves nothing behind.
+"""
+
+import collections
+import concurrent.futures
+import fcntl
+import os
+import os.path
+import re
+import shutil
+import time
+
+import mcadminpanel.agent.artifacts
+import mcadminpanel.agent.backup
+import mcadminpanel.agent.errors
+
+PROPERTIES_FILE = 'server.properties'
+
+# Buffer size of the plain copies
+COPY_BUFFER = 1024 * 1024
+
+# Escapes of the values in server.properties
+ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|.)')
+
+ESCAPED_CHARACTERS = {'n': '\n', 'r': '\r', 't': '\t', 'f': '\f'}
+
+def copy_file(source, target, method='auto'):
+    """
+    Copy a regular file with the given method and return the method used,
+    auto tries a reflink then falls back on copy_file_range
+    """
+
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        if method in ('auto', 'reflink'):
+            try:
+                fcntl.ioctl(
+                    target_file.fileno(),
+                    mcadminpanel.agent.artifacts.FICLONE,
+                    source_file.fileno(),
+                )
+                method = 'reflink'
+            except OSError:
+                if method == 'reflink':
+                    raise
+                method = 'copy_file_range'
+
+        if method == 'copy':
+            shutil.copyfileobj(source_file, target_file, COPY_BUFFER)
+        elif method == 'copy_file_range':
+            mcadminpanel.agent.backup.copy_range(
+                source_file.fileno(),
+                target_file.fileno(),
+                0,
+                os.fstat(source_file.fileno()).st_size,
+            )
+
+    shutil.copymode(source, target)
+
+    return method
+
+def copy_directories(source, target):
+    """
+    Create the directories and symbolic links of a tree and return the
+    (source, target) pairs of its regular files
+    """
+
+    files = []
+    for root, directories, names in os.walk(source):
+        directory = os.path.normpath(os.path.join(target, os.path.relpath(root, source)))
+        os.makedirs(directory, exist_ok=True)
+        shutil.copymode(root, directory)
+
+        for name in directories + names:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(directory, name))
+            elif name in names and os.path.isfile(path):
+                files.append((path, os.path.join(directory, name)))
+
+    return files
+
+def clone_tree(source, target, method='auto', workers=8, store=None):
+    """
+    Clone a directory tree and return the clone stats, the artifacts of the
+    tree are linked from the store when one is given
+    """
+
+    files = copy_directories(source, target)
+    size = sum(os.path.getsize(path) for path, _ in files)
+    methods = collections.Counter()
+
+    if store is not None:
+        artifacts = set(mcadminpanel.agent.artifacts.find_artifacts(source, store.patterns))
+        inodes = store.inodes()
+        for path, copy in files:
+            if path not in artifacts:
+                continue
+
+            stat = os.stat(path)
+            digest = inodes.get((stat.st_dev, stat.st_ino))
+            if digest is None:
+                digest, _ = store.add(path)
+            methods[store.place(digest, copy)] += 1
+        files = [(path, copy) for path, copy in files if path not in artifacts]
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        methods.update(pool.map(lambda pair: copy_file(pair[0], pair[1], method), files))
+
+    return {
+        'files': sum(methods.values()),
+        'bytes': size,
+        'methods': dict(methods),
+    }
+
+def property_value(value):
+    """
+    The text of a value in server.properties
+    """
+
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n')
+
+def property_text(value):
+    """
+    The value of an escaped server.properties value
+    """
+
+    def unescape(match):
+        escape = match.group(1)
+        if len(escape) == 5:
+            return chr(int(escape[1:], 16))
+        return ESCAPED_CHARACTERS.get(escape, escape)
+
+    return ESCAPE.sub(unescape, value)
+
+def parse_properties(text):
+    """
+    The properties set by the text of a server.properties file
+    """
+
+    properties = {}
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#!' or '=' not in stripped:
+            continue
+
+        key, value = stripped.split('=', 1)
+        properties[key.strip()] = property_text(value.strip())
+
+    return properties
+
+def read_properties(directory):
+    """
+    The properties of a server directory, empty if it has no
+    server.properties file
+    """
+
+    try:
+        with open(os.path.join(directory, PROPERTIES_FILE), 'r') as properties_file:
+            return parse_properties(properties_file.read())
+    except FileNotFoundError:
+        return {}
+
+def render_properties(text, properties):
+    """
+    Set properties in the text of a server.properties file, keeping its
+    comments and the order of its lines, new properties are added at the end
+    """
+
+    lines = text.splitlines()
+    remaining = dict(properties)
+
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#!':
+            continue
+
+        key = stripped.split('=', 1)[0].strip()
+        if key in remaining:
+            lines[index] = '{}={}'.format(key, property_value(remaining.pop(key)))
+
+    lines.extend(
+        '{}={}'.format(key, property_value(value))
+        for key, value in sorted(remaining.items())
+    )
+
+    return ''.join(line + '\n' for line in lines)
+
+def server_properties(server_conf):
+    """
+    The properties of a server set by its configuration
+    """
+
+    properties = dict(server_conf.get('properties') or {})
+
+    rcon_conf = server_conf.get('rcon')
+    if rcon_conf is not None:
+        properties.update({
+            'enable-rcon': True,
+            'rcon.port': rcon_conf['port'],
+            'rcon.password': rcon_conf['password'],
+        })
+
+    return properties
+
+def write_properties(directory, properties):
+    """
+    Render the server.properties file of a server directory
+    """
+
+    path = os.path.join(directory, PROPERTIES_FILE)
+    try:
+        with open(path, 'r') as properties_file:
+            text = properties_file.read()
+    except FileNotFoundError:
+        if not properties:
+            return
+        text = ''
+
+    mcadminpanel.agent.backup.write_atomic(
+        path,
+        render_properties(text, properties).encode('utf-8'),
+    )
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def provision(name, server_conf, directory, provision_conf, template=None, store=None):
+    """
+    Create the directory of a server from a template, the template of its
+    configuration by default, and return the provisioning stats
+    """
+
+    started = time.monotonic()
+
+    template = template or server_conf.get('template')
+    if template is None:
+        raise mcadminpanel.agent.errors.ProvisionError(
+            'Server {} has no template'.format(name),
+        )
+
+    source = os.path.join(provision_conf['templates'], template)
+    if not os.path.isdir(source):
+        raise mcadminpanel.agent.errors.ProvisionError('Unknown template {}'.format(template))
+
+    if os.path.isdir(directory) and os.listdir(directory):
+        raise mcadminpanel.agent.errors.ProvisionError(
+            'Directory {} of server {} is not empty'.format(directory, name),
+        )
+
+    staging = directory.rstrip(os.sep) + '.provisioning'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+
+    try:
+        stats = clone_tree(
+            source,
+            staging,
+            provision_conf['method'],
+            provision_conf['workers'],
+            store,
+        )
+        write_properties(staging, server_properties(server_conf))
+
+        if os.path.isdir(directory):
+            os.rmdir(directory)
+        os.rename(staging, directory)
+    except (OSError, mcadminpanel.agent.errors.MCAdminPanelError) as ex:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise mcadminpanel.agent.errors.ProvisionError(
+            'Unable to provision server {}: {}'.format(name, ex),
+        )
+
+    stats['template'] = template
+    stats['duration'] = time.monotonic() - started
+
+    return stats
+# pylint: enable=too-many-arguments,too-many-positional-arguments
@@ -0,0 +1,372 @@
+"""
+Client for the RCON protocol of Minecraft servers.
+
+RCON lets the agent run console commands on servers it did not start and
+so has no stdin for. Packets are length prefixed little endian frames of a
+request id, a packet type and a null terminated body. A server answers the
+packets of a connection in order, so many commands can be in flight on one
+connection. Long responses are split over several packets without saying
+how many, so every command is followed by a packet of an unknown type: the
+server's answer to it marks the end of the command's response.
+"""
+
+import asyncio
+import socket
+import struct
+
+import mcadminpanel.agent.errors
+
+PACKET = struct.Struct('<iii')
+
+TYPE_RESPONSE = 0
+TYPE_COMMAND = 2
+TYPE_LOGIN = 3
+TYPE_MARKER = 200
+
+# Longest command body a vanilla server accepts
+MAX_COMMAND = 1446
+
+# Largest packet accepted from a server
+MAX_PACKET = 65536
+
+def encode_packet(request_id, kind, body=''):
+    """
+    Encode a packet with its length prefix
+    """
+
+    payload = body.encode('utf-8') + b'\x00\x00'
+
+    return PACKET.pack(len(payload) + 8, request_id, kind) + payload
+
+async def read_packet(reader):
+    """
+    Read the next packet and return its request id, type and body
+    """
+
+    length, request_id, kind = PACKET.unpack(await reader.readexactly(PACKET.size))
+    if length < 10 or length > MAX_PACKET:
+        raise mcadminpanel.agent.errors.RconError(
+            'Invalid RCON packet length {}'.format(length),
+        )
+
+    payload = await reader.readexactly(length - 8)
+
+    return request_id, kind, payload[:-2].decode('utf-8', 'replace')
+
+
+# pylint: disable=too-many-instance-attributes
+class RconConnection(object):
+    """
+    A logged in RCON connection with pipelined commands
+    """
+
+    def __init__(self, reader, writer, loop=None):
+        """
+        Setup a connection on open streams, it is not logged in
+        """
+
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.last_used = self.loop.time()
+
+        self._reader = reader
+        self._writer = writer
+        self._next_id = 0
+        self._parts = {}
+        self._waiting = {}
+        self._receiver = None
+
+    @classmethod
+    async def connect(cls, host, port, password, loop=None):
+        """
+        Connect to a server and log in
+        """
+
+        reader, writer = await asyncio.open_connection(host, port)
+
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        connection = cls(reader, writer, loop=loop)
+        try:
+            await connection.login(password)
+        except BaseException:
+            writer.close()
+            raise
+
+        return connection
+
+    @property
+    def closed(self):
+        """
+        Whether the connection was closed or lost
+        """
+
+        return self._receiver is not None and self._receiver.done()
+
+    @property
+    def in_flight(self):
+        """
+        Number of commands waiting for their response
+        """
+
+        return len(self._waiting)
+
+    async def login(self, password):
+        """
+        Log in and start reading the responses
+        """
+
+        request_id = self._new_id()
+        self._writer.write(encode_packet(request_id, TYPE_LOGIN, password))
+        await self._writer.drain()
+
+        while True:
+            response_id, kind, _ = await read_packet(self._reader)
+            if kind != TYPE_COMMAND:
+                continue
+            if response_id == -1:
+                raise mcadminpanel.agent.errors.RconError('RCON login failed')
+            if response_id == request_id:
+                break
+
+        self._receiver = asyncio.ensure_future(self._receive(), loop=self.loop)
+
+    async def call(self, command):
+        """
+        Run a command and return its response
+        """
+
+        if len(command.encode('utf-8')) > MAX_COMMAND:
+            raise mcadminpanel.agent.errors.RconError(
+                'RCON commands are limited to {} bytes'.format(MAX_COMMAND),
+            )
+
+        command_id = self._new_id()
+        parts = self._parts[command_id] = []
+        try:
+            await self._send(encode_packet(command_id, TYPE_COMMAND, command))
+        finally:
+            del self._parts[command_id]
+
+        return ''.join(parts)
+
+    async def ping(self):
+        """
+        Make a round trip without running anything
+        """
+
+        await self._send(b'')
+
+    async def close(self):
+        """
+        Close the connection
+        """
+
+        self._writer.close()
+        if self._receiver is not None:
+            self._receiver.cancel()
+            await asyncio.wait([self._receiver])
+
+    def _new_id(self):
+        self._next_id = self._next_id % 0x7fffffff + 1
+
+        return self._next_id
+
+    async def _send(self, data):
+        if self.closed:
+            raise mcadminpanel.agent.errors.RconError('RCON connection is closed')
+
+        marker_id = self._new_id()
+        future = self._waiting[marker_id] = self.loop.create_future()
+        self.last_used = self.loop.time()
+        try:
+            self._writer.write(data + encode_packet(marker_id, TYPE_MARKER))
+            await self._writer.drain()
+            await future
+        finally:
+            self._waiting.pop(marker_id, None)
+
+    async def _receive(self):
+        reason = 'closed'
+        try:
+            while True:
+                request_id, _, body = await read_packet(self._reader)
+
+                parts = self._parts.get(request_id)
+                if parts is not None:
+                    parts.append(body)
+                    continue
+
+                future = self._waiting.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(None)
+        except asyncio.IncompleteReadError:
+            reason = 'closed by the server'
+        except (OSError, mcadminpanel.agent.errors.RconError) as ex:
+            reason = 'lost: {}'.format(ex)
+        finally:
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(mcadminpanel.agent.errors.RconError(
+                        'RCON connection {}'.format(reason),
+                    ))
+# pylint: enable=too-many-instance-attributes
+
+
+# pylint: disable=too-many-instance-attributes
+class RconPool(object):
+    """
+    Pool of RCON connections to a server.
+
+    Commands go to the least busy connection, a new connection is opened
+    while every open one is busy and the pool is not full. Connections that
+    were lost are dropped and replaced on the next command. Idle connections
+    are pinged every keepalive seconds so lost ones are found early.
+    Commands are never retried since the server may have run them already.
+    """
+
+    def __init__(self, rcon_conf, loop=None):
+        """
+        Setup an empty pool for the configured server
+        """
+
+        self.conf = rcon_conf
+        self.host = rcon_conf['host']
+        self.port = rcon_conf['port']
+        self.password = rcon_conf['password']
+        self.size = rcon_conf['pool_size']
+        self.keepalive = rcon_conf['keepalive']
+        self.timeout = rcon_conf['timeout']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.connections = []
+        self.opened = 0
+
+        self._connecting = []
+        self._keepalive_task = None
+
+    async def execute(self, command):
+        """
+        Run a command on one of the connections and return its response
+        """
+
+        connection = await self._connection()
+        try:
+            return await asyncio.wait_for(connection.call(command), self.timeout)
+        except asyncio.TimeoutError:
+            raise mcadminpanel.agent.errors.RconError(
+                'RCON command {} timed out after {}s'.format(command, self.timeout),
+            )
+
+    async def close(self):
+        """
+        Stop the keepalive and close every connection
+        """
+
+        connecting = list(self._connecting)
+        for task in connecting:
+            task.cancel()
+        if connecting:
+            await asyncio.wait(connecting)
+
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            await asyncio.wait([self._keepalive_task])
+            self._keepalive_task = None
+
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+
+    def stats(self):
+        """
+        Counters of the pool
+        """
+
+        return {
+            'connections': len(self.connections),
+            'in_flight': sum(connection.in_flight for connection in self.connections),
+            'opened': self.opened,
+        }
+
+    async def _connection(self):
+        self.connections = [
+            connection for connection in self.connections
+            if not connection.closed
+        ]
+
+        least_busy = min(
+            self.connections,
+            key=lambda connection: connection.in_flight,
+            default=None,
+        )
+        if least_busy is not None and (
+                least_busy.in_flight == 0
+                or len(self.connections) + len(self._connecting) >= self.size
+        ):
+            return least_busy
+
+        if least_busy is None and len(self._connecting) >= self.size:
+            # Every slot is being connected, share the first one that opens
+            return await asyncio.shield(self._connecting[0])
+
+        # The slot is reserved before connecting so other commands go on
+        # using the open connections meanwhile
+        task = asyncio.ensure_future(self._open(), loop=self.loop)
+        self._connecting.append(task)
+        task.add_done_callback(self._opened)
+
+        try:
+            return await asyncio.shield(task)
+        except mcadminpanel.agent.errors.RconError:
+            if least_busy is not None:
+                return least_busy
+            raise
+
+    async def _open(self):
+        try:
+            connection = await asyncio.wait_for(
+                RconConnection.connect(self.host, self.port, self.password, loop=self.loop),
+                self.timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as ex:
+            raise mcadminpanel.agent.errors.RconError(
+                'Unable to connect to RCON at {}:{}: {}'.format(
+                    self.host,
+                    self.port,
+                    str(ex) or 'timed out',
+                ),
+            )
+
+        self.connections.append(connection)
+        self.opened += 1
+
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.ensure_future(self._keep_alive(), loop=self.loop)
+
+        return connection
+
+    def _opened(self, task):
+        self._connecting.remove(task)
+
+        # The commands that waited for the connection may have given up
+        if not task.cancelled():
+            task.exception()
+
+    async def _keep_alive(self):
+        while True:
+            await asyncio.sleep(self.keepalive)
+
+            for connection in list(self.connections):
+                if connection.closed or connection.in_flight:
+                    continue
+                if self.loop.time() - connection.last_used < self.keepalive:
+                    continue
+
+                try:
+                    await asyncio.wait_for(connection.ping(), self.timeout)
+                except (mcadminpanel.agent.errors.RconError, asyncio.TimeoutError):
+                    await connection.close()
+# pylint: enable=too-many-instance-attributes
+
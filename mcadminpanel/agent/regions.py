@@ -0,0 +1,377 @@
+"""
+Analysis of the region files of the server worlds.
+
+Anvil region files start with an 8 KiB header: the location of each of the
+1024 chunks as a 3 byte sector offset and a 1 byte sector count, then the
+last save time of each chunk. The header is read through mmap so only its
+pages are ever read from disk, which is enough to count the chunks and find
+the oversized ones. Finding the chunks that players never stayed in needs
+their InhabitedTime, only then the compressed data of every chunk is read.
+
+Regions are scanned in a process pool and the results are cached by the
+size and modification time of each region file, so scanning again only
+reads the regions that changed. Statistics are reported one world at a
+time as soon as the world is done.
+"""
+
+import concurrent.futures
+import gzip
+import json
+import mmap
+import os
+import os.path
+import re
+import struct
+import zlib
+
+import mcadminpanel.agent.backup
+
+SECTOR = 4096
+
+HEADER_SIZE = 2 * SECTOR
+
+CHUNKS = 1024
+
+LOCATIONS = struct.Struct('>1024I')
+TIMESTAMPS = struct.Struct('>1024I')
+CHUNK_HEADER = struct.Struct('>IB')
+
+COMPRESSION_GZIP = 1
+COMPRESSION_ZLIB = 2
+COMPRESSION_NONE = 3
+
+# Flag of the compression type of chunks stored in their own .mcc file
+COMPRESSION_EXTERNAL = 0x80
+
+REGION_FILE = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.mca$')
+
+EXTERNAL_FILE = re.compile(r'^c\.(-?\d+)\.(-?\d+)\.mcc$')
+
+# NBT long tag named InhabitedTime, followed by the value
+INHABITED_TIME = b'\x04\x00\x0dInhabitedTime'
+
+def read_locations(mapped):
+    """
+    The (chunk index, sector offset, sector count, timestamp) of every
+    chunk stored in a mapped region file
+    """
+
+    locations = LOCATIONS.unpack_from(mapped, 0)
+    timestamps = TIMESTAMPS.unpack_from(mapped, SECTOR)
+
+    return [
+        (index, location >> 8, location & 0xff, timestamps[index])
+        for index, location in enumerate(locations)
+        if location
+    ]
+
+def inhabited_time(mapped, offset, external=None):
+    """
+    The InhabitedTime of the chunk at a sector offset, None if it can not be
+    read
+    """
+
+    start = offset * SECTOR
+    try:
+        length, compression = CHUNK_HEADER.unpack_from(mapped, start)
+    except struct.error:
+        return None
+
+    try:
+        if compression & COMPRESSION_EXTERNAL:
+            if external is None:
+                return None
+            with open(external, 'rb') as external_file:
+                payload = external_file.read()
+        else:
+            payload = mapped[start + CHUNK_HEADER.size:start + CHUNK_HEADER.size + length - 1]
+
+        compression &= ~COMPRESSION_EXTERNAL
+        if compression == COMPRESSION_ZLIB:
+            payload = zlib.decompress(payload)
+        elif compression == COMPRESSION_GZIP:
+            payload = gzip.decompress(payload)
+        elif compression != COMPRESSION_NONE:
+            return None
+    except (OSError, zlib.error, EOFError):
+        return None
+
+    position = payload.find(INHABITED_TIME)
+    if position < 0:
+        return None
+
+    return struct.unpack_from('>q', payload, position + len(INHABITED_TIME))[0]
+
+def region_coordinates(path):
+    """
+    The region coordinates in the name of a region file
+    """
+
+    match = REGION_FILE.match(os.path.basename(path))
+
+    return int(match.group(1)), int(match.group(2))
+
+def external_chunk(path, index):
+    """
+    The path of the external file of a chunk of a region
+    """
+
+    region_x, region_z = region_coordinates(path)
+
+    return os.path.join(
+        os.path.dirname(path),
+        'c.{}.{}.mcc'.format(region_x * 32 + index % 32, region_z * 32 + index // 32),
+    )
+
+def scan_region(path, oversized, inhabited_below=None):
+    """
+    Statistics of a region file, chunks of at least oversized bytes are
+    reported and chunks inhabited for fewer than inhabited_below ticks are
+    counted as unvisited when it is given
+    """
+
+    stats = {
+        'chunks': 0,
+        'sectors': 0,
+        'oversized': [],
+        'unvisited': None if inhabited_below is None else 0,
+        'oldest': None,
+        'newest': None,
+        'error': None,
+    }
+
+    try:
+        with open(path, 'rb') as region_file:
+            if os.fstat(region_file.fileno()).st_size < HEADER_SIZE:
+                return stats
+
+            with mmap.mmap(region_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                scan_chunks(path, mapped, stats, oversized, inhabited_below)
+    except (OSError, ValueError) as ex:
+        stats['error'] = str(ex)
+
+    return stats
+
+def scan_chunks(path, mapped, stats, oversized, inhabited_below):
+    """
+    Add the chunks of a mapped region file to its statistics
+    """
+
+    for index, offset, sectors, timestamp in read_locations(mapped):
+        stats['chunks'] += 1
+        stats['sectors'] += sectors
+        if sectors * SECTOR >= oversized:
+            stats['oversized'].append(index)
+        if timestamp:
+            stats['oldest'] = min(timestamp, stats['oldest'] or timestamp)
+            stats['newest'] = max(timestamp, stats['newest'] or timestamp)
+
+        if inhabited_below is not None:
+            ticks = inhabited_time(mapped, offset, external_chunk(path, index))
+            if ticks is not None and ticks < inhabited_below:
+                stats['unvisited'] += 1
+
+def find_worlds(directory):
+    """
+    The (world, region directory) pairs under a server directory, a world is
+    named by the path of the directory holding its region directory
+    """
+
+    for current, directories, files in os.walk(directory):
+        directories.sort()
+        if os.path.basename(current) != 'region':
+            continue
+        if not any(REGION_FILE.match(name) for name in files):
+            continue
+
+        world = os.path.relpath(os.path.dirname(current), directory)
+        yield world, current
+
+def list_regions(region_directory):
+    """
+    The region files of a region directory with their size and modification
+    time, and the number of external chunk files
+    """
+
+    regions = []
+    external = 0
+    for entry in os.scandir(region_directory):
+        if REGION_FILE.match(entry.name):
+            stat = entry.stat()
+            regions.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        elif EXTERNAL_FILE.match(entry.name):
+            external += 1
+
+    return sorted(regions), external
+
+
+class RegionCache(object):
+    """
+    Region statistics kept on disk by the size and modification time of
+    each region file
+    """
+
+    def __init__(self, path):
+        """
+        Setup the cache at the given path, nothing is cached without a path
+        """
+
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+
+    def load(self):
+        """
+        Read the cached statistics, a missing or damaged cache is empty
+        """
+
+        if not self.path:
+            return
+
+        try:
+            with open(self.path, 'r') as cache_file:
+                self.entries = json.load(cache_file)['regions']
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries = {}
+
+    def save(self):
+        """
+        Write the cached statistics
+        """
+
+        if not self.path:
+            return
+
+        mcadminpanel.agent.backup.write_json(self.path, {'regions': self.entries})
+
+    def get(self, path, key):
+        """
+        The cached statistics of a region if its file did not change
+        """
+
+        entry = self.entries.get(path)
+        if entry is None or entry['key'] != key:
+            return None
+
+        self.hits += 1
+
+        return entry['stats']
+
+    def put(self, path, key, stats):
+        """
+        Cache the statistics of a region
+        """
+
+        self.entries[path] = {'key': key, 'stats': stats}
+
+
+# pylint: disable=too-few-public-methods
+class WorldStats(object):
+    """
+    Running totals of the statistics of the regions of a world
+    """
+
+    def __init__(self, server, world):
+        """
+        Setup empty totals for a world
+        """
+
+        self.summary = {
+            'server': server,
+            'world': world,
+            'regions': 0,
+            'size': 0,
+            'chunks': 0,
+            'used': 0,
+            'oversized': 0,
+            'external': 0,
+            'unvisited': None,
+            'oldest': None,
+            'newest': None,
+            'prunable': [],
+            'oversized_regions': [],
+            'errors': [],
+        }
+
+    def add(self, path, size, stats):
+        """
+        Add the statistics of a region
+        """
+
+        summary = self.summary
+        name = os.path.basename(path)
+
+        summary['regions'] += 1
+        summary['size'] += size
+        summary['chunks'] += stats['chunks']
+        summary['used'] += stats['sectors'] * SECTOR
+        summary['oversized'] += len(stats['oversized'])
+
+        if stats['error'] is not None:
+            summary['errors'].append({'region': name, 'error': stats['error']})
+        if stats['oversized']:
+            summary['oversized_regions'].append(name)
+        if stats['unvisited'] is not None:
+            summary['unvisited'] = (summary['unvisited'] or 0) + stats['unvisited']
+            if stats['chunks'] and stats['unvisited'] == stats['chunks']:
+                summary['prunable'].append(name)
+
+        for field, pick in (('oldest', min), ('newest', max)):
+            if stats[field] is not None:
+                current = summary[field]
+                summary[field] = stats[field] if current is None else pick(current, stats[field])
+# pylint: enable=too-few-public-methods
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def scan_world(pool, workers, cache, stats, region_directory, oversized, inhabited_below):
+    """
+    Add the regions of a world to its statistics, scanning the regions
+    missing from the cache in the pool of the given number of workers
+    """
+
+    regions, stats.summary['external'] = list_regions(region_directory)
+
+    pending = []
+    for path, size, mtime_ns in regions:
+        key = [size, mtime_ns, oversized, inhabited_below]
+        cached = cache.get(path, key)
+        if cached is not None:
+            stats.add(path, size, cached)
+        else:
+            pending.append((path, size, key))
+
+    for (path, size, key), result in zip(pending, pool.map(
+            scan_region,
+            [path for path, _, _ in pending],
+            [oversized] * len(pending),
+            [inhabited_below] * len(pending),
+            chunksize=max(1, len(pending) // (4 * workers)),
+    )):
+        stats.add(path, size, result)
+        if result['error'] is None:
+            cache.put(path, key, result)
+
+def analyze(directories, cache, oversized, inhabited_below=None, processes=None):
+    """
+    Scan the worlds of the given server directories, keyed by server name,
+    and yield the statistics of every world once it is done
+    """
+
+    workers = processes or os.cpu_count() or 1
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for server, directory in sorted(directories.items()):
+            for world, region_directory in find_worlds(directory):
+                stats = WorldStats(server, world)
+                scan_world(
+                    pool,
+                    workers,
+                    cache,
+                    stats,
+                    region_directory,
+                    oversized,
+                    inhabited_below,
+                )
+
+                yield stats.summary
+# pylint: enable=too-many-arguments,too-many-positional-arguments
@@ -0,0 +1,335 @@
+"""
+Typed and validated configuration values.
+
+A schema is made of Section classes listing their fields and the validator
+of each field. Validators check a raw JSON value and convert it into an
+immutable value: lists become tuples, objects become read only mappings and
+sections become Section instances. Errors name the exact path of the bad
+value, such as servers.survival.command[0].
+"""
+
+import collections.abc
+import numbers
+import types
+
+import mcadminpanel.agent.errors
+
+REQUIRED = object()
+
+def join_path(path, key):
+    """
+    The path of a key inside of an object
+    """
+
+    return '{}.{}'.format(path, key) if path else str(key)
+
+def describe(value):
+    """
+    A short description of the type of a JSON value for error messages
+    """
+
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, numbers.Number):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, (list, tuple)):
+        return 'list'
+
+    return 'object'
+
+def to_plain(value):
+    """
+    Convert a validated value back into plain JSON values
+    """
+
+    if isinstance(value, collections.abc.Mapping):
+        return {key: to_plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_plain(item) for item in value]
+
+    return value
+
+
+class Validator(object):
+    """
+    Base class for validators of a single value
+    """
+
+    expected = 'a value'
+
+    def __call__(self, value, path):
+        if not self.accepts(value):
+            self.fail(path, 'expected {}, got {}'.format(self.expected, describe(value)))
+
+        return self.convert(value, path)
+
+    @staticmethod
+    def fail(path, message):
+        """
+        Report an invalid value
+        """
+
+        raise mcadminpanel.agent.errors.SchemaError(path, message)
+
+    def accepts(self, value):
+        """
+        Whether the value has the right type
+        """
+
+        raise NotImplementedError()
+
+    def convert(self, value, path): # pylint: disable=unused-argument
+        """
+        Convert an accepted value into its immutable form
+        """
+
+        return value
+
+
+class String(Validator):
+    """
+    A string, optionally limited to a set of choices
+    """
+
+    expected = 'a string'
+
+    def __init__(self, choices=None):
+        self.choices = choices
+
+    def accepts(self, value):
+        return isinstance(value, str)
+
+    def convert(self, value, path):
+        if self.choices is None:
+            return value
+
+        # Choices are matched regardless of case and stored as listed
+        if value.lower() not in self.choices:
+            self.fail(
+                path,
+                'expected one of {}, got {!r}'.format(', '.join(self.choices), value),
+            )
+
+        return value.lower()
+
+
+class Boolean(Validator):
+    """
+    A boolean
+    """
+
+    expected = 'a boolean'
+
+    def accepts(self, value):
+        return isinstance(value, bool)
+
+
+class Number(Validator):
+    """
+    A number with optional bounds
+    """
+
+    expected = 'a number'
+
+    def __init__(self, minimum=None, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def accepts(self, value):
+        return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+    def convert(self, value, path):
+        if self.minimum is not None and value < self.minimum:
+            self.fail(path, 'must be at least {}, got {}'.format(self.minimum, value))
+        if self.maximum is not None and value > self.maximum:
+            self.fail(path, 'must be at most {}, got {}'.format(self.maximum, value))
+
+        return value
+
+
+class Integer(Number):
+    """
+    A whole number with optional bounds
+    """
+
+    expected = 'an integer'
+
+    def accepts(self, value):
+        return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+class Scalar(Validator):
+    """
+    A string, number or boolean
+    """
+
+    expected = 'a string, number or boolean'
+
+    def accepts(self, value):
+        return isinstance(value, (str, numbers.Real))
+
+
+class Optional(Validator):
+    """
+    A value that may also be null
+    """
+
+    def __init__(self, validator):
+        self.validator = validator
+        self.expected = '{} or null'.format(validator.expected)
+
+    def accepts(self, value):
+        return value is None or self.validator.accepts(value)
+
+    def convert(self, value, path):
+        if value is None:
+            return None
+
+        return self.validator(value, path)
+
+
+class ListOf(Validator):
+    """
+    A list of values, stored as a tuple
+    """
+
+    expected = 'a list'
+
+    def __init__(self, validator, min_length=0):
+        self.validator = validator
+        self.min_length = min_length
+
+    def accepts(self, value):
+        return isinstance(value, (list, tuple))
+
+    def convert(self, value, path):
+        if len(value) < self.min_length:
+            self.fail(path, 'must have at least {} items'.format(self.min_length))
+
+        return tuple(
+            self.validator(item, '{}[{}]'.format(path, index))
+            for index, item in enumerate(value)
+        )
+
+
+class MappingOf(Validator):
+    """
+    An object with arbitrary keys, stored as a read only mapping
+    """
+
+    expected = 'an object'
+
+    def __init__(self, validator):
+        self.validator = validator
+
+    def accepts(self, value):
+        return isinstance(value, collections.abc.Mapping)
+
+    def convert(self, value, path):
+        return types.MappingProxyType({
+            key: self.validator(item, join_path(path, key))
+            for key, item in value.items()
+        })
+
+
+class SectionOf(Validator):
+    """
+    An object with a fixed set of fields described by a Section class
+    """
+
+    expected = 'an object'
+
+    def __init__(self, section):
+        self.section = section
+
+    def accepts(self, value):
+        return isinstance(value, collections.abc.Mapping)
+
+    def convert(self, value, path):
+        return self.section.build(value, path)
+
+
+class Section(collections.abc.Mapping):
+    """
+    An immutable group of validated configuration values.
+
+    Subclasses list their fields in FIELDS as (name, validator, default)
+    tuples, a REQUIRED default means the field has to be given, and name the
+    same fields in __slots__. Values are stored in slots so reading them is as
+    cheap as a normal attribute. For compatibility with plain dictionaries
+    fields can also be read by key.
+    """
+
+    __slots__ = ()
+
+    FIELDS = ()
+
+    def __init__(self, **values):
+        for name, _, _ in self.FIELDS:
+            object.__setattr__(self, name, values[name])
+
+    @classmethod
+    def build(cls, raw, path=''):
+        """
+        Validate a raw JSON object and build the section from it
+        """
+
+        names = set(name for name, _, _ in cls.FIELDS)
+        for key in sorted(raw):
+            if key not in names:
+                Validator.fail(join_path(path, key), 'unknown option')
+
+        values = {}
+        for name, validator, default in cls.FIELDS:
+            if name in raw:
+                values[name] = validator(raw[name], join_path(path, name))
+            elif default is REQUIRED:
+                Validator.fail(join_path(path, name), 'missing required option')
+            else:
+                values[name] = default
+
+        return cls(**values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Configuration values are read only')
+
+    def __delattr__(self, name):
+        raise AttributeError('Configuration values are read only')
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __iter__(self):
+        return (name for name, _, _ in self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Mapping):
+            return NotImplemented
+
+        return to_plain(self) == to_plain(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(
+            type(self).__name__,
+            ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self),
+        )
+
+    def to_dict(self):
+        """
+        The section as plain JSON values
+        """
+
+        return to_plain(self)
+
@@ -0,0 +1,811 @@
+"""
+Supervision of the Minecraft server processes managed by the agent
+"""
+
+import asyncio
+import logging
+import os.path
+import time
+
+import psutil
+
+import mcadminpanel.agent.cds
+import mcadminpanel.agent.commands
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.limits
+import mcadminpanel.agent.logparser
+import mcadminpanel.agent.logstream
+
+def setting(server_conf, supervisor_conf, name):
+    """
+    A server setting, falling back on the supervisor wide setting
+    """
+
+    value = server_conf.get(name)
+
+    return value if value is not None else supervisor_conf[name]
+
+def release_process(process):
+    """
+    Close the pipes of a process started with asyncio and leave it running,
+    asyncio kills the processes of the transports it closes
+    """
+
+    transport = process._transport # pylint: disable=protected-access
+    popen = transport.get_extra_info('subprocess')
+    if popen.returncode is None:
+        # The transport only kills processes it has not seen exit
+        popen.returncode = 0
+
+    transport.close()
+
+# pylint: disable=too-many-instance-attributes
+class ServerProcess(object):
+    """
+    A single managed server process.
+
+    The process is started with asyncio so that its output pipes are read by
+    the event loop and a slow or stuck server never blocks any of the others.
+    Crashed servers are restarted with an exponential backoff. Servers left
+    running by a previous agent can be adopted, they are watched by polling
+    their process and restarted like any other server once they exit.
+
+    The console of an adopted server stayed with the agent that started it,
+    its commands can only go over RCON.
+    """
+
+    STOPPED = 'stopped'
+    STARTING = 'starting'
+    RUNNING = 'running'
+    BACKOFF = 'backoff'
+    STOPPING = 'stopping'
+
+    READ_SIZE = 65536
+
+    # Seconds between checks of an adopted process
+    ADOPTED_POLL = 1
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, directory, server_conf, supervisor_conf, loop=None):
+        """
+        Setup a server process description, the process is not started
+        """
+
+        self.name = name
+        self.directory = None
+        self.command = None
+        self.process = None
+        self.adopted = None
+        self.limits = None
+        self.limits_conf = None
+        self.configure(directory, server_conf, supervisor_conf)
+
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self.state = ServerProcess.STOPPED
+        self.restarts = 0
+        self.failures = 0
+        self.started_at = None
+        self.start_requested = None
+        self.start_latency = None
+        self.cds_mode = None
+        self.console = mcadminpanel.agent.logstream.LogStream()
+        self.log = self.console.subscribe(mcadminpanel.agent.logparser.LogParser(name))
+        self.log.add_listener(self._log_event)
+        self.commands = mcadminpanel.agent.commands.CommandPipeline(self, loop=self.loop)
+        self.listeners = []
+
+        self._task = None
+        self._stop_requested = None
+    # pylint: enable=too-many-arguments
+
+    def configure(self, directory, server_conf, supervisor_conf):
+        """
+        Apply a server configuration.
+
+        Returns whether the change only takes effect after a restart, changed
+        limits are applied to the running process.
+        """
+
+        command = list(server_conf['command'])
+        restart = (self.directory, self.command) != (directory, command)
+        limits_changed = server_conf.get('limits') != self.limits_conf
+
+        self.directory = directory
+        self.command = command
+        self.autostart = server_conf.get('autostart', True)
+        self.hibernate = server_conf.get('hibernate')
+        self.stop_commands = list(setting(server_conf, supervisor_conf, 'stop_commands'))
+        self.stop_timeout = setting(server_conf, supervisor_conf, 'stop_timeout')
+        self.restart_delay = supervisor_conf['restart_delay']
+        self.max_restart_delay = supervisor_conf['max_restart_delay']
+        self.reset_after = supervisor_conf['reset_after']
+        self.command_timeout = supervisor_conf['command_timeout']
+        self.command_batch_size = supervisor_conf['command_batch_size']
+        self.rcon_conf = server_conf.get('rcon')
+        self.limits_conf = server_conf.get('limits')
+        self.cgroup_root = supervisor_conf['cgroup_root']
+        self.archives = None
+        if supervisor_conf['cds_archives']:
+            self.archives = mcadminpanel.agent.cds.ArchiveCache(supervisor_conf['cds_archives'])
+
+        if limits_changed and self.pid is not None:
+            self.update_limits()
+
+        return restart
+
+    def update_limits(self):
+        """
+        Apply the configured limits to the running server process
+        """
+
+        previous = self.limits
+        self.limits = mcadminpanel.agent.limits.server_limits(
+            self.name,
+            self.limits_conf,
+            self.cgroup_root,
+        )
+        if self.limits is None and previous is not None:
+            # A server without limits is back to the default priorities
+            self.limits = mcadminpanel.agent.limits.ProcessLimits({
+                'cpu_weight': mcadminpanel.agent.limits.DEFAULT_WEIGHT,
+                'io_weight': mcadminpanel.agent.limits.DEFAULT_WEIGHT,
+            })
+
+        self._apply_limits(self.pid)
+
+    @property
+    def pid(self):
+        """
+        The PID of the running server process or None
+        """
+
+        if self.process is not None:
+            return self.process.pid
+        if self.adopted is not None:
+            return self.adopted.pid
+
+        return None
+
+    @property
+    def running(self):
+        """
+        Whether the server is being supervised
+        """
+
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """
+        Start supervising the server process
+        """
+
+        if self.running:
+            return self._task
+
+        self.start_requested = time.monotonic()
+        self._stop_requested = asyncio.Event()
+        self._task = asyncio.ensure_future(self._supervise(), loop=self.loop)
+
+        return self._task
+
+    def adopt(self, process):
+        """
+        Start supervising a server process the agent did not start, given as
+        a psutil process
+        """
+
+        if self.running:
+            return self._task
+
+        self.adopted = process
+
+        return self.start()
+
+    async def detach(self):
+        """
+        Stop supervising the server and leave its process running for the
+        next agent to adopt, returns whether a process was left running
+        """
+
+        process = self.process
+        running = (
+            (process is not None and process.returncode is None) or
+            self.adopted is not None
+        )
+
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        await self.commands.close()
+        if process is not None and process.returncode is None:
+            release_process(process)
+
+        self.state = ServerProcess.STOPPED
+        self.process = None
+        self.adopted = None
+
+        return running
+
+    async def stop(self):
+        """
+        Gracefully stop the server process and wait for the supervisor to
+        finish.
+
+        The stop commands are sent to the server's console so it can save its
+        world. If the server is still running after its stop timeout it is
+        killed. Returns how long the shutdown took and whether it was killed.
+        """
+
+        started = time.monotonic()
+        report = {'latency': 0.0, 'killed': False, 'returncode': None}
+
+        if not self.running:
+            await self.commands.close()
+            return report
+
+        self.state = ServerProcess.STOPPING
+        self._stop_requested.set()
+
+        process = self.process
+        if process is not None and process.returncode is None:
+            try:
+                for command in self.stop_commands:
+                    self.send_command(command)
+            except (mcadminpanel.agent.errors.ServerError, OSError):
+                process.terminate()
+        elif self.adopted is not None:
+            await self._stop_adopted()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), self.stop_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(
+                'Server %s did not stop within %ss, killing it',
+                self.name,
+                self.stop_timeout,
+            )
+            report['killed'] = True
+            if self.process is not None and self.process.returncode is None:
+                self.process.kill()
+            elif self.adopted is not None:
+                try:
+                    self.adopted.kill()
+                except psutil.NoSuchProcess:
+                    pass
+            await self._task
+
+        await self.commands.close()
+
+        if process is not None:
+            report['returncode'] = process.returncode
+        report['latency'] = time.monotonic() - started
+
+        return report
+
+    def send_command(self, command):
+        """
+        Write a console command to the server's stdin
+        """
+
+        self.check_console()
+        if self.process is None or self.process.returncode is not None:
+            raise mcadminpanel.agent.errors.ServerError(
+                'Server {} is not running'.format(self.name),
+            )
+
+        self.process.stdin.write(command.encode('utf-8') + b'\n')
+
+    def check_console(self):
+        """
+        Refuse to use the console of an adopted server, it has none
+        """
+
+        if self.adopted is not None:
+            raise mcadminpanel.agent.errors.ServerError(
+                'Server {} was adopted and has no console, its commands need RCON'.format(
+                    self.name,
+                ),
+            )
+
+    def notify(self, event, **data):
+        """
+        Tell the listeners about a lifecycle event of the server
+        """
+
+        for listener in self.listeners:
+            try:
+                listener(self.name, event, data)
+            except Exception: # pylint: disable=broad-except
+                logging.exception('Server event listener failed')
+
+    def describe(self):
+        """
+        A summary of the server's state
+        """
+
+        return {
+            'name': self.name,
+            'state': self.state,
+            'pid': self.pid,
+            'adopted': self.adopted is not None,
+            'console': self.adopted is None,
+            'directory': self.directory,
+            'restarts': self.restarts,
+            'start_latency': self.start_latency,
+            'cds': self.cds_mode,
+            'players': len(self.log.online),
+            'commands': self.commands.stats(),
+        }
+
+    def backoff_delay(self):
+        """
+        How long to wait before restarting after the current failure count
+        """
+
+        delay = self.restart_delay * (2 ** max(self.failures - 1, 0))
+
+        return min(delay, self.max_restart_delay)
+
+    async def _supervise(self):
+        while not self._stop_requested.is_set():
+            self.state = ServerProcess.STARTING
+
+            try:
+                returncode, runtime = await self._run_once()
+            except OSError as ex:
+                logging.error('Unable to start server %s: %s', self.name, ex)
+                returncode, runtime = None, 0
+
+            if self._stop_requested.is_set():
+                self.notify('stop', returncode=returncode, runtime=runtime)
+                break
+
+            self.notify('crash', returncode=returncode, runtime=runtime)
+
+            if runtime >= self.reset_after:
+                self.failures = 0
+            self.failures += 1
+
+            delay = self.backoff_delay()
+            logging.warning(
+                'Server %s exited with %s, restarting in %ss',
+                self.name,
+                returncode,
+                delay,
+            )
+
+            self.state = ServerProcess.BACKOFF
+            try:
+                await asyncio.wait_for(self._stop_requested.wait(), delay)
+            except asyncio.TimeoutError:
+                self.restarts += 1
+                self.start_requested = time.monotonic()
+
+        self.state = ServerProcess.STOPPED
+        self.process = None
+
+    async def _stop_adopted(self):
+        if self.rcon_conf is not None:
+            try:
+                for command in self.stop_commands:
+                    await self.commands.execute(command)
+                return
+            except mcadminpanel.agent.errors.ServerError as ex:
+                logging.warning('Unable to stop server %s over RCON: %s', self.name, ex)
+
+        try:
+            self.adopted.terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+    async def _run_adopted(self):
+        process = self.adopted
+        try:
+            uptime = time.time() - process.create_time()
+        except psutil.NoSuchProcess:
+            self.adopted = None
+            return None, 0
+
+        self.started_at = time.monotonic() - uptime
+        self.state = ServerProcess.RUNNING
+        self._apply_limits(process.pid)
+
+        logging.info('Adopted server %s (pid %s)', self.name, process.pid)
+        self.notify('start', pid=process.pid, adopted=True)
+
+        try:
+            while process.is_running() and process.status() != psutil.STATUS_ZOMBIE:
+                await asyncio.sleep(
+                    0.1 if self._stop_requested.is_set() else ServerProcess.ADOPTED_POLL,
+                )
+        except psutil.NoSuchProcess:
+            pass
+
+        self.adopted = None
+
+        return None, time.monotonic() - self.started_at
+
+    def _apply_limits(self, pid):
+        if self.limits is None:
+            return
+
+        try:
+            self.limits.attach(pid)
+        except (OSError, psutil.Error) as ex:
+            logging.warning('Unable to apply the limits of server %s: %s', self.name, ex)
+
+    async def _run_once(self):
+        self.limits = mcadminpanel.agent.limits.server_limits(
+            self.name,
+            self.limits_conf,
+            self.cgroup_root,
+        )
+        try:
+            if self.adopted is not None:
+                return await self._run_adopted()
+
+            return await self._run_process()
+        finally:
+            if self.limits is not None:
+                self.limits.cleanup()
+
+    async def _run_process(self):
+        launch = mcadminpanel.agent.cds.Launch(self.command, None, None, None)
+        if self.archives is not None:
+            launch = self.archives.launch(self.name, self.command, self.directory)
+        self.cds_mode = launch.mode
+
+        try:
+            return await self._run_command(launch.command)
+        finally:
+            if self.archives is not None:
+                self.archives.finish(launch)
+
+    async def _run_command(self, command):
+        self.process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=self.directory,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=self.limits.enter if isinstance(
+                self.limits,
+                mcadminpanel.agent.limits.CgroupLimits,
+            ) else None
+        )
+        self.started_at = time.monotonic()
+        self.state = ServerProcess.RUNNING
+        self._apply_limits(self.process.pid)
+
+        if self._stop_requested.is_set():
+            self.process.terminate()
+
+        logging.info('Started server %s (pid %s)', self.name, self.process.pid)
+        self.notify('start', pid=self.process.pid)
+
+        await asyncio.gather(
+            self._pump(self.process.stdout, 'stdout'),
+            self._pump(self.process.stderr, 'stderr'),
+        )
+        returncode = await self.process.wait()
+
+        return returncode, time.monotonic() - self.started_at
+
+    def _log_event(self, name, event): # pylint: disable=unused-argument
+        if event.event != 'ready' or self.start_requested is None:
+            return
+
+        self.start_latency = time.monotonic() - self.start_requested
+        self.start_requested = None
+
+        logging.info('Server %s is ready after %.2fs', self.name, self.start_latency)
+        self.notify(
+            'ready',
+            latency=self.start_latency,
+            startup=event.data['startup'],
+            cds=self.cds_mode,
+        )
+
+    async def _pump(self, stream, channel):
+        splitter = mcadminpanel.agent.logstream.LineSplitter()
+
+        while True:
+            data = await stream.read(ServerProcess.READ_SIZE)
+            if not data:
+                rest = splitter.flush()
+                if rest:
+                    self.console.publish(channel, rest)
+                return
+
+            for line in splitter.feed(data):
+                self.console.publish(channel, line)
+# pylint: enable=too-many-instance-attributes
+
+
+class Supervisor(object):
+    """
+    Supervisor for all of the servers configured on this node
+    """
+
+    def __init__(self, root, servers_conf, supervisor_conf, loop=None):
+        """
+        Setup the server processes from the configuration
+        """
+
+        self.root = root
+        self.supervisor_conf = supervisor_conf
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.servers = {}
+        self.listeners = []
+
+        for name, server_conf in servers_conf.items():
+            self.add_server(name, server_conf)
+
+    def server_directory(self, name, server_conf):
+        """
+        The directory a server lives in
+        """
+
+        return os.path.join(self.root, server_conf.get('directory') or name)
+
+    def add_server(self, name, server_conf):
+        """
+        Add a server to the supervisor without starting it
+        """
+
+        server = ServerProcess(
+            name,
+            self.server_directory(name, server_conf),
+            server_conf,
+            self.supervisor_conf,
+            loop=self.loop,
+        )
+        server.listeners = self.listeners
+        self.servers[name] = server
+
+        return server
+
+    def add_listener(self, listener):
+        """
+        Call listener(name, event, data) on the lifecycle events of every
+        server: start, ready, stop and crash, and hibernate and wake when
+        idle servers hibernate
+        """
+
+        self.listeners.append(listener)
+
+    def get(self, name):
+        """
+        Get a server by name
+        """
+
+        try:
+            return self.servers[name]
+        except KeyError:
+            raise mcadminpanel.agent.errors.ServerError(
+                'Unknown server: {}'.format(name),
+            )
+
+    def start(self):
+        """
+        Start all of the servers that should automatically start
+        """
+
+        for server in self.servers.values():
+            if server.autostart:
+                server.start()
+
+    def adopt(self, processes):
+        """
+        Adopt the server processes found by discovery, keyed by server name
+        """
+
+        for name, process in processes.items():
+            self.get(name).adopt(process)
+
+    async def stop(self):
+        """
+        Stop all of the servers at once.
+
+        Returns the total shutdown latency and the report of every server.
+        """
+
+        started = time.monotonic()
+
+        names = list(self.servers)
+        reports = await asyncio.gather(
+            *[self.servers[name].stop() for name in names]
+        )
+
+        return {
+            'latency': time.monotonic() - started,
+            'servers': dict(zip(names, reports)),
+        }
+
+    async def detach(self):
+        """
+        Stop supervising the servers and leave the running ones running for
+        the next agent to adopt, returns the names of those servers
+        """
+
+        names = sorted(self.servers)
+        detached = await asyncio.gather(
+            *[self.servers[name].detach() for name in names]
+        )
+
+        return [name for name, running in zip(names, detached) if running]
+
+    async def reconfigure(self, servers_conf, names=None):
+        """
+        Apply a new servers configuration.
+
+        Only the named servers are touched, or every server if no names are
+        given. Removed servers are stopped, new servers are started and
+        changed servers are only restarted if their command or directory
+        changed. Returns the names of the servers for each kind of change.
+        """
+
+        if names is None:
+            names = set(servers_conf) | set(self.servers)
+
+        changes = {'added': [], 'removed': [], 'restarted': [], 'updated': []}
+        restarts = []
+
+        for name in sorted(names):
+            server = self.servers.get(name)
+            server_conf = servers_conf.get(name)
+
+            if server_conf is None:
+                if server is not None:
+                    await server.stop()
+                    del self.servers[name]
+                    changes['removed'].append(name)
+            elif server is None:
+                server = self.add_server(name, server_conf)
+                if server.autostart:
+                    server.start()
+                changes['added'].append(name)
+            elif server.configure(
+                    self.server_directory(name, server_conf),
+                    server_conf,
+                    self.supervisor_conf,
+            ) and server.running:
+                restarts.append(server)
+                changes['restarted'].append(name)
+            else:
+                changes['updated'].append(name)
+
+        await asyncio.gather(*[server.stop() for server in restarts])
+        for server in restarts:
+            server.start()
+
+        return changes
+
+    def api_routes(self):
+        """
+        The control API commands for managing servers
+        """
+
+        return {
+            'list_servers': self.api_list_servers,
+            'start_server': self.api_start_server,
+            'stop_server': self.api_stop_server,
+            'stop_all_servers': self.api_stop_all_servers,
+            'send_command': self.api_send_command,
+            'run_command': self.api_run_command,
+            'broadcast': self.api_broadcast,
+            'console': self.api_console,
+            'server_log': self.api_server_log,
+        }
+
+    def api_list_servers(self):
+        """
+        API command listing every server and its state
+        """
+
+        return [
+            self.servers[name].describe()
+            for name in sorted(self.servers)
+        ]
+
+    def api_start_server(self, name):
+        """
+        API command starting a server
+        """
+
+        server = self.get(name)
+        server.start()
+
+        return server.describe()
+
+    async def api_stop_server(self, name):
+        """
+        API command stopping a server
+        """
+
+        server = self.get(name)
+        report = await server.stop()
+
+        result = server.describe()
+        result['shutdown'] = report
+
+        return result
+
+    async def api_stop_all_servers(self):
+        """
+        API command stopping every server and reporting the shutdown latency
+        """
+
+        return await self.stop()
+
+    def api_send_command(self, name, command):
+        """
+        API command sending a console command to a server
+        """
+
+        self.get(name).send_command(command)
+
+    async def api_run_command(self, name, command, pattern=None, timeout=None):
+        """
+        API command running a console command on a server and returning its
+        response
+        """
+
+        return await self.get(name).commands.execute(
+            command,
+            mcadminpanel.agent.commands.compile_pattern(pattern),
+            timeout,
+        )
+
+    async def api_broadcast(self, command, names=None, pattern=None, timeout=None):
+        """
+        API command running a console command on many servers at once, every
+        running server by default
+        """
+
+        if names is None:
+            servers = [
+                server for _, server in sorted(self.servers.items())
+                if server.state == ServerProcess.RUNNING
+            ]
+        else:
+            servers = [self.get(name) for name in names]
+
+        compiled = mcadminpanel.agent.commands.compile_pattern(pattern)
+        results = await asyncio.gather(
+            *[server.commands.execute(command, compiled, timeout) for server in servers],
+            return_exceptions=True
+        )
+
+        response = {}
+        for server, result in zip(servers, results):
+            if isinstance(result, mcadminpanel.agent.errors.MCAdminPanelError):
+                result = {'error': str(result)}
+            elif isinstance(result, Exception):
+                raise result
+            response[server.name] = result
+
+        return response
+
+    def api_console(self, name, lines=100):
+        """
+        API command returning the most recent console lines of a server
+        """
+
+        return [
+            line.decode('utf-8', 'replace')
+            for _, line in self.get(name).console.tail.get(lines)
+        ]
+
+    def api_server_log(self, name):
+        """
+        API command returning the live state parsed from a server's console,
+        the online players and the lag spikes
+        """
+
+        return self.get(name).log.state()
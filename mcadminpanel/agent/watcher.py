@@ -0,0 +1,176 @@
+"""
+Watching the configuration file for changes
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import os.path
+import struct
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+def load_inotify():
+    """
+    Load the inotify functions from libc, returns None if unavailable
+    """
+
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+# pylint: disable=too-many-instance-attributes
+class ConfigWatcher(object):
+    """
+    Calls back when the configuration file changes.
+
+    The directory of the file is watched with inotify where it is available
+    so that editors replacing the file are noticed too. Otherwise the file's
+    modification time is polled. Bursts of changes are debounced into a
+    single callback.
+    """
+
+    DEBOUNCE = 0.2
+
+    def __init__(self, path, callback, poll_interval=2, loop=None):
+        """
+        Setup a watcher for the given file, it is not started
+        """
+
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        self._fd = None
+        self._poller = None
+        self._pending = None
+        self._last_stat = None
+
+    @property
+    def method(self):
+        """
+        How changes are being detected
+        """
+
+        if self._fd is not None:
+            return 'inotify'
+        if self._poller is not None:
+            return 'poll'
+
+        return None
+
+    def start(self, use_inotify=True):
+        """
+        Start watching for changes
+        """
+
+        self._last_stat = self._stat()
+
+        libc = load_inotify() if use_inotify else None
+        if libc is not None:
+            inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if inotify_fd >= 0:
+                watch = libc.inotify_add_watch(
+                    inotify_fd,
+                    os.fsencode(os.path.dirname(self.path)),
+                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE,
+                )
+                if watch >= 0:
+                    self._fd = inotify_fd
+                    self.loop.add_reader(inotify_fd, self._read_events)
+                    return
+                os.close(inotify_fd)
+
+        logging.debug('inotify unavailable, polling %s', self.path)
+        self._poller = asyncio.ensure_future(self._poll(), loop=self.loop)
+
+    def stop(self):
+        """
+        Stop watching for changes
+        """
+
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+
+        name = os.fsencode(os.path.basename(self.path))
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            event_name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if event_name == name:
+                self._changed()
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+
+            stat = self._stat()
+            if stat != self._last_stat:
+                self._last_stat = stat
+                self._changed()
+
+    def _changed(self):
+        if self._pending is not None:
+            self._pending.cancel()
+
+        self._pending = self.loop.call_later(ConfigWatcher.DEBOUNCE, self._notify)
+
+    def _notify(self):
+        self._pending = None
+
+        try:
+            self.callback()
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Unable to apply configuration change')
+# pylint: enable=too-many-instance-attributes
+
@@ -0,0 +1,460 @@
+"""
+Running the agent as several worker processes.
+
+The servers are sharded across the workers with a consistent hash ring so
+that when a worker exits only its own servers move, each to the worker that
+owns the next point on the ring. The parent process keeps the pid file and
+routes the control API: commands about one server go to the worker owning
+it and every other command goes to every worker with the results merged.
+
+Servers keep running when their worker fails or is sent SIGUSR2, the worker
+taking them over adopts the running processes the same way a restarted agent
+does. A worker sent SIGTERM stops its servers before it exits, they are
+started again by the worker taking them over.
+"""
+
+import asyncio
+import bisect
+import collections
+import hashlib
+import logging
+import os
+import os.path
+import re
+import signal
+
+import mcadminpanel.agent.api
+import mcadminpanel.agent.errors
+
+# Points every worker has on the ring
+REPLICAS = 64
+
+# Seconds between attempts to connect to a worker that is starting
+CONNECT_RETRY = 0.1
+
+# Seconds between checks for exited workers while stopping them
+STOP_POLL = 0.1
+
+# Commands whose results are mappings keyed by server name
+MERGED_MAPPINGS = {'backup_all', 'broadcast', 'hibernation', 'metrics'}
+
+# Commands only sent to the workers owning the servers of their names
+SPLIT_BY_NAMES = {'broadcast', 'dedupe_artifacts'}
+
+def ring_hash(key):
+    """
+    The position of a key on the ring
+    """
+
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+def worker_path(path, index):
+    """
+    The path of a worker's own copy of a file, next to the agent's
+    """
+
+    base, extension = os.path.splitext(path)
+
+    return '{}.worker{}{}'.format(base, index, extension)
+
+def worker_paths(path):
+    """
+    The copies of a file the workers made, ordered by worker
+    """
+
+    base, extension = os.path.splitext(path)
+    pattern = re.compile(
+        re.escape(os.path.basename(base)) + r'\.worker([0-9]+)' + re.escape(extension),
+    )
+
+    try:
+        filenames = os.listdir(os.path.dirname(path) or '.')
+    except FileNotFoundError:
+        return []
+
+    indexes = {}
+    for filename in filenames:
+        match = pattern.fullmatch(filename)
+        if match is not None:
+            indexes[filename] = int(match.group(1))
+
+    return [
+        os.path.join(os.path.dirname(path), filename)
+        for filename in sorted(indexes, key=indexes.get)
+    ]
+
+def describe_status(status):
+    """
+    Describe the wait status of an exited process
+    """
+
+    if os.WIFSIGNALED(status):
+        return 'signal {}'.format(os.WTERMSIG(status))
+
+    return 'exit code {}'.format(os.WEXITSTATUS(status))
+
+
+class HashRing(object):
+    """
+    Consistent hash ring assigning keys to nodes
+    """
+
+    def __init__(self, nodes=(), replicas=REPLICAS):
+        """
+        Setup a ring with the given nodes
+        """
+
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = []
+
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """
+        Add a node to the ring
+        """
+
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = ring_hash('{}-{}'.format(node, replica))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        """
+        Remove a node from the ring, its keys move to the next nodes
+        """
+
+        self.nodes.discard(node)
+        kept = [
+            (point, owner)
+            for point, owner in zip(self._points, self._owners)
+            if owner != node
+        ]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def owner(self, key):
+        """
+        The node owning a key
+        """
+
+        if not self._points:
+            raise mcadminpanel.agent.errors.MCAdminPanelError('No nodes left on the ring')
+
+        index = bisect.bisect(self._points, ring_hash(key)) % len(self._points)
+
+        return self._owners[index]
+
+    def assign(self, keys):
+        """
+        Group keys by the node owning them
+        """
+
+        assignments = collections.defaultdict(list)
+        for key in sorted(keys):
+            assignments[self.owner(key)].append(key)
+
+        return dict(assignments)
+
+def merge_results(command, args, results):
+    """
+    Merge the results of a command sent to every worker, results is a list
+    of (worker index, result) pairs
+    """
+
+    if command == 'list_servers':
+        return sorted(
+            (server for _, servers in results for server in servers),
+            key=lambda server: server['name'],
+        )
+
+    if command == 'events':
+        events = sorted(
+            (event for _, worker_events in results for event in worker_events),
+            key=lambda event: event['timestamp'],
+        )
+        return events[:args.get('limit', 1000)]
+
+    if command == 'stop_all_servers':
+        servers = {}
+        for _, report in results:
+            servers.update(report['servers'])
+        return {
+            'latency': max((report['latency'] for _, report in results), default=0),
+            'servers': servers,
+        }
+
+    if command == 'profile_stop':
+        stacks = collections.Counter()
+        for _, profile in results:
+            for entry in profile['stacks']:
+                stacks[entry['stack']] += entry['count']
+        return {
+            'duration': max((profile['duration'] for _, profile in results), default=0),
+            'samples': sum(profile['samples'] for _, profile in results),
+            'stacks': [
+                {'stack': stack, 'count': count}
+                for stack, count in stacks.most_common(args.get('top', 50))
+            ],
+        }
+
+    if command in MERGED_MAPPINGS:
+        merged = {}
+        for _, result in results:
+            merged.update(result)
+        return merged
+
+    return {'worker{}'.format(index): result for index, result in results}
+
+
+# pylint: disable=too-many-instance-attributes
+class WorkerRouter(object):
+    """
+    Routes control API commands from the parent process to the workers and
+    moves the servers of exited workers to the remaining ones
+    """
+
+    def __init__(self, ring, workers_conf, loop=None):
+        """
+        Setup routing over the workers of a ring
+        """
+
+        self.ring = ring
+        self.connect_timeout = workers_conf['connect_timeout']
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.workers = {}
+        self.owners = {}
+        self.stopping = False
+        self.on_empty = None
+
+        self._clients = {}
+        self._connecting = asyncio.Lock()
+
+    def add_worker(self, index, pid, socket, servers):
+        """
+        Track a started worker and the servers it owns
+        """
+
+        self.workers[index] = {'pid': pid, 'socket': socket, 'servers': set(servers)}
+        for name in servers:
+            self.owners[name] = index
+
+    def owner(self, name):
+        """
+        The worker owning a server, unknown servers go to the worker the ring
+        would give them to so the error comes from a worker
+        """
+
+        index = self.owners.get(name)
+        if index is None or index not in self.workers:
+            index = self.ring.owner(name)
+
+        return index
+
+    async def call(self, command, args):
+        """
+        Run a command on the workers it concerns
+        """
+
+        if 'name' in args:
+            return await self.call_worker(self.owner(args['name']), command, args)
+
+        if command == 'events' and args.get('server') is not None:
+            return await self.call_worker(self.owner(args['server']), command, args)
+
+        if command in SPLIT_BY_NAMES and args.get('names') is not None:
+            groups = collections.defaultdict(list)
+            for name in args['names']:
+                groups[self.owner(name)].append(name)
+            indexes = sorted(groups)
+            results = await asyncio.gather(*[
+                self.call_worker(index, command, dict(args, names=groups[index]))
+                for index in indexes
+            ])
+        else:
+            indexes = sorted(self.workers)
+            results = await asyncio.gather(*[
+                self.call_worker(index, command, args)
+                for index in indexes
+            ])
+
+        return merge_results(command, args, list(zip(indexes, results)))
+
+    async def call_worker(self, index, command, args):
+        """
+        Run a command on one worker
+        """
+
+        client = await self._client(index)
+
+        return await client.request(command, args)
+
+    def reap(self):
+        """
+        Collect the workers that exited, SIGCHLD handler
+        """
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            for index, worker in list(self.workers.items()):
+                if worker['pid'] == pid:
+                    self.worker_exited(index, status)
+
+    def worker_exited(self, index, status):
+        """
+        Move the servers of an exited worker to the remaining workers
+        """
+
+        worker = self.workers.pop(index)
+        client = self._clients.pop(index, None)
+        if client is not None:
+            asyncio.ensure_future(client.close(), loop=self.loop)
+
+        if self.stopping:
+            return
+
+        logging.error(
+            'Agent worker %s (pid %s) exited with %s',
+            index,
+            worker['pid'],
+            describe_status(status),
+        )
+
+        self.ring.remove(index)
+        if not self.workers:
+            logging.error('No agent workers left')
+            if self.on_empty is not None:
+                self.on_empty()
+            return
+
+        groups = collections.defaultdict(list)
+        for name in sorted(worker['servers']):
+            owner = self.ring.owner(name)
+            self.owners[name] = owner
+            self.workers[owner]['servers'].add(name)
+            groups[owner].append(name)
+
+        for owner, names in groups.items():
+            asyncio.ensure_future(self._assign(owner, names, index), loop=self.loop)
+
+    async def stop(self, timeout, signum=signal.SIGTERM):
+        """
+        Stop every worker, killing the ones still running after the timeout.
+
+        The workers stop their servers on SIGTERM and leave them running on
+        SIGUSR2.
+        """
+
+        self.stopping = True
+
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+
+        self._signal_workers(signum)
+
+        deadline = self.loop.time() + timeout
+        while self.workers and self.loop.time() < deadline:
+            self.reap()
+            await asyncio.sleep(STOP_POLL)
+
+        if self.workers:
+            logging.warning(
+                'Killing agent workers %s',
+                ', '.join(str(index) for index in sorted(self.workers)),
+            )
+            self._signal_workers(signal.SIGKILL)
+            for index, worker in list(self.workers.items()):
+                os.waitpid(worker['pid'], 0)
+                del self.workers[index]
+
+    def api_routes(self):
+        """
+        The control API commands of the parent process
+        """
+
+        return {
+            'workers': self.api_workers,
+        }
+
+    def api_workers(self):
+        """
+        API command listing the workers and the servers they own
+        """
+
+        return [
+            {
+                'index': index,
+                'pid': self.workers[index]['pid'],
+                'servers': sorted(self.workers[index]['servers']),
+            }
+            for index in sorted(self.workers)
+        ]
+
+    async def _assign(self, index, names, previous):
+        try:
+            result = await self.call_worker(
+                index,
+                'assign_servers',
+                {'names': names, 'worker': previous},
+            )
+        except mcadminpanel.agent.errors.MCAdminPanelError as ex:
+            logging.error('Unable to move servers %s to worker %s: %s', ', '.join(names), index, ex)
+            return
+
+        logging.info(
+            'Worker %s took over servers %s (adopted %s)',
+            index,
+            ', '.join(names),
+            ', '.join(result['adopted']) or 'none',
+        )
+
+    async def _client(self, index):
+        async with self._connecting:
+            client = self._clients.get(index)
+            if client is not None and not client.closed:
+                return client
+
+            worker = self.workers.get(index)
+            if worker is None:
+                raise mcadminpanel.agent.errors.APIError(
+                    'Agent worker {} is not running'.format(index),
+                )
+
+            deadline = self.loop.time() + self.connect_timeout
+            while True:
+                try:
+                    client = await mcadminpanel.agent.api.APIClient.connect(
+                        socket=worker['socket'],
+                        loop=self.loop,
+                    )
+                    break
+                except OSError as ex:
+                    if self.loop.time() >= deadline:
+                        raise mcadminpanel.agent.errors.APIError(
+                            'Unable to reach agent worker {}: {}'.format(index, ex),
+                        )
+                    await asyncio.sleep(CONNECT_RETRY)
+
+            self._clients[index] = client
+
+            return client
+
+    def _signal_workers(self, signum):
+        for worker in self.workers.values():
+            try:
+                os.kill(worker['pid'], signum)
+            except ProcessLookupError:
+                pass
+# pylint: enable=too-many-instance-attributes
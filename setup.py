@@ -12,6 +12,9 @@ setuptools.setup(
     version='0.0.1',
     packages=setuptools.find_packages(),
     install_requires=REQUIREMENTS,
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
     entry_points="""
         [console_scripts]
         mcadminpanel-agent=mcadminpanel.agent.cli:mcadminpanel_agent
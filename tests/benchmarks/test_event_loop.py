@@ -0,0 +1,176 @@
+"""
+Benchmarks for the event loop backends.
+
+Each benchmark runs a piece of the agent's own workload on every installed
+backend: reading the console output of server processes through pipes and
+making control API calls over the Unix socket. The results are printed for
+comparison, uvloop has to be at least as fast as the standard library loop
+when it is installed.
+"""
+
+import asyncio
+import os.path
+import sys
+import tempfile
+import time
+import unittest
+
+import mcadminpanel.agent.api
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.eventloop
+import mcadminpanel.agent.logstream
+
+# Console lines written by each server process
+LINES = 20000
+
+SERVERS = 8
+
+# Control API calls made over each connection
+CALLS = 2000
+
+CONNECTIONS = 8
+
+SERVER_SCRIPT = (
+    'import sys\n'
+    'for index in range({}):\n'
+    '    sys.stdout.write("[12:00:00] [Server thread/INFO]: Tick %d\\n" % index)\n'
+).format(LINES)
+
+def installed_backends():
+    """
+    The backends that can be benchmarked here
+    """
+
+    backends = ['asyncio']
+    try:
+        mcadminpanel.agent.eventloop.loop_policy('uvloop')
+    except mcadminpanel.agent.errors.ConfigurationError:
+        pass
+    else:
+        backends.append('uvloop')
+
+    return backends
+
+async def read_console():
+    """
+    Read the output of a server process the way the supervisor does
+    """
+
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', SERVER_SCRIPT,
+        stdout=asyncio.subprocess.PIPE,
+    )
+
+    console = mcadminpanel.agent.logstream.LogStream()
+    console.subscribe(mcadminpanel.agent.logstream.QueueSubscriber(maxsize=LINES))
+
+    splitter = mcadminpanel.agent.logstream.LineSplitter()
+    while True:
+        data = await process.stdout.read(65536)
+        if not data:
+            break
+        for line in splitter.feed(data):
+            console.publish('stdout', line)
+
+    await process.wait()
+
+    return console.published
+
+async def call_api(socket, loop):
+    """
+    Make pipelined control API calls over a single connection
+    """
+
+    client = await mcadminpanel.agent.api.APIClient.connect(socket=socket, loop=loop)
+    try:
+        for _ in range(CALLS // 10):
+            await asyncio.gather(*[client.call('ping') for _ in range(10)])
+    finally:
+        await client.close()
+
+def run_backend(backend, benchmark, *args):
+    """
+    Run a benchmark coroutine function on a fresh loop of a backend and
+    return its result and wall time
+    """
+
+    loop = mcadminpanel.agent.eventloop.new_event_loop(backend)
+    asyncio.set_event_loop(loop)
+    try:
+        started = time.perf_counter()
+        result = loop.run_until_complete(benchmark(loop, *args))
+        return result, time.perf_counter() - started
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class TestEventLoopBackends(unittest.TestCase):
+    """
+    Benchmarks for the agent workload on each event loop backend
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.socket = os.path.join(self.directory.name, 'agent.sock')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _compare(self, name, timings, amount):
+        for backend, duration in sorted(timings.items()):
+            print('{} on {}: {:.0f}/s'.format(name, backend, amount / duration))
+
+        if 'uvloop' not in timings:
+            raise unittest.SkipTest('uvloop is not installed, nothing to compare')
+
+        # Allow for noise, the gap between the backends is much larger
+        self.assertLess(timings['uvloop'], timings['asyncio'] * 1.1)
+
+    def test_console_pipes(self):
+        """
+        Tests the throughput of reading the console of many servers
+        """
+
+        async def benchmark(loop): # pylint: disable=unused-argument
+            return await asyncio.gather(*[read_console() for _ in range(SERVERS)])
+
+        timings = {}
+        for backend in installed_backends():
+            counts, timings[backend] = run_backend(backend, benchmark)
+            self.assertEqual([LINES] * SERVERS, counts)
+
+        self._compare('console lines', timings, LINES * SERVERS)
+
+    def test_api_socket(self):
+        """
+        Tests the throughput of control API calls over the Unix socket
+        """
+
+        async def benchmark(loop):
+            server = mcadminpanel.agent.api.APIServer(
+                {
+                    'socket': self.socket,
+                    'host': None,
+                    'port': None,
+                    'token': None,
+                    'max_pending': 64,
+                },
+                loop=loop,
+            )
+            server.route('ping', lambda: 'pong')
+            await server.start()
+            try:
+                await asyncio.gather(*[
+                    call_api(self.socket, loop)
+                    for _ in range(CONNECTIONS)
+                ])
+            finally:
+                await server.stop()
+
+        timings = {}
+        for backend in installed_backends():
+            _, timings[backend] = run_backend(backend, benchmark)
+
+        self._compare('API calls', timings, CALLS * CONNECTIONS)
+
@@ -0,0 +1,136 @@
+"""
+Benchmarks for parsing the console output of the servers.
+
+A synthetic log mixing the lines of a busy server is parsed with the log
+parser and with a parser testing every line against one pattern per event,
+the way the agent used to look for players. The single anchored dispatch
+pattern has to be faster and to keep up with millions of lines.
+"""
+
+import random
+import re
+import time
+import unittest
+
+import mcadminpanel.agent.logparser
+
+# Lines of the synthetic log
+LINES = 2000000
+
+# Lines parsed by the pattern per event parser
+BASELINE_LINES = 200000
+
+# Lines parsed per second by the log parser
+MIN_RATE = 200000
+
+# Messages of the synthetic log and how often they appear
+MESSAGES = (
+    (900, 'INFO]: [Server] Saving chunks for level {index}'),
+    (600, 'INFO]: <Player{index}> hello there, anyone up for the nether?'),
+    (50, 'INFO]: Player{index} joined the game'),
+    (50, 'INFO]: Player{index} left the game'),
+    (20, "WARN]: Can't keep up! Is the server overloaded? Running {index}ms or 40 ticks behind"),
+    (10, 'ERROR]: Exception ticking entity {index}'),
+    (10, 'INFO]: There are 2 of a max of 20 players online: Player1, Player{index}'),
+    (300, '\tat net.minecraft.server.MinecraftServer.run(MinecraftServer.java:{index})'),
+)
+
+# The separate patterns of the baseline parser
+BASELINE_PATTERNS = (
+    re.compile(rb'\]: (\w+) joined the game'),
+    re.compile(rb'\]: (\w+) left the game'),
+    re.compile(rb"\]: Can't keep up! .*?Running (\d+)ms"),
+    re.compile(rb'\]: There are (\d+) of a max (?:of )?(\d+) players online:(.*)'),
+    re.compile(rb'\]: Done \(([\d.]+)s\)!'),
+    re.compile(rb'\]: Stopping (?:the )?server'),
+    re.compile(rb'/(?:ERROR|FATAL)\]: (.*)'),
+)
+
+def synthetic_log(size=1000, seed=1):
+    """
+    A pool of distinct console lines in the proportions of MESSAGES
+    """
+
+    generator = random.Random(seed)
+    weights = [weight for weight, _ in MESSAGES]
+    lines = []
+    for index in range(size):
+        _, message = generator.choices(MESSAGES, weights)[0]
+        message = message.format(index=index)
+        if message.startswith('\t'):
+            lines.append((message + '\n').encode())
+        else:
+            lines.append('[12:00:00] [Server thread/{}\n'.format(message).encode())
+
+    return lines
+
+def baseline_parse(line):
+    """
+    Parse a line by trying every pattern in turn
+    """
+
+    for pattern in BASELINE_PATTERNS:
+        match = pattern.search(line)
+        if match is not None:
+            return match
+
+    return None
+
+def measure(parse, pool, count):
+    """
+    Parse count lines from the pool and return the lines parsed per second
+    and the number of events
+    """
+
+    size = len(pool)
+    events = 0
+
+    started = time.perf_counter()
+    for index in range(count):
+        if parse(pool[index % size]) is not None:
+            events += 1
+    duration = time.perf_counter() - started
+
+    return count / duration, events
+
+
+class TestLogParser(unittest.TestCase):
+    """
+    Benchmarks for the log parser throughput
+    """
+
+    def test_throughput(self):
+        """
+        Tests that the dispatch pattern beats one pattern per event and
+        parses millions of lines quickly
+        """
+
+        pool = synthetic_log()
+
+        baseline_rate, baseline_events = measure(baseline_parse, pool, BASELINE_LINES)
+        rate, events = measure(
+            mcadminpanel.agent.logparser.parse_line,
+            pool,
+            BASELINE_LINES,
+        )
+        self.assertEqual(baseline_events, events)
+
+        print('pattern per event: {:.0f} lines/s'.format(baseline_rate))
+        print('dispatch pattern: {:.0f} lines/s'.format(rate))
+        self.assertGreater(rate, baseline_rate)
+
+        parser = mcadminpanel.agent.logparser.LogParser('benchmark')
+        size = len(pool)
+
+        started = time.perf_counter()
+        for index in range(LINES):
+            parser.put('stdout', pool[index % size])
+        duration = time.perf_counter() - started
+
+        print('log parser: {} lines in {:.2f}s, {:.0f} lines/s'.format(
+            LINES,
+            duration,
+            LINES / duration,
+        ))
+        self.assertEqual(LINES, parser.lines)
+        self.assertGreater(LINES / duration, MIN_RATE)
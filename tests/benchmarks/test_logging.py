@@ -0,0 +1,132 @@
+"""
+Benchmarks for how long logging stalls the event loop.
+
+Each benchmark logs from a coroutine while the log file sits on a simulated
+slow disk and measures how long every logging call held up the loop. The
+agent used to write records from the logging call itself, the queued
+handler has to keep the loop running no matter how slow the disk is.
+"""
+
+import asyncio
+import logging
+import logging.handlers
+import os.path
+import queue
+import tempfile
+import time
+import unittest
+
+import mcadminpanel.agent.logqueue
+
+# Time every write to the simulated disk takes in seconds
+DISK_LATENCY = 0.002
+
+RECORDS = 200
+
+# Stall of the 99th percentile queued logging call in seconds
+STALL_BUDGET = 0.001
+
+class SlowFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """
+    The handler the agent used to log with directly, on a slow disk
+    """
+
+    def flush(self):
+        time.sleep(DISK_LATENCY)
+        super(SlowFileHandler, self).flush()
+
+
+class SlowBatchFileHandler(mcadminpanel.agent.logqueue.BatchFileHandler):
+    """
+    The handler the queued logging writes with, on a slow disk
+    """
+
+    def flush_batch(self):
+        time.sleep(DISK_LATENCY)
+        super(SlowBatchFileHandler, self).flush_batch()
+
+def measure_stall(logger, records):
+    """
+    Log from a coroutine and return the stall of every logging call
+    """
+
+    stalls = []
+
+    async def log():
+        for index in range(records):
+            started = time.perf_counter()
+            logger.info('record %s', index)
+            stalls.append(time.perf_counter() - started)
+            await asyncio.sleep(0)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(log())
+    finally:
+        loop.close()
+
+    return sorted(stalls)
+
+
+class TestLoggingStall(unittest.TestCase):
+    """
+    Benchmarks for the event loop stall caused by logging
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'agent.log')
+
+        self.logger = logging.getLogger('benchmark.logging')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+
+        self.directory.cleanup()
+
+    def _report(self, name, stalls):
+        print('{}: median {:.1f}us, max {:.1f}us per logging call'.format(
+            name,
+            stalls[len(stalls) // 2] * 1000000,
+            stalls[-1] * 1000000,
+        ))
+
+    def test_stall(self):
+        """
+        Tests that queued logging stalls the loop far less than direct writes
+        """
+
+        direct = SlowFileHandler(self.path, when='midnight')
+        self.logger.addHandler(direct)
+        try:
+            direct_stalls = measure_stall(self.logger, RECORDS)
+        finally:
+            self.logger.removeHandler(direct)
+            direct.close()
+
+        handler = mcadminpanel.agent.logqueue.DroppingQueueHandler(queue.Queue(RECORDS))
+        listener = mcadminpanel.agent.logqueue.LogListener(
+            handler.queue,
+            [SlowBatchFileHandler(self.path, when='midnight')],
+        )
+        listener.start()
+        self.logger.addHandler(handler)
+        try:
+            queued_stalls = measure_stall(self.logger, RECORDS)
+        finally:
+            self.logger.removeHandler(handler)
+            listener.stop()
+
+        self._report('direct', direct_stalls)
+        self._report('queued', queued_stalls)
+
+        self.assertGreaterEqual(direct_stalls[len(direct_stalls) // 2], DISK_LATENCY)
+        self.assertLess(queued_stalls[len(queued_stalls) * 99 // 100], STALL_BUDGET)
+        self.assertEqual(0, handler.dropped)
+
+        with open(self.path, 'r') as log_file:
+            self.assertEqual(2 * RECORDS, len(log_file.read().splitlines()))
+
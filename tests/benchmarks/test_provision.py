@@ -0,0 +1,110 @@
+"""
+Benchmarks for creating servers from templates.
+
+A template shaped like a real server, a large server jar, a few plugins, a
+pregenerated world and many small configuration files, is provisioned with
+every copy method. With the server jar and plugins linked from the artifact
+store a ready to start server has to be created in under a second.
+"""
+
+import os
+import os.path
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import mcadminpanel.agent.artifacts
+import mcadminpanel.agent.provision
+
+MIB = 1024 * 1024
+
+# Files of the synthetic template by size
+TEMPLATE = (
+    ('server.jar', 64 * MIB),
+    ('plugins/plugin{}.jar', 2 * MIB, 8),
+    ('world/region/r.{}.0.mca', 1 * MIB, 16),
+    ('config/file{}.yml', 16 * 1024, 200),
+)
+
+# Seconds to provision a server with the artifact store
+BUDGET = 1.0
+
+def write_template(directory):
+    """
+    Write the synthetic template and return its size in bytes
+    """
+
+    total = 0
+    for entry in TEMPLATE:
+        pattern, size = entry[:2]
+        for index in range(entry[2] if len(entry) > 2 else 1):
+            path = os.path.join(directory, pattern.format(index))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as output:
+                output.write(os.urandom(size))
+            total += size
+
+    return total
+
+
+class TestProvision(unittest.TestCase):
+    """
+    Benchmarks for the copy methods of provisioning
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.templates = os.path.join(self.directory.name, 'templates')
+        self.size = write_template(os.path.join(self.templates, 'paper'))
+
+        self.store = mcadminpanel.agent.artifacts.ArtifactStore(
+            None,
+            {
+                'path': os.path.join(self.directory.name, 'artifacts'),
+                'max_size': None,
+                'patterns': ['*.jar', 'plugins/*.jar'],
+            },
+            loop=unittest.mock.Mock(),
+        )
+        self.store.load()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _provision(self, name, method, store=None):
+        started = time.perf_counter()
+        stats = mcadminpanel.agent.provision.provision(
+            name,
+            {'template': 'paper', 'properties': {'motd': name}, 'rcon': None},
+            os.path.join(self.directory.name, name),
+            {'templates': self.templates, 'method': method, 'workers': 8},
+            store=store,
+        )
+        duration = time.perf_counter() - started
+
+        print('{}: {:.3f}s, {:.0f} MiB/s, {}'.format(
+            name,
+            duration,
+            self.size / MIB / duration,
+            stats['methods'],
+        ))
+
+        return duration
+
+    def test_methods(self):
+        """
+        Tests that linking artifacts beats copying them and that provisioning
+        with the store fits in the budget
+        """
+
+        self._provision('copy', 'copy')
+        self._provision('copy_file_range', 'copy_file_range')
+        auto = self._provision('auto', 'auto')
+
+        # The first provisioning stores the artifacts of the template
+        self._provision('store_first', 'auto', self.store)
+        linked = self._provision('store', 'auto', self.store)
+
+        self.assertLess(linked, auto)
+        self.assertLess(linked, BUDGET)
@@ -0,0 +1,114 @@
+"""
+Benchmarks for the CLI cold start latency.
+
+Health checks run the CLI every few seconds on every node, so the time it
+takes to import the CLI and get to a command is tracked against a budget.
+Each measurement starts a fresh interpreter and the best of several runs
+is compared to the budget to keep noise from other processes out.
+"""
+
+import json
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# Cold start budgets in seconds
+IMPORT_BUDGET = 0.25
+FIRST_COMMAND_BUDGET = 0.5
+
+RUNS = 5
+
+# Modules only some of the commands need
+HEAVY_MODULES = ('asyncio', 'daemon', 'psutil', 'logging.handlers')
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def run_python(code, *args):
+    """
+    Run code in a fresh interpreter and return its output and wall time
+    """
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable] + list(args) + ['-c', code],
+        cwd=PROJECT_ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+    return result, time.perf_counter() - started
+
+def import_time(module):
+    """
+    The cumulative import time of a module in seconds, as reported by the
+    interpreter's -X importtime option
+    """
+
+    result, _ = run_python('import {}'.format(module), '-X', 'importtime')
+
+    for line in result.stderr.decode().splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000000
+
+    raise unittest.SkipTest('-X importtime is not supported')
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Benchmarks for the CLI cold start latency
+    """
+
+    def test_lazy_imports(self):
+        """
+        Tests that importing the CLI does not import the heavy modules
+        """
+
+        result, _ = run_python(
+            'import json, sys\n'
+            'import mcadminpanel.agent.cli\n'
+            'import mcadminpanel.agent.agent\n'
+            'print(json.dumps([name for name in {!r} if name in sys.modules]))'.format(
+                HEAVY_MODULES,
+            ),
+        )
+
+        self.assertEqual([], json.loads(result.stdout.decode()))
+
+    def test_import_time(self):
+        """
+        Tests that the CLI imports within its budget
+        """
+
+        best = min(import_time('mcadminpanel.agent.cli') for _ in range(RUNS))
+
+        print('CLI import time: {:.1f}ms'.format(best * 1000))
+        self.assertLess(best, IMPORT_BUDGET)
+
+    def test_time_to_first_command(self):
+        """
+        Tests that a command starts running within its budget
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            config = os.path.join(directory, 'config.json')
+            with open(config, 'w') as config_file:
+                json.dump({'root': directory}, config_file)
+
+            code = (
+                'from mcadminpanel.agent.cli import mcadminpanel_agent\n'
+                'mcadminpanel_agent(["--config", {!r}, "generate_config", "--help"])'.format(
+                    config,
+                )
+            )
+
+            best = min(run_python(code)[1] for _ in range(RUNS))
+
+        print('CLI time to first command: {:.1f}ms'.format(best * 1000))
+        self.assertLess(best, FIRST_COMMAND_BUDGET)
+
@@ -0,0 +1,110 @@
+"""
+Tests for the CLI analyze_regions command
+"""
+
+import json
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+
+from mcadminpanel.agent.cli import mcadminpanel_agent
+
+import tests.utils.mixins
+import tests.utils.regions
+
+class TestAnalyzeRegionsCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
+    """
+    Tests for the CLI analyze_regions command
+    """
+
+    def setUp(self):
+        super(TestAnalyzeRegionsCommand, self).setUp()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.directory.name, 'regions.cache')
+
+        tests.utils.regions.write_region(
+            os.path.join(self.directory.name, 'survival', 'world', 'region'),
+            0,
+            0,
+            {0: (0, 1), 1: (40000, 1)},
+        )
+        tests.utils.regions.write_region(
+            os.path.join(self.directory.name, 'maps', 'creative', 'world', 'region'),
+            0,
+            0,
+            {0: (0, 1)},
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _configure(self, configuration):
+        configuration.return_value = configuration
+        configuration.root = self.directory.name
+        configuration.servers = {
+            'survival': {},
+            'creative': {'directory': os.path.join('maps', 'creative')},
+        }
+        configuration.regions = {
+            'cache': self.cache,
+            'processes': 1,
+            'oversized_chunk': 256 * 1024,
+        }
+
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_analyze(self, configuration):
+        """
+        Tests that the worlds of the chosen servers are written as JSON
+        lines and the cache is saved
+        """
+
+        self._configure(configuration)
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['analyze_regions', '--server', 'survival', '--inhabited-below', '100'],
+        )
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        summaries = [json.loads(line) for line in result.output.splitlines()]
+        self.assertEqual(
+            [('survival', 'world', 2, 1)],
+            [
+                (summary['server'], summary['world'], summary['chunks'], summary['unvisited'])
+                for summary in summaries
+            ],
+        )
+        self.assertTrue(os.path.exists(self.cache))
+
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_all_servers(self, configuration):
+        """
+        Tests that every server is analyzed by default
+        """
+
+        self._configure(configuration)
+
+        result = self.cli_runner.invoke(mcadminpanel_agent, ['analyze_regions'])
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertEqual(
+            ['creative', 'survival'],
+            [json.loads(line)['server'] for line in result.output.splitlines()],
+        )
+
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_unknown_server(self, configuration):
+        """
+        Tests that unknown servers are rejected
+        """
+
+        self._configure(configuration)
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['analyze_regions', '--server', 'hardcore'],
+        )
+
+        self.assertEqual(1, result.exit_code)
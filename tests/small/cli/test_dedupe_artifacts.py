@@ -0,0 +1,59 @@
+"""
+Tests for the CLI dedupe_artifacts command
+"""
+
+import json
+import unittest
+import unittest.mock
+
+from mcadminpanel.agent.cli import mcadminpanel_agent
+
+import tests.utils.mixins
+
+class TestDedupeArtifactsCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
+    """
+    Tests for the CLI dedupe_artifacts command
+    """
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_is_accessible(self, configuration, agent):
+        """
+        Tests that the command is accessible through normal use
+        """
+
+        configuration.return_value = configuration
+
+        report = {
+            'servers': {'survival': {'files': 3, 'stored': 0, 'linked': 3, 'saved_bytes': 1024}},
+            'evicted': [],
+        }
+        agent.return_value = agent
+        agent.call_api.return_value = report
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['dedupe_artifacts', '--server', 'survival'],
+        )
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertEqual(report, json.loads(result.output))
+
+        agent.call_api.assert_called_with('dedupe_artifacts', names=['survival'])
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_all_servers(self, configuration, agent):
+        """
+        Tests that every server is deduplicated by default
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.call_api.return_value = {'servers': {}, 'evicted': []}
+
+        result = self.cli_runner.invoke(mcadminpanel_agent, ['dedupe_artifacts'])
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        agent.call_api.assert_called_with('dedupe_artifacts', names=None)
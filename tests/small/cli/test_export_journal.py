@@ -0,0 +1,114 @@
+"""
+Tests for the CLI export_journal command
+"""
+
+import json
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+
+from mcadminpanel.agent.cli import mcadminpanel_agent
+
+import mcadminpanel.agent.journal
+import mcadminpanel.agent.workers
+import tests.utils.mixins
+
+class TestExportJournalCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
+    """
+    Tests for the CLI export_journal command
+    """
+
+    def setUp(self):
+        super(TestExportJournalCommand, self).setUp()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'events.journal')
+
+        writer = mcadminpanel.agent.journal.JournalWriter(self.path)
+        writer.append(1000.0, 'start', 'survival', {'pid': 12})
+        writer.append(2000.0, 'start', 'creative', {'pid': 13})
+        writer.append(3000.0, 'crash', 'survival', {'returncode': 1})
+        writer.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_export(self, configuration):
+        """
+        Tests that the matching events are written as JSON lines
+        """
+
+        configuration.return_value = configuration
+        configuration.journal = {'file': self.path}
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['export_journal', '--server', 'survival', '--since', '1500'],
+        )
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertEqual(
+            [{
+                'timestamp': 3000.0,
+                'event': 'crash',
+                'server': 'survival',
+                'data': {'returncode': 1},
+            }],
+            [json.loads(line) for line in result.output.splitlines()],
+        )
+
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_workers(self, configuration):
+        """
+        Tests that the journals of the worker processes are merged by time
+        """
+
+        path = os.path.join(self.directory.name, 'workers', 'events.journal')
+        os.makedirs(os.path.dirname(path))
+        for index, timestamps in ((0, (1000.0, 4000.0)), (1, (2000.0, 3000.0, 5000.0))):
+            writer = mcadminpanel.agent.journal.JournalWriter(
+                mcadminpanel.agent.workers.worker_path(path, index),
+            )
+            for timestamp in timestamps:
+                writer.append(timestamp, 'start', 'server{}'.format(index), {'pid': 12})
+            writer.close()
+
+        configuration.return_value = configuration
+        configuration.journal = {'file': path}
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['export_journal', '--until', '4500'],
+        )
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertEqual(
+            [
+                (1000.0, 'server0'),
+                (2000.0, 'server1'),
+                (3000.0, 'server1'),
+                (4000.0, 'server0'),
+            ],
+            [
+                (entry['timestamp'], entry['server'])
+                for entry in map(json.loads, result.output.splitlines())
+            ],
+        )
+
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_bad_time(self, configuration):
+        """
+        Tests that invalid times are rejected
+        """
+
+        configuration.return_value = configuration
+        configuration.journal = {'file': self.path}
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['export_journal', '--until', 'yesterday'],
+        )
+
+        self.assertEqual(2, result.exit_code)
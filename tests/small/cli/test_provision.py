@@ -0,0 +1,67 @@
+"""
+Tests for the CLI provision command
+"""
+
+import unittest
+import unittest.mock
+
+from mcadminpanel.agent.cli import mcadminpanel_agent
+
+import mcadminpanel.agent.errors
+import tests.utils.mixins
+
+class TestProvisionCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
+    """
+    Tests for the CLI provision command
+    """
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_is_accessible(self, configuration, agent):
+        """
+        Tests that the command is accessible through normal use
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.provision.return_value = {
+            'template': 'paper',
+            'files': 12,
+            'bytes': 4096,
+            'methods': {'link': 2, 'reflink': 10},
+            'duration': 0.05,
+        }
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['provision', 'survival', '--method', 'reflink'],
+        )
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertEqual(
+            'Provisioned server survival from template paper: 12 files in 0.05s '
+            '(2 link, 10 reflink)\n',
+            result.output,
+        )
+
+        agent.provision.assert_called_with('survival', None, 'reflink')
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_error(self, configuration, agent):
+        """
+        Tests that provisioning errors are reported without a traceback
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.provision.side_effect = mcadminpanel.agent.errors.ProvisionError(
+            'Server survival has no template',
+        )
+
+        result = self.cli_runner.invoke(mcadminpanel_agent, ['provision', 'survival'])
+
+        self.assertEqual(1, result.exit_code)
+        self.assertIn('Server survival has no template', result.output)
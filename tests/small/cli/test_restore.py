@@ -0,0 +1,62 @@
+"""
+Tests for the CLI restore command
+"""
+
+import unittest
+import unittest.mock
+
+from mcadminpanel.agent.cli import mcadminpanel_agent
+
+import mcadminpanel.agent.errors
+import tests.utils.mixins
+
+class TestRestoreCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
+    """
+    Tests for the CLI restore command
+    """
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_is_accessible(self, configuration, agent):
+        """
+        Tests that the command is accessible through normal use
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.restore.return_value = {
+            'id': '20170101T000000000000Z',
+            'stats': {'files': 3, 'duration': 1.5},
+        }
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['restore', 'survival', '--no-verify'],
+        )
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertIn('Restored 3 files of server survival', result.output)
+
+        agent.assert_called_with(configuration)
+        agent.restore.assert_called_with('survival', None, False)
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_error(self, configuration, agent):
+        """
+        Tests that restore failures are reported without a traceback
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.restore.side_effect = mcadminpanel.agent.errors.BackupError(
+            'Server survival has no backups',
+        )
+
+        result = self.cli_runner.invoke(mcadminpanel_agent, ['restore', 'survival'])
+
+        self.assertEqual(1, result.exit_code)
+        self.assertIn('Server survival has no backups', result.output)
+
@@ -0,0 +1,94 @@
+"""
+Tests for the CLI stats and profile commands
+"""
+
+import json
+import unittest
+import unittest.mock
+
+from mcadminpanel.agent.cli import mcadminpanel_agent
+
+import mcadminpanel.agent.errors
+import tests.utils.mixins
+
+class TestStatsCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
+    """
+    Tests for the CLI stats command
+    """
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_is_accessible(self, configuration, agent):
+        """
+        Tests that the command is accessible through normal use
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.call_api.return_value = {'tasks': 4, 'queues': {'log': 0}}
+
+        result = self.cli_runner.invoke(mcadminpanel_agent, ['stats'])
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertEqual({'tasks': 4, 'queues': {'log': 0}}, json.loads(result.output))
+
+        agent.call_api.assert_called_with('loop_stats')
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_error(self, configuration, agent):
+        """
+        Tests that an unreachable agent is reported without a traceback
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.call_api.side_effect = mcadminpanel.agent.errors.APIError(
+            'Unable to reach the agent',
+        )
+
+        result = self.cli_runner.invoke(mcadminpanel_agent, ['stats'])
+
+        self.assertEqual(1, result.exit_code)
+        self.assertIn('Unable to reach the agent', result.output)
+
+
+class TestProfileCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
+    """
+    Tests for the CLI profile command
+    """
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_is_accessible(self, configuration, agent):
+        """
+        Tests that the command is accessible through normal use
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+        agent.call_api.side_effect = [
+            None,
+            {
+                'duration': 0.0,
+                'samples': 3,
+                'stacks': [{'stack': 'agent.py:run;base_events.py:run_forever', 'count': 3}],
+            },
+        ]
+
+        result = self.cli_runner.invoke(
+            mcadminpanel_agent,
+            ['profile', '--duration', '0', '--top', '5'],
+        )
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        self.assertEqual('agent.py:run;base_events.py:run_forever 3\n', result.output)
+
+        agent.call_api.assert_has_calls([
+            unittest.mock.call('profile_start', interval=None),
+            unittest.mock.call('profile_stop', top=5),
+        ])
+
@@ -30,5 +30,21 @@ class TestStopCommand(tests.utils.mixins.CliRunnerMixin, unittest.TestCase):
         self.assertEqual(0, result.exit_code, 'Command did not execute properly')
 
         agent.assert_called_with(configuration)
-        agent.stop.assert_called_with()
+        agent.stop.assert_called_with(False)
+
+    @unittest.mock.patch('mcadminpanel.agent.agent.Agent')
+    @unittest.mock.patch('mcadminpanel.agent.config.Configuration')
+    def test_keep_servers(self, configuration, agent):
+        """
+        Tests that the servers can be left running for the next agent
+        """
+
+        configuration.return_value = configuration
+
+        agent.return_value = agent
+
+        result = self.cli_runner.invoke(mcadminpanel_agent, ['stop', '--keep-servers'])
+
+        self.assertEqual(0, result.exit_code, 'Command did not execute properly')
+        agent.stop.assert_called_with(True)
 
@@ -3,13 +3,18 @@ Tests for the agent process
 """
 
 import asyncio
+import functools
 import io
+import logging
+import os.path
+import signal
 import sys
 import tempfile
 import unittest
 import unittest.mock
 
 import nose
+import psutil
 
 import mcadminpanel.agent.agent
 import mcadminpanel.agent.errors
@@ -25,12 +30,91 @@ class TestAgent(unittest.TestCase):
         self.config = unittest.mock.Mock(
             root='myroot',
             pidfile='mypidfile',
+            statefile=None,
+            event_loop='asyncio',
             logging={
                 'level': 'warn',
                 'file': self.log_file.name,
                 'date_format': '%m-%d-%Y %H:%M:%S',
                 'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                'queue_size': 10000,
             },
+            supervisor={
+                'restart_delay': 1,
+                'max_restart_delay': 300,
+                'reset_after': 600,
+                'stop_commands': ['save-all', 'stop'],
+                'stop_timeout': 60,
+                'command_timeout': 10,
+                'command_batch_size': 64,
+                'cgroup_root': None,
+                'cds_archives': None,
+            },
+            metrics={
+                'interval': 5,
+                'history': 720,
+            },
+            console={
+                'file': 'console.log',
+                'queue_size': 10000,
+            },
+            api={
+                'socket': None,
+                'host': '127.0.0.1',
+                'port': None,
+                'token': None,
+                'max_pending': 64,
+            },
+            watch={
+                'enabled': False,
+                'poll_interval': 2,
+            },
+            backup={
+                'path': tempfile.gettempdir(),
+                'chunk_size': 1024 * 1024,
+                'workers': 2,
+                'rate_limit': None,
+                'save_timeout': 60,
+            },
+            journal={
+                'file': None,
+                'block_size': 64 * 1024,
+                'flush_interval': 1,
+            },
+            monitor={
+                'enabled': False,
+                'heartbeat_interval': 0.5,
+                'slow_callback': 0.1,
+                'task_cpu': False,
+                'profile_interval': 0.005,
+            },
+            workers={
+                'count': 1,
+                'connect_timeout': 10,
+            },
+            regions={
+                'cache': None,
+                'processes': 0,
+                'oversized_chunk': 256 * 1024,
+            },
+            artifacts={
+                'path': '/tmp/artifacts',
+                'max_size': None,
+                'patterns': ['*.jar'],
+            },
+            provision={
+                'templates': '/tmp/templates',
+                'method': 'auto',
+                'workers': 8,
+            },
+            hibernation={
+                'enabled': False,
+                'idle_timeout': 900,
+                'poll_interval': 30,
+                'timeout': 5,
+                'message': 'The server is starting',
+            },
+            servers={},
         )
 
     def test_constr(self):
@@ -108,6 +192,40 @@ class TestAgent(unittest.TestCase):
 
         agent.run.assert_called_with(False)
 
+    @unittest.mock.patch('daemon.pidfile.PIDLockFile')
+    @unittest.mock.patch('daemon.DaemonContext')
+    def test_start_workers(self, fake_context, fake_pidfile): # pylint: disable=unused-argument
+        """
+        Tests that the agent runs worker processes when configured to
+        """
+
+        self.config.workers['count'] = 4
+
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+        agent.run = unittest.mock.Mock()
+        agent.run_workers = unittest.mock.Mock()
+
+        agent.start(False)
+
+        agent.run_workers.assert_called_with(False, 4)
+        self.assertFalse(agent.run.called)
+
+    def test_configure_worker(self):
+        """
+        Tests that a worker only keeps its servers and its own files
+        """
+
+        self.config.servers = {'survival': {}, 'creative': {}}
+        self.config.statefile = '/srv/agent.state'
+
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+        agent.configure_worker(2, ['creative'])
+
+        self.assertEqual(['creative'], list(agent.servers_conf))
+        self.assertEqual('/srv/agent.worker2.state', agent.statefile)
+        self.assertEqual('mypidfile.worker2.sock', agent.api_conf['socket'])
+        self.assertTrue(agent.log_conf['file'].endswith('.worker2'))
+
     @unittest.mock.patch('psutil.Process')
     @unittest.mock.patch('builtins.open')
     def test_stop(self, fake_open, process):
@@ -127,6 +245,42 @@ class TestAgent(unittest.TestCase):
 
         process.assert_called_with(7)
         process.terminate.assert_called_with()
+        process.wait.assert_called_with(90)
+
+    @unittest.mock.patch('psutil.Process')
+    @unittest.mock.patch('builtins.open')
+    def test_stop_keep_servers(self, fake_open, process):
+        """
+        Tests that the agent is told to leave the servers running
+        """
+
+        fake_open.return_value = fake_open
+        fake_open.__enter__.return_value = io.StringIO('007')
+
+        process.return_value = process
+
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+        agent.stop(keep_servers=True)
+
+        process.send_signal.assert_called_with(signal.SIGUSR2)
+        process.terminate.assert_not_called()
+
+    @nose.tools.raises(mcadminpanel.agent.errors.MCAdminPanelError)
+    @unittest.mock.patch('psutil.Process')
+    @unittest.mock.patch('builtins.open')
+    def test_stop_timeout(self, fake_open, process):
+        """
+        Tests that we report an agent that does not stop in time
+        """
+
+        fake_open.return_value = fake_open
+        fake_open.__enter__.return_value = io.StringIO('007')
+
+        process.return_value = process
+        process.wait.side_effect = psutil.TimeoutExpired(90)
+
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+        agent.stop()
 
     @nose.tools.raises(mcadminpanel.agent.errors.ConfigurationError)
     def test_invalid_log_level(self):
@@ -139,6 +293,24 @@ class TestAgent(unittest.TestCase):
         agent = mcadminpanel.agent.agent.Agent(self.config)
         agent.configure_logger(True)
 
+    def test_configure_logger(self):
+        """
+        Tests that log records are written through the queue
+        """
+
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+        agent.configure_logger(True)
+        try:
+            self.assertIn(agent.log_handler, logging.getLogger().handlers)
+
+            logging.warning('queued record')
+        finally:
+            agent.stop_logger()
+
+        self.assertIsNone(agent.log_listener)
+        with open(self.log_file.name, 'r') as log_file:
+            self.assertIn('queued record', log_file.read())
+
     @unittest.mock.patch('asyncio.get_event_loop')
     def test_run_forever(self, get_event_loop):
         """
@@ -148,12 +320,143 @@ class TestAgent(unittest.TestCase):
         event_loop = unittest.mock.MagicMock(
             spec=asyncio.BaseEventLoop,
         )
+        event_loop.create_task.side_effect = lambda coro: coro.close()
         get_event_loop.return_value = event_loop
 
+        # Startup and shutdown steps still need to run on a real loop
+        real_loop = asyncio.new_event_loop()
+        event_loop.run_until_complete.side_effect = real_loop.run_until_complete
+
         agent = mcadminpanel.agent.agent.Agent(self.config)
-        agent.run(True)
+        try:
+            agent.run(True)
+        finally:
+            agent.stop_logger()
+            real_loop.close()
 
         get_event_loop.assert_called_with()
 
         event_loop.run_forever.assert_called_with()
 
+    @unittest.mock.patch('mcadminpanel.agent.supervisor.Supervisor.stop')
+    @unittest.mock.patch('mcadminpanel.agent.supervisor.Supervisor.detach')
+    @unittest.mock.patch('asyncio.get_event_loop')
+    def test_keep_servers(self, get_event_loop, detach, stop):
+        """
+        Tests that the servers are left running when the agent is stopped
+        detached, as long as the next agent can adopt them
+        """
+
+        event_loop = unittest.mock.MagicMock(
+            spec=asyncio.BaseEventLoop,
+        )
+        event_loop.create_task.side_effect = lambda coro: coro.close()
+        get_event_loop.return_value = event_loop
+
+        real_loop = asyncio.new_event_loop()
+        event_loop.run_until_complete.side_effect = real_loop.run_until_complete
+
+        detach.return_value = []
+        stop.return_value = {'latency': 0, 'servers': {}}
+
+        directory = tempfile.TemporaryDirectory()
+        try:
+            for statefile, detached in ((None, False), ('agent.state', True)):
+                detach.reset_mock()
+                stop.reset_mock()
+                self.config.statefile = statefile and os.path.join(directory.name, statefile)
+
+                agent = mcadminpanel.agent.agent.Agent(self.config)
+                event_loop.run_forever.side_effect = functools.partial(
+                    agent.stop_detached,
+                    event_loop,
+                )
+                try:
+                    agent.run(True)
+                finally:
+                    agent.stop_logger()
+
+                self.assertEqual(detached, detach.called)
+                self.assertEqual(not detached, stop.called)
+        finally:
+            real_loop.close()
+            directory.cleanup()
+
+    @unittest.mock.patch('mcadminpanel.agent.supervisor.Supervisor.stop')
+    @unittest.mock.patch('mcadminpanel.agent.supervisor.Supervisor.detach')
+    @unittest.mock.patch('asyncio.get_event_loop')
+    def test_failed_worker(self, get_event_loop, detach, stop):
+        """
+        Tests that a failing worker leaves its servers running for the worker
+        taking them over
+        """
+
+        event_loop = unittest.mock.MagicMock(
+            spec=asyncio.BaseEventLoop,
+        )
+        event_loop.create_task.side_effect = lambda coro: coro.close()
+        event_loop.run_forever.side_effect = RuntimeError('Worker failed')
+        get_event_loop.return_value = event_loop
+
+        real_loop = asyncio.new_event_loop()
+        event_loop.run_until_complete.side_effect = real_loop.run_until_complete
+
+        detach.return_value = []
+
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+        agent.worker = 1
+        try:
+            with self.assertRaises(RuntimeError):
+                agent.run(True)
+        finally:
+            agent.stop_logger()
+            real_loop.close()
+
+        detach.assert_called_with()
+        stop.assert_not_called()
+
+    @unittest.mock.patch('logging.getLogger')
+    def test_reload_log_level(self, get_logger):
+        """
+        Tests that a new log level is applied without a restart
+        """
+
+        handler = unittest.mock.Mock()
+        get_logger.return_value = get_logger
+        get_logger.handlers = [handler]
+
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+
+        self.config.reload.return_value = [('logging', 'level')]
+        self.config.logging = dict(self.config.logging, level='debug')
+
+        agent.reload_config()
+
+        get_logger.setLevel.assert_called_with(logging.DEBUG)
+        handler.setLevel.assert_called_with(logging.DEBUG)
+
+    def test_reload_servers(self):
+        """
+        Tests that server changes are handed to the supervisor
+        """
+
+        loop = asyncio.new_event_loop()
+        agent = mcadminpanel.agent.agent.Agent(self.config)
+        agent.supervisor = unittest.mock.Mock(loop=loop)
+        agent.reconfigure_servers = unittest.mock.Mock(
+            side_effect=lambda names: asyncio.sleep(0, names),
+        )
+
+        self.config.reload.return_value = [
+            ('servers', 'survival', 'command'),
+            ('servers', 'lobby'),
+        ]
+
+        try:
+            agent.reload_config()
+            loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            loop.close()
+
+        agent.reconfigure_servers.assert_called_with({'survival', 'lobby'})
+
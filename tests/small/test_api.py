@@ -0,0 +1,345 @@
+"""
+Tests for the agent control API
+"""
+
+import asyncio
+import os.path
+import socket
+import tempfile
+import unittest
+
+import nose
+
+import mcadminpanel.agent.api
+import mcadminpanel.agent.errors
+
+API_CONF = {
+    'socket': None,
+    'host': None,
+    'port': None,
+    'token': None,
+    'max_pending': 8,
+}
+
+class TestFraming(unittest.TestCase):
+    """
+    Tests for the length prefixed framing
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _reader(self, data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+
+        return reader
+
+    def test_round_trip(self):
+        """
+        Tests that a frame decodes to the original message
+        """
+
+        message = {'id': 1, 'command': 'list_servers', 'args': {}}
+        frame = mcadminpanel.agent.api.encode_frame(message)
+
+        self.assertEqual(len(frame) - 4, int.from_bytes(frame[:4], 'big'))
+        self.assertEqual(
+            message,
+            self.loop.run_until_complete(
+                mcadminpanel.agent.api.read_frame(self._reader(frame)),
+            ),
+        )
+
+    def test_end_of_stream(self):
+        """
+        Tests that the end of the stream reads as no frame
+        """
+
+        self.assertIsNone(
+            self.loop.run_until_complete(
+                mcadminpanel.agent.api.read_frame(self._reader(b'')),
+            ),
+        )
+
+    def test_truncated_frame(self):
+        """
+        Tests that a stream ending in the middle of a frame reads as its end
+        """
+
+        frame = mcadminpanel.agent.api.encode_frame({'id': 1})
+
+        self.assertIsNone(
+            self.loop.run_until_complete(
+                mcadminpanel.agent.api.read_frame(self._reader(frame[:-2])),
+            ),
+        )
+
+    @nose.tools.raises(mcadminpanel.agent.errors.APIError)
+    def test_oversized_frame(self):
+        """
+        Tests that huge frames are rejected before reading them
+        """
+
+        self.loop.run_until_complete(
+            mcadminpanel.agent.api.read_frame(self._reader(b'\xff\xff\xff\xff')),
+        )
+
+
+class TestAPIServer(unittest.TestCase):
+    """
+    Tests for the API server and client over a Unix socket
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.server = mcadminpanel.agent.api.APIServer(
+            dict(API_CONF, socket=os.path.join(self.directory.name, 'agent.sock')),
+            loop=self.loop,
+        )
+        self.order = []
+
+        async def slow(value):
+            await asyncio.sleep(0.05)
+            self.order.append(value)
+            return value
+
+        def fast(value):
+            self.order.append(value)
+            return value
+
+        def fail():
+            raise mcadminpanel.agent.errors.ServerError('Unknown server: nope')
+
+        self.server.add_routes({'slow': slow, 'fast': fast, 'fail': fail})
+        self.loop.run_until_complete(self.server.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.directory.cleanup()
+
+    def _run(self, scenario):
+        async def with_client():
+            client = await mcadminpanel.agent.api.APIClient.connect(
+                socket=self.server.socket,
+            )
+            try:
+                return await scenario(client)
+            finally:
+                await client.close()
+
+        return self.loop.run_until_complete(asyncio.wait_for(with_client(), 10))
+
+    def test_call(self):
+        """
+        Tests that a command returns its result
+        """
+
+        result = self._run(lambda client: client.call('fast', value=3))
+
+        self.assertEqual(3, result)
+
+    def test_command_argument(self):
+        """
+        Tests that commands can take an argument named command
+        """
+
+        self.server.route('run_command', lambda name, command: [name, command])
+
+        result = self._run(
+            lambda client: client.call('run_command', name='survival', command='list'),
+        )
+
+        self.assertEqual(['survival', 'list'], result)
+
+    def test_pipelining(self):
+        """
+        Tests that slow requests do not hold up later ones on a connection
+        """
+
+        results = self._run(
+            lambda client: asyncio.gather(
+                client.call('slow', value='slow'),
+                client.call('fast', value='fast'),
+            ),
+        )
+
+        self.assertEqual(['slow', 'fast'], results)
+        self.assertEqual(['fast', 'slow'], self.order)
+
+    def test_errors(self):
+        """
+        Tests that failures are reported without closing the connection
+        """
+
+        async def scenario(client):
+            errors = []
+            for command, args in (('fail', {}), ('missing', {}), ('fast', {})):
+                try:
+                    await client.call(command, **args)
+                except mcadminpanel.agent.errors.APIError as ex:
+                    errors.append(str(ex))
+
+            errors.append(await client.call('fast', value='still open'))
+
+            return errors
+
+        errors = self._run(scenario)
+
+        self.assertEqual('ServerError: Unknown server: nope', errors[0])
+        self.assertEqual('APIError: Unknown command: missing', errors[1])
+        self.assertTrue(errors[2].startswith('APIError: Invalid arguments'))
+        self.assertEqual('still open', errors[3])
+
+    def test_default_route(self):
+        """
+        Tests that commands without a handler go to the default route with
+        their arguments as a mapping
+        """
+
+        self.server.default_route(lambda command, args: [command, args])
+
+        result = self._run(
+            lambda client: client.request('broadcast', {'command': 'say hi'}),
+        )
+
+        self.assertEqual(['broadcast', {'command': 'say hi'}], result)
+
+    def test_addresses(self):
+        """
+        Tests that the server reports the socket it listens on
+        """
+
+        self.assertEqual([self.server.socket], self.server.addresses)
+
+    def test_invalid_requests(self):
+        """
+        Tests that requests which are not objects and results that can not be
+        serialized are answered with errors
+        """
+
+        response = self.loop.run_until_complete(self.server.handle([]))
+        self.assertEqual('APIError', response['error']['type'])
+
+        self.server.route('opaque', object)
+
+        async def scenario(client):
+            try:
+                await client.call('opaque')
+            except mcadminpanel.agent.errors.APIError as ex:
+                return str(ex)
+
+        self.assertTrue(self._run(scenario).startswith('InternalError: Unable to encode'))
+
+    def test_socket_permissions(self):
+        """
+        Tests that only the user running the agent can use its socket
+        """
+
+        self.assertEqual(0o600, os.stat(self.server.socket).st_mode & 0o777)
+
+    def test_stale_socket(self):
+        """
+        Tests that only sockets nobody listens on are replaced
+        """
+
+        other = mcadminpanel.agent.api.APIServer(
+            dict(API_CONF, socket=self.server.socket),
+            loop=self.loop,
+        )
+        with self.assertRaises(mcadminpanel.agent.errors.APIError):
+            self.loop.run_until_complete(other.start())
+
+        self.loop.run_until_complete(self.server.stop())
+        path = os.path.join(self.directory.name, 'agent.sock')
+        with open(path, 'w') as regular:
+            regular.write('not a socket')
+
+        with self.assertRaises(mcadminpanel.agent.errors.APIError):
+            self.loop.run_until_complete(self.server.start())
+        self.assertTrue(os.path.isfile(path))
+        os.remove(path)
+
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(path)
+        stale.close()
+
+        self.loop.run_until_complete(self.server.start())
+        self.assertEqual('fast', self._run(lambda client: client.call('fast', value='fast')))
+
+    def test_tcp_token(self):
+        """
+        Tests that requests over TCP need the token of the API
+        """
+
+        insecure = mcadminpanel.agent.api.APIServer(
+            dict(API_CONF, socket=None, host='127.0.0.1', port=0),
+            loop=self.loop,
+        )
+        with self.assertRaises(mcadminpanel.agent.errors.ConfigurationError):
+            self.loop.run_until_complete(insecure.start())
+
+        server = mcadminpanel.agent.api.APIServer(
+            dict(API_CONF, socket=None, host='127.0.0.1', port=0, token='secret'),
+            loop=self.loop,
+        )
+        server.route('ping', lambda: 'pong')
+        self.loop.run_until_complete(server.start())
+        host, port = server.addresses[0]
+
+        async def call(token):
+            client = await mcadminpanel.agent.api.APIClient.connect(
+                host=host,
+                port=port,
+                token=token,
+            )
+            try:
+                return await client.call('ping')
+            except mcadminpanel.agent.errors.APIError as ex:
+                return str(ex)
+            finally:
+                await client.close()
+
+        try:
+            results = [
+                self.loop.run_until_complete(call(token))
+                for token in (None, 'wrong', 'secret')
+            ]
+        finally:
+            self.loop.run_until_complete(server.stop())
+
+        self.assertEqual(
+            ['APIError: Invalid token', 'APIError: Invalid token', 'pong'],
+            results,
+        )
+
+    def test_handle_internal_error(self):
+        """
+        Tests that unexpected exceptions are reported as internal errors
+        """
+
+        def broken():
+            return {}['missing']
+
+        self.server.route('broken', broken)
+
+        response = self.loop.run_until_complete(
+            self.server.handle({'id': 5, 'command': 'broken'}),
+        )
+
+        self.assertEqual(5, response['id'])
+        self.assertEqual('InternalError', response['error']['type'])
+
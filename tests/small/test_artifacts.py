@@ -0,0 +1,213 @@
+"""
+Tests for the store of server jars and plugins
+"""
+
+import asyncio
+import errno
+import fcntl
+import os
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+
+import mcadminpanel.agent.artifacts
+import mcadminpanel.agent.errors
+
+JAR = b'PK\x03\x04server jar' * 1000
+
+PLUGIN = b'PK\x03\x04plugin' * 100
+
+class TestArtifactStore(unittest.TestCase):
+    """
+    Tests for deduplicating the artifacts of server directories
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.servers = {}
+        for name in ('survival', 'creative'):
+            directory = os.path.join(self.directory.name, name)
+            os.makedirs(os.path.join(directory, 'plugins'))
+            self._write(os.path.join(directory, 'server.jar'), JAR)
+            self._write(os.path.join(directory, 'plugins', 'essentials.jar'), PLUGIN)
+            self._write(os.path.join(directory, 'server.properties'), b'motd=hello\n')
+            self.servers[name] = unittest.mock.Mock(directory=directory)
+            self.servers[name].name = name
+
+        supervisor = unittest.mock.Mock(servers=self.servers)
+        supervisor.get.side_effect = self.servers.__getitem__
+
+        self.store = mcadminpanel.agent.artifacts.ArtifactStore(
+            supervisor,
+            {
+                'path': os.path.join(self.directory.name, 'artifacts'),
+                'max_size': None,
+                'patterns': ['*.jar', 'plugins/*.jar'],
+            },
+            loop=self.loop,
+        )
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.directory.cleanup()
+
+    def _write(self, path, data):
+        with open(path, 'wb') as output:
+            output.write(data)
+
+    def _path(self, name, *parts):
+        return os.path.join(self.servers[name].directory, *parts)
+
+    def test_dedupe(self):
+        """
+        Tests that identical artifacts become links to one stored copy
+        """
+
+        report = self.loop.run_until_complete(self.store.api_dedupe_artifacts())
+
+        self.assertEqual(
+            {'files': 2, 'stored': 0, 'linked': 2, 'saved_bytes': len(JAR) + len(PLUGIN)},
+            report['servers']['survival'],
+        )
+        self.assertEqual(2, report['servers']['creative']['stored'])
+        self.assertTrue(os.path.samefile(
+            self._path('survival', 'server.jar'),
+            self._path('creative', 'server.jar'),
+        ))
+        self.assertEqual(2, len(self.store.index))
+        with open(self._path('survival', 'server.jar'), 'rb') as jar:
+            self.assertEqual(JAR, jar.read())
+
+        report = self.loop.run_until_complete(self.store.api_dedupe_artifacts(['survival']))
+        self.assertEqual(
+            {'files': 2, 'stored': 0, 'linked': 0, 'saved_bytes': 0},
+            report['servers']['survival'],
+        )
+
+        artifacts = self.loop.run_until_complete(self.store.api_list_artifacts())
+        self.assertEqual([2, 2], [artifact['links'] for artifact in artifacts])
+
+    def test_place(self):
+        """
+        Tests that stored artifacts are linked into new directories
+        """
+
+        self.store.load()
+        digest, known = self.store.add(self._path('survival', 'server.jar'))
+        self.assertFalse(known)
+
+        target = os.path.join(self.directory.name, 'new', 'server.jar')
+        os.makedirs(os.path.dirname(target))
+
+        self.assertEqual('link', self.store.place(digest, target))
+        self.assertTrue(os.path.samefile(self._path('survival', 'server.jar'), target))
+
+    def test_cross_device(self):
+        """
+        Tests that artifacts are cloned or copied when they can not be linked
+        """
+
+        self.store.load()
+        digest, _ = self.store.add(self._path('survival', 'server.jar'))
+        target = self._path('creative', 'server.jar')
+
+        with unittest.mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'Cross-device')):
+            method = self.store.place(digest, target)
+
+        self.assertIn(method, ('reflink', 'copy'))
+        self.assertFalse(os.path.samefile(self._path('survival', 'server.jar'), target))
+        self.assertEqual(
+            ['plugins', 'server.jar', 'server.properties'],
+            sorted(os.listdir(self.servers['creative'].directory)),
+        )
+        with open(target, 'rb') as jar:
+            self.assertEqual(JAR, jar.read())
+
+    def test_corrupted(self):
+        """
+        Tests that an artifact changed since it was verified is hashed again
+        and removed when its hash no longer matches
+        """
+
+        self.store.load()
+        digest, _ = self.store.add(self._path('survival', 'server.jar'))
+        path = self.store.object_path(digest)
+
+        with unittest.mock.patch('mcadminpanel.agent.backup.file_digest') as file_digest:
+            self.store.verify(digest)
+        file_digest.assert_not_called()
+
+        os.chmod(path, 0o644)
+        self._write(path, b'garbage')
+
+        with self.assertLogs(level='ERROR'):
+            with self.assertRaises(mcadminpanel.agent.errors.ArtifactError):
+                self.store.place(digest, os.path.join(self.directory.name, 'server.jar'))
+        self.assertNotIn(digest, self.store.index)
+        self.assertFalse(os.path.exists(path))
+
+    def test_shared_index(self):
+        """
+        Tests that the index is not used while another process holds its lock
+        """
+
+        os.makedirs(self.store.path)
+        with open(os.path.join(self.store.path, 'index.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+            future = asyncio.ensure_future(
+                self.store.api_dedupe_artifacts(['survival']),
+                loop=self.loop,
+            )
+            self.loop.run_until_complete(asyncio.sleep(0.1))
+
+            self.assertFalse(future.done())
+            self.assertFalse(os.path.exists(os.path.join(self.store.path, 'index.json')))
+
+        report = self.loop.run_until_complete(future)
+
+        self.assertEqual(2, report['servers']['survival']['files'])
+        self.assertTrue(os.path.exists(os.path.join(self.store.path, 'index.json')))
+
+    def test_load(self):
+        """
+        Tests that artifacts missing from the index are verified before use
+        """
+
+        self.loop.run_until_complete(self.store.api_dedupe_artifacts(['survival']))
+        os.unlink(os.path.join(self.store.path, 'index.json'))
+
+        self.store.load()
+
+        self.assertEqual(2, len(self.store.index))
+        for entry in self.store.index.values():
+            self.assertIsNone(entry['verified'])
+
+    def test_evict(self):
+        """
+        Tests that the least recently used unlinked artifacts are evicted
+        """
+
+        self.store.load()
+        jar, _ = self.store.add(self._path('survival', 'server.jar'))
+        plugin, _ = self.store.add(self._path('survival', 'plugins', 'essentials.jar'))
+        self.store.index[jar]['used'] = 2
+        self.store.index[plugin]['used'] = 1
+        self.store.max_size = 0
+
+        self.assertEqual([], self.store.evict())
+
+        os.unlink(self._path('survival', 'server.jar'))
+        os.unlink(self._path('survival', 'plugins', 'essentials.jar'))
+        self.store.max_size = len(JAR)
+
+        self.assertEqual([plugin], self.store.evict())
+        self.assertEqual([jar], list(self.store.index))
+        self.assertFalse(os.path.exists(self.store.object_path(plugin)))
@@ -0,0 +1,387 @@
+"""
+Tests for the world backups
+"""
+
+import asyncio
+import os
+import os.path
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import nose
+
+import mcadminpanel.agent.backup
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.logstream
+
+CHUNK_SIZE = 4096
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Tests for the token bucket rate limiter
+    """
+
+    def test_unlimited(self):
+        """
+        Tests that no rate never waits
+        """
+
+        limiter = mcadminpanel.agent.backup.RateLimiter(None)
+
+        started = time.monotonic()
+        limiter.consume(10 ** 12)
+
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    @unittest.mock.patch('time.sleep')
+    def test_limited(self, fake_sleep):
+        """
+        Tests that taking more than the bucket holds waits for the difference
+        """
+
+        limiter = mcadminpanel.agent.backup.RateLimiter(1000)
+
+        limiter.consume(1000)
+        fake_sleep.assert_not_called()
+
+        limiter.consume(500)
+        fake_sleep.assert_called_once_with(unittest.mock.ANY)
+        self.assertAlmostEqual(0.5, fake_sleep.call_args[0][0], places=1)
+
+
+class TestWriteAtomic(unittest.TestCase):
+    """
+    Tests for replacing files atomically
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replace(self):
+        """
+        Tests that a replaced file keeps its mode and no temporary file is left
+        """
+
+        path = os.path.join(self.directory.name, 'server.properties')
+        with open(path, 'wb') as output:
+            output.write(b'motd=hello\n')
+        os.chmod(path, 0o640)
+
+        mcadminpanel.agent.backup.write_atomic(path, b'motd=bye\n')
+
+        with open(path, 'rb') as properties:
+            self.assertEqual(b'motd=bye\n', properties.read())
+        self.assertEqual(0o640, os.stat(path).st_mode & 0o7777)
+        self.assertEqual(['server.properties'], os.listdir(self.directory.name))
+
+    def test_failed_write(self):
+        """
+        Tests that the temporary file is removed when the write fails
+        """
+
+        path = os.path.join(self.directory.name, 'server.properties')
+
+        with unittest.mock.patch('os.replace', side_effect=OSError('Read-only')):
+            with self.assertRaises(OSError):
+                mcadminpanel.agent.backup.write_atomic(path, b'motd=bye\n')
+
+        self.assertEqual([], os.listdir(self.directory.name))
+
+
+class TestBackupEngine(unittest.TestCase):
+    """
+    Tests for taking snapshots of server directories
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.server_dir = os.path.join(self.directory.name, 'survival')
+        os.makedirs(os.path.join(self.server_dir, 'world', 'region'))
+
+        self.region = os.path.join(self.server_dir, 'world', 'region', 'r.0.0.mca')
+        with open(self.region, 'wb') as region:
+            for index in range(4):
+                region.write(bytes([index]) * CHUNK_SIZE)
+        with open(os.path.join(self.server_dir, 'server.properties'), 'wb') as properties:
+            properties.write(b'motd=hello\n')
+
+        self.engine = mcadminpanel.agent.backup.BackupEngine(
+            unittest.mock.Mock(),
+            {
+                'path': os.path.join(self.directory.name, 'backups'),
+                'chunk_size': CHUNK_SIZE,
+                'workers': 2,
+                'rate_limit': None,
+                'save_timeout': 1,
+            },
+            loop=self.loop,
+        )
+
+    def tearDown(self):
+        self.engine.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.directory.cleanup()
+
+    def _server(self, running):
+        server = unittest.mock.Mock(directory=self.server_dir, adopted=None)
+        server.name = 'survival'
+        server.console = mcadminpanel.agent.logstream.LogStream()
+        server.process.returncode = None if running else 0
+
+        return server
+
+    def test_snapshot(self):
+        """
+        Tests that a snapshot lists every file and stores its chunks
+        """
+
+        manifest = self.engine.snapshot('survival', self.server_dir)
+
+        files = {entry['path']: entry for entry in manifest['files']}
+        self.assertEqual(
+            {os.path.join('world', 'region', 'r.0.0.mca'), 'server.properties'},
+            set(files),
+        )
+        self.assertEqual(4, len(files[os.path.join('world', 'region', 'r.0.0.mca')]['chunks']))
+        self.assertEqual(5, manifest['stats']['new_chunks'])
+        self.assertEqual([manifest['id']], self.engine.snapshots('survival'))
+        self.assertEqual(manifest, self.engine.manifest('survival', manifest['id']))
+
+        for entry in manifest['files']:
+            for digest in entry['chunks']:
+                self.assertTrue(self.engine.store.has(digest))
+
+    def test_incremental(self):
+        """
+        Tests that later snapshots only store the chunks that changed
+        """
+
+        self.engine.snapshot('survival', self.server_dir)
+
+        with open(self.region, 'r+b') as region:
+            region.seek(2 * CHUNK_SIZE)
+            region.write(b'\xff' * CHUNK_SIZE)
+
+        manifest = self.engine.snapshot('survival', self.server_dir)
+
+        self.assertEqual(1, manifest['stats']['reused_files'])
+        self.assertEqual(4 * CHUNK_SIZE, manifest['stats']['hashed_bytes'])
+        self.assertEqual(1, manifest['stats']['new_chunks'])
+        self.assertEqual(CHUNK_SIZE, manifest['stats']['new_bytes'])
+        self.assertEqual(2, len(self.engine.snapshots('survival')))
+
+    @nose.tools.raises(mcadminpanel.agent.errors.BackupError)
+    def test_unknown_snapshot(self):
+        """
+        Tests that loading a missing snapshot fails
+        """
+
+        self.engine.manifest('survival', '20200101T000000000000Z')
+
+    def test_invalid_names(self):
+        """
+        Tests that snapshot ids and server names from the API cannot point
+        outside of the snapshots of the managed servers
+        """
+
+        mcadminpanel.agent.backup.write_json(os.path.join(self.directory.name, 'x.json'), {})
+
+        for snapshot_id in ('../../../x', 'nope', None):
+            with self.assertRaises(mcadminpanel.agent.errors.BackupError):
+                self.engine.manifest('survival', snapshot_id)
+
+        self.engine.supervisor.get.side_effect = mcadminpanel.agent.errors.ServerError(
+            'Unknown server: ../..',
+        )
+        with self.assertRaises(mcadminpanel.agent.errors.ServerError):
+            self.engine.api_list_backups('../..')
+
+    def test_backup_running_server(self):
+        """
+        Tests that saving is paused around the snapshot of a running server
+        """
+
+        server = self._server(running=True)
+
+        def send_command(command):
+            if command == 'save-all flush':
+                self.loop.call_soon(
+                    server.console.publish,
+                    'stdout',
+                    b'[Server thread/INFO]: Saved the game\n',
+                )
+
+        server.send_command.side_effect = send_command
+
+        manifest = self.loop.run_until_complete(self.engine.backup(server))
+
+        self.assertEqual(2, manifest['stats']['files'])
+        self.assertEqual(
+            [
+                unittest.mock.call('save-off'),
+                unittest.mock.call('save-all flush'),
+                unittest.mock.call('save-on'),
+            ],
+            server.send_command.call_args_list,
+        )
+
+    def test_backup_stopped_server(self):
+        """
+        Tests that a stopped server is backed up without console commands
+        """
+
+        server = self._server(running=False)
+
+        self.loop.run_until_complete(self.engine.backup(server))
+
+        server.send_command.assert_not_called()
+
+    def _adopted_server(self, rcon_conf):
+        server = unittest.mock.Mock(directory=self.server_dir, process=None, rcon_conf=rcon_conf)
+        server.name = 'survival'
+
+        async def execute(command, timeout=None):  # pylint: disable=unused-argument
+            return {'command': command, 'response': 'Saved the game'}
+
+        server.commands.execute.side_effect = execute
+
+        return server
+
+    def test_backup_adopted_server(self):
+        """
+        Tests that saving of an adopted server is paused over RCON
+        """
+
+        server = self._adopted_server({'port': 25575, 'password': 'secret'})
+
+        manifest = self.loop.run_until_complete(self.engine.backup(server))
+
+        self.assertEqual(2, manifest['stats']['files'])
+        self.assertEqual(
+            ['save-off', 'save-all flush', 'save-on'],
+            [call[0][0] for call in server.commands.execute.call_args_list],
+        )
+        server.send_command.assert_not_called()
+
+    def test_adopted_without_rcon(self):
+        """
+        Tests that a running adopted server without RCON is not backed up
+        """
+
+        server = self._adopted_server(None)
+
+        with self.assertRaises(mcadminpanel.agent.errors.BackupError):
+            self.loop.run_until_complete(self.engine.backup(server))
+
+        server.commands.execute.assert_not_called()
+        self.assertEqual([], self.engine.snapshots('survival'))
+
+    def test_save_timeout(self):
+        """
+        Tests that saving is turned back on when the server does not save
+        """
+
+        server = self._server(running=True)
+        self.engine.save_timeout = 0.05
+
+        with self.assertRaises(mcadminpanel.agent.errors.BackupError):
+            self.loop.run_until_complete(self.engine.backup(server))
+
+        server.send_command.assert_called_with('save-on')
+        self.assertEqual([], self.engine.snapshots('survival'))
+
+    def _contents(self):
+        contents = {}
+        for path in mcadminpanel.agent.backup.walk_files(self.server_dir):
+            with open(os.path.join(self.server_dir, path), 'rb') as data:
+                stat = os.stat(os.path.join(self.server_dir, path))
+                contents[path] = (data.read(), stat.st_mtime_ns)
+
+        return contents
+
+    def _check_restore(self, verify):
+        expected = self._contents()
+        manifest = self.engine.snapshot('survival', self.server_dir)
+
+        with open(self.region, 'r+b') as region:
+            region.write(b'griefed')
+        with open(os.path.join(self.server_dir, 'extra.txt'), 'wb') as extra:
+            extra.write(b'not in the backup')
+
+        stats = self.engine.restore('survival', manifest['id'], self.server_dir, verify)
+
+        self.assertEqual(expected, self._contents())
+        self.assertEqual(5, stats['chunks'])
+        self.assertFalse(os.path.exists(self.server_dir + '.restoring'))
+
+    def test_restore(self):
+        """
+        Tests that a restore verifies and rebuilds the snapshot exactly
+        """
+
+        self._check_restore(verify=True)
+
+    def test_restore_no_verify(self):
+        """
+        Tests that a restore copying chunks in the kernel rebuilds the snapshot
+        """
+
+        self._check_restore(verify=False)
+
+    def test_restore_corrupted(self):
+        """
+        Tests that a corrupted chunk fails the restore and keeps the directory
+        """
+
+        manifest = self.engine.snapshot('survival', self.server_dir)
+        expected = self._contents()
+
+        digest = manifest['files'][0]['chunks'][0]
+        with open(self.engine.store.chunk_path(digest), 'r+b') as chunk:
+            chunk.write(b'bitrot')
+
+        with self.assertRaises(mcadminpanel.agent.errors.BackupError):
+            self.engine.restore('survival', manifest['id'], self.server_dir)
+
+        self.assertEqual(expected, self._contents())
+        self.assertFalse(os.path.exists(self.server_dir + '.restoring'))
+
+    def test_restore_server_latest(self):
+        """
+        Tests that a stopped server is restored from its latest snapshot
+        """
+
+        self.engine.snapshot('survival', self.server_dir)
+        manifest = self.engine.snapshot('survival', self.server_dir)
+
+        server = self._server(running=False)
+        server.running = False
+
+        result = self.loop.run_until_complete(self.engine.restore_server(server))
+
+        self.assertEqual(manifest['id'], result['id'])
+
+    def test_restore_running_server(self):
+        """
+        Tests that running servers are not restored
+        """
+
+        self.engine.snapshot('survival', self.server_dir)
+
+        server = self._server(running=True)
+        server.running = True
+
+        with self.assertRaises(mcadminpanel.agent.errors.BackupError):
+            self.loop.run_until_complete(self.engine.restore_server(server))
+
@@ -0,0 +1,97 @@
+"""
+Tests for the class data sharing archives of the server jars
+"""
+
+import os
+import os.path
+import tempfile
+import unittest
+
+import mcadminpanel.agent.cds
+
+class TestArchiveCache(unittest.TestCase):
+    """
+    Tests for choosing and keeping the archives of server jars
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.java = os.path.join(self.directory.name, 'jdk', 'bin', 'java')
+        os.makedirs(os.path.dirname(self.java))
+        self._write(self.java, b'#!/bin/sh\n')
+        os.chmod(self.java, 0o755)
+        self._write(os.path.join(self.directory.name, 'server.jar'), b'PK\x03\x04')
+
+        self.command = [self.java, '-Xmx2G', '-jar', 'server.jar', 'nogui']
+        self.cache = mcadminpanel.agent.cds.ArchiveCache(
+            os.path.join(self.directory.name, 'archives'),
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, path, data):
+        with open(path, 'wb') as output:
+            output.write(data)
+
+    def test_not_a_jar(self):
+        """
+        Tests that commands not running a jar are left alone
+        """
+
+        command = ['/bin/sh', 'start.sh']
+        launch = self.cache.launch('survival', command, self.directory.name)
+
+        self.assertEqual(command, launch.command)
+        self.assertIsNone(launch.mode)
+
+        launch = self.cache.launch('survival', [self.java, '-jar'], self.directory.name)
+        self.assertIsNone(launch.mode)
+
+    def test_dump_then_use(self):
+        """
+        Tests that the first start dumps the archive used by the next ones
+        """
+
+        launch = self.cache.launch('survival', self.command, self.directory.name)
+
+        self.assertEqual('dump', launch.mode)
+        self.assertEqual(
+            [
+                self.java,
+                '-Xmx2G',
+                mcadminpanel.agent.cds.IGNORE_UNKNOWN,
+                mcadminpanel.agent.cds.DUMP_ARCHIVE.format(launch.temporary),
+                '-jar',
+                'server.jar',
+                'nogui',
+            ],
+            launch.command,
+        )
+
+        # A server that crashed before writing the archive leaves nothing
+        self._write(launch.temporary, b'')
+        self.cache.finish(launch)
+        self.assertFalse(os.path.exists(launch.temporary))
+        self.assertFalse(os.path.exists(launch.archive))
+
+        self._write(launch.temporary, b'archive')
+        self.cache.finish(launch)
+
+        used = self.cache.launch('survival', self.command, self.directory.name)
+        self.assertEqual('use', used.mode)
+        self.assertIn(mcadminpanel.agent.cds.USE_ARCHIVE.format(launch.archive), used.command)
+        self.assertIsNone(used.temporary)
+
+    def test_updated_jar(self):
+        """
+        Tests that an updated server jar gets a new archive
+        """
+
+        archive = self.cache.archive(self.command, self.directory.name)
+
+        path = os.path.join(self.directory.name, 'server.jar')
+        self._write(path, b'PK\x03\x04 updated')
+
+        self.assertNotEqual(archive, self.cache.archive(self.command, self.directory.name))
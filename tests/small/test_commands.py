@@ -0,0 +1,278 @@
+"""
+Tests for the console command pipeline
+"""
+
+import asyncio
+import re
+import time
+import unittest
+import unittest.mock
+
+import nose
+
+import mcadminpanel.agent.commands
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.logstream
+
+# Time a fake server takes to answer a command in seconds
+RESPONSE_DELAY = 0.05
+
+class FakeStdin(object):
+    """
+    Stdin of a fake server answering every command on its console after a
+    delay
+    """
+
+    def __init__(self, console, loop, answer):
+        self.console = console
+        self.loop = loop
+        self.answer = answer
+        self.writes = []
+
+    def write(self, data):
+        """
+        Record a write and answer each command in it
+        """
+
+        self.writes.append(data)
+        for line in data.splitlines():
+            response = self.answer(line.decode())
+            if response is not None:
+                self.loop.call_later(
+                    RESPONSE_DELAY,
+                    self.console.publish,
+                    'stdout',
+                    response.encode() + b'\n',
+                )
+
+    async def drain(self):
+        """
+        Nothing is ever buffered
+        """
+
+def answer(command):
+    """
+    The console output of a vanilla server for a command
+    """
+
+    if command.startswith('say '):
+        return '[12:00:00] [Server thread/INFO]: [Server] ' + command[4:]
+    if command.startswith('whitelist add '):
+        return '[12:00:00] [Server thread/INFO]: Added {} to the whitelist'.format(command[14:])
+    if command == 'list':
+        return '[12:00:00] [Server thread/INFO]: There are 0 of a max 20 players online:'
+    if command in ('tp', 'fly'):
+        return '[12:00:00] [Server thread/INFO]: Unknown command. Try /help for a list of commands'
+
+    return None
+
+
+class TestCommandPipeline(unittest.TestCase):
+    """
+    Tests for sending console commands and matching their responses
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            self.loop.run_until_complete(server.commands.close())
+
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _server(self, name='survival'):
+        server = unittest.mock.Mock(
+            console=mcadminpanel.agent.logstream.LogStream(),
+            command_timeout=1,
+            command_batch_size=64,
+            rcon_conf=None,
+        )
+        server.name = name
+        server.process.returncode = None
+        server.process.stdin = FakeStdin(server.console, self.loop, answer)
+        server.commands = mcadminpanel.agent.commands.CommandPipeline(server, loop=self.loop)
+
+        self.servers.append(server)
+
+        return server
+
+    def test_response(self):
+        """
+        Tests that a command resolves with its response and latency
+        """
+
+        server = self._server()
+
+        result = self.loop.run_until_complete(server.commands.execute('whitelist add Steve'))
+
+        self.assertEqual('whitelist add Steve', result['command'])
+        self.assertTrue(result['response'].endswith('Added Steve to the whitelist'))
+        self.assertGreaterEqual(result['latency'], RESPONSE_DELAY * 0.9)
+        self.assertEqual(1, server.commands.stats()['completed'])
+
+    def test_batching(self):
+        """
+        Tests that concurrent commands are written in one batch and each
+        matched to its own response
+        """
+
+        server = self._server()
+
+        results = self.loop.run_until_complete(asyncio.gather(
+            server.commands.execute('say one'),
+            server.commands.execute('list'),
+            server.commands.execute('say two'),
+        ))
+
+        self.assertEqual([b'say one\nlist\nsay two\n'], server.process.stdin.writes)
+        self.assertEqual(
+            ['[Server] one', 'There are 0', '[Server] two'],
+            [re.search(r'\[Server\] \w+|There are \d+', result['response']).group(0)
+             for result in results],
+        )
+
+    def test_no_response(self):
+        """
+        Tests that commands without a known response finish once written
+        """
+
+        server = self._server()
+
+        result = self.loop.run_until_complete(server.commands.execute('weather clear'))
+
+        self.assertIsNone(result['response'])
+
+    def test_custom_pattern(self):
+        """
+        Tests that callers can give the pattern of the response
+        """
+
+        server = self._server()
+        pattern = mcadminpanel.agent.commands.compile_pattern(r'\[Server\] custom')
+
+        result = self.loop.run_until_complete(
+            server.commands.execute('say custom', pattern),
+        )
+
+        self.assertIn('custom', result['response'])
+
+    @nose.tools.raises(mcadminpanel.agent.errors.ServerError)
+    def test_unknown_command(self):
+        """
+        Tests that commands the server does not understand fail
+        """
+
+        server = self._server()
+
+        self.loop.run_until_complete(server.commands.execute(
+            'tp',
+            mcadminpanel.agent.commands.compile_pattern('Teleported'),
+        ))
+
+    def test_unknown_command_order(self):
+        """
+        Tests that an unknown command without a response pattern does not
+        fail the commands written after it
+        """
+
+        server = self._server()
+
+        result = self.loop.run_until_complete(server.commands.execute('tp'))
+        self.loop.run_until_complete(asyncio.sleep(2 * RESPONSE_DELAY))
+        listed = self.loop.run_until_complete(server.commands.execute('list'))
+
+        self.assertIsNone(result['response'])
+        self.assertIn('There are 0', listed['response'])
+
+    def test_unknown_after_no_response(self):
+        """
+        Tests that an unknown command written after a command without a
+        response fails at once
+        """
+
+        server = self._server()
+
+        results = self.loop.run_until_complete(asyncio.gather(
+            server.commands.execute('weather clear'),
+            server.commands.execute(
+                'fly',
+                mcadminpanel.agent.commands.compile_pattern('Flying'),
+                timeout=5,
+            ),
+            return_exceptions=True
+        ))
+
+        self.assertIsNone(results[0]['response'])
+        self.assertIsInstance(results[1], mcadminpanel.agent.errors.ServerError)
+        self.assertIn('did not understand fly', str(results[1]))
+
+    def test_forget_written(self):
+        """
+        Tests that commands without a response are forgotten once they are
+        older than the command timeout
+        """
+
+        server = self._server()
+        server.command_timeout = 0.01
+
+        for _ in range(3):
+            self.loop.run_until_complete(server.commands.execute('weather clear'))
+            self.loop.run_until_complete(asyncio.sleep(0.02))
+
+        self.assertEqual(1, len(server.commands._written)) # pylint: disable=protected-access
+
+    @nose.tools.raises(mcadminpanel.agent.errors.ServerError)
+    def test_timeout(self):
+        """
+        Tests that commands that are never answered time out
+        """
+
+        server = self._server()
+
+        self.loop.run_until_complete(server.commands.execute(
+            'say nothing',
+            mcadminpanel.agent.commands.compile_pattern('never'),
+            timeout=0.1,
+        ))
+
+    @nose.tools.raises(mcadminpanel.agent.errors.ServerError)
+    def test_not_running(self):
+        """
+        Tests that commands to a stopped server fail
+        """
+
+        server = self._server()
+        server.process = None
+
+        self.loop.run_until_complete(server.commands.execute('list'))
+
+    @nose.tools.raises(mcadminpanel.agent.errors.ServerError)
+    def test_multiple_lines(self):
+        """
+        Tests that a command can not smuggle in more commands
+        """
+
+        server = self._server()
+        server.commands.submit('say hi\nstop')
+
+    def test_broadcast_concurrent(self):
+        """
+        Tests that broadcasting to many servers takes about one round trip
+        """
+
+        servers = [self._server('server{}'.format(index)) for index in range(40)]
+
+        started = time.monotonic()
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[server.commands.execute('say restarting soon') for server in servers]
+        ))
+        duration = time.monotonic() - started
+
+        self.assertEqual(40, len(results))
+        self.assertLess(duration, RESPONSE_DELAY * 5)
+
@@ -5,13 +5,14 @@ Tests for the configuration system
 import io
 import json
 import os.path
+import tempfile
 import unittest
 import unittest.mock
 
 import nose
 
-from mcadminpanel.agent.config import Configuration
-from mcadminpanel.agent.errors import ConfigurationError
+from mcadminpanel.agent.config import Configuration, diff, merge
+from mcadminpanel.agent.errors import ConfigurationError, SchemaError
 
 class TestConfiguration(unittest.TestCase):
     """
@@ -42,8 +43,8 @@ class TestConfiguration(unittest.TestCase):
         """
 
         options = {
-            'test': 'value',
-            'key': 'value',
+            'root': 'value',
+            'pidfile': 'value',
         }
 
         fake_open.return_value = io.StringIO(
@@ -148,6 +149,259 @@ class TestConfiguration(unittest.TestCase):
             'Default config did not contain the correct values',
         )
 
+    @unittest.mock.patch('builtins.open')
+    def test_typed_values(self, fake_open):
+        """
+        Tests that values are validated into immutable typed values
+        """
+
+        fake_open.return_value = io.StringIO(
+            json.dumps(
+                {
+                    'servers': {
+                        'survival': {
+                            'command': ['java', '-jar', 'server.jar'],
+                        },
+                    },
+                }
+            )
+        )
+
+        config = Configuration()
+        server = config.servers['survival']
+
+        self.assertEqual(('java', '-jar', 'server.jar'), server.command)
+        self.assertTrue(server.autostart, 'Server default was not applied')
+        self.assertIsNone(server.directory)
+        self.assertEqual(server.command, server['command'])
+        self.assertEqual(60, config.supervisor.stop_timeout)
+
+        with self.assertRaises(AttributeError):
+            server.autostart = False
+
+        with self.assertRaises(TypeError):
+            config.servers['other'] = server
+
+    @unittest.mock.patch('builtins.open')
+    def test_unknown_attribute(self, fake_open):
+        """
+        Tests that typos in option names are not silently ignored
+        """
+
+        fake_open.return_value = io.StringIO('{}')
+
+        config = Configuration()
+
+        with self.assertRaises(AttributeError):
+            config.rooot # pylint: disable=pointless-statement
+
+    @unittest.mock.patch('builtins.open')
+    def test_defaults_not_modified(self, fake_open):
+        """
+        Tests that loading a configuration never modifies the defaults
+        """
+
+        fake_open.return_value = io.StringIO(
+            json.dumps({'logging': {'level': 'debug'}})
+        )
+
+        Configuration()
+
+        self.assertEqual('warn', Configuration.DEFAULTS['logging']['level'])
+
+    @unittest.mock.patch('builtins.open')
+    def test_choices_lowercased(self, fake_open):
+        """
+        Tests that choices are matched regardless of case and stored lowercased
+        """
+
+        fake_open.return_value = io.StringIO(
+            json.dumps({'event_loop': 'UVLoop', 'logging': {'level': 'DEBUG'}})
+        )
+
+        config = Configuration()
+
+        self.assertEqual('uvloop', config.event_loop)
+        self.assertEqual('debug', config.logging['level'])
+
+    def test_validation_errors(self):
+        """
+        Tests that invalid values are reported with their exact path
+        """
+
+        cases = (
+            ({'roots': 'x'}, 'roots', 'unknown option'),
+            ({'root': 5}, 'root', 'expected a string, got number'),
+            ({'logging': 'debug'}, 'logging', 'expected an object, got string'),
+            ({'logging': {'level': 'loud'}}, 'logging.level', 'expected one of'),
+            ({'metrics': {'history': 0}}, 'metrics.history', 'must be at least 1'),
+            ({'api': {'port': True}}, 'api.port', 'expected an integer or null'),
+            (
+                {'servers': {'hub': {'command': ['java', 5]}}},
+                'servers.hub.command[1]',
+                'expected a string, got number',
+            ),
+            ({'servers': {'hub': {}}}, 'servers.hub.command', 'missing required option'),
+            ({'servers': {'hub': {'command': []}}}, 'servers.hub.command', 'at least 1'),
+            (
+                {'servers': {'hub': {'command': ['java'], 'properties': {'motd': ['a']}}}},
+                'servers.hub.properties.motd',
+                'expected a string, number or boolean, got list',
+            ),
+            (
+                {'servers': {'hub': {'command': ['java'], 'hibernate': 'yes'}}},
+                'servers.hub.hibernate',
+                'expected a boolean or null, got string',
+            ),
+        )
+
+        for options, path, message in cases:
+            with unittest.mock.patch('builtins.open') as fake_open:
+                fake_open.return_value = io.StringIO(json.dumps(options))
+
+                with self.assertRaises(SchemaError) as context:
+                    Configuration()
+
+            self.assertEqual(path, context.exception.path)
+            self.assertIn(message, str(context.exception))
+
+
+class TestReload(unittest.TestCase):
+    """
+    Tests for reloading the configuration in place
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'config.json')
+
+        self._write({
+            'logging': {'level': 'info'},
+            'servers': {
+                'survival': {'command': ['java', '-jar', 'a.jar']},
+                'creative': {'command': ['java', '-jar', 'b.jar']},
+            },
+        })
+        self.config = Configuration(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, options):
+        with open(self.path, 'w') as config_file:
+            json.dump(options, config_file)
+
+    def test_no_changes(self):
+        """
+        Tests that reloading an unchanged file reports no changes
+        """
+
+        self.assertEqual([], self.config.reload())
+
+    def test_changes(self):
+        """
+        Tests that only the changed values are reported and applied
+        """
+
+        servers = self.config.servers
+
+        self._write({
+            'logging': {'level': 'debug'},
+            'servers': {
+                'survival': {'command': ['java', '-jar', 'c.jar']},
+                'lobby': {'command': ['java']},
+            },
+        })
+
+        self.assertEqual(
+            [
+                ('logging', 'level'),
+                ('servers', 'creative'),
+                ('servers', 'lobby'),
+                ('servers', 'survival', 'command'),
+            ],
+            self.config.reload(),
+        )
+        self.assertEqual('debug', self.config.logging['level'])
+        self.assertEqual(
+            Configuration.DEFAULTS['logging']['file'],
+            self.config.logging['file'],
+            'Defaults were not merged into the changed section',
+        )
+        self.assertEqual(['lobby', 'survival'], sorted(self.config.servers))
+        self.assertEqual(['creative', 'survival'], sorted(servers))
+
+    def test_invalid_values_not_applied(self):
+        """
+        Tests that a reload with invalid values changes nothing
+        """
+
+        self._write({
+            'logging': {'level': 'debug'},
+            'servers': {'survival': {'command': 'java'}},
+        })
+
+        with self.assertRaises(SchemaError) as context:
+            self.config.reload()
+
+        self.assertEqual('servers.survival.command', context.exception.path)
+        self.assertEqual('info', self.config.logging['level'])
+
+    def test_removed_section(self):
+        """
+        Tests that a removed section goes back to its defaults
+        """
+
+        self._write({'logging': {'level': 'info'}})
+
+        self.assertEqual(
+            [('servers', 'creative'), ('servers', 'survival')],
+            self.config.reload(),
+        )
+        self.assertEqual({}, self.config.servers)
+
+    @nose.tools.raises(ConfigurationError)
+    def test_invalid_reload(self):
+        """
+        Tests that a broken file is reported without losing the old values
+        """
+
+        with open(self.path, 'w') as config_file:
+            config_file.write('{')
+
+        try:
+            self.config.reload()
+        finally:
+            self.assertEqual('info', self.config.logging['level'])
+
+def test_diff():
+    """
+    Tests that the diff reports the paths of changed values
+    """
+
+    assert diff({'a': 1, 'b': {'c': 2}}, {'a': 1, 'b': {'c': 2}}) == []
+    assert diff(
+        {'a': 1, 'b': {'c': 2, 'd': 3}},
+        {'a': 2, 'b': {'c': 2}, 'e': 4},
+    ) == [('a',), ('b', 'd'), ('e',)]
+    assert diff(1, {'a': 1}, ('x',)) == [('x',)]
+
+def test_merge_copies():
+    """
+    Tests that merged values share nothing with the merged dictionaries
+    """
+
+    defaults = {'a': {'b': [1]}, 'c': {'d': 1}}
+    overrides = {'c': {'d': 2, 'e': [2]}}
+
+    merged = merge(defaults, overrides)
+    merged['a']['b'].append(3)
+    merged['c']['e'].append(3)
+
+    assert merged['c']['d'] == 2
+    assert defaults == {'a': {'b': [1]}, 'c': {'d': 1}}
+    assert overrides == {'c': {'d': 2, 'e': [2]}}
+
 @unittest.mock.patch('builtins.open')
 def test_constr_with_path(fake_open):
     """
@@ -0,0 +1,247 @@
+"""
+Tests for adopting servers left running by a previous agent
+"""
+
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import psutil
+
+import mcadminpanel.agent.cds
+import mcadminpanel.agent.discovery
+
+SLEEPER = 'import time; time.sleep(30)'
+
+def start_process(command, cwd):
+    """
+    Start a process and wait for its command line to show, it can briefly be
+    empty after the process started
+    """
+
+    process = subprocess.Popen(command, cwd=cwd)
+
+    deadline = time.monotonic() + 5
+    while not psutil.Process(process.pid).cmdline() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return process
+
+class TestMatching(unittest.TestCase):
+    """
+    Tests for recognizing the process of a server
+    """
+
+    def setUp(self):
+        self.server = unittest.mock.Mock(
+            directory='/srv/mc/survival',
+            command=['java', '-jar', 'server.jar', 'nogui'],
+        )
+
+    def test_resolved_executable(self):
+        """
+        Tests that the executable may have been resolved to a full path
+        """
+
+        self.assertTrue(mcadminpanel.agent.discovery.matches(
+            self.server,
+            '/srv/mc/survival',
+            ['/usr/bin/java', '-jar', 'server.jar', 'nogui'],
+        ))
+
+    def test_other_directory(self):
+        """
+        Tests that the same command in another directory is another server
+        """
+
+        self.assertFalse(mcadminpanel.agent.discovery.matches(
+            self.server,
+            '/srv/mc/creative',
+            ['java', '-jar', 'server.jar', 'nogui'],
+        ))
+
+    def test_other_command(self):
+        """
+        Tests that other processes in the server directory are not the server
+        """
+
+        self.assertFalse(mcadminpanel.agent.discovery.matches(
+            self.server,
+            '/srv/mc/survival',
+            ['java', '-jar', 'backup.jar'],
+        ))
+
+    def test_unreadable(self):
+        """
+        Tests that processes that could not be inspected never match
+        """
+
+        self.assertFalse(mcadminpanel.agent.discovery.matches(self.server, None, None))
+
+    @unittest.mock.patch('psutil.process_iter')
+    def test_scan_is_cheap(self, process_iter):
+        """
+        Tests that only processes named like a server executable are
+        inspected
+        """
+
+        others = [
+            unittest.mock.Mock(pid=1000 + index, info={'name': 'bash'})
+            for index in range(1000)
+        ]
+        server = unittest.mock.Mock(pid=5000, info={'name': 'java'})
+        server.cwd.return_value = '/srv/mc/survival'
+        server.cmdline.return_value = ['/usr/bin/java', '-jar', 'server.jar', 'nogui']
+        process_iter.return_value = others + [server]
+
+        found = mcadminpanel.agent.discovery.scan({'survival': self.server})
+
+        process_iter.assert_called_with(attrs=['name'])
+        self.assertEqual({'survival': server}, found)
+        self.assertFalse(any(process.cwd.called for process in others))
+
+
+class TestDiscovery(unittest.TestCase):
+    """
+    Tests for finding and recording live server processes
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server_directory = os.path.join(self.directory.name, 'survival')
+        os.mkdir(self.server_directory)
+
+        self.command = [sys.executable, '-c', SLEEPER]
+        self.process = start_process(self.command, self.server_directory)
+
+        self.server = unittest.mock.Mock(
+            directory=self.server_directory,
+            command=self.command,
+            running=False,
+        )
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+
+        self.directory.cleanup()
+
+    def _entry(self):
+        return {
+            'pid': self.process.pid,
+            'create_time': psutil.Process(self.process.pid).create_time(),
+        }
+
+    def test_recorded(self):
+        """
+        Tests that a recorded process is adopted without scanning
+        """
+
+        with unittest.mock.patch('mcadminpanel.agent.discovery.scan') as scan:
+            found = mcadminpanel.agent.discovery.discover(
+                {'survival': self.server},
+                {'survival': self._entry()},
+            )
+
+        self.assertFalse(scan.called)
+        self.assertEqual(self.process.pid, found['survival'].pid)
+
+    def test_reused_pid(self):
+        """
+        Tests that a recorded pid now used by another process is not trusted
+        """
+
+        entry = self._entry()
+        entry['create_time'] -= 100
+
+        process = mcadminpanel.agent.discovery.check_recorded(self.server, entry)
+
+        self.assertIsNone(process)
+
+    def test_scanned(self):
+        """
+        Tests that servers missing from the state file are found by a scan
+        """
+
+        found = mcadminpanel.agent.discovery.discover({'survival': self.server}, {})
+
+        self.assertEqual(self.process.pid, found['survival'].pid)
+
+    def test_class_data_sharing(self):
+        """
+        Tests that servers started with class data sharing options are found
+        """
+
+        java = os.path.join(self.directory.name, 'bin', 'java')
+        os.mkdir(os.path.dirname(java))
+        os.symlink(sys.executable, java)
+        with open(os.path.join(self.server_directory, 'server.jar'), 'wb') as jar:
+            jar.write(b'PK\x03\x04')
+
+        self.server.command = [java, '-c', SLEEPER, '-jar', 'server.jar']
+        launch = mcadminpanel.agent.cds.ArchiveCache(
+            os.path.join(self.directory.name, 'archives'),
+        ).launch('survival', self.server.command, self.server_directory)
+        self.assertEqual('dump', launch.mode)
+
+        process = start_process(launch.command, self.server_directory)
+        try:
+            entry = {
+                'pid': process.pid,
+                'create_time': psutil.Process(process.pid).create_time(),
+            }
+            recorded = mcadminpanel.agent.discovery.check_recorded(self.server, entry)
+            scanned = mcadminpanel.agent.discovery.scan({'survival': self.server})
+        finally:
+            process.kill()
+            process.wait()
+
+        self.assertEqual(process.pid, recorded.pid)
+        self.assertEqual(process.pid, scanned['survival'].pid)
+
+    def test_supervised(self):
+        """
+        Tests that servers already supervised are not looked for
+        """
+
+        self.server.running = True
+
+        found = mcadminpanel.agent.discovery.discover({'survival': self.server}, {})
+
+        self.assertEqual({}, found)
+
+    def test_state_file(self):
+        """
+        Tests that started servers are recorded and exited ones forgotten
+        """
+
+        path = os.path.join(self.directory.name, 'state', 'agent.state')
+
+        state = mcadminpanel.agent.discovery.StateFile(path)
+        state.server_event('survival', 'start', {'pid': self.process.pid})
+        state.server_event('creative', 'start', {'pid': self.process.pid})
+        state.server_event('creative', 'crash', {'returncode': 1, 'runtime': 2})
+
+        self.assertEqual(
+            {'survival': self._entry()},
+            mcadminpanel.agent.discovery.StateFile(path).load(),
+        )
+
+    def test_damaged_state_file(self):
+        """
+        Tests that a damaged state file is ignored
+        """
+
+        path = os.path.join(self.directory.name, 'agent.state')
+        with open(path, 'w') as state_file:
+            state_file.write('{"servers": ')
+
+        with self.assertLogs(level='WARNING'):
+            servers = mcadminpanel.agent.discovery.StateFile(path).load()
+
+        self.assertEqual({}, servers)
+
@@ -0,0 +1,108 @@
+"""
+Tests for the event loop backend selection
+"""
+
+import asyncio
+import unittest
+import unittest.mock
+
+import nose
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.eventloop
+
+class TestLoopPolicy(unittest.TestCase):
+    """
+    Tests for resolving a backend to an event loop policy
+    """
+
+    def test_asyncio(self):
+        """
+        Tests that the standard library loop keeps the default policy
+        """
+
+        self.assertEqual(
+            (None, 'asyncio'),
+            mcadminpanel.agent.eventloop.loop_policy('asyncio'),
+        )
+
+    @unittest.mock.patch('importlib.import_module')
+    def test_auto_uvloop(self, import_module):
+        """
+        Tests that uvloop is used when it is installed
+        """
+
+        policy, name = mcadminpanel.agent.eventloop.loop_policy('auto')
+
+        import_module.assert_called_with('uvloop')
+        self.assertEqual(import_module.return_value.EventLoopPolicy.return_value, policy)
+        self.assertEqual('uvloop', name)
+
+    @unittest.mock.patch('importlib.import_module')
+    def test_auto_fallback(self, import_module):
+        """
+        Tests that the standard library loop is used without uvloop
+        """
+
+        import_module.side_effect = ImportError('No module named uvloop')
+
+        self.assertEqual(
+            (None, 'asyncio'),
+            mcadminpanel.agent.eventloop.loop_policy('auto'),
+        )
+
+    @nose.tools.raises(mcadminpanel.agent.errors.ConfigurationError)
+    @unittest.mock.patch('importlib.import_module')
+    def test_uvloop_missing(self, import_module):
+        """
+        Tests that asking for uvloop when it is not installed is an error
+        """
+
+        import_module.side_effect = ImportError('No module named uvloop')
+
+        mcadminpanel.agent.eventloop.loop_policy('uvloop')
+
+
+class TestNewEventLoop(unittest.TestCase):
+    """
+    Tests for creating event loops of a backend
+    """
+
+    def test_asyncio(self):
+        """
+        Tests that the standard library backend creates a standard loop
+        """
+
+        loop = mcadminpanel.agent.eventloop.new_event_loop('asyncio')
+        try:
+            self.assertIsInstance(loop, asyncio.AbstractEventLoop)
+            self.assertEqual(42, loop.run_until_complete(asyncio.sleep(0, 42)))
+        finally:
+            loop.close()
+
+    @unittest.mock.patch('importlib.import_module')
+    def test_uvloop(self, import_module):
+        """
+        Tests that the uvloop backend creates its loops from its policy
+        """
+
+        loop = mcadminpanel.agent.eventloop.new_event_loop('uvloop')
+
+        policy = import_module.return_value.EventLoopPolicy.return_value
+        self.assertEqual(policy.new_event_loop.return_value, loop)
+
+    @unittest.mock.patch('importlib.import_module')
+    @unittest.mock.patch('asyncio.get_event_loop')
+    @unittest.mock.patch('asyncio.set_event_loop_policy')
+    def test_setup(self, set_event_loop_policy, get_event_loop, import_module):
+        """
+        Tests that setting up a backend installs its policy
+        """
+
+        loop = mcadminpanel.agent.eventloop.setup_event_loop('auto')
+
+        set_event_loop_policy.assert_called_with(
+            import_module.return_value.EventLoopPolicy.return_value,
+        )
+        self.assertEqual(get_event_loop.return_value, loop)
+
@@ -0,0 +1,264 @@
+"""
+Tests for hibernating idle servers
+"""
+
+import asyncio
+import json
+import os.path
+import socket
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.hibernation
+import mcadminpanel.agent.supervisor
+from mcadminpanel.agent.hibernation import (
+    decode_string,
+    decode_varint,
+    encode_packet,
+    encode_string,
+    encode_varint,
+)
+
+RESTART_CONF = {
+    'restart_delay': 0.01,
+    'max_restart_delay': 0.04,
+    'reset_after': 600,
+    'stop_commands': ['stop'],
+    'stop_timeout': 2,
+    'command_timeout': 2,
+    'command_batch_size': 64,
+    'cgroup_root': None,
+    'cds_archives': None,
+}
+
+HIBERNATION_CONF = {
+    'enabled': True,
+    'idle_timeout': 0,
+    'poll_interval': 60,
+    'timeout': 2,
+    'message': 'The server is starting',
+}
+
+# A fake server that is ready at once, has nobody online and exits when
+# told to stop
+EMPTY_SERVER = '''
+import sys
+print('[12:00:00] [Server thread/INFO]: Done (0.1s)! For help, type "help"', flush=True)
+for line in sys.stdin:
+    if line.strip() == 'list':
+        print('[12:00:00] [Server thread/INFO]: There are 0 of a max of 20 players online: ',
+              flush=True)
+    if line.strip() == 'stop':
+        sys.exit(0)
+'''
+
+def free_port():
+    """
+    A TCP port nothing listens on
+    """
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def login(port, player):
+    """
+    Log in like a client and return the message the player is disconnected
+    with
+    """
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(
+            mcadminpanel.agent.hibernation.encode_handshake(
+                '127.0.0.1',
+                port,
+                mcadminpanel.agent.hibernation.STATE_LOGIN,
+                protocol=763,
+            )
+            + encode_packet(mcadminpanel.agent.hibernation.LOGIN_START, encode_string(player))
+        )
+        await writer.drain()
+
+        _, payload = await mcadminpanel.agent.hibernation.read_packet(reader)
+        message, _ = decode_string(payload)
+    finally:
+        writer.close()
+
+    return json.loads(message)['text']
+
+
+class TestProtocol(unittest.TestCase):
+    """
+    Tests for encoding the packets of the Minecraft protocol
+    """
+
+    def test_varint(self):
+        """
+        Tests that VarInts round trip, negative ones on five bytes
+        """
+
+        self.assertEqual(b'\xac\x02', encode_varint(300))
+        self.assertEqual(b'\xff\xff\xff\xff\x0f', encode_varint(-1))
+
+        for value in (0, 1, 127, 128, 300, 2 ** 31 - 1, -1, -2 ** 31):
+            encoded = encode_varint(value)
+            self.assertEqual((value, len(encoded)), decode_varint(encoded))
+
+        with self.assertRaises(mcadminpanel.agent.errors.HibernationError):
+            decode_varint(b'\x80\x80')
+
+    def test_handshake(self):
+        """
+        Tests that handshakes give their protocol version and next state
+        """
+
+        packet = mcadminpanel.agent.hibernation.encode_handshake('mc.example.com', 25565, 2, 763)
+        length, offset = decode_varint(packet)
+        packet_id, offset = decode_varint(packet, offset)
+
+        self.assertEqual(len(packet) - 1, length)
+        self.assertEqual(mcadminpanel.agent.hibernation.HANDSHAKE, packet_id)
+        self.assertEqual(
+            (763, 2),
+            mcadminpanel.agent.hibernation.decode_handshake(packet[offset:]),
+        )
+
+    def test_idle_status(self):
+        """
+        Tests that hibernating servers show no players
+        """
+
+        self.assertEqual(
+            {
+                'version': {'name': '1.20.1', 'protocol': 763},
+                'players': {'max': 20, 'online': 0},
+                'description': {'text': 'Survival'},
+            },
+            mcadminpanel.agent.hibernation.idle_status(
+                {
+                    'version': {'name': '1.20.1', 'protocol': 763},
+                    'players': {'max': 20, 'online': 1, 'sample': [{'name': 'Steve'}]},
+                    'description': {'text': 'Survival'},
+                },
+                {},
+            ),
+        )
+        self.assertEqual(
+            {'players': {'max': 40, 'online': 0}, 'description': {'text': 'Lobby'}},
+            mcadminpanel.agent.hibernation.idle_status(
+                None,
+                {'motd': 'Lobby', 'max-players': '40'},
+            ),
+        )
+
+
+class TestHibernator(unittest.TestCase):
+    """
+    Tests for stopping idle servers and waking them up
+    """
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.port = free_port()
+        with open(os.path.join(self.root.name, 'server.properties'), 'w') as properties:
+            properties.write('motd=Lobby\nserver-ip=127.0.0.1\nserver-port={}\n'.format(self.port))
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.root.cleanup()
+
+    def test_busy_servers(self):
+        """
+        Tests that servers are only idle once they are empty for the timeout
+        """
+
+        server = unittest.mock.Mock(
+            state='running',
+            RUNNING='running',
+            start_requested=None,
+            hibernate=None,
+        )
+        server.log.online = {'Steve'}
+        supervisor = unittest.mock.Mock(servers={'lobby': server})
+        hibernator = mcadminpanel.agent.hibernation.Hibernator(
+            supervisor,
+            dict(HIBERNATION_CONF, idle_timeout=60),
+            loop=self.loop,
+        )
+
+        self.assertEqual([], self.loop.run_until_complete(hibernator.check()))
+        self.assertEqual({}, hibernator.idle_since)
+
+        server.log.online = set()
+        self.assertEqual([], self.loop.run_until_complete(hibernator.check()))
+        self.assertIn('lobby', hibernator.idle_since)
+
+        server.hibernate = False
+        self.loop.run_until_complete(hibernator.check())
+        self.assertEqual({}, hibernator.idle_since)
+
+    def test_hibernate_and_wake(self):
+        """
+        Tests that an idle server is stopped, answers status pings while
+        hibernating and starts again when a player logs in
+        """
+
+        supervisor = mcadminpanel.agent.supervisor.Supervisor(
+            self.root.name,
+            {'lobby': {'command': [sys.executable, '-c', EMPTY_SERVER], 'directory': '.'}},
+            RESTART_CONF,
+            loop=self.loop,
+        )
+        server = supervisor.servers['lobby']
+        hibernator = mcadminpanel.agent.hibernation.Hibernator(
+            supervisor,
+            HIBERNATION_CONF,
+            loop=self.loop,
+        )
+        hibernator.start()
+
+        events = []
+        supervisor.add_listener(lambda name, event, data: events.append(event))
+
+        async def scenario():
+            supervisor.start()
+            while server.start_latency is None:
+                await asyncio.sleep(0.01)
+
+            hibernated = await hibernator.check()
+            status = await mcadminpanel.agent.hibernation.ping_server('127.0.0.1', self.port)
+            state = server.state
+
+            message = await login(self.port, 'Steve')
+            while server.state != server.RUNNING:
+                await asyncio.sleep(0.01)
+
+            await hibernator.stop()
+            await supervisor.stop()
+
+            return hibernated, status, state, message
+
+        hibernated, status, state, message = self.loop.run_until_complete(
+            asyncio.wait_for(scenario(), 10),
+        )
+
+        self.assertEqual(['lobby'], hibernated)
+        self.assertEqual(server.STOPPED, state)
+        self.assertEqual({'text': 'Lobby'}, status['description'])
+        self.assertEqual(0, status['players']['online'])
+        self.assertEqual(
+            mcadminpanel.agent.hibernation.HIBERNATING_VERSION,
+            status['version']['name'],
+        )
+        self.assertEqual('The server is starting', message)
+        self.assertEqual({}, hibernator.listeners)
+        self.assertEqual(['start', 'ready', 'stop', 'hibernate', 'wake', 'start'], events[:6])
@@ -0,0 +1,290 @@
+"""
+Tests for the binary event journal
+"""
+
+import asyncio
+import os
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+
+import nose
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.journal
+import mcadminpanel.agent.logparser
+import mcadminpanel.agent.logstream
+from mcadminpanel.agent.journal import JournalReader, JournalWriter
+
+BLOCK_SIZE = 4096
+
+class TestEncoding(unittest.TestCase):
+    """
+    Tests for encoding single events
+    """
+
+    def _round_trip(self, event, data):
+        frame = mcadminpanel.agent.journal.encode_event(1500000000.5, event, 'survival', data)
+        length, kind = mcadminpanel.agent.journal.FRAME.unpack_from(frame)
+
+        self.assertEqual(mcadminpanel.agent.journal.KIND_EVENT, kind)
+        self.assertEqual(len(frame) - mcadminpanel.agent.journal.FRAME.size, length)
+
+        return mcadminpanel.agent.journal.decode_event(
+            frame[mcadminpanel.agent.journal.FRAME.size:],
+        )
+
+    def test_event(self):
+        """
+        Tests that an event with data decodes to the original event
+        """
+
+        self.assertEqual(
+            {
+                'timestamp': 1500000000.5,
+                'event': 'crash',
+                'server': 'survival',
+                'data': {'returncode': 3},
+            },
+            self._round_trip('crash', {'returncode': 3}),
+        )
+
+    def test_metrics(self):
+        """
+        Tests that metrics keep every field, including missing ones
+        """
+
+        data = dict.fromkeys(mcadminpanel.agent.journal.METRIC_FIELDS, 2.0)
+        data['read_rate'] = None
+
+        self.assertEqual(data, self._round_trip('metrics', data)['data'])
+
+    @nose.tools.raises(mcadminpanel.agent.errors.JournalError)
+    def test_unknown_event(self):
+        """
+        Tests that unknown event types are rejected
+        """
+
+        mcadminpanel.agent.journal.encode_event(0, 'exploded', 'survival')
+
+
+class TestJournalFile(unittest.TestCase):
+    """
+    Tests for writing and reading journal files
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'events.journal')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, count):
+        writer = JournalWriter(self.path, BLOCK_SIZE)
+        for index in range(count):
+            writer.append(
+                1000.0 + index,
+                'join',
+                'survival' if index % 2 else 'creative',
+                {'player': 'player{}'.format(index)},
+            )
+        writer.close()
+
+    def test_blocks(self):
+        """
+        Tests that events fill fixed size blocks with an index for each
+        """
+
+        self._write(500)
+
+        with JournalReader(self.path) as reader:
+            self.assertEqual(BLOCK_SIZE, reader.block_size)
+            self.assertGreater(reader.block_count, 3)
+
+            first, last, count, _ = reader.index(0)
+            self.assertEqual(1000.0, first)
+            self.assertEqual(1000.0 + count - 1, last)
+            self.assertIsNone(reader.index(reader.block_count - 1))
+
+            events = list(reader.events())
+
+        self.assertEqual(500, len(events))
+        self.assertEqual(
+            [1000.0 + index for index in range(500)],
+            [event['timestamp'] for event in events],
+        )
+
+    def test_time_range(self):
+        """
+        Tests that a time range only reads the blocks it overlaps
+        """
+
+        self._write(500)
+
+        with JournalReader(self.path) as reader:
+            with unittest.mock.patch.object(reader, 'frames', wraps=reader.frames) as frames:
+                events = list(reader.events(start=1400, end=1410))
+
+            self.assertLessEqual(frames.call_count, 2)
+
+        self.assertEqual(
+            [1000.0 + index for index in range(400, 411)],
+            [event['timestamp'] for event in events],
+        )
+
+    def test_filters(self):
+        """
+        Tests that events can be limited to servers and event types
+        """
+
+        self._write(10)
+
+        with JournalReader(self.path) as reader:
+            servers = set(event['server'] for event in reader.events(servers=['survival']))
+            others = list(reader.events(events=['leave']))
+
+        self.assertEqual({'survival'}, servers)
+        self.assertEqual([], others)
+
+    def test_reopen(self):
+        """
+        Tests that reopening a journal appends after its last event
+        """
+
+        self._write(300)
+
+        writer = JournalWriter(self.path, 65536)
+        writer.append(5000.0, 'start', 'survival', {'pid': 12})
+        writer.close()
+
+        with JournalReader(self.path) as reader:
+            events = list(reader.events(start=4000))
+
+        self.assertEqual(BLOCK_SIZE, writer.block_size)
+        self.assertEqual([5000.0], [event['timestamp'] for event in events])
+
+    def test_torn_write(self):
+        """
+        Tests that a partially written frame is discarded when reopened
+        """
+
+        self._write(3)
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as journal:
+            journal.write(b'\x00\x00\x01\x00\x01torn')
+
+        writer = JournalWriter(self.path)
+        writer.close()
+
+        self.assertEqual(size, os.path.getsize(self.path))
+
+    def test_cut_at_block(self):
+        """
+        Tests that a journal cut off at the start of a block keeps the index
+        of the block before it when reopened
+        """
+
+        self._write(500)
+
+        with JournalReader(self.path) as reader:
+            kept = [
+                event['timestamp']
+                for event in reader.events()
+                if event['timestamp'] <= reader.index(1)[1]
+            ]
+
+        for size in (2 * BLOCK_SIZE + 3, 2 * BLOCK_SIZE):
+            os.truncate(self.path, size)
+
+            writer = JournalWriter(self.path)
+            writer.append(5000.0, 'start', 'survival', {'pid': 12})
+            writer.close()
+
+            with JournalReader(self.path) as reader:
+                self.assertEqual(kept[-1], reader.index(1)[1])
+                events = list(reader.events(end=6000))
+
+            self.assertEqual(kept + [5000.0], [event['timestamp'] for event in events])
+
+    @nose.tools.raises(mcadminpanel.agent.errors.JournalError)
+    def test_not_a_journal(self):
+        """
+        Tests that other files are not read as journals
+        """
+
+        with open(self.path, 'wb') as journal:
+            journal.write(b'[12:00:00] [Server thread/INFO]: Done\n')
+
+        JournalReader(self.path)
+
+
+class TestJournal(unittest.TestCase):
+    """
+    Tests for recording the agent events
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.journal = mcadminpanel.agent.journal.Journal(
+            {
+                'file': os.path.join(self.directory.name, 'events.journal'),
+                'block_size': BLOCK_SIZE,
+                'flush_interval': 0.01,
+            },
+            loop=self.loop,
+        )
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.journal.stop())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.directory.cleanup()
+
+    def test_events(self):
+        """
+        Tests that recorded events can be read back over the API
+        """
+
+        server = unittest.mock.Mock(console=mcadminpanel.agent.logstream.LogStream())
+        server.name = 'survival'
+        server.log = server.console.subscribe(
+            mcadminpanel.agent.logparser.LogParser('survival'),
+        )
+
+        self.journal.start()
+        self.journal.watch(server)
+        self.journal.server_event('survival', 'start', {'pid': 12})
+        self.journal.metrics_sample('survival', 1000.0, (1.0, 2.0, 3.0, 4.0, 5.0, 6.0))
+        server.console.publish(
+            'stdout',
+            b'[12:00:00] [Server thread/INFO]: Steve joined the game\n',
+        )
+        server.console.publish('stdout', b'[12:00:05] [Server thread/INFO]: <Steve> hi\n')
+        server.console.publish('stdout', b'[12:01:00] [Server thread/INFO]: Steve left the game\n')
+        self.journal.watch(server)
+        server.console.publish(
+            'stdout',
+            b"[12:02:00] [Server thread/WARN]: Can't keep up! Is the server overloaded? "
+            b'Running 2034ms or 40 ticks behind\n',
+        )
+
+        events = self.loop.run_until_complete(self.journal.api_events(server='survival'))
+
+        self.assertEqual(
+            ['start', 'metrics', 'join', 'leave', 'lag'],
+            [event['event'] for event in events],
+        )
+        self.assertEqual({'behind': 2034}, events[4]['data'])
+        self.assertEqual({'player': 'Steve'}, events[2]['data'])
+        self.assertEqual(6.0, events[1]['data']['write_rate'])
+
+        leaves = self.loop.run_until_complete(self.journal.api_events(event='leave'))
+        self.assertEqual(1, len(leaves))
+
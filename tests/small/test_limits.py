@@ -0,0 +1,216 @@
+"""
+Tests for the resource limits of the server processes
+"""
+
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+import psutil
+
+import mcadminpanel.agent.limits
+import mcadminpanel.agent.metrics
+
+SLEEPER = 'import time; time.sleep(30)'
+
+LIMITS = {
+    'cpu_weight': 50,
+    'cpu_quota': 1.5,
+    'memory_max': 2 * 1024 ** 3,
+    'io_weight': 200,
+}
+
+class TestWeights(unittest.TestCase):
+    """
+    Tests for mapping cgroup weights to process priorities
+    """
+
+    def test_nice(self):
+        """
+        Tests that heavier CPU weights get lower nice values
+        """
+
+        self.assertEqual(0, mcadminpanel.agent.limits.weight_to_nice(100))
+        self.assertEqual(3, mcadminpanel.agent.limits.weight_to_nice(50))
+        self.assertEqual(-3, mcadminpanel.agent.limits.weight_to_nice(200))
+        self.assertEqual(19, mcadminpanel.agent.limits.weight_to_nice(1))
+        self.assertEqual(-20, mcadminpanel.agent.limits.weight_to_nice(10000))
+
+    def test_ioprio(self):
+        """
+        Tests that heavier IO weights get higher IO priorities
+        """
+
+        self.assertEqual(4, mcadminpanel.agent.limits.weight_to_ioprio(100))
+        self.assertEqual(3, mcadminpanel.agent.limits.weight_to_ioprio(200))
+        self.assertEqual(7, mcadminpanel.agent.limits.weight_to_ioprio(1))
+        self.assertEqual(0, mcadminpanel.agent.limits.weight_to_ioprio(10000))
+
+
+class TestCgroupLimits(unittest.TestCase):
+    """
+    Tests for limits applied through a cgroup, against a fake cgroup tree
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'survival')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _read(self, *parts):
+        with open(os.path.join(*parts), 'r') as cgroup_file:
+            return cgroup_file.read()
+
+    def _write(self, name, content):
+        with open(os.path.join(self.path, name), 'w') as cgroup_file:
+            cgroup_file.write(content)
+
+    def test_setup(self):
+        """
+        Tests that the cgroup is created with its controllers and limits
+        """
+
+        limits = mcadminpanel.agent.limits.server_limits('survival', LIMITS, self.directory.name)
+
+        self.assertIsInstance(limits, mcadminpanel.agent.limits.CgroupLimits)
+        self.assertEqual('+io\n', self._read(self.directory.name, 'cgroup.subtree_control'))
+        self.assertEqual('50\n', self._read(self.path, 'cpu.weight'))
+        self.assertEqual('150000 100000\n', self._read(self.path, 'cpu.max'))
+        self.assertEqual('2147483648\n', self._read(self.path, 'memory.max'))
+        self.assertEqual('default 200\n', self._read(self.path, 'io.weight'))
+
+    def test_unlimited(self):
+        """
+        Tests that servers without limits still get their own cgroup
+        """
+
+        limits = mcadminpanel.agent.limits.server_limits('survival', None, self.directory.name)
+
+        self.assertEqual('100\n', self._read(self.path, 'cpu.weight'))
+        self.assertEqual('max 100000\n', self._read(self.path, 'cpu.max'))
+        self.assertEqual('max\n', self._read(self.path, 'memory.max'))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'io.weight')))
+
+        limits.attach(1234)
+        self.assertEqual('1234\n', self._read(self.path, 'cgroup.procs'))
+
+    def test_enter(self):
+        """
+        Tests that servers join their cgroup before they exec
+        """
+
+        limits = mcadminpanel.agent.limits.server_limits('survival', LIMITS, self.directory.name)
+        process = subprocess.Popen(  # pylint: disable=subprocess-popen-preexec-fn
+            [sys.executable, '-c', 'pass'],
+            preexec_fn=limits.enter,
+        )
+        process.wait()
+
+        self.assertEqual('{}\n'.format(process.pid), self._read(self.path, 'cgroup.procs'))
+
+    def test_usage(self):
+        """
+        Tests that the usage of the cgroup is read from its stat files
+        """
+
+        limits = mcadminpanel.agent.limits.server_limits('survival', LIMITS, self.directory.name)
+        self._write('cpu.stat', 'usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n')
+        self._write('memory.current', '1048576\n')
+        self._write(
+            'io.stat',
+            '8:0 rbytes=100 wbytes=200 rios=1 wios=2 dbytes=0 dios=0\n'
+            '8:16 rbytes=1000 wbytes=2000 rios=3 wios=4 dbytes=0 dios=0\n',
+        )
+
+        self.assertEqual(
+            {
+                'cpu_usec': 2500000,
+                'memory': 1048576,
+                'read_bytes': 1100,
+                'write_bytes': 2200,
+            },
+            limits.usage(),
+        )
+
+    def test_fallback(self):
+        """
+        Tests that an unusable cgroup root falls back to process limits
+        """
+
+        root = os.path.join(self.directory.name, 'file')
+        with open(root, 'w'):
+            pass
+
+        with self.assertLogs(level='WARNING'):
+            limits = mcadminpanel.agent.limits.server_limits('survival', LIMITS, root)
+
+        self.assertIsInstance(limits, mcadminpanel.agent.limits.ProcessLimits)
+
+    def test_sampled(self):
+        """
+        Tests that servers in a cgroup are sampled from its usage
+        """
+
+        limits = mcadminpanel.agent.limits.server_limits('survival', LIMITS, self.directory.name)
+        server = unittest.mock.Mock(pid=os.getpid(), limits=limits)
+        sampler = mcadminpanel.agent.metrics.MetricsSampler(
+            unittest.mock.Mock(servers={'survival': server}),
+            {'interval': 1, 'history': 10},
+            loop=unittest.mock.Mock(),
+        )
+
+        for timestamp, cpu_usec, read_bytes in ((100, 1000000, 0), (102, 2000000, 4096)):
+            self._write('cpu.stat', 'usage_usec {}\n'.format(cpu_usec))
+            self._write('memory.current', '1048576\n')
+            self._write('io.stat', '8:0 rbytes={} wbytes=0\n'.format(read_bytes))
+            sampler.sample(timestamp)
+
+        latest = sampler.latest('survival')
+        self.assertEqual(50, latest['cpu_percent'])
+        self.assertEqual(1048576, latest['rss'])
+        self.assertEqual(2048, latest['read_rate'])
+
+
+class TestProcessLimits(unittest.TestCase):
+    """
+    Tests for limits applied to a process without cgroups
+    """
+
+    def setUp(self):
+        self.process = subprocess.Popen([sys.executable, '-c', SLEEPER])
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+
+    def test_attach(self):
+        """
+        Tests that the limits are applied to the process
+        """
+
+        with self.assertLogs(level='WARNING'):
+            limits = mcadminpanel.agent.limits.server_limits('survival', LIMITS, None)
+        limits.attach(self.process.pid)
+
+        process = psutil.Process(self.process.pid)
+        self.assertEqual(3, process.nice())
+        self.assertEqual((psutil.IOPRIO_CLASS_BE, 3), tuple(process.ionice()))
+        self.assertEqual(
+            resource.getrlimit(resource.RLIMIT_DATA),
+            process.rlimit(resource.RLIMIT_DATA),
+        )
+        self.assertIsNone(limits.usage())
+
+    def test_unlimited(self):
+        """
+        Tests that servers without limits or cgroups are left alone
+        """
+
+        self.assertIsNone(mcadminpanel.agent.limits.server_limits('survival', None, None))
@@ -0,0 +1,170 @@
+"""
+Tests for parsing the console output of the servers
+"""
+
+import unittest
+
+import mcadminpanel.agent.logparser
+from mcadminpanel.agent.logparser import LogEvent, parse_line
+
+class TestParseLine(unittest.TestCase):
+    """
+    Tests for turning console lines into events
+    """
+
+    def test_players(self):
+        """
+        Tests that players joining and leaving are recognized
+        """
+
+        self.assertEqual(
+            LogEvent('join', {'player': 'Steve'}),
+            parse_line(b'[12:00:00] [Server thread/INFO]: Steve joined the game\n'),
+        )
+        self.assertEqual(
+            LogEvent('leave', {'player': 'Alex_2'}),
+            parse_line(b'[12:00:00] [Server thread/INFO]: Alex_2 left the game\n'),
+        )
+
+    def test_chat(self):
+        """
+        Tests that players can not fake events in the chat
+        """
+
+        self.assertIsNone(
+            parse_line(b'[12:00:00] [Server thread/INFO]: <Steve> Alex joined the game\n'),
+        )
+
+    def test_lag(self):
+        """
+        Tests that the lag warnings of old and new servers are recognized
+        """
+
+        self.assertEqual(
+            LogEvent('lag', {'behind': 2034}),
+            parse_line(
+                b"[12:00:00] [Server thread/WARN]: Can't keep up! Is the server "
+                b'overloaded? Running 2034ms or 40 ticks behind\n'
+            ),
+        )
+        self.assertEqual(
+            LogEvent('lag', {'behind': 5012}),
+            parse_line(
+                b"[12:00:00] [Server thread/WARN]: Can't keep up! Did the system time "
+                b'change, or is the server overloaded? Running 5012ms behind, '
+                b'skipping 100 tick(s)\n'
+            ),
+        )
+
+    def test_list(self):
+        """
+        Tests that the response of the list command gives the online players
+        """
+
+        self.assertEqual(
+            LogEvent('players', {'count': 2, 'max': 20, 'players': ['Steve', 'Alex']}),
+            parse_line(
+                b'[12:00:00] [Server thread/INFO]: There are 2 of a max of 20 '
+                b'players online: Steve, Alex\n'
+            ),
+        )
+        self.assertEqual(
+            LogEvent('players', {'count': 0, 'max': 10, 'players': []}),
+            parse_line(
+                b'[12:00:00] [Server thread/INFO]: There are 0 of a max 10 players online:\n'
+            ),
+        )
+
+    def test_lifecycle(self):
+        """
+        Tests that the server becoming ready and stopping are recognized
+        """
+
+        self.assertEqual(
+            LogEvent('ready', {'startup': 12.5}),
+            parse_line(
+                b'[12:00:00] [Server thread/INFO]: Done (12.5s)! For help, type "help"\n'
+            ),
+        )
+        self.assertEqual(
+            LogEvent('stopping', {}),
+            parse_line(
+                b'[12:00:00] [Server thread/INFO] [minecraft/DedicatedServer]: Stopping server\n'
+            ),
+        )
+
+    def test_errors(self):
+        """
+        Tests that error lines are events and other lines are not
+        """
+
+        self.assertEqual(
+            LogEvent('error', {'message': 'Exception ticking world'}),
+            parse_line(b'[12:00:00] [Server thread/ERROR]: Exception ticking world\n'),
+        )
+        self.assertIsNone(parse_line(b'[12:00:00] [Server thread/INFO]: Preparing spawn area\n'))
+        self.assertIsNone(parse_line(b'\tat java.lang.Thread.run(Thread.java:748)\n'))
+
+
+class TestLogParser(unittest.TestCase):
+    """
+    Tests for the live state of a server
+    """
+
+    def setUp(self):
+        self.parser = mcadminpanel.agent.logparser.LogParser('survival')
+        self.events = []
+        self.parser.add_listener(lambda name, event: self.events.append((name, event.event)))
+
+    def _feed(self, *messages):
+        for message in messages:
+            self.parser.put('stdout', '[12:00:00] [Server thread/{}\n'.format(message).encode())
+
+    def test_online(self):
+        """
+        Tests that the online players follow joins, leaves and restarts
+        """
+
+        self._feed(
+            'INFO]: Steve joined the game',
+            'INFO]: Alex joined the game',
+            'INFO]: Steve left the game',
+        )
+        self.assertEqual(['Alex'], self.parser.state()['players'])
+
+        self._feed('INFO]: There are 2 of a max of 20 players online: Alex, Herobrine')
+        self.assertEqual(['Alex', 'Herobrine'], self.parser.state()['players'])
+
+        self._feed('INFO]: Stopping server', 'INFO]: Done (3.0s)! For help, type "help"')
+        self.assertEqual([], self.parser.state()['players'])
+        self.assertEqual(3.0, self.parser.state()['startup'])
+
+    def test_lag(self):
+        """
+        Tests that lag spikes and errors are counted
+        """
+
+        self._feed(
+            "WARN]: Can't keep up! Is the server overloaded? Running 2000ms or 40 ticks behind",
+            "WARN]: Can't keep up! Is the server overloaded? Running 5000ms or 100 ticks behind",
+            "WARN]: Can't keep up! Is the server overloaded? Running 3000ms or 60 ticks behind",
+            'ERROR]: Exception ticking world',
+        )
+
+        state = self.parser.state()
+        self.assertEqual(3, state['lag_spikes'])
+        self.assertEqual(3000, state['last_lag'])
+        self.assertEqual(5000, state['max_lag'])
+        self.assertEqual(1, state['errors'])
+        self.assertEqual('Exception ticking world', state['last_error'])
+
+    def test_listeners(self):
+        """
+        Tests that listeners get the events and not the agent's own lines
+        """
+
+        self._feed('INFO]: Steve joined the game', 'INFO]: Tick')
+        self.parser.put('agent', b'[12:00:00] [Server thread/ERROR]: [3 lines dropped]\n')
+
+        self.assertEqual([('survival', 'join')], self.events)
+        self.assertEqual(2, self.parser.state()['lines'])
@@ -0,0 +1,128 @@
+"""
+Tests for the queued logging
+"""
+
+import logging
+import os.path
+import queue
+import tempfile
+import unittest
+import unittest.mock
+
+import mcadminpanel.agent.logqueue
+
+def make_record(message, level=logging.INFO):
+    """
+    A log record with the given message
+    """
+
+    return logging.makeLogRecord({
+        'name': 'test',
+        'levelno': level,
+        'levelname': logging.getLevelName(level),
+        'msg': message,
+    })
+
+
+class TestDroppingQueueHandler(unittest.TestCase):
+    """
+    Tests for the non blocking queue handler
+    """
+
+    def test_drops(self):
+        """
+        Tests that records are dropped and counted when the queue is full
+        """
+
+        handler = mcadminpanel.agent.logqueue.DroppingQueueHandler(queue.Queue(2))
+
+        for index in range(5):
+            handler.handle(make_record('record {}'.format(index)))
+
+        self.assertEqual(3, handler.dropped)
+        self.assertEqual(
+            ['record 0', 'record 1'],
+            [handler.queue.get_nowait().getMessage() for _ in range(2)],
+        )
+
+    def test_drop_warning(self):
+        """
+        Tests that the next queued record is preceded by a drop warning
+        """
+
+        handler = mcadminpanel.agent.logqueue.DroppingQueueHandler(queue.Queue(2))
+
+        for index in range(4):
+            handler.handle(make_record('record {}'.format(index)))
+        handler.queue.get_nowait()
+        handler.queue.get_nowait()
+
+        handler.handle(make_record('after'))
+
+        warning = handler.queue.get_nowait()
+        self.assertEqual(logging.WARNING, warning.levelno)
+        self.assertIn('Dropped 2 log records', warning.getMessage())
+        self.assertEqual('after', handler.queue.get_nowait().getMessage())
+
+
+class TestLogListener(unittest.TestCase):
+    """
+    Tests for the thread writing queued records
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'agent.log')
+
+        self.file_handler = mcadminpanel.agent.logqueue.BatchFileHandler(
+            self.path,
+            when='midnight',
+        )
+        self.file_handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+
+    def tearDown(self):
+        self.file_handler.close()
+        self.directory.cleanup()
+
+    def test_writes_batches(self):
+        """
+        Tests that queued records are all written and flushed once per batch
+        """
+
+        log_queue = queue.Queue()
+        for index in range(10):
+            log_queue.put(make_record('record {}'.format(index)))
+
+        listener = mcadminpanel.agent.logqueue.LogListener(log_queue, [self.file_handler])
+        with unittest.mock.patch.object(
+            self.file_handler,
+            'flush_batch',
+            wraps=self.file_handler.flush_batch,
+        ) as flush_batch:
+            listener.start()
+            listener.stop()
+
+        with open(self.path, 'r') as log_file:
+            lines = log_file.read().splitlines()
+
+        self.assertEqual(['INFO record {}'.format(index) for index in range(10)], lines)
+        self.assertLessEqual(flush_batch.call_count, 2)
+
+    def test_handler_level(self):
+        """
+        Tests that handlers only get records at or above their level
+        """
+
+        self.file_handler.setLevel(logging.WARNING)
+
+        log_queue = queue.Queue()
+        log_queue.put(make_record('quiet', logging.DEBUG))
+        log_queue.put(make_record('loud', logging.ERROR))
+
+        listener = mcadminpanel.agent.logqueue.LogListener(log_queue, [self.file_handler])
+        listener.start()
+        listener.stop()
+
+        with open(self.path, 'r') as log_file:
+            self.assertEqual('ERROR loud\n', log_file.read())
+
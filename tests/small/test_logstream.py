@@ -0,0 +1,160 @@
+"""
+Tests for the server console streaming
+"""
+
+import asyncio
+import os.path
+import tempfile
+import unittest
+
+import mcadminpanel.agent.logstream
+
+class TestLineSplitter(unittest.TestCase):
+    """
+    Tests for the incremental line splitter
+    """
+
+    def test_partial_lines(self):
+        """
+        Tests that partial lines are kept until they are completed
+        """
+
+        splitter = mcadminpanel.agent.logstream.LineSplitter()
+
+        self.assertEqual([b'one\n'], splitter.feed(b'one\ntw'))
+        self.assertEqual([b'two\n', b'three\n'], splitter.feed(b'o\nthree\nfo'))
+        self.assertEqual(b'fo', splitter.flush())
+        self.assertEqual(b'', splitter.flush())
+
+    def test_long_lines(self):
+        """
+        Tests that lines over the maximum length are split
+        """
+
+        splitter = mcadminpanel.agent.logstream.LineSplitter(max_line=4)
+
+        self.assertEqual([b'abcd', b'efgh'], splitter.feed(b'abcdefghi'))
+        self.assertEqual([b'ij\n'], splitter.feed(b'j\n'))
+
+
+class TestLogStream(unittest.TestCase):
+    """
+    Tests for the console fan out
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_tail(self):
+        """
+        Tests that the stream keeps a tail of the most recent lines
+        """
+
+        stream = mcadminpanel.agent.logstream.LogStream(tail=2)
+        for index in range(3):
+            stream.publish('stdout', str(index).encode())
+
+        self.assertEqual(3, stream.published)
+        self.assertEqual(
+            [('stdout', b'1'), ('stdout', b'2')],
+            stream.tail.get(),
+        )
+        self.assertEqual([('stdout', b'2')], stream.tail.get(1))
+
+    def test_slow_subscriber_drops(self):
+        """
+        Tests that a subscriber that falls behind drops the oldest lines
+        """
+
+        stream = mcadminpanel.agent.logstream.LogStream()
+        subscriber = stream.subscribe(
+            mcadminpanel.agent.logstream.QueueSubscriber(maxsize=2),
+        )
+
+        for index in range(5):
+            stream.publish('stdout', str(index).encode())
+
+        batch = self.loop.run_until_complete(subscriber.get())
+
+        self.assertEqual(3, subscriber.dropped)
+        self.assertEqual(
+            [
+                ('agent', b'[3 lines dropped]\n'),
+                ('stdout', b'3'),
+                ('stdout', b'4'),
+            ],
+            batch,
+        )
+
+    def test_coalesce_duplicates(self):
+        """
+        Tests that repeated lines only take up one queue entry
+        """
+
+        subscriber = mcadminpanel.agent.logstream.QueueSubscriber(maxsize=2)
+        for _ in range(100):
+            subscriber.put('stdout', b'spam\n')
+        subscriber.put('stdout', b'done\n')
+
+        batch = self.loop.run_until_complete(subscriber.get())
+
+        self.assertEqual(0, subscriber.dropped)
+        self.assertEqual(99, subscriber.coalesced)
+        self.assertEqual(
+            [
+                ('stdout', b'spam\n'),
+                ('agent', b'[last line repeated 99 more times]\n'),
+                ('stdout', b'done\n'),
+            ],
+            batch,
+        )
+
+    def test_get_waits(self):
+        """
+        Tests that consumers wait for lines and stop once closed
+        """
+
+        subscriber = mcadminpanel.agent.logstream.QueueSubscriber()
+
+        async def scenario():
+            waiting = asyncio.ensure_future(subscriber.get())
+            await asyncio.sleep(0)
+            subscriber.put('stdout', b'line\n')
+            first = await waiting
+
+            subscriber.close()
+            second = await subscriber.get()
+
+            return first, second
+
+        first, second = self.loop.run_until_complete(scenario())
+
+        self.assertEqual([('stdout', b'line\n')], first)
+        self.assertEqual([], second)
+
+    def test_file_subscriber(self):
+        """
+        Tests that lines are written to the console file
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'console.log')
+
+            subscriber = mcadminpanel.agent.logstream.FileSubscriber(
+                path,
+                loop=self.loop,
+            )
+            subscriber.start()
+            subscriber.put('stdout', b'one\n')
+            subscriber.put('stderr', b'two\n')
+
+            self.loop.run_until_complete(subscriber.stop())
+
+            with open(path, 'rb') as console_file:
+                self.assertEqual(b'one\ntwo\n', console_file.read())
+
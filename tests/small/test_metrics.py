@@ -0,0 +1,202 @@
+"""
+Tests for the server metrics sampler
+"""
+
+import os
+import unittest
+import unittest.mock
+
+import mcadminpanel.agent.metrics
+
+class TestRingBuffer(unittest.TestCase):
+    """
+    Tests for the array backed ring buffer
+    """
+
+    def test_empty(self):
+        """
+        Tests that an empty buffer has no values
+        """
+
+        ring = mcadminpanel.agent.metrics.RingBuffer(4)
+
+        self.assertEqual(0, len(ring))
+        self.assertIsNone(ring.latest)
+        self.assertEqual([], ring.tolist())
+
+    def test_wraps_around(self):
+        """
+        Tests that the oldest values are overwritten once full
+        """
+
+        ring = mcadminpanel.agent.metrics.RingBuffer(3)
+        for value in range(5):
+            ring.append(value)
+
+        self.assertEqual(3, len(ring))
+        self.assertEqual(4, ring.latest)
+        self.assertEqual([2, 3, 4], ring.tolist())
+
+
+class TestDownsampler(unittest.TestCase):
+    """
+    Tests for the bucket aggregation of samples
+    """
+
+    def test_buckets(self):
+        """
+        Tests that completed buckets hold the mean and maximum
+        """
+
+        downsampler = mcadminpanel.agent.metrics.Downsampler(60, 10, 2)
+        downsampler.add(0, (1, 10))
+        downsampler.add(30, (3, 30))
+        downsampler.add(60, (5, 50))
+
+        self.assertEqual((0, [2, 20], [3, 30]), downsampler.last())
+        self.assertEqual((60, [5, 50], [5, 50]), downsampler.current())
+
+    def test_no_samples(self):
+        """
+        Tests that there are no buckets before any samples
+        """
+
+        downsampler = mcadminpanel.agent.metrics.Downsampler(60, 10, 1)
+
+        self.assertIsNone(downsampler.last())
+        self.assertIsNone(downsampler.current())
+
+
+class TestServerMetrics(unittest.TestCase):
+    """
+    Tests for the per server history
+    """
+
+    def test_latest_and_history(self):
+        """
+        Tests that the latest sample and history are reported by field
+        """
+
+        metrics = mcadminpanel.agent.metrics.ServerMetrics(('cpu', 'rss'), 2)
+        metrics.add(1, (10, 100))
+        metrics.add(2, (20, 200))
+        metrics.add(3, (30, 300))
+
+        self.assertEqual({'timestamp': 3, 'cpu': 30, 'rss': 300}, metrics.latest())
+        self.assertEqual(
+            {'timestamp': [2, 3], 'cpu': [20, 30], 'rss': [200, 300]},
+            metrics.history(),
+        )
+
+    def test_aggregates(self):
+        """
+        Tests that every tier reports an aggregate
+        """
+
+        metrics = mcadminpanel.agent.metrics.ServerMetrics(('cpu',), 10)
+        metrics.add(0, (10,))
+        metrics.add(30, (30,))
+        metrics.add(60, (50,))
+
+        aggregates = metrics.aggregates()
+
+        self.assertEqual({'1m', '5m', '1h'}, set(aggregates))
+        self.assertTrue(aggregates['1m']['complete'])
+        self.assertEqual({'cpu': 20}, aggregates['1m']['mean'])
+        self.assertFalse(aggregates['1h']['complete'])
+        self.assertEqual({'cpu': 50}, aggregates['1h']['max'])
+
+
+class TestMetricsSampler(unittest.TestCase):
+    """
+    Tests for sampling the server processes
+    """
+
+    def setUp(self):
+        self.supervisor = unittest.mock.Mock(
+            servers={
+                'running': unittest.mock.Mock(pid=os.getpid(), limits=None),
+                'stopped': unittest.mock.Mock(pid=None, limits=None),
+            },
+        )
+
+        self.sampler = mcadminpanel.agent.metrics.MetricsSampler(
+            self.supervisor,
+            {'interval': 5, 'history': 10},
+            loop=unittest.mock.Mock(),
+        )
+
+    def test_sample_running_servers(self):
+        """
+        Tests that only running servers are sampled
+        """
+
+        self.sampler.sample(100)
+        self.sampler.sample(105)
+
+        latest = self.sampler.latest('running')
+
+        self.assertEqual(105, latest['timestamp'])
+        self.assertGreater(latest['rss'], 0)
+        self.assertGreater(latest['threads'], 0)
+        self.assertGreater(latest['fds'], 0)
+        self.assertIsNone(self.sampler.latest('stopped'))
+        self.assertEqual({}, self.sampler.aggregates('stopped'))
+
+    def test_failing_listener(self):
+        """
+        Tests that a failing listener does not stop the sampling
+        """
+
+        samples = []
+        self.sampler.add_listener(unittest.mock.Mock(side_effect=ValueError('broken')))
+        self.sampler.add_listener(lambda name, timestamp, values: samples.append(name))
+
+        with self.assertLogs(level='ERROR'):
+            self.sampler.sample(100)
+
+        self.assertEqual(['running'], samples)
+        self.assertEqual(100, self.sampler.latest('running')['timestamp'])
+
+    def test_removed_servers(self):
+        """
+        Tests that the samples of removed servers are forgotten
+        """
+
+        self.sampler.sample(100)
+        del self.supervisor.servers['running']
+        self.sampler.sample(105)
+
+        self.assertIsNone(self.sampler.latest('running'))
+        self.assertEqual({}, self.sampler.api_metrics())
+
+    def test_sample_uses_oneshot(self):
+        """
+        Tests that each process is read in a single oneshot pass
+        """
+
+        with unittest.mock.patch('psutil.Process') as process:
+            process.return_value = process
+            process.pid = os.getpid()
+            process.memory_info.return_value = unittest.mock.Mock(rss=1)
+            process.io_counters.return_value = unittest.mock.Mock(
+                read_bytes=0,
+                write_bytes=0,
+            )
+
+            self.sampler.sample(100)
+
+        process.oneshot.assert_called_with()
+        process.oneshot.return_value.__enter__.assert_called_with()
+
+    def test_dead_process(self):
+        """
+        Tests that processes that went away are skipped
+        """
+
+        self.supervisor.servers['running'].pid = 2 ** 22 + 1
+
+        self.sampler.sample(100)
+
+        self.assertIsNone(self.sampler.latest('running'))
+
@@ -0,0 +1,217 @@
+"""
+Tests for the event loop monitor
+"""
+
+import asyncio
+import threading
+import time
+import unittest
+
+import nose
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.monitor
+
+def monitor_conf(**overrides):
+    """
+    A monitor configuration with short intervals
+    """
+
+    conf = {
+        'enabled': True,
+        'heartbeat_interval': 0.01,
+        'slow_callback': 0.02,
+        'task_cpu': False,
+        'profile_interval': 0.001,
+    }
+    conf.update(overrides)
+
+    return conf
+
+def block(duration):
+    """
+    Hold the thread without letting anything else run
+    """
+
+    time.sleep(duration)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    """
+    Tests for the sampling profiler
+    """
+
+    def test_samples(self):
+        """
+        Tests that the profiler counts the stacks of the sampled thread
+        """
+
+        profiler = mcadminpanel.agent.monitor.SamplingProfiler(
+            threading.get_ident(),
+            interval=0.001,
+        )
+
+        profiler.start()
+        self.assertTrue(profiler.running)
+        block(0.1)
+        result = profiler.stop(top=5)
+
+        self.assertFalse(profiler.running)
+        self.assertGreater(result['samples'], 0)
+        self.assertLessEqual(len(result['stacks']), 5)
+        self.assertIn('test_monitor.py:block', result['stacks'][0]['stack'])
+
+
+class TestLoopMonitor(unittest.TestCase):
+    """
+    Tests for measuring the health of the event loop
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _run(self, monitor, coro):
+        monitor.start()
+        try:
+            return self.loop.run_until_complete(coro)
+        finally:
+            self.loop.run_until_complete(monitor.stop())
+
+    def test_lag(self):
+        """
+        Tests that the heartbeat measures how late the loop wakes it up
+        """
+
+        monitor = mcadminpanel.agent.monitor.LoopMonitor(monitor_conf(), loop=self.loop)
+
+        async def blocked():
+            await asyncio.sleep(0.005)
+            block(0.05)
+            await asyncio.sleep(0.03)
+
+        self._run(monitor, blocked())
+
+        self.assertGreater(len(monitor.lag), 0)
+        self.assertGreaterEqual(monitor.max_lag, 0.03)
+
+    def test_slow_callback(self):
+        """
+        Tests that a blocked loop is reported with the stack blocking it
+        """
+
+        monitor = mcadminpanel.agent.monitor.LoopMonitor(monitor_conf(), loop=self.loop)
+
+        async def blocked():
+            await asyncio.sleep(0.05)
+            block(0.2)
+            await asyncio.sleep(0.05)
+
+        with self.assertLogs(level='WARNING'):
+            self._run(monitor, blocked())
+
+        self.assertGreaterEqual(monitor.slow_count, 1)
+        slow = monitor.slow_callbacks[-1]
+        self.assertGreaterEqual(slow['duration'], 0.1)
+        self.assertIn('in block', slow['stack'])
+
+    def test_short_block(self):
+        """
+        Tests that a block barely longer than the threshold is reported
+        """
+
+        monitor = mcadminpanel.agent.monitor.LoopMonitor(
+            monitor_conf(slow_callback=0.2),
+            loop=self.loop,
+        )
+
+        async def blocked():
+            await asyncio.sleep(0.05)
+            block(0.3)
+            await asyncio.sleep(0.05)
+
+        with self.assertLogs(level='WARNING'):
+            self._run(monitor, blocked())
+
+        self.assertEqual(1, monitor.slow_count)
+
+    def test_task_cpu(self):
+        """
+        Tests that the CPU time of tasks is counted per coroutine function
+        """
+
+        monitor = mcadminpanel.agent.monitor.LoopMonitor(
+            monitor_conf(task_cpu=True),
+            loop=self.loop,
+        )
+
+        async def busy():
+            for _ in range(3):
+                sum(range(100000))
+                await asyncio.sleep(0)
+
+        async def spawn():
+            await asyncio.ensure_future(busy(), loop=self.loop)
+
+        self._run(monitor, spawn())
+
+        name = [name for name in monitor.task_cpu if name.endswith('busy')]
+        self.assertEqual(1, len(name))
+        steps, cpu = monitor.task_cpu[name[0]]
+        self.assertEqual(4, steps)
+        self.assertGreater(cpu, 0)
+
+        self.assertIn(name[0], monitor.stats()['task_cpu'])
+
+    def test_stats(self):
+        """
+        Tests that the stats include the tasks and queue gauges
+        """
+
+        monitor = mcadminpanel.agent.monitor.LoopMonitor(monitor_conf(), loop=self.loop)
+        monitor.add_gauge('log', lambda: 12)
+
+        async def stats():
+            await asyncio.sleep(0.03)
+            return monitor.api_loop_stats()
+
+        result = self._run(monitor, stats())
+
+        self.assertEqual({'log': 12}, result['queues'])
+        self.assertGreaterEqual(result['tasks'], 2)
+        self.assertGreaterEqual(result['lag']['max'], 0)
+        self.assertFalse(result['profiling'])
+        self.assertNotIn('task_cpu', result)
+
+    def test_profile(self):
+        """
+        Tests that the profiler can be toggled over the API
+        """
+
+        monitor = mcadminpanel.agent.monitor.LoopMonitor(monitor_conf(), loop=self.loop)
+
+        async def profile():
+            monitor.api_profile_start()
+            await asyncio.sleep(0.01)
+            block(0.05)
+            return await monitor.api_profile_stop(top=10)
+
+        result = self._run(monitor, profile())
+
+        self.assertGreater(result['samples'], 0)
+        self.assertTrue(any('block' in entry['stack'] for entry in result['stacks']))
+
+    @nose.tools.raises(mcadminpanel.agent.errors.MCAdminPanelError)
+    def test_profile_not_running(self):
+        """
+        Tests that stopping a profiler that was not started is an error
+        """
+
+        monitor = mcadminpanel.agent.monitor.LoopMonitor(monitor_conf(), loop=self.loop)
+
+        self.loop.run_until_complete(monitor.api_profile_stop())
+
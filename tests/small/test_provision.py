@@ -0,0 +1,202 @@
+"""
+Tests for creating servers from templates
+"""
+
+import os
+import os.path
+import tempfile
+import unittest
+import unittest.mock
+
+import mcadminpanel.agent.artifacts
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.provision
+
+JAR = b'PK\x03\x04server jar' * 1000
+
+PROPERTIES = '#Minecraft server properties\nmotd=A Minecraft Server\nserver-port=25565\n'
+
+class TestProperties(unittest.TestCase):
+    """
+    Tests for rendering server.properties
+    """
+
+    def test_render(self):
+        """
+        Tests that properties are replaced in place and new ones appended
+        """
+
+        self.assertEqual(
+            '#Minecraft server properties\n'
+            'motd=Survival\n'
+            'server-port=25565\n'
+            'max-players=40\n'
+            'pvp=false\n',
+            mcadminpanel.agent.provision.render_properties(
+                PROPERTIES,
+                {'motd': 'Survival', 'pvp': False, 'max-players': 40},
+            ),
+        )
+
+    def test_parse(self):
+        """
+        Tests that properties are read back with their escapes decoded
+        """
+
+        self.assertEqual(
+            {'motd': '§aSurvival\\n', 'server-port': '25565', 'pvp': 'false'},
+            mcadminpanel.agent.provision.parse_properties(
+                '#Minecraft server properties\n'
+                'motd=\\u00A7aSurvival\\\\n\n'
+                'server-port = 25565\n'
+                '\n'
+                'pvp=false\n'
+            ),
+        )
+
+    def test_server_properties(self):
+        """
+        Tests that the RCON settings of a server are part of its properties
+        """
+
+        self.assertEqual(
+            {
+                'motd': 'Survival',
+                'enable-rcon': True,
+                'rcon.port': 25575,
+                'rcon.password': 'secret',
+            },
+            mcadminpanel.agent.provision.server_properties({
+                'properties': {'motd': 'Survival'},
+                'rcon': {'port': 25575, 'password': 'secret'},
+            }),
+        )
+
+
+class TestProvision(unittest.TestCase):
+    """
+    Tests for cloning templates into server directories
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        self.templates = os.path.join(self.directory.name, 'templates')
+        template = os.path.join(self.templates, 'paper')
+        os.makedirs(os.path.join(template, 'plugins'))
+        os.makedirs(os.path.join(template, 'world', 'region'))
+
+        self._write(os.path.join(template, 'server.jar'), JAR)
+        self._write(os.path.join(template, 'server.properties'), PROPERTIES.encode())
+        self._write(os.path.join(template, 'world', 'region', 'r.0.0.mca'), b'\x01' * 8192)
+        self._write(os.path.join(template, 'start.sh'), b'#!/bin/sh\n')
+        os.chmod(os.path.join(template, 'start.sh'), 0o755)
+        os.symlink('server.jar', os.path.join(template, 'latest.jar'))
+
+        self.store = mcadminpanel.agent.artifacts.ArtifactStore(
+            None,
+            {
+                'path': os.path.join(self.directory.name, 'artifacts'),
+                'max_size': None,
+                'patterns': ['*.jar', 'plugins/*.jar'],
+            },
+            loop=unittest.mock.Mock(),
+        )
+        self.store.load()
+
+        self.server_conf = {
+            'template': 'paper',
+            'properties': {'motd': 'Survival'},
+            'rcon': None,
+        }
+        self.provision_conf = {'templates': self.templates, 'method': 'auto', 'workers': 2}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _write(self, path, data):
+        with open(path, 'wb') as output:
+            output.write(data)
+
+    def _provision(self, name, **kwargs):
+        return mcadminpanel.agent.provision.provision(
+            name,
+            self.server_conf,
+            os.path.join(self.directory.name, name),
+            self.provision_conf,
+            **kwargs
+        )
+
+    def test_provision(self):
+        """
+        Tests that the template is cloned and its properties rendered
+        """
+
+        stats = self._provision('survival', store=self.store)
+
+        directory = os.path.join(self.directory.name, 'survival')
+        self.assertEqual('paper', stats['template'])
+        self.assertEqual(4, stats['files'])
+        self.assertEqual(1, stats['methods']['link'])
+
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.templates, 'paper', 'server.jar'),
+            os.path.join(directory, 'server.jar'),
+        ))
+        self.assertEqual('server.jar', os.readlink(os.path.join(directory, 'latest.jar')))
+        self.assertEqual(0o755, os.stat(os.path.join(directory, 'start.sh')).st_mode & 0o777)
+        with open(os.path.join(directory, 'server.properties'), 'r') as properties:
+            self.assertIn('motd=Survival\n', properties.read())
+        with open(os.path.join(directory, 'world', 'region', 'r.0.0.mca'), 'rb') as region:
+            self.assertEqual(b'\x01' * 8192, region.read())
+
+        self.assertFalse(os.path.exists(directory + '.provisioning'))
+
+    def test_methods(self):
+        """
+        Tests that every copy method gives the same files
+        """
+
+        for method in ('copy', 'copy_file_range'):
+            self.provision_conf['method'] = method
+            stats = self._provision(method)
+
+            self.assertEqual({method: 4}, stats['methods'])
+            with open(os.path.join(self.directory.name, method, 'server.jar'), 'rb') as jar:
+                self.assertEqual(JAR, jar.read())
+
+    def test_errors(self):
+        """
+        Tests that servers without a template or with files are refused
+        """
+
+        os.makedirs(os.path.join(self.directory.name, 'creative'))
+        self._write(os.path.join(self.directory.name, 'creative', 'ops.json'), b'[]')
+
+        with self.assertRaises(mcadminpanel.agent.errors.ProvisionError):
+            self._provision('creative')
+        with self.assertRaises(mcadminpanel.agent.errors.ProvisionError):
+            self._provision('hub', template='missing')
+
+        self.server_conf['template'] = None
+        with self.assertRaises(mcadminpanel.agent.errors.ProvisionError):
+            self._provision('hub')
+
+    def test_failed_copy(self):
+        """
+        Tests that a template file shrinking while it is copied leaves no
+        staging directory behind
+        """
+
+        self.provision_conf['method'] = 'copy_file_range'
+
+        with unittest.mock.patch(
+            'mcadminpanel.agent.backup.copy_range',
+            side_effect=mcadminpanel.agent.errors.BackupError('Chunk is truncated'),
+        ):
+            with self.assertRaises(mcadminpanel.agent.errors.ProvisionError):
+                self._provision('survival')
+
+        directory = os.path.join(self.directory.name, 'survival')
+        self.assertFalse(os.path.exists(directory))
+        self.assertFalse(os.path.exists(directory + '.provisioning'))
@@ -0,0 +1,319 @@
+"""
+Tests for the RCON client against a local fake server
+"""
+
+import asyncio
+import unittest
+import unittest.mock
+
+import nose
+
+import mcadminpanel.agent.commands
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.logstream
+import mcadminpanel.agent.rcon
+from mcadminpanel.agent.rcon import encode_packet, read_packet
+
+PASSWORD = 'hunter2'
+
+class FakeRconServer(object):
+    """
+    RCON server answering commands the way a vanilla server does
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.server = None
+        self.port = None
+        self.connections = 0
+        self.writers = []
+        self.login_delay = 0
+
+    async def start(self):
+        """
+        Listen on a free local port
+        """
+
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stop listening and drop every connection
+        """
+
+        self.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop(self):
+        """
+        Close every open connection
+        """
+
+        for writer in self.writers:
+            writer.close()
+        self.writers = []
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self.writers.append(writer)
+
+        try:
+            request_id, _, password = await read_packet(reader)
+            await asyncio.sleep(self.login_delay)
+            if password != PASSWORD:
+                writer.write(encode_packet(-1, mcadminpanel.agent.rcon.TYPE_COMMAND))
+                return
+            writer.write(encode_packet(request_id, mcadminpanel.agent.rcon.TYPE_COMMAND))
+
+            while True:
+                request_id, kind, body = await read_packet(reader)
+                if kind != mcadminpanel.agent.rcon.TYPE_COMMAND:
+                    writer.write(encode_packet(
+                        request_id,
+                        mcadminpanel.agent.rcon.TYPE_RESPONSE,
+                        'Unknown request {:x}'.format(kind),
+                    ))
+                elif body == 'long':
+                    for part in ('first ', 'second ', 'third'):
+                        writer.write(encode_packet(
+                            request_id,
+                            mcadminpanel.agent.rcon.TYPE_RESPONSE,
+                            part,
+                        ))
+                elif body == 'slow':
+                    await asyncio.sleep(0.05)
+                    writer.write(encode_packet(
+                        request_id,
+                        mcadminpanel.agent.rcon.TYPE_RESPONSE,
+                        'done',
+                    ))
+                elif body == 'tp':
+                    writer.write(encode_packet(
+                        request_id,
+                        mcadminpanel.agent.rcon.TYPE_RESPONSE,
+                        'Unknown command. Try /help for a list of commands',
+                    ))
+                else:
+                    writer.write(encode_packet(
+                        request_id,
+                        mcadminpanel.agent.rcon.TYPE_RESPONSE,
+                        'ran ' + body,
+                    ))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class TestRcon(unittest.TestCase):
+    """
+    Tests for RCON connections and pools
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.server = FakeRconServer(self.loop)
+        self.loop.run_until_complete(self.server.start())
+
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            self.loop.run_until_complete(pool.close())
+        self.loop.run_until_complete(self.server.stop())
+
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _conf(self, **overrides):
+        conf = {
+            'host': '127.0.0.1',
+            'port': self.server.port,
+            'password': PASSWORD,
+            'pool_size': 2,
+            'keepalive': 30,
+            'timeout': 1,
+        }
+        conf.update(overrides)
+
+        return conf
+
+    def _pool(self, **overrides):
+        pool = mcadminpanel.agent.rcon.RconPool(self._conf(**overrides), loop=self.loop)
+        self.pools.append(pool)
+
+        return pool
+
+    def test_packet(self):
+        """
+        Tests that packets round trip through the wire format
+        """
+
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_packet(7, mcadminpanel.agent.rcon.TYPE_COMMAND, 'list'))
+
+        self.assertEqual(
+            (7, mcadminpanel.agent.rcon.TYPE_COMMAND, 'list'),
+            self.loop.run_until_complete(read_packet(reader)),
+        )
+
+    def test_execute(self):
+        """
+        Tests that commands return their response
+        """
+
+        pool = self._pool()
+
+        self.assertEqual('ran list', self.loop.run_until_complete(pool.execute('list')))
+
+    def test_fragmented(self):
+        """
+        Tests that a response split over several packets is joined
+        """
+
+        pool = self._pool()
+
+        self.assertEqual(
+            'first second third',
+            self.loop.run_until_complete(pool.execute('long')),
+        )
+
+    def test_pipelining(self):
+        """
+        Tests that many commands are in flight on one connection at once
+        """
+
+        pool = self._pool(pool_size=1)
+
+        results = self.loop.run_until_complete(asyncio.gather(
+            *[pool.execute('say {}'.format(index)) for index in range(20)]
+        ))
+
+        self.assertEqual(['ran say {}'.format(index) for index in range(20)], results)
+        self.assertEqual(1, self.server.connections)
+
+    def test_pool_size(self):
+        """
+        Tests that busy connections make the pool open more, up to its size
+        """
+
+        pool = self._pool(pool_size=3)
+
+        self.loop.run_until_complete(asyncio.gather(
+            *[pool.execute('slow') for _ in range(10)]
+        ))
+
+        self.assertEqual(3, pool.stats()['connections'])
+        self.assertEqual(3, self.server.connections)
+
+    def test_slow_connect(self):
+        """
+        Tests that commands use the open connections while another connects
+        """
+
+        pool = self._pool()
+        self.loop.run_until_complete(pool.execute('list'))
+        self.server.login_delay = 0.5
+
+        async def scenario():
+            slow = asyncio.ensure_future(pool.execute('slow'), loop=self.loop)
+            await asyncio.sleep(0.01)
+            connecting = asyncio.ensure_future(pool.execute('say 1'), loop=self.loop)
+            await asyncio.sleep(0.01)
+
+            started = self.loop.time()
+            response = await pool.execute('say 2')
+            waited = self.loop.time() - started
+
+            self.assertFalse(connecting.done())
+            await asyncio.gather(slow, connecting)
+
+            return response, waited
+
+        response, waited = self.loop.run_until_complete(scenario())
+
+        self.assertEqual('ran say 2', response)
+        self.assertLess(waited, 0.3)
+        self.assertEqual(2, pool.stats()['connections'])
+
+    def test_reconnect(self):
+        """
+        Tests that lost connections are replaced on the next command
+        """
+
+        pool = self._pool()
+        self.loop.run_until_complete(pool.execute('list'))
+
+        self.server.drop()
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        self.assertEqual('ran list', self.loop.run_until_complete(pool.execute('list')))
+        self.assertEqual(2, pool.opened)
+
+    def test_keepalive(self):
+        """
+        Tests that idle connections are pinged and found closed when lost
+        """
+
+        pool = self._pool(keepalive=0.05)
+        self.loop.run_until_complete(pool.execute('list'))
+        connection = pool.connections[0]
+        used = connection.last_used
+
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertFalse(connection.closed)
+        self.assertGreater(connection.last_used, used)
+
+        self.server.drop()
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertTrue(connection.closed)
+
+    @nose.tools.raises(mcadminpanel.agent.errors.RconError)
+    def test_bad_password(self):
+        """
+        Tests that a rejected login is reported
+        """
+
+        pool = self._pool(password='wrong')
+
+        self.loop.run_until_complete(pool.execute('list'))
+
+    @nose.tools.raises(mcadminpanel.agent.errors.RconError)
+    def test_unreachable(self):
+        """
+        Tests that a server without RCON is reported
+        """
+
+        pool = self._pool()
+        self.loop.run_until_complete(self.server.stop())
+
+        self.loop.run_until_complete(pool.execute('list'))
+
+    def test_pipeline(self):
+        """
+        Tests that servers without a process get their commands over RCON
+        """
+
+        server = unittest.mock.Mock(
+            console=mcadminpanel.agent.logstream.LogStream(),
+            command_timeout=1,
+            process=None,
+            rcon_conf=self._conf(),
+        )
+        server.name = 'adopted'
+        pipeline = mcadminpanel.agent.commands.CommandPipeline(server, loop=self.loop)
+
+        try:
+            result = self.loop.run_until_complete(pipeline.execute('whitelist add Steve'))
+            self.assertEqual('ran whitelist add Steve', result['response'])
+            self.assertEqual(1, pipeline.stats()['rcon']['connections'])
+
+            with self.assertRaises(mcadminpanel.agent.errors.ServerError):
+                self.loop.run_until_complete(pipeline.execute('tp'))
+        finally:
+            self.loop.run_until_complete(pipeline.close())
+
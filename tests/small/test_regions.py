@@ -0,0 +1,187 @@
+"""
+Tests for analyzing the region files of the server worlds
+"""
+
+import os
+import os.path
+import tempfile
+import unittest
+
+import mcadminpanel.agent.regions
+import tests.utils.regions
+
+class TestScanRegion(unittest.TestCase):
+    """
+    Tests for reading the chunks of a region file
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = tests.utils.regions.write_region(
+            self.directory.name,
+            -1,
+            2,
+            {0: (0, 1), 5: (12000, 1), 33: (10, 80)},
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_header(self):
+        """
+        Tests that chunks, sizes and save times come from the header
+        """
+
+        stats = mcadminpanel.agent.regions.scan_region(self.path, 64 * 4096)
+
+        self.assertEqual(3, stats['chunks'])
+        self.assertEqual(82, stats['sectors'])
+        self.assertEqual([33], stats['oversized'])
+        self.assertIsNone(stats['unvisited'])
+        self.assertEqual(1500000000, stats['oldest'])
+        self.assertEqual(1500000033, stats['newest'])
+        self.assertIsNone(stats['error'])
+
+    def test_inhabited(self):
+        """
+        Tests that chunks players barely stayed in are counted as unvisited
+        """
+
+        stats = mcadminpanel.agent.regions.scan_region(self.path, 64 * 4096, 100)
+
+        self.assertEqual(2, stats['unvisited'])
+
+    def test_empty(self):
+        """
+        Tests that files too short for a header have no chunks
+        """
+
+        path = os.path.join(self.directory.name, 'r.0.0.mca')
+        open(path, 'wb').close()
+
+        stats = mcadminpanel.agent.regions.scan_region(path, 4096)
+
+        self.assertEqual(0, stats['chunks'])
+        self.assertIsNone(stats['error'])
+
+    def test_external_chunk(self):
+        """
+        Tests that external chunk files are named by chunk coordinates
+        """
+
+        self.assertEqual(
+            os.path.join(self.directory.name, 'c.-27.65.mcc'),
+            mcadminpanel.agent.regions.external_chunk(self.path, 37),
+        )
+
+
+class TestAnalyze(unittest.TestCase):
+    """
+    Tests for analyzing the worlds of servers
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = os.path.join(self.directory.name, 'survival')
+
+        overworld = os.path.join(self.server, 'world', 'region')
+        tests.utils.regions.write_region(overworld, 0, 0, {0: (50000, 1), 1: (0, 1)})
+        tests.utils.regions.write_region(overworld, 0, 1, {0: (0, 1), 1: (5, 1)})
+        tests.utils.regions.write_region(
+            os.path.join(self.server, 'world_nether', 'DIM-1', 'region'),
+            0,
+            0,
+            {7: (0, 70)},
+        )
+        os.makedirs(os.path.join(self.server, 'logs'))
+
+        self.cache_path = os.path.join(self.directory.name, 'cache', 'regions.cache')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _analyze(self, inhabited_below=None):
+        cache = mcadminpanel.agent.regions.RegionCache(self.cache_path)
+        cache.load()
+
+        summaries = list(mcadminpanel.agent.regions.analyze(
+            {'survival': self.server},
+            cache,
+            64 * 4096,
+            inhabited_below,
+            processes=2,
+        ))
+        cache.save()
+
+        return summaries, cache
+
+    def test_worlds(self):
+        """
+        Tests that every world of a server is reported
+        """
+
+        summaries, _ = self._analyze(100)
+
+        self.assertEqual(
+            ['world', os.path.join('world_nether', 'DIM-1')],
+            [summary['world'] for summary in summaries],
+        )
+
+        overworld, nether = summaries
+        self.assertEqual('survival', overworld['server'])
+        self.assertEqual(2, overworld['regions'])
+        self.assertEqual(4, overworld['chunks'])
+        self.assertEqual(3, overworld['unvisited'])
+        self.assertEqual(['r.0.1.mca'], overworld['prunable'])
+        self.assertEqual(0, overworld['oversized'])
+        self.assertEqual(1, nether['oversized'])
+        self.assertEqual(['r.0.0.mca'], nether['oversized_regions'])
+
+    def test_cache(self):
+        """
+        Tests that unchanged regions are read from the cache and changed
+        ones are scanned again
+        """
+
+        first, cache = self._analyze()
+        self.assertEqual(0, cache.hits)
+
+        second, cache = self._analyze()
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(first, second)
+
+        tests.utils.regions.write_region(
+            os.path.join(self.server, 'world', 'region'),
+            0,
+            1,
+            {0: (0, 1)},
+            timestamp=1600000000,
+        )
+        third, cache = self._analyze()
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(3, third[0]['chunks'])
+
+    def test_cache_options(self):
+        """
+        Tests that the cache is not used for other options
+        """
+
+        self._analyze()
+        summaries, cache = self._analyze(100)
+
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(3, summaries[0]['unvisited'])
+
+    def test_damaged_cache(self):
+        """
+        Tests that a damaged cache is ignored
+        """
+
+        os.makedirs(os.path.dirname(self.cache_path))
+        with open(self.cache_path, 'w') as cache_file:
+            cache_file.write('{"regions": ')
+
+        summaries, cache = self._analyze()
+
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(2, len(summaries))
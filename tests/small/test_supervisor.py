@@ -0,0 +1,576 @@
+"""
+Tests for the server process supervisor
+"""
+
+import asyncio
+import gc
+import subprocess
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+import nose
+import psutil
+
+import mcadminpanel.agent.errors
+import mcadminpanel.agent.limits
+import mcadminpanel.agent.supervisor
+from mcadminpanel.agent.supervisor import ServerProcess
+
+RESTART_CONF = {
+    'restart_delay': 0.01,
+    'max_restart_delay': 0.04,
+    'reset_after': 600,
+    'stop_commands': ['save-all', 'stop'],
+    'stop_timeout': 2,
+    'command_timeout': 2,
+    'command_batch_size': 64,
+    'cgroup_root': None,
+    'cds_archives': None,
+}
+
+# A fake server that saves and exits when told to stop
+GRACEFUL = '''
+import sys
+for line in sys.stdin:
+    print('got ' + line.strip(), flush=True)
+    if line.strip() == 'stop':
+        sys.exit(0)
+'''
+
+# pylint: disable=too-many-public-methods
+class TestSupervisor(unittest.TestCase):
+    """
+    Tests for the server process supervisor
+    """
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.root.cleanup()
+
+    def _supervisor(self, **servers):
+        return mcadminpanel.agent.supervisor.Supervisor(
+            self.root.name,
+            {
+                name: {'command': [sys.executable, '-c', script], 'directory': '.'}
+                for name, script in servers.items()
+            },
+            RESTART_CONF,
+            loop=self.loop,
+        )
+
+    def test_server_directory(self):
+        """
+        Tests that servers live under the configured root
+        """
+
+        supervisor = mcadminpanel.agent.supervisor.Supervisor(
+            '/srv/mc',
+            {'survival': {'command': ['java']}},
+            RESTART_CONF,
+            loop=self.loop,
+        )
+
+        self.assertEqual(
+            '/srv/mc/survival',
+            supervisor.servers['survival'].directory,
+            'Server directory was not placed under the root',
+        )
+
+    def test_output_is_read(self):
+        """
+        Tests that output from both pipes reaches the output handlers
+        """
+
+        supervisor = self._supervisor(
+            hub='import sys; print("hello"); print("oops", file=sys.stderr)',
+        )
+        server = supervisor.servers['hub']
+
+        lines = server.console.tail.lines
+
+        async def scenario():
+            supervisor.start()
+            while len(lines) < 2:
+                await asyncio.sleep(0.01)
+            await supervisor.stop()
+
+        self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        self.assertIn(('stdout', b'hello\n'), lines)
+        self.assertIn(('stderr', b'oops\n'), lines)
+        self.assertEqual(
+            mcadminpanel.agent.supervisor.ServerProcess.STOPPED,
+            server.state,
+        )
+
+    def test_crash_restarts(self):
+        """
+        Tests that crashed servers are restarted with a backoff
+        """
+
+        supervisor = self._supervisor(crashy='import sys; sys.exit(3)')
+        server = supervisor.servers['crashy']
+
+        async def scenario():
+            supervisor.start()
+            while server.restarts < 3:
+                await asyncio.sleep(0.01)
+            await supervisor.stop()
+
+        self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        self.assertGreaterEqual(server.failures, 3)
+        self.assertEqual(0.04, server.backoff_delay(), 'Backoff was not capped')
+
+    def test_failing_log_listener(self):
+        """
+        Tests that servers are still supervised when a console listener fails
+        """
+
+        supervisor = self._supervisor(
+            crashy='print("[12:00:00] [Server thread/INFO]: Steve joined the game")',
+        )
+        server = supervisor.servers['crashy']
+
+        failing = unittest.mock.Mock(side_effect=ValueError('Broken listener'))
+        server.log.add_listener(failing)
+        server.console.subscribe(unittest.mock.Mock(put=failing))
+
+        async def scenario():
+            supervisor.start()
+            while server.restarts < 2:
+                await asyncio.sleep(0.01)
+            await supervisor.stop()
+
+        with self.assertLogs(level='ERROR'):
+            self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        self.assertTrue(failing.called)
+        self.assertIn('Steve', server.log.online)
+        self.assertEqual(
+            mcadminpanel.agent.supervisor.ServerProcess.STOPPED,
+            server.state,
+        )
+
+    def test_listeners(self):
+        """
+        Tests that listeners are told about starts, crashes and stops
+        """
+
+        supervisor = self._supervisor(graceful=GRACEFUL)
+        server = supervisor.servers['graceful']
+
+        events = []
+        supervisor.add_listener(lambda name, event, data: events.append((name, event)))
+
+        async def scenario():
+            supervisor.start()
+            while server.state != server.RUNNING:
+                await asyncio.sleep(0.01)
+            server.process.kill()
+            while server.restarts < 1 or server.state != server.RUNNING:
+                await asyncio.sleep(0.01)
+            await supervisor.stop()
+
+        self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        self.assertEqual(
+            [
+                ('graceful', 'start'),
+                ('graceful', 'crash'),
+                ('graceful', 'start'),
+                ('graceful', 'stop'),
+            ],
+            events,
+        )
+
+    def test_start_latency(self):
+        """
+        Tests that servers are timed from their start to their ready line
+        """
+
+        supervisor = self._supervisor(ready=(
+            'import time\n'
+            'print(\'[12:00:00] [Server thread/INFO]: Done (1.5s)! For help, type "help"\', '
+            'flush=True)\n'
+            'time.sleep(60)\n'
+        ))
+        server = supervisor.servers['ready']
+        server.stop_timeout = 0.2
+
+        events = []
+        supervisor.add_listener(lambda name, event, data: events.append((event, data)))
+
+        async def scenario():
+            supervisor.start()
+            while server.start_latency is None:
+                await asyncio.sleep(0.01)
+            await supervisor.stop()
+
+        self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        self.assertEqual(['start', 'ready', 'stop'], [event for event, _ in events])
+        ready = events[1][1]
+        self.assertEqual(1.5, ready['startup'])
+        self.assertIsNone(ready['cds'])
+        self.assertEqual(server.start_latency, ready['latency'])
+        self.assertEqual(server.start_latency, server.describe()['start_latency'])
+
+    def test_stop_running_server(self):
+        """
+        Tests that stopping kills a server that ignores the stop commands
+        """
+
+        supervisor = self._supervisor(forever='import time; time.sleep(60)')
+        server = supervisor.servers['forever']
+        server.stop_timeout = 0.2
+
+        async def scenario():
+            supervisor.start()
+            while server.state != server.RUNNING:
+                await asyncio.sleep(0.01)
+            process = server.process
+            report = await supervisor.stop()
+            return process, report
+
+        process, report = self.loop.run_until_complete(
+            asyncio.wait_for(scenario(), 10),
+        )
+
+        self.assertIsNotNone(process.returncode, 'Server process is still running')
+        self.assertEqual(0, server.restarts, 'Stopped server was restarted')
+        self.assertTrue(report['servers']['forever']['killed'])
+        self.assertGreaterEqual(report['servers']['forever']['latency'], 0.2)
+
+    def test_graceful_parallel_stop(self):
+        """
+        Tests that servers are saved and stopped concurrently
+        """
+
+        supervisor = self._supervisor(
+            one=GRACEFUL,
+            two=GRACEFUL,
+            stuck='import time; time.sleep(60)',
+        )
+        supervisor.servers['stuck'].stop_timeout = 0.5
+
+        async def scenario():
+            supervisor.start()
+            while any(
+                    server.state != server.RUNNING
+                    for server in supervisor.servers.values()
+            ):
+                await asyncio.sleep(0.01)
+            return await supervisor.stop()
+
+        report = self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        for name in ('one', 'two'):
+            self.assertFalse(report['servers'][name]['killed'])
+            self.assertEqual(0, report['servers'][name]['returncode'])
+            self.assertEqual(
+                ['got save-all\n', 'got stop\n'],
+                supervisor.api_console(name),
+            )
+
+        self.assertTrue(report['servers']['stuck']['killed'])
+        self.assertLess(report['latency'], 1.5, 'Servers were not stopped in parallel')
+
+    def test_adopt(self):
+        """
+        Tests that a server started by another agent is adopted and can be
+        stopped
+        """
+
+        supervisor = self._supervisor(adopted='import time; time.sleep(30)')
+        server = supervisor.servers['adopted']
+
+        orphan = subprocess.Popen(server.command)
+        try:
+            supervisor.adopt({'adopted': psutil.Process(orphan.pid)})
+
+            async def scenario():
+                while server.state != server.RUNNING:
+                    await asyncio.sleep(0.01)
+                pid = server.pid
+                report = await supervisor.api_stop_server('adopted')
+                return pid, report
+
+            with self.assertRaises(mcadminpanel.agent.errors.ServerError):
+                server.send_command('list')
+            with self.assertRaises(mcadminpanel.agent.errors.ServerError):
+                server.commands.submit('list')
+            self.assertTrue(server.describe()['adopted'])
+            self.assertFalse(server.describe()['console'])
+
+            pid, report = self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+            self.assertEqual(orphan.pid, pid)
+            self.assertFalse(report['shutdown']['killed'])
+            self.assertIsNotNone(orphan.wait(5))
+            self.assertIsNone(server.pid)
+        finally:
+            orphan.kill()
+            orphan.wait()
+
+    def test_detach(self):
+        """
+        Tests that detached servers keep running once the supervisor is gone
+        """
+
+        supervisor = self._supervisor(
+            detached='import time; time.sleep(30)',
+            stopped=GRACEFUL,
+        )
+        server = supervisor.servers['detached']
+
+        async def scenario():
+            supervisor.start()
+            while server.state != server.RUNNING:
+                await asyncio.sleep(0.01)
+            await supervisor.api_stop_server('stopped')
+            pid = server.pid
+            return pid, await supervisor.detach()
+
+        pid, detached = self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+        process = psutil.Process(pid)
+        try:
+            supervisor = server = None
+            gc.collect()
+
+            self.assertEqual(['detached'], detached)
+            self.assertTrue(process.is_running())
+            self.assertNotEqual(psutil.STATUS_ZOMBIE, process.status())
+        finally:
+            process.kill()
+            process.wait(5)
+
+    def test_backoff_delay(self):
+        """
+        Tests that the restart delay grows exponentially
+        """
+
+        supervisor = self._supervisor(idle='pass')
+        server = supervisor.servers['idle']
+
+        delays = []
+        for failures in range(1, 5):
+            server.failures = failures
+            delays.append(server.backoff_delay())
+
+        self.assertEqual([0.01, 0.02, 0.04, 0.04], delays)
+
+    def test_send_command(self):
+        """
+        Tests that console commands are written to the server's stdin
+        """
+
+        supervisor = self._supervisor(echo=GRACEFUL)
+        server = supervisor.servers['echo']
+
+        async def scenario():
+            supervisor.start()
+            while server.state != server.RUNNING:
+                await asyncio.sleep(0.01)
+            supervisor.api_send_command('echo', 'say hi')
+            while not server.console.tail.get():
+                await asyncio.sleep(0.01)
+            console = supervisor.api_console('echo')
+            await supervisor.stop()
+            return console
+
+        console = self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        self.assertEqual(['got say hi\n'], console)
+
+    def test_broadcast(self):
+        """
+        Tests that a broadcast runs a command on every running server and
+        returns each server's response
+        """
+
+        supervisor = self._supervisor(first=GRACEFUL, second=GRACEFUL, idle='pass')
+        supervisor.servers['idle'].autostart = False
+
+        async def scenario():
+            supervisor.start()
+            while any(
+                    server.state != server.RUNNING
+                    for name, server in supervisor.servers.items()
+                    if name != 'idle'
+            ):
+                await asyncio.sleep(0.01)
+            try:
+                return await supervisor.api_broadcast('say hi', pattern='got say')
+            finally:
+                await supervisor.stop()
+
+        results = self.loop.run_until_complete(asyncio.wait_for(scenario(), 10))
+
+        self.assertEqual(['first', 'second'], sorted(results))
+        self.assertEqual('got say hi', results['first']['response'])
+
+    def test_broadcast_error(self):
+        """
+        Tests that a broadcast reports the servers the command failed on
+        """
+
+        supervisor = self._supervisor(idle='pass')
+
+        results = self.loop.run_until_complete(
+            supervisor.api_broadcast('list', names=['idle']),
+        )
+        self.loop.run_until_complete(supervisor.stop())
+
+        self.assertIn('not running', results['idle']['error'])
+
+    @nose.tools.raises(mcadminpanel.agent.errors.ServerError)
+    def test_send_command_stopped(self):
+        """
+        Tests that commands can not be sent to stopped servers
+        """
+
+        supervisor = self._supervisor(idle='pass')
+        supervisor.api_send_command('idle', 'say hi')
+
+    @nose.tools.raises(mcadminpanel.agent.errors.ServerError)
+    def test_unknown_server(self):
+        """
+        Tests that unknown servers are reported
+        """
+
+        supervisor = self._supervisor(idle='pass')
+        supervisor.api_start_server('missing')
+
+    def test_list_servers(self):
+        """
+        Tests that every server is listed by name
+        """
+
+        supervisor = self._supervisor(beta='pass', alpha='pass')
+
+        servers = supervisor.api_list_servers()
+
+        self.assertEqual(['alpha', 'beta'], [server['name'] for server in servers])
+        self.assertEqual('stopped', servers[0]['state'])
+        self.assertIsNone(servers[0]['pid'])
+
+    def test_reconfigure(self):
+        """
+        Tests that only the servers that changed are touched
+        """
+
+        supervisor = self._supervisor(
+            same=GRACEFUL,
+            changed=GRACEFUL,
+            removed=GRACEFUL,
+            tuned=GRACEFUL,
+        )
+
+        servers_conf = {
+            name: {'command': list(server.command), 'directory': '.'}
+            for name, server in supervisor.servers.items()
+        }
+        del servers_conf['removed']
+        servers_conf['changed']['command'].append('--changed')
+        servers_conf['tuned']['stop_timeout'] = 1
+        servers_conf['added'] = {
+            'command': [sys.executable, '-c', GRACEFUL],
+            'directory': '.',
+        }
+
+        async def scenario():
+            supervisor.start()
+            while any(
+                    server.state != server.RUNNING
+                    for server in supervisor.servers.values()
+            ):
+                await asyncio.sleep(0.01)
+            pids = {
+                name: server.pid for name, server in supervisor.servers.items()
+            }
+
+            changes = await supervisor.reconfigure(
+                servers_conf,
+                {'changed', 'removed', 'tuned', 'added'},
+            )
+
+            while supervisor.servers['changed'].state != ServerProcess.RUNNING:
+                await asyncio.sleep(0.01)
+
+            return pids, changes
+
+        pids, changes = self.loop.run_until_complete(
+            asyncio.wait_for(scenario(), 10),
+        )
+
+        try:
+            self.assertEqual(
+                {
+                    'added': ['added'],
+                    'removed': ['removed'],
+                    'restarted': ['changed'],
+                    'updated': ['tuned'],
+                },
+                changes,
+            )
+            self.assertNotIn('removed', supervisor.servers)
+            self.assertEqual(pids['same'], supervisor.servers['same'].pid)
+            self.assertEqual(pids['tuned'], supervisor.servers['tuned'].pid)
+            self.assertEqual(1, supervisor.servers['tuned'].stop_timeout)
+            self.assertNotEqual(pids['changed'], supervisor.servers['changed'].pid)
+        finally:
+            self.loop.run_until_complete(supervisor.stop())
+
+
+    def test_reconfigure_limits(self):
+        """
+        Tests that changed limits are applied to the running server
+        """
+
+        supervisor = self._supervisor(survival=GRACEFUL)
+        server = supervisor.servers['survival']
+
+        servers_conf = {
+            'survival': {
+                'command': list(server.command),
+                'directory': '.',
+                'limits': {'cpu_weight': 50},
+            },
+        }
+
+        async def scenario():
+            supervisor.start()
+            while server.state != ServerProcess.RUNNING:
+                await asyncio.sleep(0.01)
+            pid = server.pid
+
+            changes = await supervisor.reconfigure(servers_conf, {'survival'})
+
+            return pid, changes
+
+        pid, changes = self.loop.run_until_complete(
+            asyncio.wait_for(scenario(), 10),
+        )
+
+        try:
+            self.assertEqual(['survival'], changes['updated'])
+            self.assertEqual(pid, server.pid)
+            self.assertEqual(
+                mcadminpanel.agent.limits.weight_to_nice(50),
+                psutil.Process(pid).nice(),
+            )
+        finally:
+            self.loop.run_until_complete(supervisor.stop())
+
+# pylint: enable=too-many-public-methods
@@ -0,0 +1,116 @@
+"""
+Tests for watching the configuration file
+"""
+
+import asyncio
+import os
+import os.path
+import tempfile
+import unittest
+
+import mcadminpanel.agent.watcher
+
+class TestConfigWatcher(unittest.TestCase):
+    """
+    Tests for watching the configuration file
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'config.json')
+        self._write('{}')
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.changes = []
+        self.watcher = mcadminpanel.agent.watcher.ConfigWatcher(
+            self.path,
+            lambda: self.changes.append(True),
+            poll_interval=0.05,
+            loop=self.loop,
+        )
+        self.watcher.DEBOUNCE = 0.05
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.directory.cleanup()
+
+    def _write(self, content, path=None):
+        with open(path or self.path, 'w') as config_file:
+            config_file.write(content)
+
+    def _wait_for_changes(self):
+        async def wait():
+            while not self.changes:
+                await asyncio.sleep(0.01)
+            # Give any extra callbacks a chance to fire
+            await asyncio.sleep(0.2)
+
+        self.loop.run_until_complete(asyncio.wait_for(wait(), 5))
+
+    def test_inotify(self):
+        """
+        Tests that changes are noticed with inotify
+        """
+
+        self.watcher.start()
+        if self.watcher.method != 'inotify':
+            raise unittest.SkipTest('inotify is not available')
+
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        for index in range(3):
+            self._write('{{"value": {}}}'.format(index))
+
+        self._wait_for_changes()
+
+        self.assertEqual([True], self.changes, 'Changes were not debounced')
+
+    def test_inotify_replace(self):
+        """
+        Tests that replacing the file like most editors do is noticed
+        """
+
+        self.watcher.start()
+        if self.watcher.method != 'inotify':
+            raise unittest.SkipTest('inotify is not available')
+
+        temporary = os.path.join(self.directory.name, 'config.json.tmp')
+        self._write('{"value": 1}', temporary)
+        os.rename(temporary, self.path)
+
+        self._wait_for_changes()
+
+        self.assertEqual([True], self.changes)
+
+    def test_poll(self):
+        """
+        Tests that changes are noticed by polling
+        """
+
+        self.watcher.start(use_inotify=False)
+
+        self.assertEqual('poll', self.watcher.method)
+
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self._write('{"value": "a much longer value"}')
+
+        self._wait_for_changes()
+
+        self.assertEqual([True], self.changes)
+
+    def test_unrelated_files(self):
+        """
+        Tests that changes to other files in the directory are ignored
+        """
+
+        self.watcher.start()
+
+        self._write('{}', os.path.join(self.directory.name, 'other.json'))
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+
+        self.assertEqual([], self.changes)
+
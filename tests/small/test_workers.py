@@ -0,0 +1,291 @@
+"""
+Tests for running the agent as several worker processes
+"""
+
+import asyncio
+import os.path
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import mcadminpanel.agent.api
+import mcadminpanel.agent.workers
+
+SERVERS = ['server{}'.format(index) for index in range(200)]
+
+class TestHashRing(unittest.TestCase):
+    """
+    Tests for the consistent hash ring
+    """
+
+    def test_balanced(self):
+        """
+        Tests that every node gets a fair share of the keys
+        """
+
+        ring = mcadminpanel.agent.workers.HashRing(range(4))
+
+        assignments = ring.assign(SERVERS)
+
+        self.assertEqual(set(range(4)), set(assignments))
+        for keys in assignments.values():
+            self.assertGreater(len(keys), len(SERVERS) / 4 / 2)
+
+    def test_stable(self):
+        """
+        Tests that rings with the same nodes assign keys the same way
+        """
+
+        self.assertEqual(
+            mcadminpanel.agent.workers.HashRing(range(4)).assign(SERVERS),
+            mcadminpanel.agent.workers.HashRing(reversed(range(4))).assign(SERVERS),
+        )
+
+    def test_remove(self):
+        """
+        Tests that removing a node only moves the keys it owned
+        """
+
+        ring = mcadminpanel.agent.workers.HashRing(range(4))
+        before = {key: ring.owner(key) for key in SERVERS}
+
+        ring.remove(2)
+
+        for key in SERVERS:
+            if before[key] == 2:
+                self.assertNotEqual(2, ring.owner(key))
+            else:
+                self.assertEqual(before[key], ring.owner(key))
+
+    def test_worker_path(self):
+        """
+        Tests that worker files sit next to the agent's
+        """
+
+        self.assertEqual(
+            '/srv/agent.worker3.log',
+            mcadminpanel.agent.workers.worker_path('/srv/agent.log', 3),
+        )
+
+
+class TestMergeResults(unittest.TestCase):
+    """
+    Tests for merging the results of commands sent to every worker
+    """
+
+    def test_list_servers(self):
+        """
+        Tests that server lists are joined in name order
+        """
+
+        self.assertEqual(
+            [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}],
+            mcadminpanel.agent.workers.merge_results(
+                'list_servers',
+                {},
+                [(0, [{'name': 'b'}]), (1, [{'name': 'a'}, {'name': 'c'}])],
+            ),
+        )
+
+    def test_events(self):
+        """
+        Tests that events are joined in time order up to the limit
+        """
+
+        self.assertEqual(
+            [{'timestamp': 1}, {'timestamp': 2}],
+            mcadminpanel.agent.workers.merge_results(
+                'events',
+                {'limit': 2},
+                [(0, [{'timestamp': 1}, {'timestamp': 3}]), (1, [{'timestamp': 2}])],
+            ),
+        )
+
+    def test_stop_all_servers(self):
+        """
+        Tests that the shutdown takes as long as the slowest worker
+        """
+
+        self.assertEqual(
+            {'latency': 3, 'servers': {'a': {}, 'b': {}}},
+            mcadminpanel.agent.workers.merge_results(
+                'stop_all_servers',
+                {},
+                [
+                    (0, {'latency': 3, 'servers': {'a': {}}}),
+                    (1, {'latency': 1, 'servers': {'b': {}}}),
+                ],
+            ),
+        )
+
+    def test_per_worker(self):
+        """
+        Tests that other results are reported for each worker
+        """
+
+        self.assertEqual(
+            {'worker0': {'lag': 1}, 'worker1': {'lag': 2}},
+            mcadminpanel.agent.workers.merge_results(
+                'loop_stats',
+                {},
+                [(0, {'lag': 1}), (1, {'lag': 2})],
+            ),
+        )
+
+
+class TestWorkerRouter(unittest.TestCase):
+    """
+    Tests for routing the control API to fake workers
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.ring = mcadminpanel.agent.workers.HashRing(range(3))
+        self.assignments = self.ring.assign(SERVERS)
+        self.router = mcadminpanel.agent.workers.WorkerRouter(
+            self.ring,
+            {'connect_timeout': 1},
+            loop=self.loop,
+        )
+        self.assigned = {}
+        self.servers = []
+
+        for index in range(3):
+            socket = os.path.join(self.directory.name, 'worker{}.sock'.format(index))
+            self.servers.append(self._worker(index, socket))
+            self.router.add_worker(index, None, socket, self.assignments[index])
+
+    def tearDown(self):
+        self.router.workers.clear()
+        self.loop.run_until_complete(self.router.stop(0))
+        for server in self.servers:
+            self.loop.run_until_complete(server.stop())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        self.directory.cleanup()
+
+    def _worker(self, index, socket):
+        server = mcadminpanel.agent.api.APIServer(
+            {'socket': socket, 'host': None, 'port': None, 'token': None, 'max_pending': 8},
+            loop=self.loop,
+        )
+
+        def owned():
+            return sorted(self.router.workers.get(index, {}).get('servers', []))
+
+        def assign_servers(names, worker=None):
+            self.assigned[index] = (names, worker)
+            return {'adopted': names, 'started': []}
+
+        server.add_routes({
+            'list_servers': lambda: [{'name': name} for name in owned()],
+            'start_server': lambda name: {'name': name, 'worker': index},
+            'broadcast': lambda command, names=None: {name: index for name in names or owned()},
+            'assign_servers': assign_servers,
+        })
+        self.loop.run_until_complete(server.start())
+
+        return server
+
+    def test_by_name(self):
+        """
+        Tests that server commands go to the worker owning the server
+        """
+
+        for name in ('server1', 'server2', 'server3'):
+            result = self.loop.run_until_complete(
+                self.router.call('start_server', {'name': name}),
+            )
+            self.assertEqual(self.ring.owner(name), result['worker'])
+
+    def test_fan_out(self):
+        """
+        Tests that other commands go to every worker
+        """
+
+        result = self.loop.run_until_complete(self.router.call('list_servers', {}))
+
+        self.assertEqual(sorted(SERVERS), [server['name'] for server in result])
+
+    def test_broadcast_names(self):
+        """
+        Tests that a broadcast to some servers only reaches their workers
+        """
+
+        result = self.loop.run_until_complete(self.router.call(
+            'broadcast',
+            {'command': 'say hi', 'names': ['server1', 'server2']},
+        ))
+
+        self.assertEqual(
+            {name: self.ring.owner(name) for name in ('server1', 'server2')},
+            result,
+        )
+
+    def test_worker_exited(self):
+        """
+        Tests that the servers of an exited worker move to the others and
+        nothing else moves
+        """
+
+        with self.assertLogs(level='ERROR'):
+            self.router.worker_exited(1, signal.SIGKILL)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+        moved = sorted(
+            name
+            for names, worker in self.assigned.values()
+            for name in names
+        )
+        self.assertEqual(self.assignments[1], moved)
+        self.assertEqual({1}, set(worker for _, worker in self.assigned.values()))
+        self.assertEqual([0, 2], [worker['index'] for worker in self.router.api_workers()])
+
+        result = self.loop.run_until_complete(self.router.call('list_servers', {}))
+        self.assertEqual(sorted(SERVERS), [server['name'] for server in result])
+
+
+class TestStopWorkers(unittest.TestCase):
+    """
+    Tests for stopping worker processes
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_stop(self):
+        """
+        Tests that workers are terminated and reaped, and killed if they
+        ignore it
+        """
+
+        router = mcadminpanel.agent.workers.WorkerRouter(
+            mcadminpanel.agent.workers.HashRing(range(2)),
+            {'connect_timeout': 1},
+            loop=self.loop,
+        )
+        polite = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        stubborn = subprocess.Popen([
+            sys.executable,
+            '-c',
+            'import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(30)',
+        ])
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        router.add_worker(0, polite.pid, None, [])
+        router.add_worker(1, stubborn.pid, None, [])
+
+        with self.assertLogs(level='WARNING'):
+            self.loop.run_until_complete(router.stop(0.5))
+
+        self.assertEqual({}, router.workers)
@@ -0,0 +1,51 @@
+"""
+Synthetic region files for the region analyzer tests
+"""
+
+import os
+import os.path
+import struct
+import zlib
+
+SECTOR = 4096
+
+def chunk_data(inhabited):
+    """
+    Compressed NBT data of a chunk inhabited for the given number of ticks
+    """
+
+    nbt = (
+        b'\x0a\x00\x00'
+        b'\x03\x00\x0bDataVersion' + struct.pack('>i', 3465) +
+        b'\x04\x00\x0dInhabitedTime' + struct.pack('>q', inhabited) +
+        b'\x00'
+    )
+
+    return zlib.compress(nbt)
+
+def write_region(directory, region_x, region_z, chunks, timestamp=1500000000):
+    """
+    Write a region file holding the given chunks, a mapping of chunk index
+    to (inhabited ticks, sector count), and return its path
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    locations = [0] * 1024
+    body = b''
+    offset = 2
+    for index, (inhabited, sectors) in sorted(chunks.items()):
+        data = chunk_data(inhabited)
+        body += (struct.pack('>IB', len(data) + 1, 2) + data).ljust(sectors * SECTOR, b'\x00')
+        locations[index] = offset << 8 | sectors
+        offset += sectors
+
+    timestamps = [timestamp + index if index in chunks else 0 for index in range(1024)]
+
+    path = os.path.join(directory, 'r.{}.{}.mca'.format(region_x, region_z))
+    with open(path, 'wb') as region_file:
+        region_file.write(struct.pack('>1024I', *locations))
+        region_file.write(struct.pack('>1024I', *timestamps))
+        region_file.write(body)
+
+    return path